@@ -24,7 +24,7 @@ class EmailConfigAdmin(admin.ModelAdmin):
             'fields': ('protocol', 'server_host', 'server_port', 'username', 'password', 'use_ssl')
         }),
         ('Configuración de Ingesta', {
-            'fields': ('folder_to_monitor', 'check_interval', 'mark_as_read', 'ingesta_enabled')
+            'fields': ('folder_to_monitor', 'sync_mode', 'fetch_batch_size', 'rule_trace_level', 'rule_trace_sample_rate', 'rule_profiling_enabled', 'rule_profiling_sample_rate', 'idle_enabled', 'check_interval', 'mark_as_read', 'ingesta_enabled')
         }),
         ('Estado de Conexión', {
             'fields': ('connection_status', 'connection_error', 'last_check', 'created_at', 'updated_at')
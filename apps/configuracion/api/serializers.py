@@ -39,7 +39,7 @@ class EmailConfigSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'tenant', 'tenant_name', 'email_address', 'protocol', 
             'server_host', 'server_port', 'username', 'use_ssl', 
-            'folder_to_monitor', 'check_interval', 'mark_as_read', 
+            'folder_to_monitor', 'sync_mode', 'fetch_batch_size', 'rule_trace_level', 'rule_trace_sample_rate', 'rule_profiling_enabled', 'rule_profiling_sample_rate', 'idle_enabled', 'check_interval', 'mark_as_read', 
             'ingesta_enabled', 'last_check', 'connection_status', 
             'connection_error', 'created_at', 'updated_at'
         ]
@@ -68,6 +68,18 @@ class EmailConfig(models.Model):
         ('pop3', 'POP3'),
     ]
     
+    SYNC_MODE_CHOICES = [
+        ('incremental', 'Incremental por UID'),
+        ('no_leidos', 'Solo correos no leídos'),
+    ]
+    
+    RULE_TRACE_LEVEL_CHOICES = [
+        ('off', 'Desactivada'),
+        ('errores', 'Solo errores'),
+        ('coincidencias', 'Errores y coincidencias'),
+        ('completo', 'Completa (cada regla evaluada)'),
+    ]
+    
     tenant = models.OneToOneField('tenants.Tenant', on_delete=models.CASCADE, related_name='email_config')
     email_address = models.EmailField(verbose_name="Dirección de Correo Monitoreada")
     protocol = models.CharField(max_length=4, choices=PROTOCOL_CHOICES, default='imap', verbose_name="Protocolo")
@@ -83,6 +95,48 @@ class EmailConfig(models.Model):
         validators=[MinValueValidator(1), MaxValueValidator(60)]
     )
     mark_as_read = models.BooleanField(default=True, verbose_name="Marcar como Leído")
+    sync_mode = models.CharField(
+        max_length=20,
+        choices=SYNC_MODE_CHOICES,
+        default='incremental',
+        verbose_name="Modo de Sincronización IMAP"
+    )
+    fetch_batch_size = models.IntegerField(
+        default=200,
+        verbose_name="Mensajes por Lote de Descarga",
+        help_text="Número de UID solicitados en cada UID FETCH (IMAP)",
+        validators=[MinValueValidator(1), MaxValueValidator(1000)]
+    )
+    rule_trace_level = models.CharField(
+        max_length=15,
+        choices=RULE_TRACE_LEVEL_CHOICES,
+        default='coincidencias',
+        verbose_name="Nivel de Traza de Reglas",
+        help_text="Qué eventos de la evaluación de reglas se guardan en el registro de log"
+    )
+    rule_trace_sample_rate = models.FloatField(
+        default=1.0,
+        verbose_name="Muestreo de Traza de Reglas",
+        help_text="Fracción de correos (0 a 1) cuya evaluación se traza; los errores se registran siempre",
+        validators=[MinValueValidator(0.0), MaxValueValidator(1.0)]
+    )
+    rule_profiling_enabled = models.BooleanField(
+        default=False,
+        verbose_name="Perfilar Reglas",
+        help_text="Registra el tiempo de evaluación de cada regla y condición durante la ingesta"
+    )
+    rule_profiling_sample_rate = models.FloatField(
+        default=0.1,
+        verbose_name="Muestreo del Perfil de Reglas",
+        help_text="Fracción de correos (0 a 1) cuya evaluación de reglas se cronometra",
+        validators=[MinValueValidator(0.0), MaxValueValidator(1.0)]
+    )
+    idle_enabled = models.BooleanField(
+        default=False,
+        verbose_name="Ingesta Inmediata (IMAP IDLE)",
+        help_text="Mantiene una conexión IMAP en espera e ingiere los correos nuevos en cuanto llegan; "
+                  "la verificación periódica sigue activa como respaldo"
+    )
     ingesta_enabled = models.BooleanField(default=True, verbose_name="Habilitar Ingesta")
     last_check = models.DateTimeField(null=True, blank=True, verbose_name="Última Verificación")
     connection_status = models.CharField(max_length=50, default="no_verificado", verbose_name="Estado de Conexión")
@@ -65,6 +65,27 @@ class EmailConfigService:
             if 'folder_to_monitor' in data:
                 config.folder_to_monitor = data['folder_to_monitor']
             
+            if 'sync_mode' in data:
+                config.sync_mode = data['sync_mode']
+            
+            if 'fetch_batch_size' in data:
+                config.fetch_batch_size = int(data['fetch_batch_size'])
+            
+            if 'rule_trace_level' in data:
+                config.rule_trace_level = data['rule_trace_level']
+            
+            if 'rule_trace_sample_rate' in data:
+                config.rule_trace_sample_rate = float(data['rule_trace_sample_rate'])
+            
+            if 'rule_profiling_enabled' in data:
+                config.rule_profiling_enabled = data['rule_profiling_enabled'] == 'true'
+            
+            if 'rule_profiling_sample_rate' in data:
+                config.rule_profiling_sample_rate = float(data['rule_profiling_sample_rate'])
+            
+            if 'idle_enabled' in data:
+                config.idle_enabled = data['idle_enabled'] == 'true'
+            
             if 'check_interval' in data:
                 config.check_interval = int(data['check_interval'])
             
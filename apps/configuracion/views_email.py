@@ -39,6 +39,13 @@ class EmailConfigView(View):
                     'username': config.username,
                     'use_ssl': config.use_ssl,
                     'folder_to_monitor': config.folder_to_monitor,
+                    'sync_mode': config.sync_mode,
+                    'fetch_batch_size': config.fetch_batch_size,
+                    'rule_trace_level': config.rule_trace_level,
+                    'rule_trace_sample_rate': config.rule_trace_sample_rate,
+                    'rule_profiling_enabled': config.rule_profiling_enabled,
+                    'rule_profiling_sample_rate': config.rule_profiling_sample_rate,
+                    'idle_enabled': config.idle_enabled,
                     'check_interval': config.check_interval,
                     'mark_as_read': config.mark_as_read,
                     'ingesta_enabled': config.ingesta_enabled,
@@ -94,6 +101,27 @@ class EmailConfigView(View):
             if 'folder_to_monitor' in data:
                 config.folder_to_monitor = data['folder_to_monitor']
             
+            if 'sync_mode' in data:
+                config.sync_mode = data['sync_mode']
+            
+            if 'fetch_batch_size' in data:
+                config.fetch_batch_size = int(data['fetch_batch_size'])
+            
+            if 'rule_trace_level' in data:
+                config.rule_trace_level = data['rule_trace_level']
+            
+            if 'rule_trace_sample_rate' in data:
+                config.rule_trace_sample_rate = float(data['rule_trace_sample_rate'])
+            
+            if 'rule_profiling_enabled' in data:
+                config.rule_profiling_enabled = data['rule_profiling_enabled'].lower() == 'true'
+            
+            if 'rule_profiling_sample_rate' in data:
+                config.rule_profiling_sample_rate = float(data['rule_profiling_sample_rate'])
+            
+            if 'idle_enabled' in data:
+                config.idle_enabled = data['idle_enabled'].lower() == 'true'
+            
             if 'check_interval' in data:
                 config.check_interval = int(data['check_interval'])
             
@@ -3,7 +3,9 @@ from django.utils.html import format_html
 from .models import (
     ServicioIngesta, 
     HistorialEjecucion, 
+    SincronizacionCarpeta,
     CorreoIngesta,
+    BlobAdjunto,
     ArchivoAdjunto,
     LogActividad,
     EstadisticaDiaria,
@@ -11,7 +13,8 @@ from .models import (
     CondicionRegla,
     HistorialAplicacionRegla,
     CategoriaRegla,
-    RegistroLogRegla
+    RegistroLogRegla,
+    EstadisticaRegla
 )
 
 @admin.register(ServicioIngesta)
@@ -19,16 +22,17 @@ class ServicioIngestaAdmin(admin.ModelAdmin):
     list_display = ('tenant', 'nombre', 'activo', 'intervalo_minutos', 'ultima_ejecucion', 'en_ejecucion')
     list_filter = ('activo', 'en_ejecucion', 'tenant')
     search_fields = ('nombre', 'descripcion')
-    readonly_fields = ('ultima_ejecucion', 'proxima_ejecucion', 'ultima_verificacion', 'fecha_creacion', 'fecha_modificacion')
+    readonly_fields = ('intervalo_actual_minutos', 'ultima_ejecucion', 'proxima_ejecucion', 'despachado_en', 'lease_expira', 'cancelacion_solicitada', 'continuacion', 'ultima_verificacion', 'fecha_creacion', 'fecha_modificacion')
     fieldsets = (
         ('Información General', {
             'fields': ('tenant', 'nombre', 'descripcion', 'activo')
         }),
         ('Configuración', {
-            'fields': ('intervalo_minutos',)
+            'fields': ('intervalo_minutos', 'intervalo_adaptativo', 'intervalo_minimo_minutos',
+                       'intervalo_maximo_minutos', 'intervalo_actual_minutos')
         }),
         ('Estado', {
-            'fields': ('en_ejecucion', 'ultima_ejecucion', 'proxima_ejecucion', 'ultima_verificacion')
+            'fields': ('en_ejecucion', 'despachado_en', 'lease_expira', 'cancelacion_solicitada', 'continuacion', 'ultima_ejecucion', 'proxima_ejecucion', 'ultima_verificacion')
         }),
         ('Auditoría', {
             'fields': ('fecha_creacion', 'fecha_modificacion', 'modificado_por')
@@ -56,10 +60,17 @@ class HistorialEjecucionAdmin(admin.ModelAdmin):
         }),
     )
 
+@admin.register(SincronizacionCarpeta)
+class SincronizacionCarpetaAdmin(admin.ModelAdmin):
+    list_display = ('servicio', 'carpeta', 'uid_validity', 'ultimo_uid', 'resincronizaciones', 'fecha_actualizacion')
+    list_filter = ('servicio__tenant',)
+    search_fields = ('servicio__nombre', 'carpeta')
+    readonly_fields = ('fecha_ultima_resincronizacion', 'fecha_actualizacion')
+
 @admin.register(CorreoIngesta)
 class CorreoIngestaAdmin(admin.ModelAdmin):
     list_display = ('asunto', 'remitente', 'fecha_recepcion', 'estado', 'glosas_extraidas')
-    list_filter = ('estado', 'servicio__tenant')
+    list_filter = ('estado', 'prefiltro_imap', 'servicio__tenant')
     search_fields = ('asunto', 'remitente', 'mensaje_id')
     readonly_fields = ('fecha_recepcion', 'fecha_procesamiento')
     fieldsets = (
@@ -79,10 +90,21 @@ class CorreoIngestaAdmin(admin.ModelAdmin):
 
 @admin.register(ArchivoAdjunto)
 class ArchivoAdjuntoAdmin(admin.ModelAdmin):
-    list_display = ('nombre_archivo', 'correo', 'tipo_contenido', 'tamaño', 'procesado')
+    list_display = ('nombre_archivo', 'correo', 'tipo_contenido', 'tamaño', 'procesado', 'descargado')
     list_filter = ('procesado', 'tipo_contenido')
     search_fields = ('nombre_archivo', 'correo__asunto')
-    readonly_fields = ('fecha_procesamiento',)
+    readonly_fields = ('fecha_procesamiento', 'origen_imap')
+
+    @admin.display(boolean=True, description='Descargado')
+    def descargado(self, obj):
+        return not obj.pendiente_descarga
+
+@admin.register(BlobAdjunto)
+class BlobAdjuntoAdmin(admin.ModelAdmin):
+    list_display = ('hash_sha256', 'tenant', 'tamaño', 'referencias', 'procesado', 'fecha_creacion')
+    list_filter = ('procesado', 'tenant')
+    search_fields = ('hash_sha256',)
+    readonly_fields = ('hash_sha256', 'archivo', 'tamaño', 'referencias', 'fecha_creacion')
 
 @admin.register(LogActividad)
 class LogActividadAdmin(admin.ModelAdmin):
@@ -97,6 +119,13 @@ class EstadisticaDiariaAdmin(admin.ModelAdmin):
     list_filter = ('tenant', 'fecha')
     search_fields = ('tenant__name',)
 
+@admin.register(EstadisticaRegla)
+class EstadisticaReglaAdmin(admin.ModelAdmin):
+    list_display = ('regla', 'condicion', 'periodo', 'evaluaciones', 'coincidencias', 'tiempo_total_ns')
+    list_filter = ('periodo',)
+    search_fields = ('regla__nombre',)
+    raw_id_fields = ('regla', 'condicion')
+
 class CondicionReglaInline(admin.TabularInline):
     """Inline para editar condiciones de una regla compuesta."""
     model = CondicionRegla
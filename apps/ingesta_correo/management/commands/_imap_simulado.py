@@ -0,0 +1,269 @@
+"""
+Servidor IMAP simulado para los comandos de benchmark.
+Imita el formato de respuesta de imaplib y contabiliza el tiempo de red
+(latencia por ida y vuelta y transferencia) en un reloj simulado, de modo que
+los benchmarks sean rápidos y reproducibles sin un servidor real.
+"""
+
+import re
+import shlex
+from datetime import datetime
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.utils import parsedate_to_datetime
+
+
+SECCION_RE = re.compile(r'BODY\.PEEK\[([^\]]*)\]', re.I)
+
+
+def generar_mensaje(uid, tamaño_bytes=20 * 1024, remitente='glosas@eps.example.com', tamaño_adjunto=0,
+                    asunto=None, tamaño_imagen=0):
+    """
+    Genera un correo RFC822 sintético de aproximadamente el tamaño indicado.
+    Con tamaño_adjunto > 0 incluye además un PDF adjunto de ese tamaño (en base64)
+    y con tamaño_imagen > 0 una imagen de firma adjunta, irrelevante para las glosas.
+    """
+    mensaje = EmailMessage()
+    mensaje['Message-ID'] = f'<bench-{uid}@zentraflow.local>'
+    mensaje['From'] = remitente
+    mensaje['To'] = 'ingesta@ips.example.com'
+    mensaje['Subject'] = asunto or f'Glosa {uid}'
+    mensaje['Date'] = 'Mon, 06 May 2024 10:00:00 -0500'
+    mensaje.set_content('Contenido de la glosa ' + ('x' * max(0, tamaño_bytes - 300)))
+    if tamaño_adjunto:
+        contenido = (b'%PDF-1.4 glosa ' + str(uid).encode() + b' ') * (tamaño_adjunto // 16 + 1)
+        mensaje.add_attachment(
+            contenido[:tamaño_adjunto], maintype='application', subtype='pdf', filename=f'glosa_{uid}.pdf'
+        )
+    if tamaño_imagen:
+        mensaje.add_attachment(
+            (b'\x89PNG firma ' * (tamaño_imagen // 11 + 1))[:tamaño_imagen],
+            maintype='image', subtype='png', filename='firma.png'
+        )
+    return mensaje.as_bytes()
+
+
+def expandir_conjunto(conjunto):
+    """Expande un conjunto de secuencias IMAP ("1:3,7") en una lista de enteros."""
+    uids = []
+    for parte in conjunto.split(','):
+        if ':' in parte:
+            inicio, fin = parte.split(':')
+            uids.extend(range(int(inicio), int(fin) + 1))
+        elif parte:
+            uids.append(int(parte))
+    return uids
+
+
+def _tokens_busqueda(criterio):
+    """Separa un criterio de SEARCH en tokens, con los paréntesis como tokens propios."""
+    lexer = shlex.shlex(criterio, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    tokens = []
+    for token in lexer:
+        # Los paréntesis de agrupación solo aparecen fuera de las cadenas
+        while token.startswith('(') and token != '(':
+            tokens.append('(')
+            token = token[1:]
+        cierres = len(token) - len(token.rstrip(')'))
+        if token.rstrip(')'):
+            tokens.append(token.rstrip(')'))
+        tokens.extend(')' * cierres)
+    return tokens
+
+
+def _fecha_busqueda(valor):
+    return datetime.strptime(valor, '%d-%b-%Y').date()
+
+
+def _cadena(valor):
+    if valor is None:
+        return 'NIL'
+    return '"' + str(valor).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _lista_parametros(pares):
+    if not pares:
+        return 'NIL'
+    return '(' + ' '.join(f'{_cadena(clave)} {_cadena(valor)}' for clave, valor in pares) + ')'
+
+
+def _cuerpo(parte):
+    """Bytes del cuerpo de una parte hoja tal como están en el mensaje."""
+    if parte.get_content_maintype() == 'message':
+        return parte.get_payload(0).as_bytes()
+    return parte.get_payload().encode('ascii', errors='surrogateescape')
+
+
+def _bodystructure(parte):
+    """BODYSTRUCTURE de una parte con los campos que interpretan los clientes."""
+    if parte.get_content_maintype() == 'multipart':
+        hijas = ''.join(_bodystructure(hija) for hija in parte.get_payload())
+        return f'({hijas} {_cadena(parte.get_content_subtype())})'
+
+    cuerpo = _cuerpo(parte)
+    campos = [
+        _cadena(parte.get_content_maintype()), _cadena(parte.get_content_subtype()),
+        _lista_parametros((parte.get_params() or [])[1:]), 'NIL', 'NIL',
+        _cadena(parte.get('Content-Transfer-Encoding', '7bit')), str(len(cuerpo)),
+    ]
+    if parte.get_content_maintype() == 'text':
+        campos.append(str(cuerpo.count(b'\n')))
+    elif parte.get_content_type() == 'message/rfc822':
+        campos.extend(['NIL', _bodystructure(parte.get_payload(0)), str(cuerpo.count(b'\n'))])
+    disposicion = 'NIL'
+    if parte.get('Content-Disposition'):
+        parametros = (parte.get_params(header='content-disposition') or [])[1:]
+        disposicion = f'({_cadena(parte.get_content_disposition())} {_lista_parametros(parametros)})'
+    campos.extend(['NIL', disposicion, 'NIL', 'NIL'])
+    return '(' + ' '.join(campos) + ')'
+
+
+class ServidorImapSimulado:
+    """
+    Servidor IMAP en memoria con costo de red simulado.
+
+    Args:
+        mensajes: Diccionario {uid: bytes RFC822}
+        rtt: Latencia de ida y vuelta en segundos
+        bytes_por_segundo: Ancho de banda simulado
+        uid_validity: UIDVALIDITY informado al seleccionar la carpeta
+    """
+
+    def __init__(self, mensajes, rtt=0.03, bytes_por_segundo=6 * 1024 * 1024, uid_validity=1):
+        self.mensajes = mensajes
+        self.uid_validity = uid_validity
+        self.rtt = rtt
+        self.bytes_por_segundo = bytes_por_segundo
+        self.tiempo_red = 0.0
+        self.idas_y_vueltas = 0
+        self.bytes_transferidos = 0
+        self._partes_cache = {}
+
+    def _cobrar(self, bytes_transferidos):
+        self.idas_y_vueltas += 1
+        self.bytes_transferidos += bytes_transferidos
+        self.tiempo_red += self.rtt + bytes_transferidos / self.bytes_por_segundo
+
+    def select(self, carpeta='INBOX', readonly=False):
+        self._cobrar(0)
+        return 'OK', [str(len(self.mensajes)).encode()]
+
+    def response(self, codigo):
+        if codigo.upper() == 'UIDVALIDITY':
+            return codigo, [str(self.uid_validity).encode()]
+        return codigo, [None]
+
+    def uid(self, comando, *args):
+        comando = comando.upper()
+        if comando == 'SEARCH':
+            self._cobrar(0)
+            criterio = ' '.join(arg for arg in args if arg)
+            encontrados = [uid for uid in sorted(self.mensajes) if self._cumple(uid, criterio)]
+            return 'OK', [' '.join(str(uid) for uid in encontrados).encode()]
+
+        if comando == 'FETCH':
+            conjunto, items = args
+            data = []
+            transferidos = 0
+            estructura = 'BODYSTRUCTURE' in items.upper()
+            tamaño = 'RFC822.SIZE' in items.upper()
+            secciones = SECCION_RE.findall(items)
+            for uid in expandir_conjunto(conjunto):
+                contenido = self.mensajes.get(uid)
+                if contenido is None:
+                    continue
+                if estructura:
+                    respuesta = f'{uid} (UID {uid} BODYSTRUCTURE {self._estructura(uid)})'.encode()
+                    transferidos += len(respuesta)
+                    data.append(respuesta)
+                    continue
+                for indice, seccion in enumerate(secciones):
+                    literal = self._seccion(uid, seccion)
+                    prefijo = f'{uid} (UID {uid} ' if indice == 0 else ' '
+                    if indice == 0 and tamaño:
+                        prefijo += f'RFC822.SIZE {len(contenido)} '
+                    cabecera = f'{prefijo}BODY[{seccion.split(" ")[0].upper()}] {{{len(literal)}}}'
+                    transferidos += len(literal)
+                    data.append((cabecera.encode(), literal))
+                data.append(b')')
+            self._cobrar(transferidos)
+            return 'OK', data
+
+        if comando == 'STORE':
+            self._cobrar(0)
+            return 'OK', [None]
+
+        raise ValueError(f'Comando no soportado por el servidor simulado: {comando}')
+
+    def _partes(self, uid):
+        """Mensaje parseado y sus partes hoja por número de sección IMAP."""
+        if uid not in self._partes_cache:
+            mensaje = message_from_bytes(self.mensajes[uid])
+            partes = {}
+
+            def recorrer(parte, seccion):
+                if parte.get_content_maintype() == 'multipart':
+                    for indice, hija in enumerate(parte.get_payload(), 1):
+                        recorrer(hija, f'{seccion}.{indice}' if seccion else str(indice))
+                else:
+                    partes[seccion or '1'] = parte
+
+            recorrer(mensaje, '')
+            self._partes_cache[uid] = (mensaje, partes)
+        return self._partes_cache[uid]
+
+    def _seccion(self, uid, seccion):
+        contenido = self.mensajes[uid]
+        seccion = seccion.upper()
+        if not seccion:
+            return contenido
+        if seccion.startswith('HEADER'):
+            return contenido.split(b'\n\n', 1)[0] + b'\n\n'
+        parte = self._partes(uid)[1].get(seccion)
+        return _cuerpo(parte) if parte is not None else b''
+
+    def _estructura(self, uid):
+        return _bodystructure(self._partes(uid)[0])
+
+    def _cumple(self, uid, criterio):
+        """Evalúa el subconjunto de SEARCH que usa la ingesta: UID, FROM, SUBJECT, SENT*, OR y paréntesis."""
+        tokens = _tokens_busqueda(criterio)
+        mensaje = message_from_bytes(self.mensajes[uid].split(b'\n\n', 1)[0])
+        posicion = 0
+
+        def clave():
+            nonlocal posicion
+            token = tokens[posicion].upper()
+            posicion += 1
+            if token == '(':
+                resultado = True
+                while tokens[posicion] != ')':
+                    resultado = clave() and resultado
+                posicion += 1
+                return resultado
+            if token == 'OR':
+                primero = clave()
+                return clave() or primero
+            if token in ('ALL', 'UNSEEN'):
+                return True
+            argumento = tokens[posicion]
+            posicion += 1
+            if token == 'UID':
+                mayor = max(self.mensajes)
+                return uid in expandir_conjunto(argumento.replace('*', str(mayor)))
+            if token in ('FROM', 'SUBJECT'):
+                cabecera = mensaje.get('From' if token == 'FROM' else 'Subject', '')
+                return argumento.casefold() in cabecera.casefold()
+            if token in ('SENTON', 'SENTSINCE', 'SENTBEFORE'):
+                enviado = parsedate_to_datetime(mensaje['Date']).date()
+                limite = _fecha_busqueda(argumento)
+                return {'SENTON': enviado == limite, 'SENTSINCE': enviado >= limite,
+                        'SENTBEFORE': enviado < limite}[token]
+            raise ValueError(f'Criterio no soportado por el servidor simulado: {token}')
+
+        resultado = True
+        while posicion < len(tokens):
+            resultado = clave() and resultado
+        return resultado
@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.backtest_reglas_service import BacktestReglasService
+
+
+class Command(BaseCommand):
+    help = 'Reproduce las reglas de filtrado de un servicio sobre los correos de los últimos N días'
+
+    def add_arguments(self, parser):
+        parser.add_argument('servicio_id', type=int, help='ID del servicio de ingesta')
+        parser.add_argument('--dias', type=int, default=30, help='Antigüedad máxima de los correos (días)')
+        parser.add_argument('--incluir', type=int, nargs='*', default=[], help='IDs de reglas a añadir a las activas')
+        parser.add_argument('--excluir', type=int, nargs='*', default=[], help='IDs de reglas activas a quitar')
+        parser.add_argument('--procesos', type=int, default=None, help='Procesos del pool (por defecto uno por CPU)')
+        parser.add_argument('--trozo', type=int, default=2000, help='Correos por trozo')
+        parser.add_argument('--muestra', type=int, default=20, help='Correos con cambio de acción a listar')
+        parser.add_argument('--json', action='store_true', help='Mostrar el informe completo en JSON')
+
+    def handle(self, *args, **options):
+        if not ServicioIngesta.objects.filter(id=options['servicio_id']).exists():
+            raise CommandError(f"No existe el servicio de ingesta {options['servicio_id']}")
+
+        informe = BacktestReglasService.ejecutar(
+            options['servicio_id'],
+            dias=options['dias'],
+            incluir=options['incluir'],
+            excluir=options['excluir'],
+            procesos=options['procesos'],
+            tamaño_trozo=options['trozo'],
+            max_muestra=options['muestra'],
+        )
+
+        if options['json']:
+            self.stdout.write(json.dumps(informe, indent=2, ensure_ascii=False, default=str))
+            return
+
+        self.stdout.write(
+            f"{informe['correos_evaluados']} correos de los últimos {informe['dias']} días evaluados en "
+            f"{informe['segundos']:.1f}s con {informe['procesos']} procesos\n"
+        )
+        self.stdout.write(f"{'id':>6} {'prioridad':>9} {'coincidencias':>13} {'primera':>8}  regla")
+        for regla in informe['reglas']:
+            estado = '' if regla['activa'] else ' (inactiva)'
+            self.stdout.write(
+                f"{regla['id']:>6} {regla['prioridad']:>9} {regla['coincidencias']:>13} "
+                f"{regla['primera_coincidencia']:>8}  {regla['nombre']}{estado}"
+            )
+        self.stdout.write(f"{'':>6} {'':>9} {'':>13} {informe['sin_coincidencia']:>8}  (ninguna regla)")
+
+        cambios = informe['cambios']
+        self.stdout.write(f"\nCorreos cuya acción cambiaría: {cambios['total']}")
+        for transicion in cambios['transiciones']:
+            self.stdout.write(
+                f"  {transicion['accion_anterior'] or '(ninguna)'} -> "
+                f"{transicion['accion_nueva'] or '(ninguna)'}: {transicion['correos']}"
+            )
+        for cambio in cambios['muestra']:
+            self.stdout.write(
+                f"  correo {cambio['correo_id']}: {cambio['accion_anterior'] or '(ninguna)'} -> "
+                f"{cambio['accion_nueva'] or '(ninguna)'} ({cambio['asunto'][:60]})"
+            )
@@ -0,0 +1,73 @@
+import email
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from apps.ingesta_correo.models import ArchivoAdjunto
+from apps.ingesta_correo.services.adjunto_storage_service import AdjuntoStorageService, ArchivoAdjuntoStream
+from ._imap_simulado import generar_mensaje
+
+
+class Command(BaseCommand):
+    help = 'Compara la memoria adicional al guardar un adjunto grande: escritura por trozos frente a la anterior'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tamano-mb', type=int, default=50, help='Tamaño del adjunto (MB)')
+
+    def handle(self, *args, **options):
+        tamaño = options['tamano_mb'] * 1024 * 1024
+        self.stdout.write(f"Generando un correo con un adjunto de {options['tamano_mb']} MB...")
+        mensaje = email.message_from_bytes(generar_mensaje(1, 1024, tamaño_adjunto=tamaño))
+        parte = [parte for parte in mensaje.walk() if parte.get_filename()][0]
+
+        media_root = tempfile.mkdtemp(prefix='benchmark_adjuntos_')
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                resultados = [
+                    ('anterior', *self._medir(lambda: self._guardar_anterior(parte))),
+                    ('por trozos', *self._medir(lambda: self._guardar_por_trozos(parte))),
+                ]
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        # La memoria del mensaje ya descargado no se cuenta: solo lo que añade la escritura
+        self.stdout.write(f"\n{'modo':>11} {'memoria adicional (MB)':>23} {'tiempo (s)':>11}")
+        for modo, pico, segundos in resultados:
+            self.stdout.write(f"{modo:>11} {pico / 1024 / 1024:>23.1f} {segundos:>11.2f}")
+
+    @staticmethod
+    def _medir(funcion):
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        funcion()
+        segundos = time.perf_counter() - inicio
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return pico, segundos
+
+    @staticmethod
+    def _guardar_por_trozos(parte):
+        storage = ArchivoAdjunto._meta.get_field('archivo').storage
+        storage.save(AdjuntoStorageService.ruta_temporal(1), ArchivoAdjuntoStream(parte, 'glosa.pdf'))
+
+    @staticmethod
+    def _guardar_anterior(parte):
+        """Reproduce la escritura anterior: memoria, archivo temporal, relectura y almacenamiento."""
+        temp_dir = tempfile.mkdtemp()
+        temp_file_path = os.path.join(temp_dir, 'glosa.pdf')
+        with open(temp_file_path, 'wb') as f:
+            f.write(parte.get_payload(decode=True))
+        os.path.getsize(temp_file_path)
+
+        storage = ArchivoAdjunto._meta.get_field('archivo').storage
+        with open(temp_file_path, 'rb') as f:
+            storage.save('adjuntos_correo/tenant_1/glosa.pdf', ContentFile(f.read()))
+
+        os.remove(temp_file_path)
+        os.rmdir(temp_dir)
@@ -0,0 +1,158 @@
+import heapq
+import random
+import statistics
+import time
+from collections import deque
+
+from django.core.management.base import BaseCommand
+
+from apps.ingesta_correo.services.despacho_ingesta_service import Candidato, planificar
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+from ._imap_simulado import ServidorImapSimulado, generar_mensaje
+
+# Segundos entre ejecuciones de check_scheduled_services
+TICK = 60.0
+
+
+class Command(BaseCommand):
+    help = 'Simula la ingesta de varios tenants con 1..N workers, con y sin el despacho por cupos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tenants', type=int, default=30, help='Tenants con correo pendiente')
+        parser.add_argument('--hosts', type=int, default=3, help='Servidores de correo que comparten los tenants')
+        parser.add_argument('--limite-proveedor', type=int, default=4,
+                            help='Conexiones simultáneas que acepta cada servidor (las demás se rechazan)')
+        parser.add_argument('--servicios-por-tenant', type=int, default=2, help='Servicios de ingesta por tenant')
+        parser.add_argument('--mensajes', type=int, default=200, help='Correos pendientes de un tenant típico')
+        parser.add_argument('--atraso-grande', type=int, default=5000,
+                            help='Correos pendientes del primer tenant (un atraso grande)')
+        parser.add_argument('--workers', default='1,2,4,8,16,32', help='Cantidades de workers a comparar')
+        parser.add_argument('--tamano-kb', type=int, default=20, help='Tamaño aproximado de cada mensaje (KB)')
+        parser.add_argument('--rtt-ms', type=float, default=30.0, help='Latencia de ida y vuelta (ms)')
+        parser.add_argument('--ancho-banda-mbps', type=float, default=50.0, help='Ancho de banda simulado (Mbps)')
+        parser.add_argument('--semilla', type=int, default=1, help='Semilla del reparto de correos')
+
+    def handle(self, *args, **options):
+        rtt = options['rtt_ms'] / 1000
+        costo_mensaje = self._medir_costo_mensaje(options, rtt)
+        # Conexión, LOGIN, SELECT y SEARCH antes del primer FETCH
+        costo_conexion = 4 * rtt
+        self.stdout.write(f"Costo medido por mensaje: {costo_mensaje * 1000:.2f} ms (lotes de 100)\n")
+
+        aleatorio = random.Random(options['semilla'])
+        hosts = [f'imap{indice}.example.com' for indice in range(options['hosts'])]
+        servicios = []
+        for tenant_id in range(1, options['tenants'] + 1):
+            pendientes = options['atraso_grande'] if tenant_id == 1 else int(
+                options['mensajes'] * aleatorio.uniform(0.5, 1.5)
+            )
+            host = hosts[(tenant_id - 1) % len(hosts)]
+            por_servicio = max(1, pendientes // options['servicios_por_tenant'])
+            for _ in range(options['servicios_por_tenant']):
+                servicios.append({
+                    'id': len(servicios) + 1, 'tenant_id': tenant_id, 'host': host, 'mensajes': por_servicio,
+                    'duracion': costo_conexion + por_servicio * costo_mensaje,
+                })
+        total = sum(servicio['mensajes'] for servicio in servicios)
+        self.stdout.write(
+            f"{len(servicios)} servicios de {options['tenants']} tenants en {len(hosts)} servidores, "
+            f"{total} correos; cada servidor acepta {options['limite_proveedor']} conexiones\n"
+        )
+
+        self.stdout.write(
+            f"{'workers':>7} {'modo':>12} {'total (s)':>10} {'msg/s':>8} {'rechazos':>9} "
+            f"{'fin mediano (s)':>16} {'fin p95 (s)':>12}"
+        )
+        for workers in [int(valor) for valor in options['workers'].split(',') if valor]:
+            for modo in ('sin despacho', 'despacho'):
+                resultado = self._simular(servicios, workers, options['limite_proveedor'], modo == 'despacho', rtt)
+                fines = sorted(resultado['fin_por_tenant'][tenant] for tenant in resultado['fin_por_tenant'] if tenant != 1)
+                self.stdout.write(
+                    f"{workers:>7} {modo:>12} {resultado['total']:>10.1f} {total / resultado['total']:>8.0f} "
+                    f"{resultado['rechazos']:>9} {statistics.median(fines):>16.1f} "
+                    f"{fines[int(len(fines) * 0.95) - 1]:>12.1f}"
+                )
+
+    def _medir_costo_mensaje(self, options, rtt):
+        """Segundos por mensaje (red simulada más parseo real) de una descarga por lotes."""
+        cantidad = 200
+        mensajes = {uid: generar_mensaje(uid, options['tamano_kb'] * 1024) for uid in range(1, cantidad + 1)}
+        servidor = ServidorImapSimulado(
+            mensajes, rtt=rtt, bytes_por_segundo=options['ancho_banda_mbps'] * 1024 * 1024 / 8
+        )
+        inicio = time.perf_counter()
+        for _ in ImapSyncService.fetch_lotes(servidor, sorted(mensajes), 100, deduplicar=False):
+            pass
+        return (servidor.tiempo_red + time.perf_counter() - inicio) / cantidad
+
+    def _simular(self, servicios, workers, limite_proveedor, despacho, rtt):
+        """
+        Simulación en tiempo virtual. Sin despacho, cada verificación encola todo
+        lo pendiente y una conexión por encima del límite del servidor se rechaza
+        hasta la siguiente verificación; con despacho, solo se encola lo que cabe
+        en los cupos y se vuelve a despachar al terminar cada ejecución.
+        """
+        por_id = {servicio['id']: servicio for servicio in servicios}
+        pendientes = [servicio['id'] for servicio in servicios]
+        cola = deque()
+        reservados = set()
+        conexiones = {}
+        eventos = []
+        secuencia = 0
+        libres = workers
+        rechazos = 0
+        fin_por_tenant = {}
+        ahora = 0.0
+
+        def programar(instante, tipo, servicio_id=None):
+            nonlocal secuencia
+            secuencia += 1
+            heapq.heappush(eventos, (instante, secuencia, tipo, servicio_id))
+
+        def despachar():
+            esperando = [servicio_id for servicio_id in pendientes if servicio_id not in reservados]
+            if despacho:
+                elegidos = planificar(
+                    [Candidato(i, por_id[i]['tenant_id'], por_id[i]['host']) for i in esperando],
+                    [(por_id[i]['tenant_id'], por_id[i]['host']) for i in reservados],
+                    max_por_host=limite_proveedor,
+                )
+                esperando = [candidato.servicio_id for candidato in elegidos]
+            for servicio_id in esperando:
+                reservados.add(servicio_id)
+                cola.append(servicio_id)
+
+        def asignar():
+            nonlocal libres, rechazos
+            while libres and cola:
+                servicio = por_id[cola.popleft()]
+                libres -= 1
+                if conexiones.get(servicio['host'], 0) >= limite_proveedor:
+                    # El servidor rechaza el LOGIN: el worker queda libre enseguida
+                    rechazos += 1
+                    programar(ahora + 2 * rtt, 'rechazo', servicio['id'])
+                    continue
+                conexiones[servicio['host']] = conexiones.get(servicio['host'], 0) + 1
+                programar(ahora + servicio['duracion'], 'fin', servicio['id'])
+
+        despachar()
+        asignar()
+        programar(TICK, 'tick')
+        while pendientes:
+            ahora, _, tipo, servicio_id = heapq.heappop(eventos)
+            if tipo == 'tick':
+                despachar()
+                programar(ahora + TICK, 'tick')
+            else:
+                libres += 1
+                reservados.discard(servicio_id)
+                if tipo == 'fin':
+                    servicio = por_id[servicio_id]
+                    conexiones[servicio['host']] -= 1
+                    pendientes.remove(servicio_id)
+                    fin_por_tenant[servicio['tenant_id']] = ahora
+                    if despacho:
+                        despachar()
+            asignar()
+
+        return {'total': ahora, 'rechazos': rechazos, 'fin_por_tenant': fin_por_tenant}
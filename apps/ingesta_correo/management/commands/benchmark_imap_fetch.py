@@ -0,0 +1,123 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+from apps.ingesta_correo.services.prefiltro_imap_service import PrefiltroImap
+from apps.ingesta_correo.services.regla_motor_service import MotorReglas, ReglaMotorService
+from ._imap_simulado import ServidorImapSimulado, generar_mensaje
+
+
+class Command(BaseCommand):
+    help = 'Compara el tiempo de descarga IMAP según el tamaño de lote de UID FETCH'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mensajes', type=int, default=5000, help='Mensajes en el buzón simulado')
+        parser.add_argument('--tamano-kb', type=int, default=20, help='Tamaño aproximado de cada mensaje (KB)')
+        parser.add_argument('--rtt-ms', type=float, default=30.0, help='Latencia de ida y vuelta (ms)')
+        parser.add_argument('--ancho-banda-mbps', type=float, default=50.0, help='Ancho de banda simulado (Mbps)')
+        parser.add_argument('--lotes', default='1,10,50,100,200,500', help='Tamaños de lote a comparar')
+        parser.add_argument('--imagen-kb', type=int, default=0,
+                            help='Imagen de firma adjunta a cada mensaje (KB); compara la descarga parcial')
+        parser.add_argument('--ignorados', type=int, default=0,
+                            help='Porcentaje de boletines que una regla IGNORAR descarta (compara el prefiltro IMAP)')
+
+    REMITENTE_BOLETIN = 'boletin@marketing.example.com'
+
+    def handle(self, *args, **options):
+        total = options['mensajes']
+        rtt = options['rtt_ms'] / 1000
+        bytes_por_segundo = options['ancho_banda_mbps'] * 1024 * 1024 / 8
+        lotes = [int(valor) for valor in options['lotes'].split(',') if valor]
+
+        self.stdout.write(f"Generando {total} mensajes de ~{options['tamano_kb']} KB...")
+        ignorados = max(0, min(options['ignorados'], 100))
+        mensajes = {
+            uid: generar_mensaje(
+                uid, options['tamano_kb'] * 1024,
+                # Boletines repartidos uniformemente en el buzón
+                remitente=self.REMITENTE_BOLETIN if uid * ignorados // 100 != (uid - 1) * ignorados // 100
+                else 'glosas@eps.example.com',
+                tamaño_imagen=options['imagen_kb'] * 1024,
+            )
+            for uid in range(1, total + 1)
+        }
+        uids = sorted(mensajes)
+
+        self.stdout.write(f"RTT={options['rtt_ms']} ms, ancho de banda={options['ancho_banda_mbps']} Mbps\n")
+        self.stdout.write(f"{'lote':>6} {'idas/vueltas':>13} {'red (s)':>9} {'parseo (s)':>11} {'total (s)':>10} {'msg/s':>9}")
+
+        resultados = []
+        for tamaño_lote in lotes:
+            servidor = ServidorImapSimulado(mensajes, rtt=rtt, bytes_por_segundo=bytes_por_segundo)
+
+            inicio = time.perf_counter()
+            recibidos = sum(
+                len(mensajes_lote)
+                for _, mensajes_lote in ImapSyncService.fetch_lotes(servidor, uids, tamaño_lote, deduplicar=False)
+            )
+            parseo = time.perf_counter() - inicio
+
+            total_segundos = servidor.tiempo_red + parseo
+            resultados.append((tamaño_lote, total_segundos))
+            self.stdout.write(
+                f"{tamaño_lote:>6} {servidor.idas_y_vueltas:>13} {servidor.tiempo_red:>9.2f} "
+                f"{parseo:>11.2f} {total_segundos:>10.2f} {recibidos / total_segundos:>9.0f}"
+            )
+
+        # Recomendar el menor lote que queda a menos de un 5% del mejor tiempo:
+        # lotes mayores apenas mejoran y aumentan la memoria por lote
+        mejor = min(segundos for _, segundos in resultados)
+        recomendado = min(lote for lote, segundos in resultados if segundos <= mejor * 1.05)
+        self.stdout.write(self.style.SUCCESS(f"\nTamaño de lote recomendado: {recomendado}"))
+
+        if ignorados:
+            self._comparar_prefiltro(mensajes, uids, recomendado, rtt, bytes_por_segundo)
+        if options['imagen_kb']:
+            self._comparar_parcial(mensajes, uids, recomendado, rtt, bytes_por_segundo)
+
+    def _comparar_parcial(self, mensajes, uids, tamaño_lote, rtt, bytes_por_segundo):
+        """Descarga el buzón completo y guiada por BODYSTRUCTURE."""
+        self.stdout.write(f"\nDescarga parcial con lote {tamaño_lote}:")
+        self.stdout.write(f"{'modo':>14} {'idas/vueltas':>13} {'MB':>8} {'red (s)':>9} {'total (s)':>10}")
+        for nombre, parcial in (('completa', False), ('parcial', True)):
+            servidor = ServidorImapSimulado(mensajes, rtt=rtt, bytes_por_segundo=bytes_por_segundo)
+            inicio = time.perf_counter()
+            for _ in ImapSyncService.fetch_lotes(servidor, uids, tamaño_lote, deduplicar=False, parcial=parcial):
+                pass
+            total_segundos = servidor.tiempo_red + time.perf_counter() - inicio
+            self.stdout.write(
+                f"{nombre:>14} {servidor.idas_y_vueltas:>13} {servidor.bytes_transferidos / 1024 / 1024:>8.1f} "
+                f"{servidor.tiempo_red:>9.2f} {total_segundos:>10.2f}"
+            )
+
+    def _comparar_prefiltro(self, mensajes, uids, tamaño_lote, rtt, bytes_por_segundo):
+        """Descarga el buzón con y sin el prefiltro de una regla IGNORAR por remitente."""
+        regla = ReglaFiltrado(
+            id=1, nombre='Boletines', campo=ReglaFiltrado.TipoCampo.REMITENTE,
+            condicion=ReglaFiltrado.TipoCondicion.CONTIENE, valor=self.REMITENTE_BOLETIN,
+            prioridad=1, accion=ReglaFiltrado.TipoAccion.IGNORAR,
+        )
+        motor = MotorReglas([ReglaMotorService.compilar_regla(regla)])
+
+        self.stdout.write(f"\nPrefiltro IMAP con lote {tamaño_lote}:")
+        self.stdout.write(f"{'modo':>14} {'descargados':>12} {'omitidos':>9} {'MB':>8} {'red (s)':>9} {'total (s)':>10}")
+        for nombre, usar_prefiltro in (('sin prefiltro', False), ('con prefiltro', True)):
+            servidor = ServidorImapSimulado(mensajes, rtt=rtt, bytes_por_segundo=bytes_por_segundo)
+            inicio = time.perf_counter()
+            prefiltro = None
+            if usar_prefiltro:
+                prefiltro = PrefiltroImap.desde_motor(motor)
+                prefiltro.buscar(servidor, uids)
+            descargados = omitidos = 0
+            for _, mensajes_lote in ImapSyncService.fetch_lotes(
+                servidor, uids, tamaño_lote, deduplicar=False, prefiltro=prefiltro
+            ):
+                descargados += len(mensajes_lote)
+                omitidos += len(prefiltro.omitidos) if prefiltro else 0
+            total_segundos = servidor.tiempo_red + time.perf_counter() - inicio
+            self.stdout.write(
+                f"{nombre:>14} {descargados:>12} {omitidos:>9} {servidor.bytes_transferidos / 1024 / 1024:>8.1f} "
+                f"{servidor.tiempo_red:>9.2f} {total_segundos:>10.2f}"
+            )
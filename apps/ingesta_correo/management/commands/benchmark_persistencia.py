@@ -0,0 +1,128 @@
+import email
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ArchivoAdjunto, CorreoIngesta, HistorialAplicacionRegla, ServicioIngesta
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+from apps.ingesta_correo.services.ingesta_persistencia_service import IngestaPersistenciaService
+from apps.ingesta_correo.services.regla_filtrado_service import ReglaFiltradoService
+from apps.tenants.models import Tenant
+from ._imap_simulado import generar_mensaje
+
+
+class Command(BaseCommand):
+    help = 'Compara el rendimiento de la persistencia por lotes frente a la persistencia fila a fila'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--correos', type=int, default=1000, help='Correos a persistir en cada modo')
+        parser.add_argument('--tamano-kb', type=int, default=4, help='Tamaño del cuerpo de cada correo (KB)')
+        parser.add_argument('--adjunto-kb', type=int, default=32, help='Tamaño del adjunto de cada correo (KB), 0 sin adjunto')
+        parser.add_argument('--lote', type=int, default=200, help='Tamaño de lote de la persistencia por lotes')
+
+    def handle(self, *args, **options):
+        total = options['correos']
+        self.stdout.write(f"Generando {total} correos...")
+        mensajes = [
+            email.message_from_bytes(generar_mensaje(
+                uid, options['tamano_kb'] * 1024, tamaño_adjunto=options['adjunto_kb'] * 1024
+            ))
+            for uid in range(1, total + 1)
+        ]
+
+        sufijo = uuid.uuid4().hex[:8]
+        tenant = Tenant.objects.create(
+            name=f'Benchmark {sufijo}', domain=f'benchmark-{sufijo}.local',
+            nit='0', direccion='-', telefono='-', correo_contacto='benchmark@zentraflow.local'
+        )
+        servicio = ServicioIngesta.objects.create(tenant=tenant, nombre='Benchmark persistencia')
+        media_root = tempfile.mkdtemp(prefix='benchmark_persistencia_')
+
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                resultados = [
+                    ('fila a fila', *self._medir(lambda: self._persistir_por_fila(servicio, mensajes, 'fila'))),
+                    (f"lotes de {options['lote']}", *self._medir(
+                        lambda: self._persistir_por_lotes(servicio, mensajes, 'lote', options['lote'])
+                    )),
+                ]
+        finally:
+            tenant.delete()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        self.stdout.write(f"\n{'modo':>14} {'consultas':>10} {'tiempo (s)':>11} {'correos/s':>10}")
+        for modo, consultas, segundos in resultados:
+            self.stdout.write(f"{modo:>14} {consultas:>10} {segundos:>11.2f} {total / segundos:>10.0f}")
+
+        mejora = resultados[0][2] / resultados[1][2]
+        self.stdout.write(self.style.SUCCESS(f"\nLa persistencia por lotes es {mejora:.1f}x más rápida"))
+
+    @staticmethod
+    def _medir(funcion):
+        with CaptureQueriesContext(connection) as consultas:
+            inicio = time.perf_counter()
+            funcion()
+            segundos = time.perf_counter() - inicio
+        return len(consultas), segundos
+
+    @staticmethod
+    def _parsear(mensajes, prefijo):
+        return [
+            CorreoParserService.parsear(mensaje, f"{prefijo}-{mensaje['Message-ID']}")
+            for mensaje in mensajes
+        ]
+
+    def _persistir_por_lotes(self, servicio, mensajes, prefijo, tamaño_lote):
+        for inicio in range(0, len(mensajes), tamaño_lote):
+            lote = self._parsear(mensajes[inicio:inicio + tamaño_lote], prefijo)
+            IngestaPersistenciaService.persistir_lote(servicio, lote)
+
+    def _persistir_por_fila(self, servicio, mensajes, prefijo):
+        """Reproduce la persistencia anterior: varias consultas y un commit por correo."""
+        for datos in self._parsear(mensajes, prefijo):
+            if CorreoIngesta.objects.filter(mensaje_id=datos['mensaje_id']).exists():
+                continue
+
+            correo = CorreoIngesta.objects.create(
+                servicio=servicio,
+                mensaje_id=datos['mensaje_id'],
+                remitente=datos['remitente'],
+                destinatarios=datos['destinatarios'],
+                asunto=datos['asunto'],
+                fecha_recepcion=datos['fecha_recepcion'],
+                contenido_plano=datos['contenido_plano'],
+                contenido_html=datos['contenido_html'],
+                estado=CorreoIngesta.Estado.PENDIENTE
+            )
+
+            for adjunto in datos['adjuntos']:
+                contenido = adjunto['parte'].get_payload(decode=True)
+                registro = ArchivoAdjunto(
+                    correo=correo,
+                    nombre_archivo=adjunto['nombre_archivo'],
+                    tipo_contenido=adjunto['tipo_contenido'],
+                    tamaño=len(contenido)
+                )
+                ruta = f"adjuntos_correo/tenant_{servicio.tenant_id}/{adjunto['nombre_archivo']}"
+                registro.archivo.save(ruta, ContentFile(contenido), save=True)
+
+            regla_aplicada = ReglaFiltradoService.aplicar_reglas(correo)
+            if regla_aplicada:
+                HistorialAplicacionRegla.objects.create(
+                    regla=regla_aplicada,
+                    correo=correo,
+                    resultado=True,
+                    accion_ejecutada=regla_aplicada.accion
+                )
+                regla_aplicada.ejecutar_accion(correo)
+            else:
+                correo.estado = CorreoIngesta.Estado.PROCESADO
+                correo.fecha_procesamiento = timezone.now()
+                correo.save()
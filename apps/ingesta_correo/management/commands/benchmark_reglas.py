@@ -0,0 +1,135 @@
+import random
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services import aho_corasick
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_motor_service import (
+    MotorReglas, ReglaCompilada, ReglaMotorService, RegistroPatrones, compilar_condicion
+)
+from apps.ingesta_correo.services.regla_test_service import ReglaTestService
+
+
+class Command(BaseCommand):
+    help = 'Compara la evaluación regla por regla, compilada secuencial y compilada con Aho-Corasick'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reglas', type=int, default=500, help='Número de reglas del servicio')
+        parser.add_argument('--tamano-kb', type=int, default=100, help='Tamaño del contenido del correo (KB)')
+        parser.add_argument('--correos', type=int, default=50, help='Correos a evaluar')
+        parser.add_argument('--compuestas', type=int, default=0,
+                            help='Compara además N reglas compuestas en orden guardado y reordenadas')
+
+    def handle(self, *args, **options):
+        aleatorio = random.Random(42)
+        reglas = self._generar_reglas(options['reglas'], aleatorio)
+        datos = {
+            'asunto': 'Glosa factura FE-1234 paciente',
+            'remitente': 'glosas@eps.example.com',
+            'destinatario': 'ingesta@ips.example.com',
+            'contenido': ''.join(aleatorio.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(options['tamano_kb'] * 1024)),
+            'adjunto': 'glosa.xlsx',
+        }
+        valores = InstantaneaCorreo.desde_datos_prueba(datos)
+
+        total = options['correos']
+        resultados = []
+
+        inicio = time.perf_counter()
+        for _ in range(total):
+            for regla in reglas:
+                if ReglaTestService.evaluar_regla_completa(regla, datos)['cumple']:
+                    break
+        resultados.append(('regla por regla', time.perf_counter() - inicio))
+
+        motores = [('secuencial', MotorReglas([ReglaMotorService.compilar_regla(regla) for regla in reglas]))]
+
+        registro = RegistroPatrones()
+        motores.append(('aho-corasick', MotorReglas(
+            [ReglaMotorService.compilar_regla(regla, registro=registro) for regla in reglas], registro=registro
+        )))
+
+        if aho_corasick.ahocorasick is not None:
+            # Comparar también la implementación en Python puro usada sin pyahocorasick
+            with mock.patch.object(aho_corasick, 'ahocorasick', None):
+                registro = RegistroPatrones()
+                motores.append(('aho-corasick py', MotorReglas(
+                    [ReglaMotorService.compilar_regla(regla, registro=registro) for regla in reglas], registro=registro
+                )))
+
+        for modo, motor in motores:
+            inicio = time.perf_counter()
+            for _ in range(total):
+                motor.primera_coincidencia(valores)
+            resultados.append((modo, time.perf_counter() - inicio))
+
+        self.stdout.write(f"{options['reglas']} reglas, contenido de {options['tamano_kb']} KB, {total} correos\n")
+        self.stdout.write(f"{'modo':>16} {'µs/correo':>12}")
+        for modo, segundos in resultados:
+            self.stdout.write(f"{modo:>16} {segundos / total * 1e6:>12.1f}")
+
+        if options['compuestas']:
+            self._comparar_compuestas(options['compuestas'], valores, total, aleatorio)
+
+    def _comparar_compuestas(self, cantidad, valores, total, aleatorio):
+        """
+        Reglas Y cuya primera condición guardada es una regex sobre el contenido
+        y la última una igualdad del remitente que casi nunca se cumple.
+        """
+        reglas = []
+        for i in range(cantidad):
+            regla = ReglaFiltrado(
+                id=i + 1, nombre=f'Compuesta {i + 1}', es_compuesta=True,
+                operador_logico=ReglaFiltrado.TipoOperador.Y, prioridad=i,
+                accion=ReglaFiltrado.TipoAccion.PROCESAR,
+            )
+            condiciones = [
+                SimpleNamespace(campo='contenido', condicion='regex', valor=r'\bglosa\w*\s+\d+', orden=0),
+                SimpleNamespace(campo='asunto', condicion='contiene', valor='glosa', orden=1),
+                SimpleNamespace(campo='remitente', condicion='es_igual',
+                                valor=f'eps{aleatorio.randint(0, 10 ** 6)}@example.com', orden=2),
+            ]
+            reglas.append((regla, condiciones))
+
+        def en_orden_guardado(regla, condiciones):
+            predicados = [compilar_condicion(c.campo, c.condicion, c.valor) for c in condiciones]
+            return ReglaCompilada(regla, lambda v, e=None: all(p(v, e) for p in predicados))
+
+        guardado = MotorReglas([en_orden_guardado(regla, condiciones) for regla, condiciones in reglas])
+        reordenado = MotorReglas([ReglaMotorService.compilar_regla(regla, condiciones) for regla, condiciones in reglas])
+
+        self.stdout.write(f"\n{cantidad} reglas compuestas Y de 3 condiciones")
+        for modo, motor in (('orden guardado', guardado), ('reordenadas', reordenado)):
+            inicio = time.perf_counter()
+            for _ in range(total):
+                motor.primera_coincidencia(valores)
+            self.stdout.write(f"{modo:>16} {(time.perf_counter() - inicio) / total * 1e6:>12.1f}")
+
+        estadisticas = reordenado.estadisticas_condiciones()[0]
+        self.stdout.write(f"\n{estadisticas['nombre']} ({estadisticas['llamadas']} llamadas), orden de evaluación:")
+        for condicion in estadisticas['condiciones']:
+            self.stdout.write(
+                f"  [{condicion['orden']}] {condicion['condicion']:<45} coste estimado {condicion['coste_estimado']:>5} "
+                f"muestras {condicion['muestras']:>4} aciertos {condicion['tasa_aciertos']} ns {condicion['ns_medio']}"
+            )
+
+    @staticmethod
+    def _generar_reglas(cantidad, aleatorio):
+        """Reglas simples sin coincidencias, el peor caso: se evalúan todas."""
+        campos = ['asunto', 'remitente', 'contenido']
+        reglas = []
+        for i in range(cantidad):
+            reglas.append(ReglaFiltrado(
+                id=i + 1,
+                nombre=f'Regla {i + 1}',
+                campo=aleatorio.choice(campos),
+                condicion=ReglaFiltrado.TipoCondicion.CONTIENE,
+                valor=f'patron-{i}-{aleatorio.randint(0, 10 ** 6)}',
+                prioridad=i,
+                accion=ReglaFiltrado.TipoAccion.PROCESAR,
+            ))
+        return reglas
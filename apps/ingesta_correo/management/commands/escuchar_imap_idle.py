@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.ingesta_correo.services.imap_idle_service import SupervisorIdle
+
+
+class Command(BaseCommand):
+    help = 'Mantiene conexiones IMAP IDLE y dispara la ingesta en cuanto llega correo nuevo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tenant', type=int, help='Escuchar solo la configuración de este tenant')
+        parser.add_argument('--refresco', type=int, default=60,
+                            help='Segundos entre revisiones de las configuraciones con IDLE activo')
+
+    def handle(self, *args, **options):
+        supervisor = SupervisorIdle(tenant_id=options['tenant'])
+        self.stdout.write(self.style.SUCCESS('Escuchando buzones con IMAP IDLE (Ctrl+C para salir)...'))
+        activos = None
+        try:
+            while True:
+                cantidad = supervisor.sincronizar()
+                if cantidad != activos:
+                    self.stdout.write(f'Buzones en escucha: {cantidad}')
+                    activos = cantidad
+                time.sleep(options['refresco'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            supervisor.detener()
+            self.stdout.write(self.style.SUCCESS('Escucha IMAP IDLE detenida'))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.perfil_reglas_service import PerfilReglasService
+
+
+class Command(BaseCommand):
+    help = 'Lista las reglas de un servicio con mayor tiempo de evaluación según el perfil de reglas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('servicio_id', type=int, help='ID del ServicioIngesta')
+        parser.add_argument('--dias', type=int, default=7, help='Días de estadísticas considerados')
+        parser.add_argument('--limite', type=int, default=10, help='Número de reglas listadas')
+
+    def handle(self, *args, **options):
+        costosas = PerfilReglasService.reglas_mas_costosas(
+            options['servicio_id'], dias=options['dias'], limite=options['limite']
+        )
+        if not costosas:
+            self.stdout.write("Sin mediciones: active el perfil de reglas del tenant (rule_profiling_enabled)")
+            return
+
+        ids = [fila['regla_id'] for fila in costosas]
+        resumen = PerfilReglasService.resumen(ids, dias=options['dias'])
+        condiciones = {
+            condicion.id: condicion
+            for regla in ReglaFiltrado.objects.filter(id__in=ids).prefetch_related('condiciones')
+            for condicion in regla.condiciones.all()
+        }
+
+        self.stdout.write(f"{'regla':<40} {'total ms':>10} {'evaluaciones':>12} {'p50 µs':>9} {'p95 µs':>9}")
+        for fila in costosas:
+            datos = resumen.get(fila['regla_id'], {})
+            self.stdout.write(
+                f"{fila['regla__nombre'][:40]:<40} {fila['tiempo_total_ns'] / 1e6:>10.1f} {fila['evaluaciones']:>12} "
+                f"{datos.get('p50_us')!s:>9} {datos.get('p95_us')!s:>9}"
+            )
+            for condicion_id, condicion in sorted(datos.get('condiciones', {}).items(), key=lambda c: -(c[1]['p95_us'] or 0)):
+                nombre = str(condiciones[condicion_id]) if condicion_id in condiciones else condicion_id
+                self.stdout.write(
+                    f"  {nombre!s:<38} {'':>10} {condicion['evaluaciones']:>12} "
+                    f"{condicion['p50_us']!s:>9} {condicion['p95_us']!s:>9}"
+                )
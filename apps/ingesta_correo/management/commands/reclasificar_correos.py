@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.reclasificacion_service import ReclasificacionService
+
+
+class Command(BaseCommand):
+    help = 'Reaplica las reglas activas de un servicio a sus correos ya ingeridos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('servicio_id', type=int, help='ID del servicio de ingesta')
+        parser.add_argument('--dias', type=int, default=None, help='Solo correos de los últimos N días')
+        parser.add_argument('--trozo', type=int, default=2000, help='Correos por trozo')
+        parser.add_argument('--dry-run', action='store_true', help='Solo mostrar lo que se haría')
+
+    def handle(self, *args, **options):
+        if not ServicioIngesta.objects.filter(id=options['servicio_id']).exists():
+            raise CommandError(f"No existe el servicio de ingesta {options['servicio_id']}")
+
+        inicio = time.perf_counter()
+        resultado = ReclasificacionService.reclasificar(
+            options['servicio_id'], dias=options['dias'], tamaño_trozo=options['trozo'], dry_run=options['dry_run']
+        )
+        segundos = time.perf_counter() - inicio
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Correos evaluados: {resultado['correos_evaluados']}, con cambio de estado: "
+            f"{resultado['correos_cambiados']} ({segundos:.1f}s)"
+        ))
+        for estado, correos in sorted(resultado['por_estado'].items()):
+            self.stdout.write(f"  {estado}: {correos}")
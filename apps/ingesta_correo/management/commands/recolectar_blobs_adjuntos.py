@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from apps.ingesta_correo.models import BlobAdjunto
+from apps.ingesta_correo.services.adjunto_storage_service import AdjuntoStorageService
+
+
+class Command(BaseCommand):
+    help = 'Recalcula las referencias de los blobs de adjuntos y elimina los que ya no se usan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Solo mostrar lo que se haría')
+
+    def handle(self, *args, **options):
+        corregidos = 0
+        eliminados = 0
+
+        for blob in BlobAdjunto.objects.annotate(en_uso=Count('adjuntos')).iterator():
+            if blob.en_uso != blob.referencias:
+                corregidos += 1
+                if not options['dry_run']:
+                    BlobAdjunto.objects.filter(id=blob.id).update(referencias=blob.en_uso)
+
+            if blob.en_uso == 0:
+                eliminados += 1
+                if not options['dry_run']:
+                    AdjuntoStorageService.liberar_referencia(blob.id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Blobs con referencias corregidas: {corregidos}, blobs eliminados: {eliminados}"
+        ))
@@ -0,0 +1,104 @@
+import bisect
+import random
+import statistics
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand
+
+from apps.ingesta_correo.services.ingesta_scheduler_service import intervalo_adaptativo, siguiente_ejecucion
+
+TICK = timedelta(minutes=1)
+INICIO = datetime(2024, 5, 6, tzinfo=dt_timezone.utc)
+
+
+def _poisson(aleatorio, desde, hasta, por_hora):
+    """Llegadas de un proceso de Poisson entre desde y hasta."""
+    llegadas = []
+    instante = desde
+    while por_hora > 0:
+        instante += timedelta(hours=aleatorio.expovariate(por_hora))
+        if instante >= hasta:
+            break
+        llegadas.append(instante)
+    return llegadas
+
+
+def generar_llegadas(perfil, dias, aleatorio):
+    """Horas de llegada del correo de un buzón según su perfil de actividad."""
+    llegadas = []
+    for dia in range(dias):
+        inicio = INICIO + timedelta(days=dia)
+        if perfil == 'silencioso':
+            llegadas += _poisson(aleatorio, inicio, inicio + timedelta(days=1), 3 / 24)
+        elif perfil == 'oficina':
+            llegadas += _poisson(aleatorio, inicio + timedelta(hours=8), inicio + timedelta(hours=18), 10)
+        elif perfil == 'rafagas':
+            for _ in range(3):
+                rafaga = inicio + timedelta(minutes=aleatorio.uniform(0, 24 * 60 - 30))
+                llegadas += _poisson(aleatorio, rafaga, rafaga + timedelta(minutes=30), 40)
+        elif perfil == 'constante':
+            llegadas += _poisson(aleatorio, inicio, inicio + timedelta(days=1), 30)
+    return sorted(llegadas)
+
+
+def simular(llegadas, dias, intervalo, adaptativo=False, minimo=2, maximo=30):
+    """
+    Sondea el buzón en ticks de un minuto con la misma programación que la
+    ingesta (siguiente_ejecucion e intervalo_adaptativo).
+
+    Returns:
+        dict: conexiones, latencias (minutos desde la llegada hasta la ingesta)
+    """
+    fin = INICIO + timedelta(days=dias)
+    proxima = None
+    ingeridos = 0
+    conexiones = 0
+    latencias = []
+    ahora = INICIO
+    while ahora < fin:
+        if proxima is None or proxima <= ahora:
+            conexiones += 1
+            hasta = bisect.bisect_right(llegadas, ahora)
+            nuevos = llegadas[ingeridos:hasta]
+            latencias.extend((ahora - llegada).total_seconds() / 60 for llegada in nuevos)
+            ingeridos = hasta
+            if adaptativo:
+                intervalo = intervalo_adaptativo(intervalo, len(nuevos), minimo, maximo)
+            proxima = siguiente_ejecucion(proxima, ahora, intervalo)
+        ahora += TICK
+    return {'conexiones': conexiones, 'latencias': latencias}
+
+
+class Command(BaseCommand):
+    help = 'Compara conexiones por día y latencia de ingesta del sondeo fijo y el adaptativo'
+
+    PERFILES = ('silencioso', 'oficina', 'rafagas', 'constante')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=7, help='Días simulados')
+        parser.add_argument('--fijos', default='5,15', help='Intervalos fijos a comparar (minutos)')
+        parser.add_argument('--minimo', type=int, default=2, help='Intervalo mínimo del modo adaptativo')
+        parser.add_argument('--maximo', type=int, default=30, help='Intervalo máximo del modo adaptativo')
+        parser.add_argument('--semilla', type=int, default=1, help='Semilla de las llegadas de correo')
+
+    def handle(self, *args, **options):
+        dias = options['dias']
+        politicas = [(f'fijo {valor} min', int(valor), False) for valor in options['fijos'].split(',') if valor]
+        politicas.append((f"adaptativo {options['minimo']}-{options['maximo']}", options['minimo'], True))
+
+        self.stdout.write(
+            f"{'perfil':>11} {'correos/día':>12} {'política':>16} {'conexiones/día':>15} "
+            f"{'latencia media':>15} {'latencia p95':>13}"
+        )
+        for perfil in self.PERFILES:
+            llegadas = generar_llegadas(perfil, dias, random.Random(options['semilla']))
+            for nombre, intervalo, adaptativo in politicas:
+                resultado = simular(
+                    llegadas, dias, intervalo, adaptativo, minimo=options['minimo'], maximo=options['maximo']
+                )
+                latencias = sorted(resultado['latencias']) or [0.0]
+                self.stdout.write(
+                    f"{perfil:>11} {len(llegadas) / dias:>12.0f} {nombre:>16} "
+                    f"{resultado['conexiones'] / dias:>15.0f} {statistics.mean(latencias):>14.1f}m "
+                    f"{latencias[max(0, int(len(latencias) * 0.95) - 1)]:>12.1f}m"
+                )
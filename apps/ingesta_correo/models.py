@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils import timezone
 from apps.tenants.models import Tenant
@@ -43,21 +44,73 @@ class ServicioIngesta(models.Model):
     fecha_modificacion = models.DateTimeField(auto_now=True)
     modificado_por = models.ForeignKey('authentication.ZentraflowUser', on_delete=models.SET_NULL, null=True, blank=True)
     intervalo_minutos = models.IntegerField(default=5)
+    intervalo_adaptativo = models.BooleanField(default=False, help_text="Vuelve al intervalo mínimo tras encontrar correo nuevo y lo duplica tras cada ejecución sin correo")
+    intervalo_minimo_minutos = models.PositiveIntegerField(default=2, help_text="Intervalo mínimo del modo adaptativo")
+    intervalo_maximo_minutos = models.PositiveIntegerField(default=30, help_text="Intervalo máximo del modo adaptativo")
+    intervalo_actual_minutos = models.PositiveIntegerField(null=True, blank=True, editable=False, help_text="Intervalo vigente en el modo adaptativo")
     proxima_ejecucion = models.DateTimeField(null=True, blank=True)
     en_ejecucion = models.BooleanField(default=False)
+    lease_token = models.CharField(max_length=32, null=True, blank=True, editable=False)
+    lease_expira = models.DateTimeField(null=True, blank=True, editable=False, help_text="Una ejecución tiene el servicio hasta esta hora si no renueva su lease")
+    despachado_en = models.DateTimeField(null=True, blank=True, editable=False, help_text="Ocupa un cupo de concurrencia desde que se encola hasta que termina la ejecución")
+    cancelacion_solicitada = models.DateTimeField(null=True, blank=True, editable=False, help_text="La ejecución en curso se detiene en cuanto la ve, entre lotes")
+    continuacion = models.JSONField(null=True, blank=True, editable=False, help_text="Punto desde el que sigue una ejecución que agotó su presupuesto (historial y último mensaje procesado)")
     ultima_verificacion = models.DateTimeField(null=True, blank=True)
+    version_reglas = models.PositiveIntegerField(default=0, editable=False, help_text="Se incrementa al modificar reglas, condiciones o categorías")
 
     class Meta:
         verbose_name = "Servicio de Ingesta"
         verbose_name_plural = "Servicios de Ingesta"
         unique_together = ('tenant', 'nombre')
+        indexes = [
+            # Cola de vencidos: solo los servicios activos, por próxima ejecución
+            models.Index(fields=['proxima_ejecucion'], condition=models.Q(activo=True), name='servicio_vencimiento_idx'),
+            models.Index(fields=['despachado_en']),
+        ]
 
     def __str__(self):
         return f"{self.nombre} - {self.tenant}"
 
+    CAMPOS_ATOMICOS = (
+        'version_reglas', 'lease_token', 'lease_expira', 'despachado_en', 'continuacion', 'cancelacion_solicitada',
+    )
+
+    def save(self, *args, **kwargs):
+        # Un servicio activo siempre tiene próxima ejecución: la cola de
+        # vencidos solo busca por rango en (activo, proxima_ejecucion)
+        if self.activo and self.proxima_ejecucion is None:
+            self.proxima_ejecucion = timezone.now()
+        # Estas columnas solo cambian mediante UPDATE atómicos (ReglaMotorService.invalidar,
+        # lease, despacho, continuaciones y cancelación) o con update_fields explícitos;
+        # un save completo con una instancia desactualizada no debe revertirlas
+        if not self._state.adding and not kwargs.get('update_fields') and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.CAMPOS_ATOMICOS
+            ]
+        super().save(*args, **kwargs)
+
+    def clean(self):
+        if self.intervalo_minimo_minutos and self.intervalo_maximo_minutos \
+                and self.intervalo_minimo_minutos > self.intervalo_maximo_minutos:
+            raise ValidationError({'intervalo_maximo_minutos': "Debe ser mayor o igual que el intervalo mínimo"})
+
+    @property
+    def intervalo_efectivo(self):
+        """Minutos entre ejecuciones: el intervalo fijo o el vigente del modo adaptativo."""
+        if not self.intervalo_adaptativo:
+            return self.intervalo_minutos
+        actual = self.intervalo_actual_minutos or self.intervalo_minutos
+        return min(max(actual, self.intervalo_minimo_minutos or 1), self.intervalo_maximo_minutos or actual)
+
     def actualizar_proxima_ejecucion(self):
         """Actualiza el timestamp de próxima ejecución basado en el intervalo."""
-        self.proxima_ejecucion = timezone.now() + timezone.timedelta(minutes=self.intervalo_minutos)
+        if self.pk is None:
+            self.proxima_ejecucion = timezone.now() + timezone.timedelta(minutes=self.intervalo_efectivo)
+            return self.proxima_ejecucion
+        # Primer turno del servicio en su cuadrícula, desfasada de la de los demás
+        from apps.ingesta_correo.services.ingesta_scheduler_service import turno_siguiente
+        self.proxima_ejecucion = turno_siguiente(self.pk, timezone.now(), self.intervalo_efectivo)
         return self.proxima_ejecucion
 
     def tiempo_hasta_proxima_ejecucion(self):
@@ -140,6 +193,28 @@ class HistorialEjecucion(models.Model):
             return (self.fecha_fin - self.fecha_inicio).total_seconds()
         return None
 
+class SincronizacionCarpeta(models.Model):
+    """
+    Punto de control de la sincronización incremental IMAP.
+    Guarda, por servicio y carpeta, el UIDVALIDITY del buzón y el UID más alto
+    ya procesado, de modo que cada ejecución solo solicite los UID posteriores.
+    """
+    servicio = models.ForeignKey(ServicioIngesta, on_delete=models.CASCADE, related_name='sincronizaciones')
+    carpeta = models.CharField(max_length=100)
+    uid_validity = models.BigIntegerField(null=True, blank=True)
+    ultimo_uid = models.BigIntegerField(default=0)
+    resincronizaciones = models.IntegerField(default=0, help_text="Número de resincronizaciones completas por cambio de UIDVALIDITY")
+    fecha_ultima_resincronizacion = models.DateTimeField(null=True, blank=True)
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Sincronización de Carpeta"
+        verbose_name_plural = "Sincronizaciones de Carpetas"
+        unique_together = ('servicio', 'carpeta')
+
+    def __str__(self):
+        return f"{self.servicio} - {self.carpeta} (UID {self.ultimo_uid})"
+
 class CorreoIngesta(models.Model):
     class Estado(models.TextChoices):
         PENDIENTE = 'PENDIENTE', 'Pendiente'
@@ -158,6 +233,7 @@ class CorreoIngesta(models.Model):
     estado = models.CharField(max_length=20, choices=Estado.choices, default=Estado.PENDIENTE)
     error = models.TextField(null=True, blank=True)
     glosas_extraidas = models.IntegerField(default=0)
+    prefiltro_imap = models.BooleanField(default=False, help_text="Ignorado por el prefiltro IMAP sin descargar cuerpo ni destinatarios; la reclasificación y el backtest no lo evalúan")
     
     class Meta:
         verbose_name = "Correo"
@@ -167,14 +243,42 @@ class CorreoIngesta(models.Model):
     def __str__(self):
         return f"{self.asunto} - {self.fecha_recepcion}"
 
+class BlobAdjunto(models.Model):
+    """
+    Contenido físico de un adjunto, direccionado por su SHA-256 dentro de cada tenant.
+    Todos los ArchivoAdjunto con el mismo contenido comparten un único blob.
+    """
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='blobs_adjuntos')
+    hash_sha256 = models.CharField(max_length=64)
+    archivo = models.FileField(max_length=500)
+    tamaño = models.BigIntegerField()
+    referencias = models.PositiveIntegerField(default=0, help_text="Número de ArchivoAdjunto que usan este blob")
+    procesado = models.BooleanField(default=False, help_text="Indica si ya se extrajeron glosas de este contenido")
+    glosas_extraidas = models.IntegerField(default=0)
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name = "Blob de Adjunto"
+        verbose_name_plural = "Blobs de Adjuntos"
+        unique_together = ('tenant', 'hash_sha256')
+    
+    def __str__(self):
+        return f"{self.hash_sha256[:12]} ({self.referencias} referencias)"
+
 class ArchivoAdjunto(models.Model):
     correo = models.ForeignKey(CorreoIngesta, on_delete=models.CASCADE, related_name='adjuntos')
+    blob = models.ForeignKey(BlobAdjunto, on_delete=models.RESTRICT, null=True, blank=True, related_name='adjuntos')
     nombre_archivo = models.CharField(max_length=255)
     tipo_contenido = models.CharField(max_length=100)
     tamaño = models.IntegerField()
-    archivo = models.FileField(upload_to=adjunto_upload_path, max_length=500)
+    archivo = models.FileField(upload_to=adjunto_upload_path, max_length=500, blank=True)
+    hash_sha256 = models.CharField(max_length=64, blank=True, default='', db_index=True, help_text="SHA-256 del contenido decodificado")
     procesado = models.BooleanField(default=False)
     fecha_procesamiento = models.DateTimeField(null=True, blank=True)
+    origen_imap = models.JSONField(
+        null=True, blank=True,
+        help_text="Ubicación en el servidor (carpeta, uid_validity, uid, seccion) de un adjunto aún no descargado"
+    )
     
     class Meta:
         verbose_name = "Archivo Adjunto"
@@ -182,11 +286,16 @@ class ArchivoAdjunto(models.Model):
     
     def __str__(self):
         return self.nombre_archivo
+
+    @property
+    def pendiente_descarga(self):
+        """True si el adjunto se registró sin descargar su contenido."""
+        return not self.archivo and bool(self.origen_imap)
         
     def save(self, *args, **kwargs):
         """Sobrescribe el método save para garantizar que los archivos se guarden con el tenant en la ruta."""
         # Solo modificar la ruta si el archivo es nuevo y existe la relación completa
-        if not self.id and self.correo_id and hasattr(self, 'archivo'):
+        if not self.id and self.correo_id and self.archivo:
             try:
                 if self.correo.servicio and self.correo.servicio.tenant:
                     # Si el archivo ya se ha asignado pero no guardado aún
@@ -323,95 +432,39 @@ class ReglaFiltrado(models.Model):
             return f"{self.nombre} (Regla compuesta)"
         return f"{self.nombre} ({self.get_campo_display()} {self.get_condicion_display()} '{self.valor}')"
     
-    def evaluar(self, correo):
+    def evaluar(self, correo, instantanea=None):
         """
         Evalúa la regla contra un correo específico.
         
+        Compila la regla en cada llamada; para evaluarla contra varios correos,
+        compílala una vez con ReglaMotorService.compilar_regla y usa cumple().
+        
         Args:
             correo: Un objeto CorreoIngesta a evaluar
+            instantanea: InstantaneaCorreo del correo (opcional), para no
+                reconstruirla al evaluar varias reglas contra el mismo correo
             
         Returns:
             bool: True si la regla se cumple, False en caso contrario
         """
-        if self.es_compuesta:
-            # Evaluar grupo de condiciones
-            condiciones = self.condiciones.all()
-            if not condiciones:
-                return False
-                
-            if self.operador_logico == self.TipoOperador.Y:
-                # Todas deben cumplirse
-                return all(condicion.evaluar(correo) for condicion in condiciones)
-            else:
-                # Al menos una debe cumplirse
-                return any(condicion.evaluar(correo) for condicion in condiciones)
-        else:
-            # Regla simple (retrocompatible)
-            return self._evaluar_condicion_simple(correo)
-            
-    def _evaluar_condicion_simple(self, correo):
-        """Evalúa una condición simple en un correo."""
-        valor_campo = self._obtener_valor_campo(correo, self.campo)
-        
-        # Convertir condición a mayúsculas para hacer la comparación insensible a mayúsculas/minúsculas
-        condicion_upper = self.condicion.upper() if self.condicion else ""
+        from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+        from apps.ingesta_correo.services.regla_motor_service import ReglaMotorService
         
-        # Convertir a minúsculas para comparaciones insensibles a mayúsculas/minúsculas
-        valor_campo_lower = valor_campo.lower()
-        valor_lower = self.valor.lower() if self.valor else ""
-        
-        # Evaluar según tipo de condición
-        if condicion_upper == self.TipoCondicion.CONTIENE.upper():
-            return valor_lower in valor_campo_lower
-        elif condicion_upper == self.TipoCondicion.NO_CONTIENE.upper():
-            return valor_lower not in valor_campo_lower
-        elif condicion_upper == self.TipoCondicion.ES_IGUAL.upper():
-            return valor_lower == valor_campo_lower
-        elif condicion_upper == self.TipoCondicion.NO_ES_IGUAL.upper():
-            return valor_lower != valor_campo_lower
-        elif condicion_upper == self.TipoCondicion.EMPIEZA_CON.upper():
-            return valor_campo_lower.startswith(valor_lower)
-        elif condicion_upper == self.TipoCondicion.TERMINA_CON.upper():
-            return valor_campo_lower.endswith(valor_lower)
-        elif condicion_upper == self.TipoCondicion.REGEX.upper():
-            import re
-            try:
-                return bool(re.search(self.valor, valor_campo, re.IGNORECASE))
-            except re.error:
-                return False
-        
-        return False
-        
-    def _obtener_valor_campo(self, correo, campo):
-        """Obtiene el valor del campo especificado de un correo."""
-        # Convertir campo a mayúsculas para hacer la comparación insensible a mayúsculas/minúsculas
-        campo_upper = campo.upper() if campo else ""
-        
-        if campo_upper == self.TipoCampo.REMITENTE.upper():
-            return correo.remitente
-        elif campo_upper == self.TipoCampo.ASUNTO.upper():
-            return correo.asunto
-        elif campo_upper == self.TipoCampo.CONTENIDO.upper():
-            return correo.contenido_plano or ""
-        elif campo_upper == self.TipoCampo.ADJUNTO_NOMBRE.upper():
-            # Concatenar todos los nombres de adjuntos
-            return " ".join([adj.nombre_archivo for adj in correo.adjuntos.all()])
-        elif campo_upper == self.TipoCampo.TIENE_ADJUNTOS.upper():
-            return str(correo.adjuntos.exists())
-        elif campo_upper == self.TipoCampo.ADJUNTO_TIPO.upper():
-            return " ".join([adj.tipo_contenido for adj in correo.adjuntos.all()])
-        elif campo_upper == self.TipoCampo.ADJUNTO_TAMAÑO.upper():
-            # Tamaño total de los adjuntos en KB
-            return str(sum([adj.tamaño for adj in correo.adjuntos.all()]) / 1024)
-        elif campo_upper == self.TipoCampo.FECHA_RECEPCION.upper():
-            return correo.fecha_recepcion.strftime('%Y-%m-%d %H:%M:%S')
-        return ""
+        if instantanea is None:
+            instantanea = InstantaneaCorreo.desde_correo(correo)
+        return ReglaMotorService.compilar_regla(self).cumple(instantanea)
         
     def registrar_uso(self):
-        """Registra que la regla ha sido aplicada."""
-        self.conteo_usos += 1
-        self.ultima_aplicacion = timezone.now()
-        self.save(update_fields=['conteo_usos', 'ultima_aplicacion'])
+        """
+        Registra que la regla ha sido aplicada con un UPDATE relativo inmediato.
+        Al aplicar reglas a un lote se usa ContadorUsosReglas, que escribe una
+        vez por lote.
+        """
+        from apps.ingesta_correo.services.uso_reglas_service import ContadorUsosReglas
+        
+        contador = ContadorUsosReglas()
+        contador.registrar(self)
+        contador.flush()
         
     def esta_activa(self):
         """Verifica si la regla está activa considerando fechas de inicio/fin."""
@@ -429,7 +482,8 @@ class ReglaFiltrado(models.Model):
         
     def ejecutar_accion(self, correo):
         """
-        Ejecuta la acción definida por la regla sobre un correo.
+        Ejecuta la acción definida por la regla sobre un correo y lo guarda.
+        El uso de la regla lo registra quien la evaluó (aplicar_reglas).
         
         Args:
             correo: Objeto CorreoIngesta sobre el que se ejecutará la acción
@@ -437,8 +491,20 @@ class ReglaFiltrado(models.Model):
         Returns:
             bool: True si la acción se ejecutó correctamente
         """
-        self.registrar_uso()
+        self.aplicar_accion(correo)
+        
+        # Guardar cambios en el correo
+        correo.save()
+        return True
+        
+    def aplicar_accion(self, correo):
+        """
+        Aplica la acción de la regla sobre el correo en memoria, sin guardarlo.
+        Permite persistir los cambios de varios correos con un solo bulk_update.
         
+        Args:
+            correo: Objeto CorreoIngesta sobre el que se aplicará la acción
+        """
         if self.accion == self.TipoAccion.PROCESAR:
             # Marcar para procesamiento
             correo.estado = CorreoIngesta.Estado.PENDIENTE
@@ -458,10 +524,6 @@ class ReglaFiltrado(models.Model):
             if not correo.detalles:
                 correo.detalles = {}
             correo.detalles['etiquetas'] = etiquetas
-        
-        # Guardar cambios en el correo
-        correo.save()
-        return True
 
 
 class CondicionRegla(models.Model):
@@ -483,73 +545,17 @@ class CondicionRegla(models.Model):
     def __str__(self):
         return f"{self.get_campo_display()} {self.get_condicion_display()} '{self.valor}'"
         
-    def evaluar(self, correo):
-        """Evalúa esta condición contra un correo específico."""
-        valor_campo = self._obtener_valor_campo(correo, self.campo)
-        
-        # Convertir condición a mayúsculas para hacer la comparación insensible a mayúsculas/minúsculas
-        condicion_upper = self.condicion.upper() if self.condicion else ""
-        
-        # Evaluar según tipo de condición
-        if condicion_upper == ReglaFiltrado.TipoCondicion.CONTIENE.upper():
-            return self.valor in valor_campo
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.NO_CONTIENE.upper():
-            return self.valor not in valor_campo
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.ES_IGUAL.upper():
-            return self.valor == valor_campo
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.NO_ES_IGUAL.upper():
-            return self.valor != valor_campo
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.EMPIEZA_CON.upper():
-            return valor_campo.startswith(self.valor)
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.TERMINA_CON.upper():
-            return valor_campo.endswith(self.valor)
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.REGEX.upper():
-            import re
-            try:
-                return bool(re.search(self.valor, valor_campo))
-            except re.error:
-                return False
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.MAYOR_QUE.upper():
-            try:
-                return float(valor_campo) > float(self.valor)
-            except (ValueError, TypeError):
-                return False
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.MENOR_QUE.upper():
-            try:
-                return float(valor_campo) < float(self.valor)
-            except (ValueError, TypeError):
-                return False
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.ES_VERDADERO.upper():
-            return valor_campo.lower() in ('true', 'verdadero', 'si', 'yes', '1')
-        elif condicion_upper == ReglaFiltrado.TipoCondicion.ES_FALSO.upper():
-            return valor_campo.lower() in ('false', 'falso', 'no', '0')
-        
-        return False
-        
-    def _obtener_valor_campo(self, correo, campo):
-        """Obtiene el valor del campo especificado de un correo."""
-        # Convertir campo a mayúsculas para hacer la comparación insensible a mayúsculas/minúsculas
-        campo_upper = campo.upper() if campo else ""
+    def evaluar(self, correo, instantanea=None):
+        """
+        Evalúa esta condición contra un correo específico (o su InstantaneaCorreo).
+        Compila la condición en cada llamada: para varios correos, usar compilar_condicion una vez.
+        """
+        from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+        from apps.ingesta_correo.services.regla_motor_service import compilar_condicion
         
-        if campo_upper == self.TipoCampo.REMITENTE.upper():
-            return correo.remitente
-        elif campo_upper == self.TipoCampo.ASUNTO.upper():
-            return correo.asunto
-        elif campo_upper == self.TipoCampo.CONTENIDO.upper():
-            return correo.contenido_plano or ""
-        elif campo_upper == self.TipoCampo.ADJUNTO_NOMBRE.upper():
-            # Concatenar todos los nombres de adjuntos
-            return " ".join([adj.nombre_archivo for adj in correo.adjuntos.all()])
-        elif campo_upper == self.TipoCampo.TIENE_ADJUNTOS.upper():
-            return str(correo.adjuntos.exists())
-        elif campo_upper == self.TipoCampo.ADJUNTO_TIPO.upper():
-            return " ".join([adj.tipo_contenido for adj in correo.adjuntos.all()])
-        elif campo_upper == self.TipoCampo.ADJUNTO_TAMAÑO.upper():
-            # Tamaño total de los adjuntos en KB
-            return str(sum([adj.tamaño for adj in correo.adjuntos.all()]) / 1024)
-        elif campo_upper == self.TipoCampo.FECHA_RECEPCION.upper():
-            return correo.fecha_recepcion.strftime('%Y-%m-%d %H:%M:%S')
-        return ""
+        if instantanea is None:
+            instantanea = InstantaneaCorreo.desde_correo(correo)
+        return compilar_condicion(self.campo, self.condicion, self.valor)(instantanea)
 
 
 class HistorialAplicacionRegla(models.Model):
@@ -660,6 +666,34 @@ class RegistroLogRegla(models.Model):
         )
 
 
+class EstadisticaRegla(models.Model):
+    """
+    Coste de evaluación de una regla (condicion vacía) o de una condición de
+    regla compuesta durante una hora, medido sobre los correos muestreados por
+    el perfil de reglas. histograma[i] cuenta las evaluaciones que tardaron
+    entre 2^(i-1) y 2^i nanosegundos.
+    """
+    regla = models.ForeignKey(ReglaFiltrado, on_delete=models.CASCADE, related_name='estadisticas')
+    condicion = models.ForeignKey(CondicionRegla, on_delete=models.CASCADE, related_name='estadisticas',
+                                  null=True, blank=True)
+    periodo = models.DateTimeField(help_text="Inicio de la hora medida")
+    evaluaciones = models.PositiveIntegerField(default=0)
+    coincidencias = models.PositiveIntegerField(default=0)
+    tiempo_total_ns = models.BigIntegerField(default=0)
+    histograma = models.JSONField(default=list)
+    
+    class Meta:
+        verbose_name = "Estadística de Regla"
+        verbose_name_plural = "Estadísticas de Reglas"
+        ordering = ['-periodo']
+        indexes = [
+            models.Index(fields=['regla', 'periodo']),
+            models.Index(fields=['periodo']),
+        ]
+        
+    def __str__(self):
+        return f"{self.regla_id}/{self.condicion_id or '-'} {self.periodo:%Y-%m-%d %H:00}: {self.evaluaciones} evaluaciones"
+
 # Añadimos relación de categoría a las reglas
 ReglaFiltrado.add_to_class('categoria', 
                            models.ForeignKey(CategoriaRegla, 
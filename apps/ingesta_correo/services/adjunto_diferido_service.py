@@ -0,0 +1,92 @@
+"""
+Descarga bajo demanda de los adjuntos que la ingesta registró sin contenido.
+
+La ingesta parcial (ImapSyncService.fetch_parcial) solo descarga los adjuntos
+relevantes para las glosas; del resto guarda en ArchivoAdjunto.origen_imap la
+carpeta, el UIDVALIDITY, el UID y la sección MIME. Al abrir uno de ellos se
+descarga esa sección del servidor y se guarda como cualquier otro adjunto.
+"""
+
+import logging
+
+from django.db import transaction
+
+from apps.configuracion.models import EmailConfig
+from apps.ingesta_correo.models import ArchivoAdjunto
+from apps.ingesta_correo.services.adjunto_storage_service import AdjuntoStorageService
+from apps.ingesta_correo.services.estructura_imap import ParteImap
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+
+logger = logging.getLogger(__name__)
+
+
+class AdjuntoDiferidoService:
+    """Servicio para descargar adjuntos diferidos desde el servidor IMAP."""
+
+    @staticmethod
+    def descargar_seccion(server, origen):
+        """
+        Descarga la sección del adjunto con la carpeta ya seleccionada.
+
+        Returns:
+            bytes: Contenido de la sección, todavía con su Content-Transfer-Encoding
+        """
+        uid, seccion = int(origen['uid']), origen['seccion']
+        contenido = ImapSyncService.fetch_secciones(server, [uid], [seccion]).get(uid, {}).get(seccion)
+        if contenido is None:
+            raise Exception(f"El mensaje UID {uid} ya no está en la carpeta {origen['carpeta']}")
+        return contenido
+
+    @classmethod
+    def descargar(cls, adjunto, server=None):
+        """
+        Descarga y guarda un adjunto diferido; no hace nada si ya tiene archivo.
+
+        Args:
+            adjunto: ArchivoAdjunto con origen_imap
+            server: Conexión imaplib autenticada opcional (si se omite se abre una
+                con la configuración de correo del tenant)
+
+        Returns:
+            ArchivoAdjunto: El adjunto con archivo, blob, tamaño y hash actualizados
+        """
+        if not adjunto.pendiente_descarga:
+            return adjunto
+
+        origen = adjunto.origen_imap
+        tenant_id = adjunto.correo.servicio.tenant_id
+        propia = server is None
+        if propia:
+            server = ImapSyncService.conectar(EmailConfig.objects.get(tenant_id=tenant_id))
+        try:
+            uid_validity = ImapSyncService.seleccionar_carpeta(server, origen['carpeta'])
+            if origen.get('uid_validity') and uid_validity != origen['uid_validity']:
+                raise Exception(
+                    f"La carpeta {origen['carpeta']} cambió de UIDVALIDITY; el adjunto ya no se puede descargar"
+                )
+            contenido = cls.descargar_seccion(server, origen)
+        finally:
+            if propia:
+                try:
+                    server.logout()
+                except Exception:
+                    pass
+
+        parte = ParteImap(origen['seccion'], adjunto.tipo_contenido, {}, origen.get('codificacion', ''), len(contenido))
+        parte = parte.cabeceras()
+        parte.set_payload(contenido.decode('ascii', errors='surrogateescape'))
+        guardado = AdjuntoStorageService.guardar(tenant_id, parte, adjunto.nombre_archivo)
+
+        with transaction.atomic():
+            # Otra petición pudo descargarlo mientras tanto: el blob es el mismo
+            # por contenido, pero la referencia solo se cuenta una vez
+            actual = ArchivoAdjunto.objects.select_for_update().get(id=adjunto.id)
+            if actual.pendiente_descarga:
+                actual.archivo = guardado['archivo']
+                actual.blob = guardado['blob']
+                actual.tamaño = guardado['tamaño']
+                actual.hash_sha256 = guardado['hash_sha256']
+                actual.save(update_fields=['archivo', 'blob', 'tamaño', 'hash_sha256'])
+                AdjuntoStorageService.registrar_referencias([actual])
+                logger.info(f"Adjunto diferido {actual.id} descargado ({actual.tamaño} bytes)")
+        return actual
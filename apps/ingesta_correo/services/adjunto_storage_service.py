@@ -0,0 +1,269 @@
+import binascii
+import hashlib
+import logging
+import os
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.files.base import File
+from django.db import transaction
+from django.db.models import F, RestrictedError
+
+from apps.ingesta_correo.models import ArchivoAdjunto, BlobAdjunto
+
+logger = logging.getLogger(__name__)
+
+# Caracteres del payload codificado que se decodifican por iteración
+TAMAÑO_TROZO = 256 * 1024
+
+
+def _a_bytes(texto):
+    """Convierte un payload str a bytes del mismo modo que el paquete email."""
+    try:
+        return texto.encode('ascii', 'surrogateescape')
+    except UnicodeError:
+        return texto.encode('raw-unicode-escape')
+
+
+class ArchivoAdjuntoStream(File):
+    """
+    Archivo de Django que decodifica el payload de una parte MIME por trozos.
+
+    El almacenamiento consume chunks() y escribe cada trozo directamente en la
+    ruta final; mientras tanto se calcula el tamaño y el SHA-256 del contenido
+    decodificado, sin copias completas en memoria ni archivos temporales.
+    """
+
+    def __init__(self, parte, nombre, tamaño_trozo=TAMAÑO_TROZO):
+        super().__init__(None, nombre)
+        self.parte = parte
+        self.tamaño_trozo = tamaño_trozo
+        self.hash = hashlib.sha256()
+        self.tamaño = 0
+        self.consumido = False
+
+    @property
+    def size(self):
+        return self.tamaño
+
+    def open(self, mode=None):
+        return self
+
+    def close(self):
+        pass
+
+    def chunks(self, chunk_size=None):
+        for trozo in self._decodificar():
+            if trozo:
+                self.hash.update(trozo)
+                self.tamaño += len(trozo)
+                yield trozo
+        self.consumido = True
+
+    def _decodificar(self):
+        # get_payload() sin decodificar recorre y copia el texto completo para
+        # detectar bytes no ASCII; se lee el payload original directamente
+        payload = self.parte._payload
+        codificacion = str(self.parte.get('Content-Transfer-Encoding', '')).strip().lower()
+
+        if not isinstance(payload, str) or codificacion not in ('base64', 'quoted-printable', '7bit', '8bit', 'binary', ''):
+            # Partes anidadas (message/rfc822) o codificaciones poco comunes como uuencode
+            yield self.parte.get_payload(decode=True) or b''
+        elif codificacion == 'base64':
+            yield from self._decodificar_base64(payload)
+        elif codificacion == 'quoted-printable':
+            yield from self._decodificar_quoted_printable(payload)
+        else:
+            for inicio in range(0, len(payload), self.tamaño_trozo):
+                yield _a_bytes(payload[inicio:inicio + self.tamaño_trozo])
+
+    def _decodificar_base64(self, payload):
+        resto = ''
+        for inicio in range(0, len(payload), self.tamaño_trozo):
+            datos = resto + ''.join(payload[inicio:inicio + self.tamaño_trozo].split())
+            # Solo se decodifican grupos completos de 4 caracteres
+            corte = len(datos) - len(datos) % 4
+            resto = datos[corte:]
+            if corte:
+                yield binascii.a2b_base64(datos[:corte])
+        if resto:
+            # Igual que el paquete email: se completa el relleno que falte
+            yield binascii.a2b_base64(resto + '=' * (-len(resto) % 4))
+
+    def _decodificar_quoted_printable(self, payload):
+        resto = ''
+        for inicio in range(0, len(payload), self.tamaño_trozo):
+            datos = resto + payload[inicio:inicio + self.tamaño_trozo]
+            # Cortar en fin de línea para no partir una secuencia "=XX" o un salto suave
+            corte = datos.rfind('\n') + 1
+            resto = datos[corte:]
+            if corte:
+                yield binascii.a2b_qp(_a_bytes(datos[:corte]))
+        if resto:
+            yield binascii.a2b_qp(_a_bytes(resto))
+
+
+class AdjuntoStorageService:
+    """
+    Servicio para escribir adjuntos de correo en el almacenamiento.
+
+    Los adjuntos se guardan direccionados por contenido: un blob por SHA-256 y
+    tenant en adjuntos_correo/tenant_<id>/blobs/, compartido por todos los
+    ArchivoAdjunto que lo referencian y eliminado al desaparecer el último.
+    """
+
+    @staticmethod
+    def _storage():
+        return ArchivoAdjunto._meta.get_field('archivo').storage
+
+    @staticmethod
+    def ruta_temporal(tenant_id):
+        """Ruta de escritura mientras aún no se conoce el hash del contenido."""
+        return f'adjuntos_correo/tenant_{tenant_id}/blobs/tmp/{uuid.uuid4().hex}'
+
+    @staticmethod
+    def ruta_blob(tenant_id, hash_sha256):
+        """Ruta definitiva de un blob, repartida en subdirectorios por prefijo del hash."""
+        return f'adjuntos_correo/tenant_{tenant_id}/blobs/{hash_sha256[:2]}/{hash_sha256[2:4]}/{hash_sha256}'
+
+    @classmethod
+    def _mover(cls, origen, destino):
+        """Mueve un archivo dentro del almacenamiento sin volver a copiar su contenido si es posible."""
+        storage = cls._storage()
+        try:
+            ruta_origen, ruta_destino = storage.path(origen), storage.path(destino)
+        except NotImplementedError:
+            # Almacenamientos remotos: copiar y eliminar el original
+            with storage.open(origen) as archivo:
+                if not storage.exists(destino):
+                    storage.save(destino, archivo)
+            storage.delete(origen)
+            return
+
+        os.makedirs(os.path.dirname(ruta_destino), exist_ok=True)
+        os.replace(ruta_origen, ruta_destino)
+
+    @classmethod
+    @contextmanager
+    def transaccion(cls):
+        """
+        transaction.atomic que además borra los archivos de los blobs creados
+        dentro si la transacción se revierte: su BlobAdjunto no llega a existir
+        y nada más los limpiaría (los borrados, en cambio, esperan al commit en
+        la señal post_delete). Devuelve la lista que se pasa a guardar(nuevos=...).
+
+        Uso:
+            with AdjuntoStorageService.transaccion() as nuevos:
+                AdjuntoStorageService.guardar(tenant_id, parte, nombre, nuevos=nuevos)
+        """
+        nuevos = []
+        try:
+            with transaction.atomic():
+                yield nuevos
+        except Exception:
+            for nombre in nuevos:
+                cls.eliminar_archivo_blob(nombre)
+            raise
+
+    @classmethod
+    def guardar(cls, tenant_id, parte, nombre_archivo, nuevos=None):
+        """
+        Decodifica un adjunto por trozos y lo asocia al blob de su contenido.
+
+        El contenido se escribe una sola vez en una ruta temporal mientras se
+        calcula su SHA-256; si el tenant ya tiene ese blob la copia se descarta,
+        si no se mueve a su ruta definitiva y se crea el BlobAdjunto. El conteo de
+        referencias lo incrementa quien crea los ArchivoAdjunto (ver
+        registrar_referencias).
+
+        Args:
+            tenant_id: ID del tenant propietario
+            parte: Parte MIME (email.message.Message) del adjunto
+            nombre_archivo: Nombre decodificado del archivo
+            nuevos: Lista de transaccion() donde se anotan los blobs creados,
+                para borrar su archivo si la transacción se revierte
+
+        Returns:
+            dict: {'blob': BlobAdjunto, 'archivo': nombre en el almacenamiento,
+            'tamaño': bytes decodificados, 'hash_sha256': resumen hexadecimal,
+            'nuevo': True si el contenido no existía para el tenant}
+        """
+        storage = cls._storage()
+        contenido = ArchivoAdjuntoStream(parte, nombre_archivo)
+        temporal = storage.save(cls.ruta_temporal(tenant_id), contenido)
+
+        if not contenido.consumido:
+            # Backends que no leen por chunks(): el tamaño y el hash no son fiables
+            logger.warning(f"El almacenamiento no consumió el adjunto '{nombre_archivo}' por trozos")
+
+        hash_sha256 = contenido.hash.hexdigest()
+        try:
+            blob = BlobAdjunto.objects.filter(tenant_id=tenant_id, hash_sha256=hash_sha256).first()
+        except Exception:
+            storage.delete(temporal)
+            raise
+
+        if blob is not None and storage.exists(blob.archivo.name):
+            storage.delete(temporal)
+            nuevo = False
+        else:
+            ruta = cls.ruta_blob(tenant_id, hash_sha256)
+            cls._mover(temporal, ruta)
+            try:
+                blob, nuevo = BlobAdjunto.objects.get_or_create(
+                    tenant_id=tenant_id,
+                    hash_sha256=hash_sha256,
+                    defaults={'archivo': ruta, 'tamaño': contenido.tamaño}
+                )
+            except Exception:
+                if blob is None:
+                    cls.eliminar_archivo_blob(ruta)
+                raise
+            if nuevo and nuevos is not None:
+                nuevos.append(ruta)
+
+        return {
+            'blob': blob,
+            'archivo': blob.archivo.name,
+            'tamaño': contenido.tamaño,
+            'hash_sha256': hash_sha256,
+            'nuevo': nuevo,
+        }
+
+    @staticmethod
+    def registrar_referencias(adjuntos):
+        """
+        Incrementa el conteo de referencias de los blobs usados por nuevos ArchivoAdjunto.
+        Agrupa los blobs por número de referencias para usar pocas consultas UPDATE.
+        """
+        por_blob = Counter(adjunto.blob_id for adjunto in adjuntos if adjunto.blob_id)
+        por_cantidad = {}
+        for blob_id, cantidad in por_blob.items():
+            por_cantidad.setdefault(cantidad, []).append(blob_id)
+
+        for cantidad, blob_ids in por_cantidad.items():
+            BlobAdjunto.objects.filter(id__in=blob_ids).update(referencias=F('referencias') + cantidad)
+
+    @staticmethod
+    def liberar_referencia(blob_id):
+        """
+        Descuenta una referencia de un blob y lo elimina si ya no tiene ninguna.
+        El archivo físico se borra al confirmar la transacción (señal post_delete).
+        """
+        with transaction.atomic():
+            BlobAdjunto.objects.filter(id=blob_id, referencias__gt=0).update(referencias=F('referencias') - 1)
+            for blob in BlobAdjunto.objects.filter(id=blob_id, referencias=0):
+                try:
+                    blob.delete()
+                except RestrictedError:
+                    # El conteo quedó desfasado: aún hay adjuntos que lo usan
+                    logger.warning(f"Blob {blob.hash_sha256} sin referencias contadas pero aún en uso")
+
+    @classmethod
+    def eliminar_archivo_blob(cls, nombre):
+        """Elimina el archivo físico de un blob ya borrado de la base de datos."""
+        try:
+            cls._storage().delete(nombre)
+        except Exception as e:
+            logger.error(f"Error al eliminar el archivo del blob {nombre}: {str(e)}")
@@ -0,0 +1,96 @@
+"""
+Búsqueda simultánea de múltiples subcadenas (Aho-Corasick).
+
+Se usa el autómata en C de pyahocorasick si está instalado y, si no, una
+implementación en Python puro con la misma interfaz.
+"""
+
+from collections import deque
+
+try:
+    import ahocorasick
+except ImportError:  # pragma: no cover - depende del entorno
+    ahocorasick = None
+
+
+class AutomataPython:
+    """Autómata de Aho-Corasick en Python puro."""
+
+    def __init__(self, patrones):
+        """
+        Args:
+            patrones: Diccionario {patrón: clave}; los patrones no pueden ser vacíos
+        """
+        self.transiciones = [{}]
+        self.fallos = [0]
+        self.salidas = [frozenset()]
+
+        salidas = [set()]
+        for patron, clave in patrones.items():
+            nodo = 0
+            for caracter in patron:
+                siguiente = self.transiciones[nodo].get(caracter)
+                if siguiente is None:
+                    siguiente = len(self.transiciones)
+                    self.transiciones[nodo][caracter] = siguiente
+                    self.transiciones.append({})
+                    self.fallos.append(0)
+                    salidas.append(set())
+                nodo = siguiente
+            salidas[nodo].add(clave)
+
+        # Enlaces de fallo por recorrido en anchura; cada nodo hereda las salidas de su fallo
+        cola = deque(self.transiciones[0].values())
+        while cola:
+            nodo = cola.popleft()
+            for caracter, hijo in self.transiciones[nodo].items():
+                cola.append(hijo)
+                fallo = self.fallos[nodo]
+                while fallo and caracter not in self.transiciones[fallo]:
+                    fallo = self.fallos[fallo]
+                destino = self.transiciones[fallo].get(caracter, 0)
+                self.fallos[hijo] = destino if destino != hijo else 0
+                salidas[hijo] |= salidas[self.fallos[hijo]]
+
+        self.salidas = [frozenset(salida) for salida in salidas]
+        self.total = len(set(patrones.values()))
+
+    def buscar(self, texto):
+        """Devuelve el conjunto de claves cuyos patrones aparecen en el texto."""
+        transiciones, fallos, salidas = self.transiciones, self.fallos, self.salidas
+        encontrados = set()
+        nodo = 0
+        for caracter in texto:
+            while nodo and caracter not in transiciones[nodo]:
+                nodo = fallos[nodo]
+            nodo = transiciones[nodo].get(caracter, 0)
+            if salidas[nodo]:
+                encontrados |= salidas[nodo]
+                if len(encontrados) == self.total:
+                    break
+        return encontrados
+
+
+class AutomataC:
+    """Adaptador de pyahocorasick con la interfaz de AutomataPython."""
+
+    def __init__(self, patrones):
+        self.automata = ahocorasick.Automaton()
+        for patron, clave in patrones.items():
+            self.automata.add_word(patron, clave)
+        self.automata.make_automaton()
+
+    def buscar(self, texto):
+        return {clave for _, clave in self.automata.iter(texto)}
+
+
+def construir_automata(patrones):
+    """
+    Construye el autómata para los patrones dados.
+
+    Args:
+        patrones: Diccionario {patrón no vacío: clave}
+    """
+    if ahocorasick is not None:
+        return AutomataC(patrones)
+    return AutomataPython(patrones)
@@ -0,0 +1,279 @@
+"""
+Backtest de reglas de filtrado sobre el histórico de correos de un servicio.
+
+Reproduce un conjunto candidato de reglas contra los correos de los últimos N
+días y lo compara con la acción que se aplicó realmente al ingerirlos. Los
+correos se leen por trozos con values()/iterator() (sin instanciar modelos) y
+cada trozo se evalúa con el motor compilado en un pool de procesos; cada
+proceso compila las reglas una sola vez.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from django.db import connections
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ArchivoAdjunto, CorreoIngesta, HistorialAplicacionRegla, ReglaFiltrado
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_motor_service import MotorReglas, ReglaMotorService, RegistroPatrones
+
+logger = logging.getLogger(__name__)
+
+CAMPOS_CORREO = ('id', 'remitente', 'destinatarios', 'asunto', 'contenido_plano', 'fecha_recepcion')
+CAMPOS_REGLA = (
+    'id', 'nombre', 'prioridad', 'accion', 'es_compuesta', 'operador_logico',
+    'campo', 'condicion', 'valor', 'fecha_inicio', 'fecha_fin',
+)
+
+# Motor del proceso trabajador, compilado una vez en _inicializar_trabajador
+_motor = None
+_ahora = None
+
+
+def _compilar(especificacion):
+    """Reconstruye y compila las reglas a partir de su especificación serializable."""
+    registro = RegistroPatrones()
+    compiladas = []
+    for datos, condiciones in especificacion:
+        regla = ReglaFiltrado(**datos)
+        condiciones = [SimpleNamespace(**condicion) for condicion in condiciones]
+        compiladas.append(ReglaMotorService.compilar_regla(regla, condiciones, registro=registro))
+    return MotorReglas(compiladas, registro=registro)
+
+
+def _inicializar_trabajador(especificacion, ahora):
+    global _motor, _ahora
+    _motor = _compilar(especificacion)
+    _ahora = ahora
+
+
+def _evaluar_trozo(trozo, max_muestra):
+    """
+    Evalúa un trozo de correos con el motor del proceso.
+
+    Args:
+        trozo: Lista de tuplas (fila de CorreoIngesta, adjuntos, acción anterior)
+
+    Returns:
+        dict: Contadores parciales que BacktestReglasService combina
+    """
+    coincidencias = Counter()
+    primeras = Counter()
+    transiciones = Counter()
+    muestra = []
+    for fila, adjuntos, accion_anterior in trozo:
+        instantanea = InstantaneaCorreo.construir(
+            remitente=fila['remitente'],
+            asunto=fila['asunto'],
+            contenido=fila['contenido_plano'],
+            destinatarios=fila['destinatarios'],
+            fecha_recepcion=fila['fecha_recepcion'],
+            adjuntos=adjuntos,
+            correo_id=fila['id'],
+        )
+        cumplen = _motor.coincidencias(instantanea, _ahora)
+        for regla in cumplen:
+            coincidencias[regla.id] += 1
+
+        primera = cumplen[0] if cumplen else None
+        primeras[primera.id if primera else None] += 1
+
+        accion_nueva = primera.accion if primera else None
+        if accion_nueva != accion_anterior:
+            transiciones[(accion_anterior, accion_nueva)] += 1
+            if len(muestra) < max_muestra:
+                muestra.append({
+                    'correo_id': fila['id'],
+                    'asunto': fila['asunto'],
+                    'accion_anterior': accion_anterior,
+                    'accion_nueva': accion_nueva,
+                    'regla_id': primera.id if primera else None,
+                })
+    return {
+        'correos': len(trozo),
+        'coincidencias': coincidencias,
+        'primeras': primeras,
+        'transiciones': transiciones,
+        'muestra': muestra,
+    }
+
+
+class BacktestReglasService:
+    """Reproduce un conjunto de reglas contra el histórico de correos de un servicio."""
+
+    @staticmethod
+    def reglas_candidatas(servicio_id, incluir=None, excluir=None):
+        """
+        Reglas activas del servicio más las indicadas en incluir (p. ej. borradores
+        inactivos) y menos las de excluir, en orden de prioridad.
+        """
+        filtro = ReglaFiltrado.objects.filter(servicio_id=servicio_id)
+        reglas = filtro.filter(activa=True)
+        if incluir:
+            reglas = reglas | filtro.filter(id__in=incluir)
+        if excluir:
+            reglas = reglas.exclude(id__in=excluir)
+        return list(reglas.order_by('prioridad', 'id').prefetch_related('condiciones'))
+
+    @staticmethod
+    def _especificacion(reglas):
+        """Datos primitivos de las reglas y sus condiciones, serializables para el pool."""
+        especificacion = []
+        for regla in reglas:
+            condiciones = []
+            if regla.es_compuesta:
+                condiciones = [
+                    {'campo': c.campo, 'condicion': c.condicion, 'valor': c.valor, 'orden': c.orden}
+                    for c in sorted(regla.condiciones.all(), key=lambda c: c.orden)
+                ]
+            especificacion.append(({campo: getattr(regla, campo) for campo in CAMPOS_REGLA}, condiciones))
+        return especificacion
+
+    @staticmethod
+    def _leer_trozos(servicio_id, desde, tamaño_trozo):
+        """
+        Genera trozos de (fila, adjuntos, acción anterior) en orden de id.
+
+        Los correos se recorren con un cursor de servidor (iterator) y, por
+        trozo, los adjuntos y la acción aplicada en la ingesta se leen con una
+        consulta por los id del trozo cada una: un rango de id traería también
+        los de otros servicios, intercalados en la misma tabla. Los ignorados
+        por el prefiltro IMAP no tienen cuerpo ni destinatarios y quedan fuera.
+        """
+        filas = (
+            CorreoIngesta.objects
+            .filter(servicio_id=servicio_id, fecha_recepcion__gte=desde, prefiltro_imap=False)
+            .order_by('id')
+            .values(*CAMPOS_CORREO)
+            .iterator(chunk_size=tamaño_trozo)
+        )
+        acciones_validas = set(ReglaFiltrado.TipoAccion.values)
+        while True:
+            trozo = list(itertools.islice(filas, tamaño_trozo))
+            if not trozo:
+                return
+            ids = [fila['id'] for fila in trozo]
+
+            adjuntos = {}
+            for correo_id, nombre, tipo, tamaño in ArchivoAdjunto.objects.filter(
+                correo_id__in=ids
+            ).values_list('correo_id', 'nombre_archivo', 'tipo_contenido', 'tamaño'):
+                adjuntos.setdefault(correo_id, []).append((nombre, tipo, tamaño))
+
+            # Última acción aplicada por la ingesta; el probador de reglas guarda
+            # textos descriptivos en accion_ejecutada y se descartan
+            acciones = {}
+            for correo_id, accion in HistorialAplicacionRegla.objects.filter(
+                correo_id__in=ids, resultado=True
+            ).order_by('fecha_aplicacion', 'id').values_list('correo_id', 'accion_ejecutada'):
+                if accion in acciones_validas:
+                    acciones[correo_id] = accion
+
+            yield [(fila, adjuntos.get(fila['id'], []), acciones.get(fila['id'])) for fila in trozo]
+
+    @classmethod
+    def ejecutar(cls, servicio_id, dias=30, incluir=None, excluir=None, procesos=None,
+                 tamaño_trozo=2000, max_muestra=100):
+        """
+        Ejecuta el backtest.
+
+        Args:
+            servicio_id: ID del ServicioIngesta
+            dias: Antigüedad máxima (días) de los correos reproducidos
+            incluir: IDs de reglas a añadir a las activas (p. ej. inactivas en prueba)
+            excluir: IDs de reglas activas a quitar
+            procesos: Procesos del pool; 1 evalúa en el proceso actual. Por
+                defecto uno por CPU
+            tamaño_trozo: Correos leídos y enviados al pool por trozo
+            max_muestra: Máximo de correos con cambio de acción listados
+
+        Returns:
+            dict: Informe serializable a JSON con las coincidencias por regla,
+            la distribución de la primera coincidencia y los cambios de acción
+        """
+        inicio = time.perf_counter()
+        ahora = timezone.now()
+        desde = ahora - timezone.timedelta(days=dias)
+        reglas = cls.reglas_candidatas(servicio_id, incluir, excluir)
+        especificacion = cls._especificacion(reglas)
+
+        if procesos is None:
+            procesos = os.cpu_count() or 1
+        if procesos > 1 and multiprocessing.current_process().daemon:
+            # Los workers prefork de Celery son daemon y no pueden crear procesos hijos
+            logger.warning("Backtest de reglas en un proceso daemon: se evalúa sin pool de procesos")
+            procesos = 1
+
+        total = {'correos': 0, 'coincidencias': Counter(), 'primeras': Counter(),
+                 'transiciones': Counter(), 'muestra': []}
+
+        def acumular(parcial):
+            total['correos'] += parcial['correos']
+            for clave in ('coincidencias', 'primeras', 'transiciones'):
+                total[clave].update(parcial[clave])
+            espacio = max_muestra - len(total['muestra'])
+            total['muestra'].extend(parcial['muestra'][:espacio])
+
+        trozos = cls._leer_trozos(servicio_id, desde, tamaño_trozo)
+        if procesos <= 1:
+            _inicializar_trabajador(especificacion, ahora)
+            for trozo in trozos:
+                acumular(_evaluar_trozo(trozo, max_muestra))
+        else:
+            # fork: los hijos heredan Django ya configurado. Se crean todos antes de
+            # abrir el cursor de lectura para que no hereden ninguna conexión abierta
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=procesos, mp_context=multiprocessing.get_context('fork'),
+                initializer=_inicializar_trabajador, initargs=(especificacion, ahora)
+            ) as pool:
+                pool.submit(int).result()
+                # Como mucho dos trozos en cola por proceso para acotar la memoria
+                pendientes = []
+                for trozo in trozos:
+                    pendientes.append(pool.submit(_evaluar_trozo, trozo, max_muestra))
+                    if len(pendientes) >= procesos * 2:
+                        acumular(pendientes.pop(0).result())
+                for futuro in pendientes:
+                    acumular(futuro.result())
+
+        segundos = time.perf_counter() - inicio
+        logger.info(
+            f"Backtest de {len(reglas)} reglas sobre {total['correos']} correos del servicio "
+            f"{servicio_id} en {segundos:.1f}s"
+        )
+        return {
+            'servicio_id': servicio_id,
+            'dias': dias,
+            'correos_evaluados': total['correos'],
+            'segundos': round(segundos, 2),
+            'procesos': procesos,
+            'reglas': [
+                {
+                    'id': regla.id,
+                    'nombre': regla.nombre,
+                    'prioridad': regla.prioridad,
+                    'accion': regla.accion,
+                    'activa': regla.activa,
+                    'coincidencias': total['coincidencias'][regla.id],
+                    'primera_coincidencia': total['primeras'][regla.id],
+                }
+                for regla in reglas
+            ],
+            'sin_coincidencia': total['primeras'][None],
+            'cambios': {
+                'total': sum(total['transiciones'].values()),
+                'transiciones': [
+                    {'accion_anterior': anterior, 'accion_nueva': nueva, 'correos': correos}
+                    for (anterior, nueva), correos in total['transiciones'].most_common()
+                ],
+                'muestra': total['muestra'],
+            },
+        }
@@ -0,0 +1,88 @@
+"""
+Cancelación cooperativa de ejecuciones de ingesta.
+
+Cancelar una ejecución no mata el worker: se marca
+ServicioIngesta.cancelacion_solicitada y la ejecución consulta su
+TokenCancelacion entre etapas (antes de pedir el siguiente lote, entre los
+mensajes que parsea y antes de persistir el lote, que es donde se aplican las
+reglas). Al verla lanza IngestaCancelada: lo ya persistido queda guardado, el
+lote a medias no avanza el punto de control, la conexión IMAP/POP3 se cierra
+de forma ordenada y el historial queda CANCELADO. La marca se limpia al
+liberar el cupo de la ejecución.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.lease_ingesta_service import LeaseIngesta
+
+logger = logging.getLogger(__name__)
+
+# Segundos mínimos entre consultas de la marca: el token se comprueba por mensaje
+INTERVALO_CONSULTA = getattr(settings, 'INGESTA_CANCELACION_CONSULTA_SEGUNDOS', 2)
+
+
+class IngestaCancelada(Exception):
+    """La ejecución se detuvo porque se solicitó su cancelación."""
+
+
+class TokenCancelacion:
+    """
+    Token que una ejecución comprueba entre etapas.
+
+    Uso:
+        token = TokenCancelacion(servicio_id)
+        for lote in lotes:
+            token.comprobar()
+            ...
+    """
+
+    def __init__(self, servicio_id, intervalo=None):
+        self.servicio_id = servicio_id
+        self.intervalo = INTERVALO_CONSULTA if intervalo is None else intervalo
+        self.consultado = None
+        self.cancelado = False
+
+    def solicitada(self):
+        """Si se pidió cancelar la ejecución (consulta la base como mucho cada intervalo)."""
+        if self.cancelado:
+            return True
+        ahora = time.monotonic()
+        if self.consultado is not None and ahora - self.consultado < self.intervalo:
+            return False
+        self.consultado = ahora
+        self.cancelado = ServicioIngesta.objects.filter(
+            id=self.servicio_id, cancelacion_solicitada__isnull=False
+        ).exists()
+        return self.cancelado
+
+    def comprobar(self):
+        """
+        Raises:
+            IngestaCancelada: Si se pidió cancelar la ejecución
+        """
+        if self.solicitada():
+            raise IngestaCancelada(f"Ejecución del servicio {self.servicio_id} cancelada")
+
+    @staticmethod
+    def solicitar(servicio_id, ahora):
+        """
+        Marca la cancelación si el servicio tiene una ejecución viva: con el
+        lease vigente o despachada con la reserva aún vigente. en_ejecucion no
+        sirve, porque queda en True si el worker muere, y una marca sin
+        ejecución que la atienda cancelaría la siguiente ejecución programada.
+
+        Returns:
+            bool: Si había una ejecución que cancelar
+        """
+        # Importación local: el despacho depende del planificador, que depende de este módulo
+        from apps.ingesta_correo.services.despacho_ingesta_service import RESERVA_MAXIMA
+
+        if servicio_id in LeaseIngesta.vigentes([servicio_id]):
+            servicios = ServicioIngesta.objects.filter(id=servicio_id)
+        else:
+            servicios = ServicioIngesta.objects.filter(id=servicio_id, despachado_en__gt=ahora - RESERVA_MAXIMA)
+        return servicios.update(cancelacion_solicitada=ahora) == 1
@@ -0,0 +1,116 @@
+import logging
+import os
+from email.header import decode_header, make_header
+from email.utils import parsedate_to_datetime
+
+from django.utils import timezone
+
+from apps.ingesta_correo.models import CorreoIngesta
+
+logger = logging.getLogger(__name__)
+
+
+class CorreoParserService:
+    """Servicio para convertir mensajes de correo en datos listos para persistir."""
+
+    @staticmethod
+    def normalizar_mensaje_id(valor, respaldo):
+        """
+        Message-ID tal como se guarda en CorreoIngesta: sin espacios y recortado
+        a la longitud de la columna. Se aplica una sola vez, al leer la cabecera,
+        para que la deduplicación y los mapas de UID/número por Message-ID usen
+        la misma clave que la base de datos.
+        """
+        valor = (valor or '').strip() or respaldo
+        return valor[:CorreoIngesta._meta.get_field('mensaje_id').max_length]
+
+    @staticmethod
+    def decodificar_cabecera(valor):
+        """Decodifica una cabecera RFC 2047; devuelve cadena vacía si no existe."""
+        if not valor:
+            return ''
+        try:
+            return str(make_header(decode_header(valor)))
+        except Exception:
+            return str(valor)
+
+    @staticmethod
+    def obtener_fecha(valor):
+        """Convierte la cabecera Date en datetime con zona horaria."""
+        if not valor:
+            return timezone.now()
+        try:
+            fecha = parsedate_to_datetime(valor)
+        except (TypeError, ValueError):
+            return timezone.now()
+        if timezone.is_naive(fecha):
+            fecha = timezone.make_aware(fecha)
+        return fecha
+
+    @staticmethod
+    def _decodificar_texto(parte):
+        """Decodifica el cuerpo de texto de una parte usando su charset declarado."""
+        contenido = parte.get_payload(decode=True)
+        if contenido is None:
+            return ''
+        charset = parte.get_content_charset() or 'utf-8'
+        try:
+            return contenido.decode(charset, errors='replace')
+        except LookupError:
+            return contenido.decode('utf-8', errors='replace')
+
+    @classmethod
+    def parsear(cls, email_message, mensaje_id):
+        """
+        Extrae cabeceras, contenido y adjuntos de un mensaje.
+
+        Los adjuntos no se decodifican aquí: se conserva la parte MIME para que
+        la capa de persistencia la escriba directamente en el almacenamiento.
+
+        Args:
+            email_message: Objeto email.message.Message
+            mensaje_id: Identificador único del mensaje
+
+        Returns:
+            dict: Campos de CorreoIngesta más la lista 'adjuntos' con
+            {'nombre_archivo', 'tipo_contenido', 'parte'} y 'origen_imap' en
+            los adjuntos pendientes de descarga
+        """
+        contenido_plano = ''
+        contenido_html = ''
+        adjuntos = []
+
+        for parte in email_message.walk():
+            if parte.get_content_maintype() == 'multipart':
+                continue
+
+            nombre = parte.get_filename()
+            if nombre and parte.get('Content-Disposition'):
+                nombre = os.path.basename(cls.decodificar_cabecera(nombre))
+                if nombre:
+                    adjunto = {
+                        'nombre_archivo': nombre,
+                        'tipo_contenido': parte.get_content_type(),
+                        'parte': parte,
+                    }
+                    # Adjunto no descargado todavía (ver estructura_imap.construir_mensaje)
+                    if getattr(parte, 'origen_imap', None):
+                        adjunto['origen_imap'] = parte.origen_imap
+                    adjuntos.append(adjunto)
+                continue
+
+            if parte.get_content_type() == 'text/plain':
+                contenido_plano = cls._decodificar_texto(parte)
+            elif parte.get_content_type() == 'text/html':
+                contenido_html = cls._decodificar_texto(parte)
+
+        return {
+            'mensaje_id': mensaje_id,
+            'remitente': cls.decodificar_cabecera(email_message.get('From')),
+            'destinatarios': cls.decodificar_cabecera(email_message.get('To')),
+            'asunto': cls.decodificar_cabecera(email_message.get('Subject')),
+            'fecha_recepcion': cls.obtener_fecha(email_message.get('Date')),
+            'contenido_plano': contenido_plano,
+            'contenido_html': contenido_html,
+            'adjuntos': adjuntos,
+        }
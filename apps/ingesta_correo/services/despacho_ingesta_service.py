@@ -0,0 +1,281 @@
+"""
+Despacho de ejecuciones de ingesta con límites de concurrencia.
+
+check_scheduled_services ya no encola todos los servicios pendientes a la vez:
+el despacho reparte los cupos por servidor de correo (varios tenants suelen
+compartir proveedor y este limita las conexiones simultáneas) y por tenant, y
+alterna entre tenants para que uno con muchos servicios o un atraso grande
+no acapare los workers. Lo que no cabe se queda pendiente para el siguiente
+despacho, que también se lanza al terminar cada ejecución.
+
+Cada servicio despachado guarda despachado_en hasta que su ejecución termina;
+mientras tanto ocupa su cupo, y si el worker muere el cupo se libera al pasar
+RESERVA_MAXIMA. Las ejecuciones que no pasan por el despacho reservan su
+cupo al tomar el lease (ocupar), y un candidato con lease vigente
+(LeaseIngesta) cuenta como ocupado y no se vuelve a despachar.
+
+Cada despacho reclama sus candidatos con SELECT ... FOR UPDATE SKIP LOCKED y
+solo lee los servicios vencidos y los que tienen reserva, así que su costo no
+crece con el total de servicios. Dos despachos simultáneos toman candidatos
+distintos pero no ven las reservas del otro hasta que este confirma, así que
+pueden pasarse del cupo por un despacho; el lease impide que el mismo
+servicio se ejecute dos veces.
+
+Los turnos de cada servicio están desfasados dentro de su intervalo
+(turno_siguiente), y el despacho periódico mira un horizonte hacia delante:
+encola lo que vence antes del próximo despacho con un countdown hasta su
+turno, más un jitter aleatorio de hasta JITTER_SEGUNDOS. Así las ejecuciones
+no arrancan todas en el segundo en que dispara el beat. histograma_carga
+muestra cómo quedan repartidas las ejecuciones a lo largo del intervalo.
+"""
+
+import logging
+import math
+import random
+from collections import Counter, OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from apps.configuracion.models import EmailConfig
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.ingesta_scheduler_service import IngestaSchedulerService
+from apps.ingesta_correo.services.lease_ingesta_service import LeaseIngesta
+
+logger = logging.getLogger(__name__)
+
+MAX_POR_HOST = getattr(settings, 'INGESTA_MAX_POR_HOST', 4)
+MAX_POR_TENANT = getattr(settings, 'INGESTA_MAX_POR_TENANT', 1)
+RESERVA_MAXIMA = timezone.timedelta(minutes=getattr(settings, 'INGESTA_RESERVA_MAXIMA_MINUTOS', 30))
+JITTER_SEGUNDOS = getattr(settings, 'INGESTA_JITTER_SEGUNDOS', 15)
+
+Candidato = namedtuple('Candidato', ['servicio_id', 'tenant_id', 'host'])
+
+
+def normalizar_host(host):
+    return (host or '').strip().lower() or None
+
+
+def planificar(candidatos, ocupados=(), max_por_host=MAX_POR_HOST, max_por_tenant=MAX_POR_TENANT, limite=None):
+    """
+    Elige qué candidatos despachar sin superar los cupos, alternando entre tenants.
+
+    Args:
+        candidatos: Candidato en orden de espera (el que más espera primero)
+        ocupados: (tenant_id, host) de las ejecuciones despachadas que aún no terminan
+        max_por_host: Ejecuciones simultáneas por servidor de correo (None = sin límite)
+        max_por_tenant: Ejecuciones simultáneas por tenant (None = sin límite)
+        limite: Máximo de candidatos a elegir (None = todos los que quepan)
+
+    Returns:
+        list: Candidatos elegidos, en el orden en que deben encolarse
+    """
+    por_tenant = Counter(tenant_id for tenant_id, _ in ocupados)
+    por_host = Counter(host for _, host in ocupados if host)
+
+    # Cola de cada tenant; los tenants se atienden en el orden de su candidato más antiguo
+    colas = OrderedDict()
+    for candidato in candidatos:
+        colas.setdefault(candidato.tenant_id, []).append(candidato)
+
+    elegidos = []
+    while colas and (limite is None or len(elegidos) < limite):
+        # Una vuelta: como mucho un candidato por tenant
+        for tenant_id in list(colas):
+            if limite is not None and len(elegidos) >= limite:
+                break
+            cola = colas[tenant_id]
+            if max_por_tenant is not None and por_tenant[tenant_id] >= max_por_tenant:
+                del colas[tenant_id]
+                continue
+            while cola:
+                candidato = cola.pop(0)
+                if candidato.host and max_por_host is not None and por_host[candidato.host] >= max_por_host:
+                    continue
+                elegidos.append(candidato)
+                por_tenant[tenant_id] += 1
+                if candidato.host:
+                    por_host[candidato.host] += 1
+                break
+            if not cola:
+                del colas[tenant_id]
+    return elegidos
+
+
+class DespachoIngestaService:
+    """Servicio que decide qué ejecuciones de ingesta encolar según los cupos."""
+
+    @staticmethod
+    def ocupados(ahora=None):
+        """ServicioIngesta despachados cuya ejecución sigue en curso (o su reserva vigente)."""
+        ahora = ahora or timezone.now()
+        return ServicioIngesta.objects.filter(despachado_en__gt=ahora - RESERVA_MAXIMA)
+
+    @staticmethod
+    def hosts_por_tenant(tenant_ids):
+        return {
+            tenant_id: normalizar_host(host)
+            for tenant_id, host in EmailConfig.objects.filter(tenant_id__in=tenant_ids)
+            .values_list('tenant_id', 'server_host')
+        }
+
+    @staticmethod
+    def retraso(proxima, ahora, horizonte, jitter=JITTER_SEGUNDOS):
+        """
+        Segundos de espera antes de ejecutar un servicio despachado con
+        horizonte: hasta su turno (sin pasar del horizonte) más el jitter.
+        """
+        espera = 0.0
+        if proxima is not None:
+            espera = min(max((proxima - ahora).total_seconds(), 0.0), horizonte)
+        if jitter:
+            espera += random.uniform(0, jitter)
+        return round(espera, 1)
+
+    @classmethod
+    def despachar(cls, servicios=None, encolar=None, horizonte=None):
+        """
+        Encola los servicios pendientes que caben en los cupos.
+
+        Args:
+            servicios: QuerySet de ServicioIngesta candidatos (por defecto, los
+                pendientes según IngestaSchedulerService)
+            encolar: Función que recibe el ID de cada servicio elegido y los
+                segundos de espera (por defecto process_email_ingestion.apply_async
+                con countdown)
+            horizonte: Segundos hacia delante que cubre el despacho (el tiempo
+                hasta el siguiente). Con horizonte, los servicios que vencen
+                dentro de él se encolan con espera hasta su turno más jitter; sin
+                él, se encolan para ejecutarse ya
+
+        Returns:
+            list: IDs de los servicios despachados
+        """
+        ahora = timezone.now()
+        if servicios is None:
+            servicios = IngestaSchedulerService.verificar_servicios_pendientes(
+                ahora + timezone.timedelta(seconds=horizonte) if horizonte else ahora
+            )
+        if encolar is None:
+            from apps.ingesta_correo.tasks import process_email_ingestion
+
+            def encolar(servicio_id, retraso):
+                process_email_ingestion.apply_async(args=[servicio_id], countdown=retraso)
+
+        with transaction.atomic():
+            # Los candidatos se reclaman con SKIP LOCKED: un despacho concurrente
+            # se salta las filas que este ya tomó en lugar de esperar o repetirlas
+            pendientes = list(
+                servicios.select_for_update(skip_locked=True)
+                .filter(Q(despachado_en__isnull=True) | Q(despachado_en__lte=ahora - RESERVA_MAXIMA))
+                .order_by(F('proxima_ejecucion').asc(nulls_first=True), 'id')
+                .values_list('id', 'tenant_id', 'proxima_ejecucion')
+            )
+            if not pendientes:
+                return []
+            programadas = {servicio_id: proxima for servicio_id, _, proxima in pendientes}
+            pendientes = [(servicio_id, tenant_id) for servicio_id, tenant_id, _ in pendientes]
+
+            ocupados = list(cls.ocupados(ahora).values_list('id', 'tenant_id'))
+            # Candidatos que ya se están ejecutando sin reserva (una reserva vencida)
+            con_lease = LeaseIngesta.vigentes(servicio_id for servicio_id, _ in pendientes)
+            ocupados.extend(item for item in pendientes if item[0] in con_lease)
+            pendientes = [item for item in pendientes if item[0] not in con_lease]
+
+            hosts = cls.hosts_por_tenant({tenant_id for _, tenant_id in ocupados + pendientes})
+            elegidos = planificar(
+                [Candidato(servicio_id, tenant_id, hosts.get(tenant_id)) for servicio_id, tenant_id in pendientes],
+                [(tenant_id, hosts.get(tenant_id)) for _, tenant_id in ocupados],
+            )
+            ids = [candidato.servicio_id for candidato in elegidos]
+            ServicioIngesta.objects.filter(id__in=ids).update(despachado_en=ahora)
+
+        if len(ids) < len(pendientes):
+            logger.info(f"Despacho de ingesta: {len(ids)} de {len(pendientes)} servicios; el resto espera cupo")
+        for servicio_id in ids:
+            encolar(servicio_id, cls.retraso(programadas[servicio_id], ahora, horizonte) if horizonte else 0)
+        return ids
+
+    @staticmethod
+    def ocupar(servicio_id):
+        """
+        Reserva el cupo de una ejecución que no pasó por el despacho
+        (execute_ingestion_now); no cambia una reserva vigente.
+        """
+        ahora = timezone.now()
+        ServicioIngesta.objects.filter(
+            Q(despachado_en__isnull=True) | Q(despachado_en__lte=ahora - RESERVA_MAXIMA), id=servicio_id
+        ).update(despachado_en=ahora)
+
+    @staticmethod
+    def liberar(servicio_id):
+        """
+        Libera el cupo del servicio al terminar su ejecución, registra la hora
+        de fin como última ejecución, descarta una cancelación ya atendida y
+        programa la siguiente. Si la ejecución
+        dejó una continuación, el servicio queda vencido ya para que el
+        despacho la encole con los cupos.
+        """
+        fin = timezone.now()
+        inicio, continuacion = ServicioIngesta.objects.filter(id=servicio_id).values_list(
+            'despachado_en', 'continuacion'
+        ).first() or (None, None)
+        if continuacion:
+            programacion = {'proxima_ejecucion': fin}
+        else:
+            programacion = IngestaSchedulerService.programacion_siguiente(servicio_id, inicio or fin)
+        ServicioIngesta.objects.filter(id=servicio_id).update(
+            despachado_en=None, cancelacion_solicitada=None, ultima_ejecucion=fin, **programacion
+        )
+
+    @staticmethod
+    def histograma_carga(ventana_minutos=None, cubo_segundos=60, ahora=None):
+        """
+        Ejecuciones programadas por cubo de tiempo en la ventana siguiente,
+        proyectando los turnos de cada servicio activo a partir de su
+        proxima_ejecucion. Los servicios vencidos cuentan en el primer cubo.
+
+        Args:
+            ventana_minutos: Duración de la ventana (por defecto, el mayor
+                intervalo efectivo entre los servicios activos)
+            cubo_segundos: Ancho de cada cubo del histograma
+
+        Returns:
+            dict: inicio, cubo_segundos, cubos (ejecuciones por cubo), servicios,
+                maximo, media y pico_relativo (maximo / media)
+        """
+        ahora = ahora or timezone.now()
+        servicios = list(ServicioIngesta.objects.filter(activo=True).only(
+            'proxima_ejecucion', 'intervalo_minutos', 'intervalo_adaptativo',
+            'intervalo_minimo_minutos', 'intervalo_maximo_minutos', 'intervalo_actual_minutos',
+        ))
+        if ventana_minutos is None:
+            ventana_minutos = max((max(1, servicio.intervalo_efectivo or 1) for servicio in servicios), default=15)
+        fin = ahora + timezone.timedelta(minutes=ventana_minutos)
+        cubos = [0] * max(1, math.ceil(ventana_minutos * 60 / cubo_segundos))
+
+        for servicio in servicios:
+            # Un intervalo no positivo (sin validación en el modelo) no debe colgar la proyección
+            intervalo = timezone.timedelta(minutes=max(1, servicio.intervalo_efectivo or 1))
+            turno = max(servicio.proxima_ejecucion or ahora, ahora)
+            while turno < fin:
+                cubos[int((turno - ahora).total_seconds() // cubo_segundos)] += 1
+                turno += intervalo
+
+        media = sum(cubos) / len(cubos)
+        return {
+            'inicio': ahora,
+            'cubo_segundos': cubo_segundos,
+            'cubos': cubos,
+            'servicios': len(servicios),
+            'maximo': max(cubos),
+            'media': round(media, 2),
+            'pico_relativo': round(max(cubos) / media, 2) if media else 0,
+        }
+
+    @staticmethod
+    def en_espera():
+        """Si hay servicios pendientes esperando cupo (para relanzar el despacho al liberar uno)."""
+        return IngestaSchedulerService.verificar_servicios_pendientes().filter(despachado_en__isnull=True).exists()
@@ -0,0 +1,318 @@
+"""
+BODYSTRUCTURE de IMAP y reconstrucción de mensajes descargados por partes.
+
+La ingesta lee primero la estructura MIME de cada mensaje y descarga solo las
+partes de texto y los adjuntos relevantes para la extracción de glosas
+(BODY.PEEK[n]); el resto de adjuntos queda registrado con su sección para
+descargarlo cuando se abra. Con las partes descargadas se arma un
+email.message.Message equivalente al del mensaje completo, de modo que
+CorreoParserService lo procese sin cambios.
+"""
+
+import os
+import re
+from email.message import Message
+from email.parser import BytesHeaderParser
+
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+
+TIPOS_TEXTO = ('text/plain', 'text/html')
+# Adjuntos con posibles glosas: se descargan durante la ingesta
+TIPOS_ADJUNTO_RELEVANTES = {
+    'application/pdf',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/xml',
+    'text/xml',
+    'text/csv',
+    'text/plain',
+    'application/zip',
+    'application/x-zip-compressed',
+}
+EXTENSIONES_ADJUNTO_RELEVANTES = {
+    '.pdf', '.xls', '.xlsx', '.xlsm', '.doc', '.docx', '.xml', '.csv', '.txt', '.zip', '.json',
+}
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+SECCION_RE = re.compile(rb'BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$')
+UID_RE = re.compile(rb'UID (\d+)')
+INICIO_MENSAJE_RE = re.compile(rb'^\s*\d+ \(')
+TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.S)
+
+
+class ParteImap:
+    """Parte hoja de un BODYSTRUCTURE."""
+
+    __slots__ = ('seccion', 'tipo', 'parametros', 'codificacion', 'tamaño', 'disposicion', 'parametros_disposicion')
+
+    def __init__(self, seccion, tipo, parametros, codificacion, tamaño, disposicion=None, parametros_disposicion=None):
+        self.seccion = seccion
+        self.tipo = tipo
+        self.parametros = parametros
+        self.codificacion = codificacion
+        self.tamaño = tamaño
+        self.disposicion = disposicion
+        self.parametros_disposicion = parametros_disposicion or {}
+
+    @property
+    def tamaño_decodificado(self):
+        """Tamaño aproximado del contenido decodificado (BODYSTRUCTURE informa el codificado)."""
+        if self.codificacion == 'base64':
+            # 76 caracteres y CRLF por línea, 3 bytes por cada 4 caracteres
+            return self.tamaño * 76 // 78 * 3 // 4
+        return self.tamaño
+
+    def cabeceras(self):
+        """Cabeceras MIME de la parte tal como aparecerían en el mensaje."""
+        parte = Message()
+        parte['Content-Type'] = _con_parametros(self.tipo, self.parametros)
+        if self.codificacion:
+            parte['Content-Transfer-Encoding'] = self.codificacion
+        if self.disposicion:
+            parte['Content-Disposition'] = _con_parametros(self.disposicion, self.parametros_disposicion)
+        return parte
+
+    def __repr__(self):
+        return f'ParteImap({self.seccion!r}, {self.tipo!r}, {self.tamaño})'
+
+
+def _con_parametros(valor, parametros):
+    for clave, dato in parametros.items():
+        valor += f'; {clave}="' + dato.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return valor
+
+
+def unir_fragmentos(fragmentos):
+    """
+    Une los fragmentos de imaplib de una respuesta en un solo texto.
+
+    Los literales {n} se convierten en cadenas entre comillas para que la
+    respuesta se pueda tokenizar de una vez.
+    """
+    texto = b''
+    for fragmento in fragmentos:
+        if isinstance(fragmento, tuple):
+            cabecera, literal = fragmento
+            cabecera = LITERAL_RE.sub(b'', cabecera.rstrip())
+            literal = (literal or b'').replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            texto += cabecera + b'"' + literal + b'"'
+        elif fragmento:
+            texto += fragmento
+    return texto.decode('utf-8', errors='replace')
+
+
+def agrupar_por_mensaje(data):
+    """Separa la respuesta de un UID FETCH en la lista de fragmentos de cada mensaje."""
+    mensajes = []
+    for item in data or []:
+        inicio = item[0] if isinstance(item, tuple) else item
+        if isinstance(inicio, bytes) and INICIO_MENSAJE_RE.match(inicio) or not mensajes:
+            mensajes.append([])
+        mensajes[-1].append(item)
+    return mensajes
+
+
+def parsear_lista(texto):
+    """
+    Convierte una lista parentizada de IMAP en listas de Python.
+    NIL se convierte en None; átomos y cadenas quedan como str.
+    """
+    pila = [[]]
+    for abre, cierra, cadena, atomo in TOKEN_RE.findall(texto):
+        if abre:
+            pila.append([])
+        elif cierra:
+            if len(pila) == 1:
+                break
+            lista = pila.pop()
+            pila[-1].append(lista)
+        elif atomo:
+            pila[-1].append(None if atomo.upper() == 'NIL' else atomo)
+        else:
+            pila[-1].append(re.sub(r'\\(.)', r'\1', cadena))
+    while len(pila) > 1:
+        lista = pila.pop()
+        pila[-1].append(lista)
+    return pila[0]
+
+
+def _parametros(lista):
+    if not isinstance(lista, list):
+        return {}
+    return {
+        str(lista[i]).lower(): str(lista[i + 1] or '')
+        for i in range(0, len(lista) - 1, 2)
+        if lista[i] is not None
+    }
+
+
+def partes_hoja(estructura, seccion=''):
+    """
+    Partes hoja de un BODYSTRUCTURE ya convertido con parsear_lista, con su
+    número de sección ('1', '2.1', ...). Un mensaje sin partes tiene la sección 1.
+    """
+    if estructura and isinstance(estructura[0], list):
+        # Las partes de un multipart preceden al subtipo y las extensiones
+        partes = []
+        indice = 0
+        for hijo in estructura:
+            if not isinstance(hijo, list):
+                break
+            indice += 1
+            partes.extend(partes_hoja(hijo, f'{seccion}.{indice}' if seccion else str(indice)))
+        return partes
+
+    tipo = f'{estructura[0]}/{estructura[1]}'.lower()
+    codificacion = (estructura[5] or '').lower() if len(estructura) > 5 else ''
+    try:
+        tamaño = int(estructura[6] or 0)
+    except (IndexError, TypeError, ValueError):
+        tamaño = 0
+
+    # Extensiones: md5 y disposición, tras los campos propios de text y message/rfc822
+    if tipo.startswith('text/'):
+        indice_disposicion = 9
+    elif tipo == 'message/rfc822':
+        indice_disposicion = 11
+    else:
+        indice_disposicion = 8
+    disposicion, parametros_disposicion = None, {}
+    if len(estructura) > indice_disposicion and isinstance(estructura[indice_disposicion], list):
+        datos = estructura[indice_disposicion]
+        disposicion = str(datos[0]).lower() if datos and datos[0] else None
+        parametros_disposicion = _parametros(datos[1] if len(datos) > 1 else None)
+
+    return [ParteImap(
+        seccion or '1', tipo, _parametros(estructura[2]), codificacion, tamaño, disposicion, parametros_disposicion
+    )]
+
+
+def estructuras_por_mensaje(data):
+    """
+    Extrae el BODYSTRUCTURE de cada mensaje de la respuesta a un UID FETCH (BODYSTRUCTURE).
+
+    Returns:
+        dict: {uid: lista de ParteImap}; los mensajes con una estructura que no
+        se pudo interpretar se omiten
+    """
+    estructuras = {}
+    for fragmentos in agrupar_por_mensaje(data):
+        texto = unir_fragmentos(fragmentos)
+        # "n (UID u BODYSTRUCTURE (...))": se descarta el número de secuencia
+        elementos = parsear_lista(texto[texto.find('('):])
+        if not elementos or not isinstance(elementos[0], list):
+            continue
+        datos = elementos[0]
+        pares = dict(zip(
+            (str(clave).upper() if isinstance(clave, str) else clave for clave in datos[::2]),
+            datos[1::2],
+        ))
+        try:
+            uid = int(pares['UID'])
+            partes = partes_hoja(pares['BODYSTRUCTURE'])
+        except (KeyError, TypeError, ValueError, IndexError):
+            continue
+        if partes:
+            estructuras[uid] = partes
+    return estructuras
+
+
+def secciones_por_mensaje(data):
+    """
+    Extrae las secciones descargadas de cada mensaje de la respuesta a un
+    UID FETCH con varios BODY.PEEK[...].
+
+    Returns:
+        dict: {uid: {seccion: bytes}}
+    """
+    resultado = {}
+    for fragmentos in agrupar_por_mensaje(data):
+        metadatos = b''
+        secciones = {}
+        for fragmento in fragmentos:
+            if isinstance(fragmento, tuple):
+                metadatos += b' ' + fragmento[0]
+                seccion = SECCION_RE.search(fragmento[0])
+                if seccion:
+                    secciones[seccion.group(1).decode('ascii', errors='replace').upper()] = fragmento[1] or b''
+            elif fragmento:
+                metadatos += b' ' + fragmento
+        uid = UID_RE.search(metadatos)
+        if uid:
+            resultado[int(uid.group(1))] = secciones
+    return resultado
+
+
+def es_adjunto(parte):
+    """Misma regla que CorreoParserService: parte con nombre de archivo y Content-Disposition."""
+    return bool(parte.disposicion and parte.cabeceras().get_filename())
+
+
+def es_relevante(parte):
+    """Si un adjunto puede contener glosas y debe descargarse durante la ingesta."""
+    if parte.tipo in TIPOS_ADJUNTO_RELEVANTES:
+        return True
+    nombre = CorreoParserService.decodificar_cabecera(parte.cabeceras().get_filename())
+    return os.path.splitext(nombre)[1].lower() in EXTENSIONES_ADJUNTO_RELEVANTES
+
+
+def plan_descarga(partes):
+    """
+    Secciones a descargar de un mensaje, o None si conviene descargarlo completo:
+    cuando no hay ningún adjunto que diferir o contiene mensajes anidados
+    (message/rfc822), cuyos adjuntos se procesan por separado.
+    """
+    secciones = []
+    diferidas = 0
+    for parte in partes:
+        if parte.tipo == 'message/rfc822':
+            return None
+        if es_adjunto(parte):
+            if es_relevante(parte):
+                secciones.append(parte.seccion)
+            else:
+                diferidas += 1
+        elif parte.tipo in TIPOS_TEXTO:
+            secciones.append(parte.seccion)
+    return tuple(secciones) if diferidas else None
+
+
+def construir_mensaje(cabecera, partes, contenidos, origen=None):
+    """
+    Arma un email.message.Message con las cabeceras del mensaje y las partes
+    descargadas. Los adjuntos no descargados quedan sin contenido y con el
+    atributo origen_imap ({'seccion', 'codificacion', 'tamaño'} más los datos
+    de origen recibidos) para descargarlos más tarde.
+
+    Args:
+        cabecera: Bytes de BODY[HEADER]
+        partes: Lista de ParteImap del mensaje
+        contenidos: {seccion: bytes} descargados
+        origen: Datos comunes del origen (p. ej. uid, carpeta, uid_validity)
+    """
+    mensaje = BytesHeaderParser().parsebytes(cabecera or b'')
+    multipart = mensaje.get_content_maintype() == 'multipart'
+    if multipart:
+        mensaje.set_payload(None)
+
+    for parte in partes:
+        contenido = contenidos.get(parte.seccion)
+        if multipart:
+            destino = parte.cabeceras()
+        else:
+            destino = mensaje
+        if contenido is None:
+            destino.set_payload('')
+            if es_adjunto(parte):
+                destino.origen_imap = dict(
+                    origen or {}, seccion=parte.seccion, codificacion=parte.codificacion,
+                    tamaño=parte.tamaño_decodificado,
+                )
+        else:
+            # Igual que BytesParser: los bytes no ASCII se conservan como surrogates
+            destino.set_payload(contenido.decode('ascii', errors='surrogateescape'))
+        if multipart:
+            mensaje.attach(destino)
+    return mensaje
@@ -0,0 +1,268 @@
+"""
+Ingesta inmediata con IMAP IDLE (RFC 2177).
+
+Por cada EmailConfig con idle_enabled se mantiene una conexión en espera sobre
+la carpeta monitoreada. Cuando el servidor anuncia con EXISTS que la carpeta
+creció, se dispara la ingesta del tenant; la sincronización incremental por
+UID descarga solo los mensajes posteriores al punto de control. La conexión
+se reabre con espera exponencial ante cualquier error y la verificación
+periódica de check_scheduled_services sigue funcionando como respaldo.
+"""
+
+import logging
+import random
+import re
+import select
+import threading
+import time
+
+from django.db import close_old_connections
+
+from apps.configuracion.models import EmailConfig
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.despacho_ingesta_service import DespachoIngestaService
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+
+logger = logging.getLogger(__name__)
+
+# RFC 2177: los servidores pueden cortar un IDLE a los 30 minutos
+REINICIO_IDLE = 29 * 60
+ESPERA_INICIAL = 1.0
+ESPERA_MAXIMA = 300.0
+# Segundos que se esperan tras un EXISTS para agrupar los correos que llegan juntos
+AGRUPAR = 2.0
+TIEMPO_RESPUESTA = 30.0
+
+EXISTS_RE = re.compile(rb'^\* (\d+) EXISTS', re.I)
+EXPUNGE_RE = re.compile(rb'^\* \d+ EXPUNGE', re.I)
+
+
+class LectorLineas:
+    """
+    Lee líneas de respuesta directamente del socket con un tiempo máximo.
+
+    El archivo de imaplib no admite tiempos de espera (tras uno queda
+    inutilizable), así que durante IDLE se lee el socket con select. Para
+    SSL también se consulta pending(), los datos ya descifrados que select
+    no ve.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def leer(self, timeout):
+        """Devuelve la siguiente línea sin CRLF, o None si no llegó ninguna a tiempo."""
+        limite = time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            pendiente = getattr(self.sock, 'pending', None)
+            if not (pendiente and pendiente()):
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return None
+                legibles, _, _ = select.select([self.sock], [], [], restante)
+                if not legibles:
+                    return None
+            datos = self.sock.recv(4096)
+            if not datos:
+                raise Exception("El servidor IMAP cerró la conexión")
+            self.buffer += datos
+        linea, self.buffer = self.buffer.split(b'\n', 1)
+        return linea.rstrip(b'\r')
+
+
+class EscuchaIdle:
+    """
+    Conexión IDLE de una configuración de correo, con reconexión y espera exponencial.
+
+    Args:
+        config: EmailConfig a escuchar
+        al_recibir: Función llamada con el EmailConfig cuando hay correo nuevo
+        reinicio_idle: Segundos tras los que se renueva el IDLE
+        espera_inicial: Espera antes de la primera reconexión (se duplica en cada fallo)
+        espera_maxima: Espera máxima entre reconexiones
+        agrupar: Segundos que se esperan tras un EXISTS antes de notificar
+    """
+
+    def __init__(self, config, al_recibir, reinicio_idle=REINICIO_IDLE, espera_inicial=ESPERA_INICIAL,
+                 espera_maxima=ESPERA_MAXIMA, agrupar=AGRUPAR):
+        self.config = config
+        self.al_recibir = al_recibir
+        self.reinicio_idle = reinicio_idle
+        self.espera_inicial = espera_inicial
+        self.espera_maxima = espera_maxima
+        self.agrupar = agrupar
+        self.detenido = threading.Event()
+        self.conectado = threading.Event()
+        self.reconexiones = 0
+        self.notificaciones = 0
+        self.existentes = None
+
+    def detener(self):
+        self.detenido.set()
+
+    def ejecutar(self):
+        """Escucha hasta que se llame a detener(), reconectando tras cada fallo."""
+        espera = self.espera_inicial
+        while not self.detenido.is_set():
+            try:
+                self._sesion()
+                espera = self.espera_inicial
+            except Exception as e:
+                self.reconexiones += 1
+                logger.warning(
+                    f"IDLE de {self.config.email_address} interrumpido: {str(e)}; reintento en {espera:.0f}s"
+                )
+            finally:
+                self.conectado.clear()
+            # Jitter para que los listeners de un mismo servidor no reconecten a la vez
+            if self.detenido.wait(espera * random.uniform(0.8, 1.2)):
+                break
+            espera = min(espera * 2, self.espera_maxima)
+
+    def _sesion(self):
+        server = ImapSyncService.conectar(self.config)
+        try:
+            if 'IDLE' not in server.capabilities:
+                raise Exception("El servidor no soporta IDLE; se usa solo la verificación periódica")
+            result, data = server.select(self.config.folder_to_monitor)
+            if result != 'OK':
+                raise Exception(f"No se pudo seleccionar la carpeta {self.config.folder_to_monitor}")
+            self.existentes = int(data[0]) if data and data[0] else 0
+            self.conectado.set()
+            logger.info(f"IDLE de {self.config.email_address} conectado ({self.existentes} mensajes)")
+
+            # Lo que llegó mientras no había conexión
+            self._notificar()
+            lector = LectorLineas(server.sock)
+            while not self.detenido.is_set():
+                if self._idle(server, lector):
+                    self._notificar()
+        finally:
+            try:
+                server.logout()
+            except Exception:
+                pass
+
+    def _idle(self, server, lector):
+        """
+        Un ciclo IDLE: espera hasta reinicio_idle segundos o hasta que la
+        carpeta crezca y pasen agrupar segundos sin más novedades.
+
+        Returns:
+            bool: True si llegaron mensajes nuevos
+        """
+        tag = server._new_tag()
+        server.send(tag + b' IDLE\r\n')
+        linea = lector.leer(TIEMPO_RESPUESTA)
+        if linea is None or not linea.startswith(b'+'):
+            raise Exception(f"El servidor rechazó IDLE: {linea!r}")
+
+        nuevos = False
+        limite = time.monotonic() + self.reinicio_idle
+        while not self.detenido.is_set():
+            ahora = time.monotonic()
+            if ahora >= limite:
+                break
+            # Lecturas cortas para atender detener() sin esperar al siguiente aviso
+            linea = lector.leer(min(1.0, limite - ahora))
+            if linea is None:
+                continue
+            if self._procesar(linea):
+                nuevos = True
+                limite = min(limite, time.monotonic() + self.agrupar)
+            elif linea.startswith(b'* BYE'):
+                raise Exception(f"El servidor cerró la sesión: {linea.decode(errors='replace')}")
+
+        server.send(b'DONE\r\n')
+        while True:
+            linea = lector.leer(TIEMPO_RESPUESTA)
+            if linea is None:
+                raise Exception("El servidor no confirmó el fin de IDLE")
+            if linea.startswith(tag + b' '):
+                if not linea[len(tag) + 1:].upper().startswith(b'OK'):
+                    raise Exception(f"IDLE terminó con error: {linea.decode(errors='replace')}")
+                return nuevos
+            nuevos = self._procesar(linea) or nuevos
+
+    def _procesar(self, linea):
+        """Actualiza el número de mensajes con EXISTS/EXPUNGE; True si la carpeta creció."""
+        coincidencia = EXISTS_RE.match(linea)
+        if coincidencia:
+            cantidad = int(coincidencia.group(1))
+            crecio = self.existentes is None or cantidad > self.existentes
+            self.existentes = cantidad
+            return crecio
+        if EXPUNGE_RE.match(linea) and self.existentes:
+            self.existentes -= 1
+        return False
+
+    def _notificar(self):
+        self.notificaciones += 1
+        try:
+            self.al_recibir(self.config)
+        except Exception as e:
+            logger.error(f"Error al disparar la ingesta de {self.config.email_address}: {str(e)}")
+        finally:
+            close_old_connections()
+
+
+def disparar_ingesta(config):
+    """
+    Despacha la ingesta de los servicios activos del tenant de la configuración.
+    Respeta los cupos de concurrencia: si no hay cupo, el servicio queda
+    pendiente y se despacha cuando se libere.
+    """
+    servicios = DespachoIngestaService.despachar(
+        ServicioIngesta.objects.filter(tenant_id=config.tenant_id, activo=True)
+    )
+    logger.info(f"Correo nuevo en {config.email_address}: {len(servicios)} servicios de ingesta encolados")
+    return servicios
+
+
+class SupervisorIdle:
+    """
+    Mantiene un hilo EscuchaIdle por cada configuración IMAP con idle_enabled,
+    arrancando y deteniendo hilos a medida que cambian las configuraciones.
+    """
+
+    def __init__(self, al_recibir=disparar_ingesta, tenant_id=None, **opciones):
+        self.al_recibir = al_recibir
+        self.tenant_id = tenant_id
+        self.opciones = opciones
+        # {config_id: (EscuchaIdle, hilo, updated_at)}
+        self.escuchas = {}
+
+    def configuraciones(self):
+        configs = EmailConfig.objects.filter(
+            protocol='imap', idle_enabled=True, ingesta_enabled=True, tenant__is_active=True
+        ).select_related('tenant')
+        if self.tenant_id:
+            configs = configs.filter(tenant_id=self.tenant_id)
+        return list(configs)
+
+    def sincronizar(self):
+        """Arranca los listeners nuevos, reinicia los modificados y detiene los desactivados."""
+        vigentes = {config.id: config for config in self.configuraciones()}
+        for config_id, (escucha, hilo, version) in list(self.escuchas.items()):
+            config = vigentes.get(config_id)
+            if config is None or config.updated_at != version or not hilo.is_alive():
+                escucha.detener()
+                del self.escuchas[config_id]
+
+        for config_id, config in vigentes.items():
+            if config_id in self.escuchas:
+                continue
+            escucha = EscuchaIdle(config, self.al_recibir, **self.opciones)
+            hilo = threading.Thread(target=escucha.ejecutar, name=f'idle-{config.tenant_id}', daemon=True)
+            hilo.start()
+            self.escuchas[config_id] = (escucha, hilo, config.updated_at)
+        close_old_connections()
+        return len(self.escuchas)
+
+    def detener(self, timeout=5.0):
+        for escucha, hilo, _ in self.escuchas.values():
+            escucha.detener()
+        for escucha, hilo, _ in self.escuchas.values():
+            hilo.join(timeout)
+        self.escuchas = {}
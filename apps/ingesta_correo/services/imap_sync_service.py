@@ -0,0 +1,472 @@
+# apps/ingesta_correo/services/imap_sync_service.py
+"""
+Servicio de sincronización IMAP.
+Implementa la sincronización incremental basada en UID: en lugar de depender
+de la bandera \\Seen, se guarda el UIDVALIDITY y el último UID procesado por
+servicio y carpeta, y en cada ejecución solo se solicitan los UID posteriores.
+"""
+
+import re
+import email
+import imaplib
+import logging
+from email.parser import BytesHeaderParser
+from django.utils import timezone
+from apps.ingesta_correo.models import SincronizacionCarpeta, LogActividad, CorreoIngesta
+from apps.ingesta_correo.services import estructura_imap
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+
+logger = logging.getLogger(__name__)
+
+UID_RE = re.compile(rb'UID (\d+)')
+SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+
+ITEMS_CABECERAS = '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM SUBJECT)])'
+ITEMS_CUERPO = '(BODY.PEEK[])'
+ITEMS_ESTRUCTURA = '(BODYSTRUCTURE)'
+
+class ImapSyncService:
+    """Servicio para la sincronización incremental de carpetas IMAP."""
+
+    MODO_INCREMENTAL = 'incremental'
+    MODO_NO_LEIDOS = 'no_leidos'
+
+    @staticmethod
+    def conectar(config):
+        """Abre y autentica una conexión IMAP con la configuración de correo del tenant."""
+        if config.use_ssl:
+            server = imaplib.IMAP4_SSL(config.server_host, config.server_port)
+        else:
+            server = imaplib.IMAP4(config.server_host, config.server_port)
+        server.login(config.username, config.password)
+        return server
+
+    @staticmethod
+    def obtener_checkpoint(servicio, carpeta):
+        """
+        Obtiene (o crea) el punto de control de sincronización de una carpeta.
+
+        Args:
+            servicio: Objeto ServicioIngesta
+            carpeta: Nombre de la carpeta IMAP monitoreada
+
+        Returns:
+            SincronizacionCarpeta: Punto de control de la carpeta
+        """
+        checkpoint, _ = SincronizacionCarpeta.objects.get_or_create(
+            servicio=servicio,
+            carpeta=carpeta
+        )
+        return checkpoint
+
+    @staticmethod
+    def seleccionar_carpeta(server, carpeta):
+        """
+        Selecciona la carpeta en el servidor y devuelve su UIDVALIDITY.
+
+        Args:
+            server: Conexión imaplib autenticada
+            carpeta: Nombre de la carpeta a seleccionar
+
+        Returns:
+            int: UIDVALIDITY de la carpeta, o None si el servidor no lo informa
+        """
+        result, _ = server.select(carpeta)
+        if result != 'OK':
+            raise Exception(f"No se pudo seleccionar la carpeta {carpeta}")
+
+        _, data = server.response('UIDVALIDITY')
+        if not data or data[0] is None:
+            return None
+
+        try:
+            return int(data[0])
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _parsear_uids(data):
+        """Convierte la respuesta de un UID SEARCH en una lista ordenada de enteros."""
+        if not data or not data[0]:
+            return []
+        return sorted(int(uid) for uid in data[0].split())
+
+    @classmethod
+    def buscar_uids_nuevos(cls, server, checkpoint, uid_validity):
+        """
+        Busca los UID posteriores al último procesado en la carpeta seleccionada.
+
+        Si el UIDVALIDITY del servidor difiere del guardado, los UID anteriores
+        dejan de ser válidos y se realiza una resincronización completa controlada:
+        el punto de control vuelve a cero y la deduplicación por Message-ID evita
+        que se creen correos repetidos.
+
+        Args:
+            server: Conexión imaplib con la carpeta ya seleccionada
+            checkpoint: Objeto SincronizacionCarpeta de la carpeta
+            uid_validity: UIDVALIDITY informado por el servidor
+
+        Returns:
+            list: UID (enteros) pendientes de procesar, en orden ascendente
+        """
+        if checkpoint.uid_validity != uid_validity:
+            if checkpoint.uid_validity is not None:
+                cls._registrar_resincronizacion(checkpoint, uid_validity)
+
+            checkpoint.uid_validity = uid_validity
+            checkpoint.ultimo_uid = 0
+            checkpoint.save(update_fields=[
+                'uid_validity', 'ultimo_uid', 'resincronizaciones',
+                'fecha_ultima_resincronizacion', 'fecha_actualizacion'
+            ])
+
+        desde = checkpoint.ultimo_uid + 1
+        result, data = server.uid('SEARCH', None, f'UID {desde}:*')
+        if result != 'OK':
+            raise Exception("No se pudo buscar correos nuevos por UID")
+
+        # "n:*" siempre incluye el mensaje con el UID más alto aunque sea menor que n,
+        # por lo que se descartan los UID ya procesados
+        uids = [uid for uid in cls._parsear_uids(data) if uid > checkpoint.ultimo_uid]
+        logger.info(
+            f"Carpeta '{checkpoint.carpeta}': {len(uids)} mensajes nuevos desde UID {desde} "
+            f"(servicio {checkpoint.servicio_id})"
+        )
+        return uids
+
+    @classmethod
+    def buscar_uids_no_leidos(cls, server):
+        """
+        Busca los UID de los correos no leídos (modo de sincronización heredado).
+
+        Args:
+            server: Conexión imaplib con la carpeta ya seleccionada
+
+        Returns:
+            list: UID (enteros) de los mensajes sin la bandera \\Seen
+        """
+        result, data = server.uid('SEARCH', None, 'UNSEEN')
+        if result != 'OK':
+            raise Exception("No se pudo buscar correos no leídos")
+        return cls._parsear_uids(data)
+
+    @staticmethod
+    def formatear_conjunto(uids):
+        """
+        Compacta una lista de UID en un conjunto de secuencias IMAP.
+        Por ejemplo, [1, 2, 3, 7, 9, 10] se convierte en "1:3,7,9:10".
+        """
+        rangos = []
+        inicio = anterior = None
+        for uid in sorted(uids):
+            if inicio is None:
+                inicio = anterior = uid
+            elif uid == anterior + 1:
+                anterior = uid
+            else:
+                rangos.append(f"{inicio}:{anterior}" if inicio != anterior else f"{inicio}")
+                inicio = anterior = uid
+        if inicio is not None:
+            rangos.append(f"{inicio}:{anterior}" if inicio != anterior else f"{inicio}")
+        return ','.join(rangos)
+
+    @staticmethod
+    def _parsear_respuesta_fetch(data):
+        """
+        Extrae las tuplas (uid, metadatos, contenido) de la respuesta de imaplib a un UID FETCH.
+
+        imaplib devuelve una tupla (cabecera, literal) por mensaje seguida de un
+        cierre b')'. El UID y el RFC822.SIZE suelen venir en la cabecera, pero
+        algunos servidores los envían después del literal, en el elemento de cierre,
+        por lo que ambos se concatenan como metadatos.
+        """
+        resultados = []
+        actual = None
+
+        def cerrar(actual):
+            metadatos, contenido = actual
+            coincidencia = UID_RE.search(metadatos)
+            if coincidencia:
+                resultados.append((int(coincidencia.group(1)), metadatos, contenido))
+
+        for item in data or []:
+            if isinstance(item, tuple):
+                if actual is not None:
+                    cerrar(actual)
+                actual = [item[0], item[1]]
+            elif isinstance(item, bytes) and actual is not None:
+                actual[0] += b' ' + item
+        if actual is not None:
+            cerrar(actual)
+
+        return resultados
+
+    @staticmethod
+    def _dividir_lotes(uids, tamaño_lote):
+        """Divide la lista ordenada de UID en lotes del tamaño indicado."""
+        tamaño_lote = max(1, int(tamaño_lote or 1))
+        uids = sorted(uids)
+        return [uids[i:i + tamaño_lote] for i in range(0, len(uids), tamaño_lote)]
+
+    @classmethod
+    def _fetch_contenidos(cls, server, lote, items):
+        """Ejecuta un UID FETCH sobre un lote y devuelve las respuestas ordenadas por UID."""
+        result, data = server.uid('FETCH', cls.formatear_conjunto(lote), items)
+        if result != 'OK':
+            raise Exception(f"No se pudo descargar el lote de UID {lote[0]}-{lote[-1]}")
+
+        solicitados = set(lote)
+        respuestas = [respuesta for respuesta in cls._parsear_respuesta_fetch(data) if respuesta[0] in solicitados]
+        respuestas.sort(key=lambda respuesta: respuesta[0])
+        return respuestas
+
+    @staticmethod
+    def obtener_mensaje_id(uid, mensaje):
+        """
+        Devuelve el Message-ID de un mensaje (completo o solo cabeceras).
+        Si el mensaje no tiene Message-ID se usa un identificador derivado del UID.
+        """
+        return CorreoParserService.normalizar_mensaje_id(mensaje.get('Message-ID'), f'IMAP-{uid}')
+
+    @classmethod
+    def fetch_cabeceras(cls, server, lote):
+        """
+        Descarga solo las cabeceras relevantes y el tamaño de un lote de mensajes.
+
+        Usa BODY.PEEK para no alterar la bandera \\Seen.
+
+        Args:
+            server: Conexión imaplib con la carpeta ya seleccionada
+            lote: Lista de UID
+
+        Returns:
+            dict: {uid: {'mensaje_id', 'remitente', 'asunto', 'fecha', 'tamaño'}}
+        """
+        cabeceras = {}
+        parser = BytesHeaderParser()
+        for uid, metadatos, contenido in cls._fetch_contenidos(server, lote, ITEMS_CABECERAS):
+            mensaje = parser.parsebytes(contenido or b'')
+            tamaño = SIZE_RE.search(metadatos)
+            cabeceras[uid] = {
+                'mensaje_id': cls.obtener_mensaje_id(uid, mensaje),
+                'remitente': mensaje.get('From', ''),
+                'asunto': mensaje.get('Subject', ''),
+                'fecha': mensaje.get('Date'),
+                'tamaño': int(tamaño.group(1)) if tamaño else None,
+            }
+        return cabeceras
+
+    @staticmethod
+    def filtrar_nuevos(cabeceras):
+        """
+        Resuelve con una sola consulta qué mensajes de un lote ya fueron ingeridos.
+
+        Args:
+            cabeceras: Diccionario devuelto por fetch_cabeceras
+
+        Returns:
+            list: UID de los mensajes cuyo Message-ID no existe todavía, sin
+            repetir Message-ID dentro del mismo lote
+        """
+        ids = {datos['mensaje_id'] for datos in cabeceras.values()}
+        existentes = set(
+            CorreoIngesta.objects.filter(mensaje_id__in=ids).values_list('mensaje_id', flat=True)
+        )
+
+        nuevos = []
+        for uid in sorted(cabeceras):
+            mensaje_id = cabeceras[uid]['mensaje_id']
+            if mensaje_id in existentes:
+                continue
+            existentes.add(mensaje_id)
+            nuevos.append(uid)
+        return nuevos
+
+    @classmethod
+    def fetch_lotes(cls, server, uids, tamaño_lote, deduplicar=True, prefiltro=None,
+                    parcial=False, carpeta=None, uid_validity=None):
+        """
+        Descarga los mensajes por lotes de UID en lugar de un UID FETCH por mensaje.
+
+        Es un generador: cada lote se solicita en pocas idas y vueltas y sus
+        mensajes se entregan parseados al resto del pipeline, que los persiste
+        juntos antes de pedir el siguiente lote, por lo que solo un lote reside
+        en memoria a la vez.
+
+        Con deduplicar=True cada lote se descarga en dos fases: primero las
+        cabeceras y el tamaño, luego se descartan con una sola consulta los
+        Message-ID ya almacenados y solo se descarga el cuerpo de los nuevos.
+
+        Con un prefiltro (PrefiltroImap con su búsqueda ya ejecutada) tampoco
+        se descarga el cuerpo de los candidatos que sus cabeceras confirman
+        como ignorados; quedan en prefiltro.omitidos como (uid, cabecera,
+        regla) hasta el siguiente lote.
+
+        En modo parcial se lee antes el BODYSTRUCTURE y de los mensajes con
+        adjuntos irrelevantes para las glosas solo se descargan las cabeceras,
+        las partes de texto y los adjuntos relevantes (ver fetch_parcial).
+
+        Args:
+            server: Conexión imaplib con la carpeta ya seleccionada
+            uids: Lista de UID a descargar
+            tamaño_lote: Número máximo de UID por UID FETCH
+            deduplicar: Si se omiten los mensajes ya ingeridos antes de descargarlos
+            prefiltro: PrefiltroImap opcional de las reglas que ignoran correo
+            parcial: Si se descargan solo las partes necesarias de cada mensaje
+            carpeta: Carpeta seleccionada, registrada en los adjuntos diferidos
+            uid_validity: UIDVALIDITY de la carpeta, registrado en los adjuntos diferidos
+
+        Yields:
+            tuple: (lote, mensajes) donde lote es la lista de UID solicitados y
+            mensajes la lista de (uid, email.message.Message) descargados, en
+            orden ascendente de UID
+        """
+        for lote in cls._dividir_lotes(uids, tamaño_lote):
+            pendientes = lote
+            cabeceras = None
+            if deduplicar:
+                cabeceras = cls.fetch_cabeceras(server, lote)
+                pendientes = cls.filtrar_nuevos(cabeceras)
+                if len(pendientes) < len(lote):
+                    logger.info(f"Lote UID {lote[0]}-{lote[-1]}: {len(lote) - len(pendientes)} mensajes ya ingeridos omitidos")
+
+            if prefiltro is not None:
+                pendientes = cls._aplicar_prefiltro(server, prefiltro, pendientes, cabeceras)
+
+            mensajes = []
+            if pendientes and parcial:
+                mensajes = cls.fetch_parcial(server, pendientes, {'carpeta': carpeta, 'uid_validity': uid_validity})
+            elif pendientes:
+                mensajes = cls._fetch_completos(server, pendientes)
+            yield lote, mensajes
+
+    @classmethod
+    def _fetch_completos(cls, server, uids):
+        return [
+            (uid, email.message_from_bytes(contenido))
+            for uid, _, contenido in cls._fetch_contenidos(server, uids, ITEMS_CUERPO)
+        ]
+
+    @classmethod
+    def fetch_estructuras(cls, server, lote):
+        """
+        Descarga el BODYSTRUCTURE de un lote de mensajes.
+
+        Returns:
+            dict: {uid: lista de estructura_imap.ParteImap}
+        """
+        result, data = server.uid('FETCH', cls.formatear_conjunto(lote), ITEMS_ESTRUCTURA)
+        if result != 'OK':
+            raise Exception(f"No se pudo leer la estructura del lote de UID {lote[0]}-{lote[-1]}")
+        return estructura_imap.estructuras_por_mensaje(data)
+
+    @classmethod
+    def fetch_secciones(cls, server, uids, secciones):
+        """
+        Descarga las mismas secciones (BODY.PEEK[seccion]) de varios mensajes.
+
+        Returns:
+            dict: {uid: {seccion: bytes}}
+        """
+        items = '(' + ' '.join(f'BODY.PEEK[{seccion}]' for seccion in secciones) + ')'
+        result, data = server.uid('FETCH', cls.formatear_conjunto(uids), items)
+        if result != 'OK':
+            raise Exception(f"No se pudieron descargar las secciones {', '.join(secciones)} de los UID {uids[0]}-{uids[-1]}")
+        solicitados = set(uids)
+        return {uid: datos for uid, datos in estructura_imap.secciones_por_mensaje(data).items() if uid in solicitados}
+
+    @classmethod
+    def fetch_parcial(cls, server, uids, origen=None):
+        """
+        Descarga un lote según el BODYSTRUCTURE de cada mensaje.
+
+        Los mensajes con adjuntos irrelevantes para las glosas se arman con sus
+        cabeceras, partes de texto y adjuntos relevantes; los adjuntos omitidos
+        quedan marcados con origen_imap para descargarlos al abrirlos. Los
+        mensajes sin nada que omitir (o cuya estructura no se pudo leer) se
+        descargan completos. Los mensajes con la misma lista de secciones se
+        piden en un solo UID FETCH.
+
+        Args:
+            server: Conexión imaplib con la carpeta ya seleccionada
+            uids: Lista ordenada de UID
+            origen: Datos comunes registrados en los adjuntos omitidos (carpeta, uid_validity)
+
+        Returns:
+            list: (uid, email.message.Message) en orden ascendente de UID
+        """
+        estructuras = cls.fetch_estructuras(server, uids)
+        completos, grupos = [], {}
+        for uid in uids:
+            partes = estructuras.get(uid)
+            secciones = estructura_imap.plan_descarga(partes) if partes else None
+            if secciones is None:
+                completos.append(uid)
+            else:
+                grupos.setdefault(('HEADER',) + secciones, []).append(uid)
+
+        mensajes = dict(cls._fetch_completos(server, completos)) if completos else {}
+        for secciones, uids_grupo in grupos.items():
+            for uid, contenidos in cls.fetch_secciones(server, uids_grupo, secciones).items():
+                mensajes[uid] = estructura_imap.construir_mensaje(
+                    contenidos.get('HEADER'), estructuras[uid], contenidos, dict(origen or {}, uid=uid)
+                )
+        if grupos:
+            diferidos = sum(len(uids_grupo) for uids_grupo in grupos.values())
+            logger.info(f"Lote UID {uids[0]}-{uids[-1]}: {diferidos} mensajes descargados sin sus adjuntos irrelevantes")
+        return [(uid, mensajes[uid]) for uid in uids if uid in mensajes]
+
+    @classmethod
+    def _aplicar_prefiltro(cls, server, prefiltro, pendientes, cabeceras):
+        """Separa los candidatos del prefiltro confirmados como ignorados y devuelve el resto."""
+        prefiltro.omitidos = []
+        candidatos = [uid for uid in pendientes if uid in prefiltro.candidatos]
+        if not candidatos:
+            return pendientes
+
+        if cabeceras is None:
+            cabeceras = cls.fetch_cabeceras(server, candidatos)
+        omitidos = set()
+        for uid in candidatos:
+            regla = prefiltro.confirmar(cabeceras.get(uid))
+            if regla is not None:
+                prefiltro.omitidos.append((uid, cabeceras[uid], regla))
+                omitidos.add(uid)
+
+        if omitidos:
+            logger.info(f"{len(omitidos)} mensajes ignorados por reglas sin descargar su cuerpo")
+        return [uid for uid in pendientes if uid not in omitidos]
+
+    @staticmethod
+    def registrar_progreso(checkpoint, uid):
+        """
+        Avanza el punto de control hasta el UID indicado.
+
+        Args:
+            checkpoint: Objeto SincronizacionCarpeta
+            uid: UID procesado
+        """
+        if checkpoint is None or uid <= checkpoint.ultimo_uid:
+            return
+
+        checkpoint.ultimo_uid = uid
+        checkpoint.save(update_fields=['ultimo_uid', 'fecha_actualizacion'])
+
+    @staticmethod
+    def _registrar_resincronizacion(checkpoint, uid_validity):
+        """Registra en logs que el UIDVALIDITY cambió y se hará una resincronización completa."""
+        mensaje = (
+            f"UIDVALIDITY de la carpeta '{checkpoint.carpeta}' cambió de "
+            f"{checkpoint.uid_validity} a {uid_validity}; se realizará una resincronización completa"
+        )
+        logger.warning(f"{mensaje} (servicio {checkpoint.servicio_id})")
+
+        checkpoint.resincronizaciones += 1
+        checkpoint.fecha_ultima_resincronizacion = timezone.now()
+
+        LogActividad.objects.create(
+            tenant_id=checkpoint.servicio.tenant_id,
+            evento='RESINCRONIZACION_IMAP',
+            detalles=mensaje,
+            estado='warning'
+        )
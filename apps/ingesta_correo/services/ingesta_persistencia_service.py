@@ -0,0 +1,357 @@
+import logging
+import random
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ArchivoAdjunto, CorreoIngesta, HistorialAplicacionRegla
+from apps.ingesta_correo.services.adjunto_storage_service import AdjuntoStorageService
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+from apps.ingesta_correo.services.perfil_reglas_service import PerfilReglasService
+from apps.ingesta_correo.services.regla_filtrado_service import ReglaFiltradoService
+from apps.ingesta_correo.services.regla_motor_service import ReglaMotorService
+from apps.ingesta_correo.services.traza_reglas_service import TrazaReglasService
+from apps.ingesta_correo.services.uso_reglas_service import ContadorUsosReglas
+
+logger = logging.getLogger(__name__)
+
+
+class IngestaPersistenciaService:
+    """
+    Servicio para persistir por lotes los correos ingeridos.
+
+    Cada lote se guarda en una sola transacción con un bulk_create por tabla
+    (correos, adjuntos, historial y traza de reglas) y un bulk_update final
+    de los estados, en lugar de varios INSERT/UPDATE por correo.
+    """
+
+    @staticmethod
+    def _extraer_glosas(adjunto):
+        """
+        Aquí procesarías el documento para extraer glosas.
+        Por ahora, simulamos algunas glosas extraídas.
+        """
+        return random.randint(1, 5)  # Reemplazar con lógica real
+
+    @staticmethod
+    def _nuevo_resultado():
+        return {
+            'correos_nuevos': 0,
+            'correos_procesados': 0,
+            'archivos_procesados': 0,
+            'glosas_extraidas': 0,
+            'mensajes_guardados': [],
+            'errores': [],
+        }
+
+    @classmethod
+    def persistir_lote(cls, servicio, correos_parseados):
+        """
+        Persiste un lote de correos parseados y les aplica las reglas de filtrado.
+
+        Los Message-ID ya existentes (o repetidos dentro del lote) se omiten. Si
+        otra ejecución guarda alguno entre esa consulta y el INSERT, el correo
+        queda como suyo: este lote no le crea adjuntos ni historial ni lo cuenta.
+
+        Args:
+            servicio: ServicioIngesta propietario de los correos
+            correos_parseados: Lista de diccionarios devueltos por CorreoParserService.parsear,
+                con el mensaje_id ya normalizado (CorreoParserService.normalizar_mensaje_id)
+
+        Returns:
+            dict: Estadísticas del lote ('correos_nuevos', 'correos_procesados',
+            'archivos_procesados', 'glosas_extraidas'), los Message-ID guardados
+            y la lista de errores
+        """
+        resultado = cls._nuevo_resultado()
+        if not correos_parseados:
+            return resultado
+
+        tenant_id = servicio.tenant_id
+
+        # Si el lote se revierte, los archivos de los blobs creados se borran
+        with AdjuntoStorageService.transaccion() as blobs_nuevos:
+            ids = {datos['mensaje_id'] for datos in correos_parseados}
+            existentes = set(
+                CorreoIngesta.objects.filter(mensaje_id__in=ids).values_list('mensaje_id', flat=True)
+            )
+
+            nuevos = []
+            for datos in correos_parseados:
+                if datos['mensaje_id'] in existentes:
+                    continue
+                existentes.add(datos['mensaje_id'])
+                nuevos.append(datos)
+
+            if not nuevos:
+                return resultado
+
+            # Escribir los archivos antes de crear las filas para conocer tamaños y glosas.
+            # El contenido repetido reutiliza su blob y no se vuelve a extraer.
+            adjuntos_por_correo = []
+            blobs_procesados = {}
+            for datos in nuevos:
+                adjuntos = []
+                for adjunto in datos['adjuntos']:
+                    if adjunto.get('origen_imap'):
+                        # Adjunto irrelevante para las glosas: solo sus metadatos
+                        origen = dict(adjunto['origen_imap'])
+                        adjuntos.append({
+                            'nombre_archivo': adjunto['nombre_archivo'][:255],
+                            'tipo_contenido': adjunto['tipo_contenido'][:100],
+                            'tamaño': origen.pop('tamaño', 0),
+                            'archivo': '',
+                            'hash_sha256': '',
+                            'blob': None,
+                            'glosas': 0,
+                            'origen_imap': origen,
+                        })
+                        continue
+                    try:
+                        guardado = AdjuntoStorageService.guardar(
+                            tenant_id, adjunto['parte'], adjunto['nombre_archivo'], nuevos=blobs_nuevos
+                        )
+                    except Exception as e:
+                        error_msg = f"Error al procesar adjunto {adjunto['nombre_archivo']}: {str(e)}"
+                        logger.error(f"Error al procesar adjunto para correo {datos['mensaje_id']}: {str(e)}")
+                        resultado['errores'].append(error_msg)
+                        continue
+                    blob = guardado['blob']
+                    if blob.id not in blobs_procesados:
+                        if not blob.procesado:
+                            blob.glosas_extraidas = cls._extraer_glosas(adjunto)
+                            blob.procesado = True
+                            blob.save(update_fields=['glosas_extraidas', 'procesado'])
+                        blobs_procesados[blob.id] = blob.glosas_extraidas
+                    adjuntos.append({
+                        'nombre_archivo': adjunto['nombre_archivo'][:255],
+                        'tipo_contenido': adjunto['tipo_contenido'][:100],
+                        'tamaño': guardado['tamaño'],
+                        'archivo': guardado['archivo'],
+                        'hash_sha256': guardado['hash_sha256'],
+                        'blob': blob,
+                        'glosas': blobs_procesados[blob.id],
+                    })
+                adjuntos_por_correo.append(adjuntos)
+
+            correos = [
+                CorreoIngesta(
+                    servicio=servicio,
+                    mensaje_id=datos['mensaje_id'],
+                    remitente=datos['remitente'][:255],
+                    destinatarios=datos['destinatarios'],
+                    asunto=datos['asunto'][:500],
+                    fecha_recepcion=datos['fecha_recepcion'],
+                    contenido_plano=datos['contenido_plano'],
+                    contenido_html=datos['contenido_html'],
+                    estado=CorreoIngesta.Estado.PENDIENTE,
+                    glosas_extraidas=sum(adjunto['glosas'] for adjunto in adjuntos),
+                )
+                for datos, adjuntos in zip(nuevos, adjuntos_por_correo)
+            ]
+            insertados = {id(correo) for correo in cls._insertar_correos(servicio, correos)}
+
+            guardados = []
+            registros_adjuntos = []
+            for correo, adjuntos in zip(correos, adjuntos_por_correo):
+                if id(correo) not in insertados:
+                    continue
+
+                registros = [
+                    ArchivoAdjunto(
+                        correo=correo,
+                        nombre_archivo=adjunto['nombre_archivo'],
+                        tipo_contenido=adjunto['tipo_contenido'],
+                        tamaño=adjunto['tamaño'],
+                        archivo=adjunto['archivo'],
+                        hash_sha256=adjunto['hash_sha256'],
+                        blob=adjunto['blob'],
+                        origen_imap=adjunto.get('origen_imap'),
+                    )
+                    for adjunto in adjuntos
+                ]
+                registros_adjuntos.extend(registros)
+                # Las reglas consultan correo.adjuntos: se sirven desde memoria
+                correo._prefetched_objects_cache = {'adjuntos': registros}
+                guardados.append(correo)
+
+            ArchivoAdjunto.objects.bulk_create(registros_adjuntos)
+            AdjuntoStorageService.registrar_referencias(registros_adjuntos)
+
+            historial = cls._aplicar_reglas(guardados, resultado)
+            HistorialAplicacionRegla.objects.bulk_create(historial)
+            CorreoIngesta.objects.bulk_update(guardados, ['estado', 'fecha_procesamiento'])
+
+        resultado['correos_nuevos'] = len(guardados)
+        resultado['correos_procesados'] = len(guardados)
+        resultado['archivos_procesados'] = len(registros_adjuntos)
+        resultado['glosas_extraidas'] = sum(correo.glosas_extraidas for correo in guardados)
+        resultado['mensajes_guardados'] = [correo.mensaje_id for correo in guardados]
+        return resultado
+
+    @classmethod
+    def registrar_ignorados(cls, servicio, omitidos):
+        """
+        Guarda como ignorados los mensajes que el prefiltro IMAP descartó sin
+        descargar su cuerpo, con el historial de la regla que los ignoró.
+
+        Args:
+            servicio: ServicioIngesta propietario de los correos
+            omitidos: Lista de (uid, cabecera, ReglaCompilada) de PrefiltroImap.omitidos
+
+        Returns:
+            dict: Mismo formato que persistir_lote
+        """
+        resultado = cls._nuevo_resultado()
+        if not omitidos:
+            return resultado
+
+        ahora = timezone.now()
+        with transaction.atomic():
+            existentes = set(
+                CorreoIngesta.objects.filter(
+                    mensaje_id__in={cabecera['mensaje_id'] for _, cabecera, _ in omitidos}
+                ).values_list('mensaje_id', flat=True)
+            )
+
+            correos, reglas = [], {}
+            for _, cabecera, compilada in omitidos:
+                mensaje_id = cabecera['mensaje_id']
+                if mensaje_id in existentes:
+                    continue
+                existentes.add(mensaje_id)
+                correos.append(CorreoIngesta(
+                    servicio=servicio,
+                    mensaje_id=mensaje_id,
+                    remitente=CorreoParserService.decodificar_cabecera(cabecera['remitente'])[:255],
+                    destinatarios='',
+                    asunto=CorreoParserService.decodificar_cabecera(cabecera['asunto'])[:500],
+                    fecha_recepcion=CorreoParserService.obtener_fecha(cabecera['fecha']),
+                    estado='IGNORADO',
+                    fecha_procesamiento=ahora,
+                    prefiltro_imap=True,
+                ))
+                reglas[mensaje_id] = compilada.regla
+
+            if not correos:
+                return resultado
+
+            contador = ContadorUsosReglas(momento=ahora)
+            historial, guardados = [], []
+            for correo in cls._insertar_correos(servicio, correos):
+                regla = reglas[correo.mensaje_id]
+                contador.registrar(regla)
+                historial.append(HistorialAplicacionRegla(
+                    regla=regla,
+                    correo=correo,
+                    fecha_aplicacion=ahora,
+                    resultado=True,
+                    accion_ejecutada=regla.accion,
+                    detalles={'prefiltro_imap': True},
+                ))
+                guardados.append(correo.mensaje_id)
+            HistorialAplicacionRegla.objects.bulk_create(historial)
+            contador.flush_al_confirmar()
+
+        resultado['correos_nuevos'] = len(guardados)
+        resultado['correos_procesados'] = len(guardados)
+        resultado['mensajes_guardados'] = guardados
+        return resultado
+
+    @staticmethod
+    def _insertar_correos(servicio, correos):
+        """
+        Inserta los correos y devuelve los que insertó esta llamada, con su id.
+
+        Un solo bulk_create en un savepoint; si otra ejecución guardó alguno de
+        los Message-ID después de consultar los existentes, el lote se reintenta
+        correo a correo y se omiten los que ya existen. ignore_conflicts no sirve
+        aquí: la consulta posterior de ids también devolvería los correos de la
+        otra ejecución.
+
+        Returns:
+            list: Correos insertados, en el orden recibido
+        """
+        try:
+            with transaction.atomic():
+                CorreoIngesta.objects.bulk_create(correos)
+            insertados = correos
+        except IntegrityError:
+            insertados = []
+            for correo in correos:
+                # Un trozo anterior del bulk_create revertido pudo dejarle id
+                correo.id = None
+                try:
+                    with transaction.atomic():
+                        CorreoIngesta.objects.bulk_create([correo])
+                except IntegrityError:
+                    logger.info(f"El correo {correo.mensaje_id} lo guardó otra ejecución; se omite")
+                    continue
+                insertados.append(correo)
+
+        # Sin RETURNING en el INSERT las claves se leen después: todos estos correos son de esta llamada
+        sin_id = [correo for correo in insertados if correo.id is None]
+        if sin_id:
+            ids_por_mensaje = dict(
+                CorreoIngesta.objects.filter(
+                    servicio=servicio, mensaje_id__in=[correo.mensaje_id for correo in sin_id]
+                ).values_list('mensaje_id', 'id')
+            )
+            for correo in sin_id:
+                correo.id = ids_por_mensaje[correo.mensaje_id]
+                correo._state.adding = False
+                correo._state.db = CorreoIngesta.objects.db
+        return insertados
+
+    @staticmethod
+    def _aplicar_reglas(correos, resultado):
+        """
+        Aplica las reglas de filtrado a cada correo del lote sin guardarlo.
+
+        Returns:
+            list: Registros HistorialAplicacionRegla pendientes de bulk_create
+        """
+        historial = []
+        if not correos:
+            return historial
+        # Un solo motor de reglas compiladas, una traza y un contador de usos para todo el lote
+        motor = ReglaMotorService.obtener_motor(correos[0].servicio_id)
+        tenant_id = correos[0].servicio.tenant_id
+        traza = TrazaReglasService.para_tenant(tenant_id)
+        perfil = PerfilReglasService.para_tenant(tenant_id)
+        contador = ContadorUsosReglas(momento=timezone.now())
+        for correo in correos:
+            try:
+                regla_aplicada = ReglaFiltradoService.aplicar_reglas(
+                    correo, motor=motor, traza=traza, contador=contador, perfil=perfil
+                )
+
+                if regla_aplicada:
+                    historial.append(HistorialAplicacionRegla(
+                        regla=regla_aplicada,
+                        correo=correo,
+                        fecha_aplicacion=timezone.now(),
+                        resultado=True,
+                        accion_ejecutada=regla_aplicada.accion
+                    ))
+                    regla_aplicada.aplicar_accion(correo)
+                    logger.info(f"Regla '{regla_aplicada.nombre}' aplicada al correo {correo.id}")
+                else:
+                    # No se encontró una regla aplicable, procesar normalmente
+                    correo.estado = CorreoIngesta.Estado.PROCESADO
+                    correo.fecha_procesamiento = timezone.now()
+                    logger.info(f"No se encontraron reglas aplicables para el correo {correo.id}")
+            except Exception as e:
+                error_msg = f"Error al aplicar reglas de filtrado: {str(e)}"
+                logger.error(f"Error al aplicar reglas para correo {correo.id}: {str(e)}")
+                resultado['errores'].append(error_msg)
+
+                # En caso de error, procesar el correo normalmente
+                correo.estado = CorreoIngesta.Estado.PROCESADO
+                correo.fecha_procesamiento = timezone.now()
+        traza.flush()
+        # Los usos se escriben tras el commit del lote, fuera de su transacción
+        contador.flush_al_confirmar()
+        if perfil is not None:
+            transaction.on_commit(perfil.flush_si_corresponde)
+        return historial
@@ -1,12 +1,82 @@
 # apps/ingesta_correo/services/ingesta_scheduler_service.py
 
 import logging
+from datetime import datetime, timezone as dt_timezone
 from django.utils import timezone
 from django.db import transaction
 from apps.ingesta_correo.models import ServicioIngesta, HistorialEjecucion, LogActividad
+from apps.ingesta_correo.services.cancelacion_ingesta_service import TokenCancelacion
 
 logger = logging.getLogger(__name__)
 
+# Origen común de las cuadrículas de turnos; cada servicio se desfasa de él
+ORIGEN_TURNOS = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+# Parte fraccionaria de la razón áurea: los desfases de IDs consecutivos
+# quedan repartidos casi uniformemente en el intervalo (secuencia de Weyl)
+PROPORCION_AUREA = 0.6180339887498949
+
+
+def fase_servicio(servicio_id, intervalo_minutos):
+    """
+    Desfase determinista, en segundos, de los turnos del servicio dentro de
+    su intervalo. Depende solo del ID y del intervalo, así que no cambia
+    entre ejecuciones ni reinicios.
+    """
+    periodo = max(1, intervalo_minutos or 1) * 60
+    return int((servicio_id * PROPORCION_AUREA) % 1 * periodo)
+
+
+def turno_siguiente(servicio_id, desde, intervalo_minutos):
+    """
+    Primer turno del servicio estrictamente posterior a desde. Los turnos de
+    un servicio forman la cuadrícula ORIGEN_TURNOS + fase + k * intervalo, de
+    modo que los servicios con el mismo intervalo no coinciden en el mismo
+    minuto sino que se reparten a lo largo del intervalo.
+    """
+    intervalo = timezone.timedelta(minutes=max(1, intervalo_minutos or 1))
+    base = ORIGEN_TURNOS + timezone.timedelta(seconds=fase_servicio(servicio_id, intervalo_minutos))
+    return base + ((desde - base) // intervalo + 1) * intervalo
+
+
+def siguiente_ejecucion(programada, inicio, intervalo_minutos, servicio_id=None):
+    """
+    Próxima ejecución de un servicio cuya ejecución empezó en inicio.
+    
+    Se mantiene la cadencia de la hora programada (programada + n intervalos)
+    para que el servicio no se desplace con la espera hasta el despacho ni con
+    la duración de cada ejecución. Si una ejecución dura más que el intervalo,
+    la siguiente queda vencida al terminar y se hace una sola vez, sin
+    acumular los turnos perdidos.
+    
+    Args:
+        programada: proxima_ejecucion con la que se despachó la ejecución (o None)
+        inicio: Hora en que empezó (se despachó) la ejecución
+        intervalo_minutos: Intervalo del servicio
+        servicio_id: Si se indica, la siguiente ejecución cae en el turno
+            del servicio (turno_siguiente) posterior a la programada y al inicio
+    """
+    if servicio_id is not None:
+        # Con despacho anticipado el inicio puede ser anterior a la hora programada
+        return turno_siguiente(servicio_id, max(inicio, programada or inicio), intervalo_minutos)
+    intervalo = timezone.timedelta(minutes=max(1, intervalo_minutos or 1))
+    if programada is None or programada > inicio:
+        return inicio + intervalo
+    return programada + ((inicio - programada) // intervalo + 1) * intervalo
+
+
+def intervalo_adaptativo(actual, correos_nuevos, minimo, maximo):
+    """
+    Siguiente intervalo del modo adaptativo: el mínimo tras una ejecución con
+    correo nuevo (el correo suele llegar en rachas) y el doble tras una vacía,
+    hasta el máximo.
+    """
+    minimo = max(1, minimo or 1)
+    maximo = max(minimo, maximo or minimo)
+    if correos_nuevos:
+        return minimo
+    return min(max((actual or minimo) * 2, minimo), maximo)
+
+
 class IngestaSchedulerService:
     """
     Servicio para gestionar la programación y ejecución del servicio de ingesta de correo.
@@ -20,6 +90,14 @@ class IngestaSchedulerService:
         """
         count = 0
         try:
+            # Los servicios activos sin programar se ejecutan en su primer turno,
+            # no todos a la vez
+            ahora = timezone.now()
+            sin_programar = ServicioIngesta.objects.filter(activo=True, proxima_ejecucion__isnull=True)
+            for servicio in sin_programar.only('id', 'intervalo_minutos'):
+                ServicioIngesta.objects.filter(id=servicio.id, proxima_ejecucion__isnull=True).update(
+                    proxima_ejecucion=turno_siguiente(servicio.id, ahora, servicio.intervalo_minutos)
+                )
             servicios = ServicioIngesta.objects.filter(activo=True)
             for servicio in servicios:
                 try:
@@ -35,26 +113,132 @@ class IngestaSchedulerService:
             return 0
     
     @classmethod
-    def verificar_servicios_pendientes(cls):
+    def verificar_servicios_pendientes(cls, ahora=None):
         """
         Verifica qué servicios están pendientes de ejecución según su programación.
-        Retorna un QuerySet con los servicios que deben ejecutarse.
+        Retorna un QuerySet con los servicios activos cuya proxima_ejecucion ya
+        llegó. Se resuelve con el índice
+        (activo, proxima_ejecucion), así que el costo depende de los servicios
+        vencidos y no del total.
+        """
+        ahora = ahora or timezone.now()
+        return ServicioIngesta.objects.filter(activo=True, proxima_ejecucion__lte=ahora)
+    
+    @classmethod
+    def programacion_siguiente(cls, servicio_id, inicio):
+        """
+        Campos de programación del servicio tras terminar una ejecución que
+        empezó en inicio: proxima_ejecucion y, en el modo adaptativo, el nuevo
+        intervalo según los correos nuevos de la última ejecución registrada
+        en HistorialEjecucion (una ejecución con error no cambia el intervalo).
+        
+        Returns:
+            dict: Campos para actualizar el ServicioIngesta (vacío si no existe)
+        """
+        servicio = ServicioIngesta.objects.filter(id=servicio_id).only(
+            'proxima_ejecucion', 'intervalo_minutos', 'intervalo_adaptativo',
+            'intervalo_minimo_minutos', 'intervalo_maximo_minutos', 'intervalo_actual_minutos',
+        ).first()
+        if servicio is None:
+            return {}
+        
+        campos = {}
+        intervalo = servicio.intervalo_minutos
+        if servicio.intervalo_adaptativo:
+            ultima = HistorialEjecucion.objects.filter(servicio_id=servicio_id).order_by('-fecha_inicio').values(
+                'correos_nuevos', 'estado'
+            ).first()
+            intervalo = servicio.intervalo_efectivo
+            if ultima and ultima['estado'] != HistorialEjecucion.EstadoEjecucion.ERROR:
+                intervalo = intervalo_adaptativo(
+                    intervalo, ultima['correos_nuevos'],
+                    servicio.intervalo_minimo_minutos, servicio.intervalo_maximo_minutos,
+                )
+            campos['intervalo_actual_minutos'] = intervalo
+        
+        campos['proxima_ejecucion'] = siguiente_ejecucion(
+            servicio.proxima_ejecucion, inicio, intervalo, servicio_id=servicio_id
+        )
+        return campos
+    
+    @classmethod
+    def configurar_intervalo_adaptativo(cls, servicio_id, activo, minimo=None, maximo=None, usuario=None):
+        """
+        Activa o desactiva el modo adaptativo de un servicio y fija sus límites.
+        
+        Args:
+            servicio_id: ID del servicio a modificar
+            activo: Si el intervalo debe adaptarse a la actividad del buzón
+            minimo: Intervalo mínimo en minutos (opcional)
+            maximo: Intervalo máximo en minutos (opcional)
+            usuario: Usuario que realiza el cambio
+        
+        Returns:
+            dict: Resultado de la operación
         """
         try:
-            ahora = timezone.now()
-            servicios = ServicioIngesta.objects.filter(
-                activo=True,
-                ultima_ejecucion__isnull=True
-            ) | ServicioIngesta.objects.filter(
-                activo=True,
-                ultima_ejecucion__lt=ahora - timezone.timedelta(minutes=5)  # Intervalo mínimo entre ejecuciones
+            servicio = ServicioIngesta.objects.get(id=servicio_id)
+            
+            servicio.intervalo_adaptativo = bool(activo)
+            if minimo not in (None, ''):
+                servicio.intervalo_minimo_minutos = int(minimo)
+            if maximo not in (None, ''):
+                servicio.intervalo_maximo_minutos = int(maximo)
+            if servicio.intervalo_minimo_minutos < 1:
+                return {
+                    'success': False,
+                    'message': "El intervalo mínimo debe ser mayor a 0 minutos"
+                }
+            if servicio.intervalo_minimo_minutos > servicio.intervalo_maximo_minutos:
+                return {
+                    'success': False,
+                    'message': "El intervalo máximo debe ser mayor o igual que el mínimo"
+                }
+            # El modo adaptativo parte del intervalo fijo del servicio
+            servicio.intervalo_actual_minutos = None
+            
+            if usuario:
+                servicio.modificado_por = usuario
+            
+            servicio.save()
+            
+            LogActividad.objects.create(
+                tenant=servicio.tenant,
+                evento='CONFIGURACION_ACTUALIZADA',
+                detalles=(
+                    f"Intervalo adaptativo {'activado' if servicio.intervalo_adaptativo else 'desactivado'} "
+                    f"({servicio.intervalo_minimo_minutos}-{servicio.intervalo_maximo_minutos} minutos)"
+                ) + (f" por usuario {usuario.email}" if usuario else ""),
+                usuario=usuario
             )
             
-            # En esta versión simplificada, todos los servicios son válidos
-            return servicios
+            return {
+                'success': True,
+                'message': f"Intervalo adaptativo {'activado' if servicio.intervalo_adaptativo else 'desactivado'}",
+                'servicio_id': servicio.id,
+                'intervalo_adaptativo': servicio.intervalo_adaptativo,
+                'intervalo_minimo_minutos': servicio.intervalo_minimo_minutos,
+                'intervalo_maximo_minutos': servicio.intervalo_maximo_minutos,
+            }
+        
+        except ServicioIngesta.DoesNotExist:
+            return {
+                'success': False,
+                'message': f"No se encontró el servicio con ID {servicio_id}"
+            }
+        
+        except ValueError:
+            return {
+                'success': False,
+                'message': "Los intervalos deben ser números enteros"
+            }
+        
         except Exception as e:
-            logger.error(f"Error al verificar servicios pendientes: {str(e)}")
-            return ServicioIngesta.objects.none()
+            logger.error(f"Error al configurar el intervalo adaptativo del servicio {servicio_id}: {str(e)}")
+            return {
+                'success': False,
+                'message': f"Error al configurar el intervalo adaptativo: {str(e)}"
+            }
     
     @classmethod
     def ejecutar_servicio(cls, servicio_id):
@@ -163,6 +347,13 @@ class IngestaSchedulerService:
             if not activo:
                 servicio.en_ejecucion = False
                 servicio.proxima_ejecucion = None
+                # Una ejecución a medias no continúa: su historial se cierra con lo procesado
+                if servicio.continuacion:
+                    HistorialEjecucion.objects.filter(
+                        id=servicio.continuacion.get('historial_id'),
+                        estado=HistorialEjecucion.EstadoEjecucion.EN_PROCESO
+                    ).update(estado=HistorialEjecucion.EstadoEjecucion.PARCIAL, fecha_fin=timezone.now())
+                    ServicioIngesta.objects.filter(id=servicio.id).update(continuacion=None)
             # Si se está activando, actualizar próxima ejecución
             else:
                 servicio.actualizar_proxima_ejecucion()
@@ -279,6 +470,70 @@ class IngestaSchedulerService:
                 'message': f"Error al cambiar el intervalo del servicio: {str(e)}"
             }
     
+    @staticmethod
+    def cancelar_ejecucion(servicio_id, usuario=None):
+        """
+        Solicita cancelar la ejecución en curso (o encolada) de un servicio.
+        La ejecución se detiene en cuanto lo comprueba, entre lotes; una
+        continuación pendiente sin ejecución encolada se cierra aquí.
+        
+        Args:
+            servicio_id: ID del servicio cuya ejecución se cancela
+            usuario: Usuario que solicita la cancelación
+        
+        Returns:
+            dict: Resultado de la operación
+        """
+        try:
+            servicio = ServicioIngesta.objects.get(id=servicio_id)
+            ahora = timezone.now()
+            
+            solicitada = TokenCancelacion.solicitar(servicio.id, ahora)
+            if not solicitada and servicio.continuacion:
+                HistorialEjecucion.objects.filter(
+                    id=servicio.continuacion.get('historial_id'),
+                    estado=HistorialEjecucion.EstadoEjecucion.EN_PROCESO
+                ).update(
+                    estado=HistorialEjecucion.EstadoEjecucion.CANCELADO,
+                    fecha_fin=ahora,
+                    mensaje_error="Ejecución cancelada"
+                )
+                ServicioIngesta.objects.filter(id=servicio.id).update(continuacion=None)
+                solicitada = True
+            
+            if not solicitada:
+                return {
+                    'success': False,
+                    'message': "El servicio no tiene ninguna ejecución en curso"
+                }
+            
+            LogActividad.objects.create(
+                tenant=servicio.tenant,
+                evento='INGESTA_CANCELACION_SOLICITADA',
+                detalles=f"Cancelación de la ejecución de ingesta solicitada" +
+                        (f" por usuario {usuario.email}" if usuario else ""),
+                usuario=usuario
+            )
+            
+            return {
+                'success': True,
+                'message': "Cancelación solicitada; la ejecución se detendrá en breve y conservará lo ya guardado",
+                'servicio_id': servicio.id
+            }
+        
+        except ServicioIngesta.DoesNotExist:
+            return {
+                'success': False,
+                'message': f"No se encontró el servicio con ID {servicio_id}"
+            }
+        
+        except Exception as e:
+            logger.error(f"Error al cancelar la ejecución del servicio {servicio_id}: {str(e)}")
+            return {
+                'success': False,
+                'message': f"Error al cancelar la ejecución: {str(e)}"
+            }
+    
     @staticmethod
     def ejecutar_ahora(servicio_id, usuario=None):
         """
@@ -0,0 +1,141 @@
+"""
+Instantánea inmutable de los campos evaluables de un correo.
+
+Se construye una sola vez por correo (desde el correo guardado con sus adjuntos
+precargados, desde el mensaje parseado o desde los datos del probador de
+reglas) y la comparten las reglas simples, las compuestas y ReglaTestService,
+de modo que ninguna condición vuelve a consultar los adjuntos.
+"""
+
+from apps.ingesta_correo.models import ReglaFiltrado
+
+TipoCampo = ReglaFiltrado.TipoCampo
+
+FORMATO_FECHA = '%Y-%m-%d %H:%M:%S'
+
+
+def normalizar_texto(valor):
+    """Texto plegado (casefold) para comparaciones insensibles a mayúsculas."""
+    return (valor or '').casefold()
+
+
+class InstantaneaCorreo(dict):
+    """
+    Diccionario de solo lectura {campo: valor normalizado} de un correo.
+
+    Los valores son cadenas plegadas con casefold; los agregados de adjuntos
+    también se exponen como atributos numéricos (num_adjuntos, tamaño_adjuntos
+    en bytes). Hereda de dict para que los predicados compilados usen el get()
+    nativo.
+    """
+
+    __slots__ = ('correo_id', 'num_adjuntos', 'tamaño_adjuntos')
+
+    def __init__(self, valores, correo_id=None, num_adjuntos=0, tamaño_adjuntos=0):
+        super().__init__(valores)
+        object.__setattr__(self, 'correo_id', correo_id)
+        object.__setattr__(self, 'num_adjuntos', num_adjuntos)
+        object.__setattr__(self, 'tamaño_adjuntos', tamaño_adjuntos)
+
+    def _inmutable(self, *args, **kwargs):
+        raise TypeError('InstantaneaCorreo es inmutable')
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = __ior__ = _inmutable
+    clear = pop = popitem = setdefault = update = _inmutable
+
+    def __reduce__(self):
+        # Necesario para copiarla o enviarla a otro proceso sin pasar por __setitem__
+        return (self.__class__, (dict(self), self.correo_id, self.num_adjuntos, self.tamaño_adjuntos))
+
+    @classmethod
+    def construir(cls, remitente='', asunto='', contenido='', destinatarios='', fecha_recepcion=None,
+                  adjuntos=(), correo_id=None):
+        """
+        Args:
+            fecha_recepcion: datetime o cadena ya formateada
+            adjuntos: Iterable de tuplas (nombre, tipo de contenido, tamaño en bytes)
+        """
+        nombres, tipos, tamaño = [], [], 0
+        for nombre, tipo, tamaño_adjunto in adjuntos:
+            nombres.append(nombre or '')
+            tipos.append(tipo or '')
+            tamaño += tamaño_adjunto or 0
+        num_adjuntos = len(nombres)
+
+        if fecha_recepcion and not isinstance(fecha_recepcion, str):
+            fecha_recepcion = fecha_recepcion.strftime(FORMATO_FECHA)
+
+        return cls({
+            TipoCampo.REMITENTE: normalizar_texto(remitente),
+            TipoCampo.ASUNTO: normalizar_texto(asunto),
+            TipoCampo.CONTENIDO: normalizar_texto(contenido),
+            'destinatario': normalizar_texto(destinatarios),
+            TipoCampo.ADJUNTO_NOMBRE: normalizar_texto(' '.join(nombres)),
+            TipoCampo.ADJUNTO_TIPO: normalizar_texto(' '.join(tipos)),
+            TipoCampo.ADJUNTO_TAMAÑO: str(tamaño / 1024),
+            TipoCampo.TIENE_ADJUNTOS: str(bool(num_adjuntos)).lower(),
+            TipoCampo.FECHA_RECEPCION: fecha_recepcion or '',
+        }, correo_id=correo_id, num_adjuntos=num_adjuntos, tamaño_adjuntos=tamaño)
+
+    @classmethod
+    def desde_correo(cls, correo):
+        """
+        Instantánea de un CorreoIngesta. Los adjuntos se leen con una sola
+        consulta, o sin ninguna si ya están en la caché de prefetch.
+        """
+        adjuntos = correo.adjuntos.all() if correo.pk else ()
+        return cls.construir(
+            remitente=correo.remitente,
+            asunto=correo.asunto,
+            contenido=correo.contenido_plano,
+            destinatarios=correo.destinatarios,
+            fecha_recepcion=correo.fecha_recepcion,
+            adjuntos=[(adj.nombre_archivo, adj.tipo_contenido, adj.tamaño) for adj in adjuntos],
+            correo_id=correo.pk,
+        )
+
+    @classmethod
+    def desde_parseado(cls, datos, tamaños_adjuntos=None):
+        """
+        Instantánea de un mensaje devuelto por CorreoParserService.parsear.
+
+        Args:
+            tamaños_adjuntos: Tamaños en bytes de los adjuntos, en el mismo orden
+                que datos['adjuntos'], si ya se conocen (p. ej. tras guardarlos)
+        """
+        adjuntos = datos.get('adjuntos', [])
+        tamaños = tamaños_adjuntos or [0] * len(adjuntos)
+        return cls.construir(
+            remitente=datos.get('remitente'),
+            asunto=datos.get('asunto'),
+            contenido=datos.get('contenido_plano'),
+            destinatarios=datos.get('destinatarios'),
+            fecha_recepcion=datos.get('fecha_recepcion'),
+            adjuntos=[
+                (adjunto['nombre_archivo'], adjunto.get('tipo_contenido'), tamaño)
+                for adjunto, tamaño in zip(adjuntos, tamaños)
+            ],
+        )
+
+    @classmethod
+    def desde_datos_prueba(cls, datos_prueba):
+        """
+        Instantánea de los datos de prueba del probador de reglas: asunto,
+        remitente, destinatario, contenido, adjunto (nombre) y, opcionalmente,
+        adjunto_tipo, adjunto_tamaño (KB) y fecha_recepcion.
+        """
+        nombre = datos_prueba.get('adjunto') or datos_prueba.get(TipoCampo.ADJUNTO_NOMBRE) or ''
+        tamaño_kb = datos_prueba.get(TipoCampo.ADJUNTO_TAMAÑO) or 0
+        try:
+            tamaño = float(tamaño_kb) * 1024
+        except (TypeError, ValueError):
+            tamaño = 0
+        adjuntos = [(nombre, datos_prueba.get(TipoCampo.ADJUNTO_TIPO, ''), tamaño)] if nombre else []
+        return cls.construir(
+            remitente=datos_prueba.get('remitente'),
+            asunto=datos_prueba.get('asunto'),
+            contenido=datos_prueba.get('contenido'),
+            destinatarios=datos_prueba.get('destinatario') or datos_prueba.get('destinatarios'),
+            fecha_recepcion=datos_prueba.get(TipoCampo.FECHA_RECEPCION),
+            adjuntos=adjuntos,
+        )
@@ -0,0 +1,154 @@
+"""
+Lease de ejecución por servicio de ingesta (una sola ejecución a la vez).
+
+process_email_ingestion adquiere el lease de su servicio antes de conectarse
+al buzón y lo renueva en cada lote; si otra ejecución lo tiene vigente, la
+nueva termina sin hacer nada. El lease caduca a los LEASE_SEGUNDOS sin
+renovarse, así que el de un worker caído se recupera solo, y si una ejecución
+descubre al renovar que perdió su lease se detiene para no solaparse con la
+que lo tomó.
+
+El lease se guarda en la fila de ServicioIngesta (lease_token/lease_expira) o
+en la caché de Django, según INGESTA_LEASE_BACKEND ('db' o 'cache'); la caché
+debe ser compartida entre workers (Redis, Memcached o base de datos).
+"""
+
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ServicioIngesta
+
+logger = logging.getLogger(__name__)
+
+LEASE_BACKEND = getattr(settings, 'INGESTA_LEASE_BACKEND', 'db')
+LEASE_SEGUNDOS = getattr(settings, 'INGESTA_LEASE_SEGUNDOS', 300)
+PREFIJO_CACHE = 'ingesta:lease:'
+
+
+class AlmacenLeaseDb:
+    """Lease en las columnas lease_token/lease_expira de ServicioIngesta, con UPDATE condicionales."""
+
+    def adquirir(self, servicio_id, token, segundos):
+        ahora = timezone.now()
+        return ServicioIngesta.objects.filter(
+            Q(lease_expira__isnull=True) | Q(lease_expira__lte=ahora), id=servicio_id
+        ).update(lease_token=token, lease_expira=ahora + timezone.timedelta(seconds=segundos)) == 1
+
+    def renovar(self, servicio_id, token, segundos):
+        return ServicioIngesta.objects.filter(id=servicio_id, lease_token=token).update(
+            lease_expira=timezone.now() + timezone.timedelta(seconds=segundos)
+        ) == 1
+
+    def liberar(self, servicio_id, token):
+        ServicioIngesta.objects.filter(id=servicio_id, lease_token=token).update(lease_token=None, lease_expira=None)
+
+    def vigentes(self, servicio_ids):
+        return set(
+            ServicioIngesta.objects.filter(id__in=servicio_ids, lease_expira__gt=timezone.now())
+            .values_list('id', flat=True)
+        )
+
+
+class AlmacenLeaseCache:
+    """Lease en la caché de Django: add() solo escribe si la clave no existe o ya expiró."""
+
+    def _clave(self, servicio_id):
+        return f'{PREFIJO_CACHE}{servicio_id}'
+
+    def adquirir(self, servicio_id, token, segundos):
+        return cache.add(self._clave(servicio_id), token, segundos)
+
+    def renovar(self, servicio_id, token, segundos):
+        # Leer y extender no es atómico, pero solo el dueño renueva y otro worker
+        # solo puede tomar la clave después de que expire
+        clave = self._clave(servicio_id)
+        return cache.get(clave) == token and cache.touch(clave, segundos)
+
+    def liberar(self, servicio_id, token):
+        clave = self._clave(servicio_id)
+        if cache.get(clave) == token:
+            cache.delete(clave)
+
+    def vigentes(self, servicio_ids):
+        claves = {self._clave(servicio_id): servicio_id for servicio_id in servicio_ids}
+        return {claves[clave] for clave in cache.get_many(list(claves))}
+
+
+ALMACENES = {'db': AlmacenLeaseDb, 'cache': AlmacenLeaseCache}
+
+
+def obtener_almacen(backend=None):
+    backend = backend or LEASE_BACKEND
+    if backend not in ALMACENES:
+        raise Exception(f"Backend de lease desconocido: {backend}")
+    return ALMACENES[backend]()
+
+
+class LeaseIngesta:
+    """
+    Lease adquirido por una ejecución.
+
+    Uso:
+        lease = LeaseIngesta.adquirir(servicio_id)
+        if lease is None:
+            ...  # otra ejecución está en curso
+        try:
+            ...
+            lease.latido()  # en cada lote
+        finally:
+            lease.liberar()
+    """
+
+    def __init__(self, servicio_id, token, almacen, segundos):
+        self.servicio_id = servicio_id
+        self.token = token
+        self.almacen = almacen
+        self.segundos = segundos
+        self.renovado = time.monotonic()
+
+    @classmethod
+    def adquirir(cls, servicio_id, segundos=None, backend=None):
+        """
+        Returns:
+            LeaseIngesta, o None si otra ejecución tiene el lease vigente
+        """
+        almacen = obtener_almacen(backend)
+        segundos = segundos or LEASE_SEGUNDOS
+        token = uuid.uuid4().hex
+        if not almacen.adquirir(servicio_id, token, segundos):
+            return None
+        return cls(servicio_id, token, almacen, segundos)
+
+    @staticmethod
+    def vigentes(servicio_ids, backend=None):
+        """IDs de los servicios con un lease vigente."""
+        servicio_ids = list(servicio_ids)
+        if not servicio_ids:
+            return set()
+        return obtener_almacen(backend).vigentes(servicio_ids)
+
+    def latido(self):
+        """
+        Renueva el lease si pasó un tercio de su duración desde la última
+        renovación (para no escribir en cada lote).
+
+        Raises:
+            Exception: Si el lease expiró y lo tomó otra ejecución
+        """
+        if time.monotonic() - self.renovado < self.segundos / 3:
+            return
+        if not self.almacen.renovar(self.servicio_id, self.token, self.segundos):
+            raise Exception(f"Se perdió el lease del servicio {self.servicio_id}; otra ejecución lo tomó")
+        self.renovado = time.monotonic()
+
+    def liberar(self):
+        try:
+            self.almacen.liberar(self.servicio_id, self.token)
+        except Exception as e:
+            logger.error(f"Error al liberar el lease del servicio {self.servicio_id}: {str(e)}")
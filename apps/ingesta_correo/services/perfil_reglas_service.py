@@ -0,0 +1,240 @@
+"""
+Perfil del coste de evaluación de las reglas de filtrado.
+
+Con el perfil activado para el tenant, en una fracción de los correos se
+cronometra cada regla evaluada y cada condición de las reglas compuestas. Las
+mediciones se acumulan en memoria del proceso y se vuelcan cada
+INTERVALO_FLUSH segundos en EstadisticaRegla, una fila por regla (o condición)
+y hora. Los tiempos se guardan en un histograma de potencias de 2 para
+calcular p50/p95 sin conservar cada medición.
+"""
+
+import logging
+import random
+import threading
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from apps.configuracion.models import EmailConfig
+from apps.ingesta_correo.models import CondicionRegla, EstadisticaRegla, ReglaFiltrado
+
+logger = logging.getLogger(__name__)
+
+INTERVALO_FLUSH = 60
+CUBETAS = 40
+
+
+def cubeta(nanosegundos):
+    """Índice de la cubeta del histograma: la de [2^(i-1), 2^i) ns."""
+    return min(int(nanosegundos).bit_length(), CUBETAS - 1)
+
+
+def sumar_histogramas(destino, origen):
+    if len(destino) < len(origen):
+        destino.extend([0] * (len(origen) - len(destino)))
+    for indice, cantidad in enumerate(origen):
+        destino[indice] += cantidad
+    return destino
+
+
+def percentil(histograma, fraccion):
+    """
+    Percentil aproximado en nanosegundos: el punto medio geométrico de la
+    cubeta que lo contiene (error máximo de un factor √2).
+    """
+    total = sum(histograma)
+    if not total:
+        return None
+    objetivo = fraccion * total
+    acumulado = 0
+    for indice, cantidad in enumerate(histograma):
+        acumulado += cantidad
+        if cantidad and acumulado >= objetivo:
+            return 2 ** (indice - 0.5) if indice else 0
+    return 2 ** (len(histograma) - 0.5)
+
+
+class PerfilReglas:
+    """Mediciones pendientes de volcar de los correos muestreados de un tenant."""
+
+    def __init__(self, tenant_id, muestreo=0.1, aleatorio=None):
+        self.tenant_id = tenant_id
+        self.muestreo = min(max(muestreo, 0.0), 1.0)
+        self.aleatorio = aleatorio or random
+        # {(regla_id, condicion_id): [evaluaciones, coincidencias, ns, histograma]}
+        self.mediciones = {}
+        self.ultimo_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def muestrear(self):
+        """Decide si se cronometra la evaluación del correo actual."""
+        return self.aleatorio.random() < self.muestreo
+
+    def registrar(self, regla_id, condicion_id, nanosegundos, cumple):
+        medicion = self.mediciones.get((regla_id, condicion_id))
+        if medicion is None:
+            medicion = self.mediciones[(regla_id, condicion_id)] = [0, 0, 0, [0] * CUBETAS]
+        medicion[0] += 1
+        medicion[1] += cumple
+        medicion[2] += nanosegundos
+        medicion[3][cubeta(nanosegundos)] += 1
+
+    def flush_si_corresponde(self):
+        """Vuelca las mediciones si pasaron INTERVALO_FLUSH segundos desde el último volcado."""
+        if time.monotonic() - self.ultimo_flush >= INTERVALO_FLUSH:
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """
+        Suma las mediciones acumuladas a las filas de EstadisticaRegla de la
+        hora actual, creando las que falten.
+
+        Returns:
+            int: Número de filas escritas
+        """
+        with self._lock:
+            mediciones, self.mediciones = self.mediciones, {}
+            self.ultimo_flush = time.monotonic()
+        if not mediciones:
+            return 0
+
+        periodo = timezone.now().replace(minute=0, second=0, microsecond=0)
+        try:
+            # Las reglas o condiciones borradas desde la medición se descartan
+            reglas = set(ReglaFiltrado.objects.filter(
+                id__in={regla_id for regla_id, _ in mediciones}
+            ).values_list('id', flat=True))
+            condiciones = set(CondicionRegla.objects.filter(
+                id__in={condicion_id for _, condicion_id in mediciones if condicion_id}
+            ).values_list('id', flat=True))
+            mediciones = {
+                clave: medicion for clave, medicion in mediciones.items()
+                if clave[0] in reglas and (clave[1] is None or clave[1] in condiciones)
+            }
+
+            with transaction.atomic():
+                # Filas bloqueadas en orden de id para que los workers no se interbloqueen
+                existentes = {}
+                for fila in (
+                    EstadisticaRegla.objects.select_for_update()
+                    .filter(periodo=periodo, regla_id__in=reglas)
+                    .order_by('id')
+                ):
+                    existentes.setdefault((fila.regla_id, fila.condicion_id), fila)
+
+                actualizar, crear = [], []
+                for (regla_id, condicion_id), (evaluaciones, coincidencias, ns, histograma) in mediciones.items():
+                    fila = existentes.get((regla_id, condicion_id))
+                    if fila is None:
+                        crear.append(EstadisticaRegla(
+                            regla_id=regla_id, condicion_id=condicion_id, periodo=periodo,
+                            evaluaciones=evaluaciones, coincidencias=coincidencias,
+                            tiempo_total_ns=ns, histograma=histograma,
+                        ))
+                        continue
+                    fila.evaluaciones += evaluaciones
+                    fila.coincidencias += coincidencias
+                    fila.tiempo_total_ns += ns
+                    fila.histograma = sumar_histogramas(list(fila.histograma or []), histograma)
+                    actualizar.append(fila)
+
+                EstadisticaRegla.objects.bulk_update(
+                    actualizar, ['evaluaciones', 'coincidencias', 'tiempo_total_ns', 'histograma']
+                )
+                EstadisticaRegla.objects.bulk_create(crear)
+            return len(actualizar) + len(crear)
+        except Exception as e:
+            logger.error(f"Error al guardar el perfil de reglas del tenant {self.tenant_id}: {str(e)}")
+            return 0
+
+
+class PerfilReglasService:
+    """Perfiles en proceso por tenant y consulta de las estadísticas guardadas."""
+
+    _perfiles = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def para_tenant(cls, tenant_id):
+        """
+        Perfil del proceso para el tenant, o None si el tenant no lo tiene
+        activado. Cuesta una consulta; se recomienda obtenerlo una vez por lote.
+        """
+        config = (
+            EmailConfig.objects.filter(tenant_id=tenant_id)
+            .values_list('rule_profiling_enabled', 'rule_profiling_sample_rate')
+            .first()
+        )
+        if not config or not config[0]:
+            return None
+
+        with cls._lock:
+            perfil = cls._perfiles.get(tenant_id)
+            if perfil is None:
+                perfil = cls._perfiles[tenant_id] = PerfilReglas(tenant_id, config[1])
+        perfil.muestreo = min(max(config[1], 0.0), 1.0)
+        return perfil
+
+    @staticmethod
+    def resumen(regla_ids, dias=7):
+        """
+        Coste de evaluación de las reglas en los últimos días.
+
+        Returns:
+            dict: {regla_id: {'evaluaciones', 'coincidencias', 'media_us',
+            'p50_us', 'p95_us', 'condiciones': {condicion_id: {...}}}}
+        """
+        desde = timezone.now() - timedelta(days=dias)
+        acumulado = {}
+        for regla_id, condicion_id, evaluaciones, coincidencias, ns, histograma in (
+            EstadisticaRegla.objects.filter(regla_id__in=regla_ids, periodo__gte=desde)
+            .values_list('regla_id', 'condicion_id', 'evaluaciones', 'coincidencias', 'tiempo_total_ns', 'histograma')
+        ):
+            total = acumulado.setdefault((regla_id, condicion_id), [0, 0, 0, []])
+            total[0] += evaluaciones
+            total[1] += coincidencias
+            total[2] += ns
+            sumar_histogramas(total[3], histograma or [])
+
+        resumen = {}
+        for (regla_id, condicion_id), (evaluaciones, coincidencias, ns, histograma) in acumulado.items():
+            datos = {
+                'evaluaciones': evaluaciones,
+                'coincidencias': coincidencias,
+                'media_us': round(ns / evaluaciones / 1000, 1) if evaluaciones else None,
+                'p50_us': PerfilReglasService._a_us(percentil(histograma, 0.5)),
+                'p95_us': PerfilReglasService._a_us(percentil(histograma, 0.95)),
+            }
+            regla = resumen.setdefault(regla_id, {'condiciones': {}})
+            if condicion_id is None:
+                regla.update(datos)
+            else:
+                regla['condiciones'][condicion_id] = datos
+        return resumen
+
+    @staticmethod
+    def _a_us(nanosegundos):
+        return round(nanosegundos / 1000, 1) if nanosegundos is not None else None
+
+    @staticmethod
+    def reglas_mas_costosas(servicio_id, dias=7, limite=10):
+        """
+        Reglas del servicio con mayor tiempo total de evaluación muestreado.
+
+        Returns:
+            list: Diccionarios con regla_id, regla__nombre, tiempo_total_ns y evaluaciones
+        """
+        desde = timezone.now() - timedelta(days=dias)
+        return list(
+            EstadisticaRegla.objects.filter(
+                regla__servicio_id=servicio_id, condicion__isnull=True, periodo__gte=desde
+            )
+            .values('regla_id', 'regla__nombre')
+            .annotate(tiempo_total_ns=Sum('tiempo_total_ns'), evaluaciones=Sum('evaluaciones'))
+            .order_by('-tiempo_total_ns')[:limite]
+        )
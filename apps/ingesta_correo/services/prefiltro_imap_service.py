@@ -0,0 +1,239 @@
+"""
+Prefiltro IMAP de las reglas que ignoran correo.
+
+Las reglas IGNORAR que solo miran cabeceras (remitente, asunto y fecha de
+recepción con CONTIENE/ES_IGUAL) se traducen a un criterio de UID SEARCH para
+que el servidor señale los mensajes candidatos antes de descargarlos. Cada
+candidato se confirma con sus cabeceras y los mismos predicados compilados del
+motor de reglas, de modo que solo se omite la descarga de los mensajes que la
+ingesta habría ignorado con certeza; el resto sigue el camino normal.
+
+Solo se usan las reglas IGNORAR que preceden por prioridad a toda regla con
+otra acción: así la primera regla que coincide, sea cual sea, también ignora.
+Si una regla IGNORAR no traducible precede a la que confirma el prefiltro, el
+historial atribuye el correo a esta última.
+"""
+
+import logging
+import re
+from datetime import date, timedelta
+from email.utils import parsedate_to_datetime
+
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_motor_service import (
+    ReglaMotorService, normalizar_campo, normalizar_condicion
+)
+
+logger = logging.getLogger(__name__)
+
+TipoCampo = ReglaFiltrado.TipoCampo
+TipoCondicion = ReglaFiltrado.TipoCondicion
+
+CLAVES_TEXTO = {TipoCampo.REMITENTE: 'FROM', TipoCampo.ASUNTO: 'SUBJECT'}
+CONDICIONES_ELEGIBLES = (TipoCondicion.CONTIENE, TipoCondicion.ES_IGUAL)
+# Prefijo 'AAAA', 'AAAA-MM' o 'AAAA-MM-DD' del formato de fecha de InstantaneaCorreo
+FECHA_RE = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?')
+MESES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+# Límite de reglas por SEARCH para acotar la longitud del comando
+MAX_REGLAS = 50
+
+
+def _fecha_imap(dia):
+    return f'{dia.day}-{MESES[dia.month - 1]}-{dia.year}'
+
+
+def _cadena_imap(valor):
+    """Cadena entre comillas de IMAP, o None si requiere un literal (no ASCII o saltos de línea)."""
+    if not valor or not valor.isascii() or '\r' in valor or '\n' in valor:
+        return None
+    return '"' + valor.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _criterio_fecha(condicion, valor):
+    """
+    SENTON o SENTSINCE/SENTBEFORE para una fecha de recepción que empieza por
+    un año, mes o día concreto. Usa la cabecera Date, igual que la ingesta; en
+    'AAAA-MM-DD HH:MM:SS' solo el año tiene cuatro cifras seguidas, así que
+    CONTIENE con un valor así equivale a un prefijo.
+    """
+    coincidencia = FECHA_RE.match(valor)
+    if not coincidencia:
+        return None
+    año, mes, dia = coincidencia.groups()
+    if condicion == TipoCondicion.ES_IGUAL and not dia:
+        return None
+    try:
+        if dia:
+            return f'SENTON {_fecha_imap(date(int(año), int(mes), int(dia)))}'
+        if mes:
+            inicio = date(int(año), int(mes), 1)
+            fin = (inicio + timedelta(days=31)).replace(day=1)
+        else:
+            inicio, fin = date(int(año), 1, 1), date(int(año) + 1, 1, 1)
+    except ValueError:
+        return None
+    return f'SENTSINCE {_fecha_imap(inicio)} SENTBEFORE {_fecha_imap(fin)}'
+
+
+def criterio_condicion(campo, condicion, valor):
+    """
+    Criterio de SEARCH que incluye a todos los mensajes que cumplen la
+    condición (puede incluir más), o None si la condición no es traducible.
+    """
+    campo = normalizar_campo(campo)
+    condicion = normalizar_condicion(condicion)
+    if condicion not in CONDICIONES_ELEGIBLES or not valor:
+        return None
+    if campo in CLAVES_TEXTO:
+        cadena = _cadena_imap(valor)
+        return f'{CLAVES_TEXTO[campo]} {cadena}' if cadena else None
+    if campo == TipoCampo.FECHA_RECEPCION:
+        return _criterio_fecha(condicion, valor.strip())
+    return None
+
+
+def criterio_regla(regla, condiciones=None):
+    """
+    Criterio de SEARCH de una regla completa, o None si alguna condición no es traducible.
+
+    Args:
+        regla: Objeto ReglaFiltrado
+        condiciones: Condiciones de la regla compuesta; si se omiten se usan
+            las de regla.condiciones (prefetch si está disponible)
+    """
+    if not regla.es_compuesta:
+        return criterio_condicion(regla.campo, regla.condicion, regla.valor)
+
+    if condiciones is None:
+        condiciones = regla.condiciones.all()
+    condiciones = sorted(condiciones, key=lambda condicion: condicion.orden)
+    criterios = [criterio_condicion(c.campo, c.condicion, c.valor) for c in condiciones]
+    if not criterios or None in criterios:
+        return None
+    if len(criterios) == 1:
+        return criterios[0]
+    if regla.operador_logico == ReglaFiltrado.TipoOperador.Y:
+        return '(' + ' '.join(criterios) + ')'
+    return _disyuncion(criterios)
+
+
+def _disyuncion(criterios):
+    """OR de IMAP es binario: OR a OR b c."""
+    criterio = criterios[-1]
+    for anterior in reversed(criterios[:-1]):
+        criterio = f'OR {anterior} {criterio}'
+    return criterio
+
+
+class PrefiltroImap:
+    """Reglas IGNORAR traducidas a SEARCH y confirmadas con las cabeceras del mensaje."""
+
+    def __init__(self, motor, reglas, criterio):
+        """
+        Args:
+            motor: MotorReglas del servicio, para confirmar con sus predicados
+            reglas: ReglaCompilada elegibles, en orden de prioridad
+            criterio: Criterio de SEARCH que cubre todas las reglas
+        """
+        self.motor = motor
+        self.reglas = reglas
+        self.criterio = criterio
+        self.candidatos = set()
+        # Mensajes omitidos en el último lote de ImapSyncService.fetch_lotes
+        self.omitidos = []
+
+    @classmethod
+    def desde_motor(cls, motor, ahora=None):
+        """
+        Construye el prefiltro con las reglas IGNORAR vigentes que preceden a
+        cualquier regla con otra acción, o devuelve None si no hay ninguna
+        traducible.
+        """
+        ahora = ahora or timezone.now()
+        elegibles = []
+        criterios = []
+        for compilada in motor.reglas:
+            if not compilada.vigente(ahora):
+                continue
+            if compilada.accion != ReglaFiltrado.TipoAccion.IGNORAR:
+                break
+            criterio = criterio_regla(compilada.regla)
+            if criterio is None:
+                continue
+            elegibles.append(compilada)
+            criterios.append(criterio)
+            if len(elegibles) >= MAX_REGLAS:
+                break
+
+        if not elegibles:
+            return None
+        return cls(motor, elegibles, _disyuncion(criterios))
+
+    @classmethod
+    def para_servicio(cls, servicio_id):
+        """Prefiltro de las reglas activas del servicio (usa el motor en caché)."""
+        return cls.desde_motor(ReglaMotorService.obtener_motor(servicio_id))
+
+    def buscar(self, server, uids):
+        """
+        Ejecuta el UID SEARCH sobre el rango de UID pendientes y guarda los
+        candidatos. Si el servidor rechaza el criterio no se omite nada.
+
+        Returns:
+            set: UID candidatos a ignorarse
+        """
+        self.candidatos = set()
+        if not uids:
+            return self.candidatos
+        try:
+            result, data = server.uid('SEARCH', None, f'UID {min(uids)}:{max(uids)} {self.criterio}')
+        except Exception as e:
+            logger.warning(f"El servidor IMAP no aceptó el prefiltro de reglas: {str(e)}")
+            return self.candidatos
+        if result != 'OK':
+            logger.warning(f"El servidor IMAP no aceptó el prefiltro de reglas: {data}")
+            return self.candidatos
+
+        pendientes = set(uids)
+        self.candidatos = {
+            int(uid) for uid in (data[0].split() if data and data[0] else []) if int(uid) in pendientes
+        }
+        return self.candidatos
+
+    @staticmethod
+    def _fecha(valor):
+        """Fecha de la cabecera Date como la interpreta CorreoParserService, o None si no hay."""
+        if not valor:
+            return None
+        try:
+            fecha = parsedate_to_datetime(valor)
+        except (TypeError, ValueError):
+            return None
+        if timezone.is_naive(fecha):
+            fecha = timezone.make_aware(fecha)
+        return fecha
+
+    def confirmar(self, cabecera):
+        """
+        Regla que ignora con certeza el mensaje según sus cabeceras, o None.
+
+        Args:
+            cabecera: Datos del mensaje devueltos por ImapSyncService.fetch_cabeceras
+        """
+        if not cabecera:
+            return None
+        fecha = self._fecha(cabecera.get('fecha'))
+        instantanea = InstantaneaCorreo.construir(
+            remitente=CorreoParserService.decodificar_cabecera(cabecera.get('remitente')),
+            asunto=CorreoParserService.decodificar_cabecera(cabecera.get('asunto')),
+            fecha_recepcion=fecha,
+        )
+        encontrados = self.motor.buscar_patrones(instantanea)
+        for compilada in self.reglas:
+            if compilada.predicado(instantanea, encontrados):
+                return compilada
+        return None
@@ -0,0 +1,55 @@
+"""
+Presupuesto de una ejecución de ingesta en mensajes y en tiempo.
+
+process_email_ingestion ya no intenta vaciar todo el buzón en una sola
+tarea: cada ejecución (tramo) procesa como mucho PRESUPUESTO_MENSAJES
+mensajes y deja de pedir lotes al pasar PRESUPUESTO_SEGUNDOS. Si quedan
+mensajes, guarda en ServicioIngesta.continuacion el punto desde el que
+seguir y el servicio queda vencido de inmediato, de modo que el despacho
+encola la continuación respetando los cupos y alternando con los demás
+tenants. Todos los tramos acumulan sus totales en el mismo
+HistorialEjecucion, que sigue EN_PROCESO hasta el último.
+
+Tramos cortos también mantienen las tareas muy por debajo del visibility
+timeout del broker y no retienen los mensajes prefetcheados de un worker.
+"""
+
+import time
+
+from django.conf import settings
+
+PRESUPUESTO_MENSAJES = getattr(settings, 'INGESTA_PRESUPUESTO_MENSAJES', 1000)
+PRESUPUESTO_SEGUNDOS = getattr(settings, 'INGESTA_PRESUPUESTO_SEGUNDOS', 300)
+
+
+class PresupuestoIngesta:
+    """
+    Presupuesto de un tramo.
+
+    Uso:
+        presupuesto = PresupuestoIngesta()
+        pendientes = presupuesto.recortar(uids)
+        for lote in lotes:
+            if presupuesto.agotado():
+                presupuesto.pendiente = True
+                break
+            ...
+    """
+
+    def __init__(self, mensajes=None, segundos=None):
+        self.mensajes = mensajes if mensajes is not None else PRESUPUESTO_MENSAJES
+        self.segundos = segundos if segundos is not None else PRESUPUESTO_SEGUNDOS
+        self.inicio = time.monotonic()
+        # Si al terminar el tramo quedan mensajes para una continuación
+        self.pendiente = False
+
+    def recortar(self, elementos):
+        """Los primeros elementos que caben en el presupuesto de mensajes; marca pendiente si sobran."""
+        if self.mensajes and len(elementos) > self.mensajes:
+            self.pendiente = True
+            return elementos[:self.mensajes]
+        return elementos
+
+    def agotado(self):
+        """Si el tramo ya consumió su tiempo (se comprueba entre lotes)."""
+        return bool(self.segundos) and time.monotonic() - self.inicio >= self.segundos
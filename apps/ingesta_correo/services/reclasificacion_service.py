@@ -0,0 +1,335 @@
+"""
+Reclasificación masiva de correos históricos tras cambiar las reglas de filtrado.
+
+Los correos se procesan por trozos en formato columnar: cada campo evaluable
+es un array de NumPy, cada condición produce una máscara booleana, las reglas
+compuestas combinan sus máscaras con AND/OR y la regla ganadora de cada correo
+se obtiene con un argmax sobre la matriz de máscaras ordenada por prioridad.
+Los estados resultantes se guardan con bulk_update.
+
+Sin NumPy se usa el motor compilado correo a correo, con el mismo resultado.
+"""
+
+import logging
+import re
+
+from django.db import transaction
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ArchivoAdjunto, CorreoIngesta, HistorialAplicacionRegla, ReglaFiltrado
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo, normalizar_texto
+from apps.ingesta_correo.services.regla_motor_service import (
+    VALORES_FALSOS, VALORES_VERDADEROS, MotorReglas, ReglaMotorService, RegistroPatrones,
+    _a_numero, normalizar_campo, normalizar_condicion,
+)
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depende del entorno
+    np = None
+
+logger = logging.getLogger(__name__)
+
+TipoCampo = ReglaFiltrado.TipoCampo
+TipoCondicion = ReglaFiltrado.TipoCondicion
+
+# Campos más largos que esto no se convierten a arrays de ancho fijo (np.str_):
+# ocuparían n × longitud máxima × 4 bytes
+LONGITUD_MAXIMA_STR = 2048
+
+
+class EvaluadorVectorizado:
+    """Evalúa un conjunto de reglas sobre un trozo de correos con operaciones por columnas."""
+
+    def __init__(self, reglas, ahora=None):
+        """
+        Args:
+            reglas: ReglaFiltrado ordenadas por prioridad, con condiciones precargadas
+            ahora: Momento con el que se comprueba la vigencia de las reglas
+        """
+        ahora = ahora or timezone.now()
+        self.reglas = reglas
+        self.registro = RegistroPatrones()
+        self.vigentes = []
+        # Por regla: (operador, [(campo, condición, valor, clave del patrón)])
+        self.especificaciones = []
+
+        for regla in reglas:
+            if regla.es_compuesta:
+                condiciones = [
+                    (condicion.campo, condicion.condicion, condicion.valor)
+                    for condicion in sorted(regla.condiciones.all(), key=lambda condicion: condicion.orden)
+                ]
+                operador = regla.operador_logico
+            else:
+                condiciones = [(regla.campo, regla.condicion, regla.valor)]
+                operador = ReglaFiltrado.TipoOperador.Y
+
+            especificacion = []
+            for campo, condicion, valor in condiciones:
+                campo = normalizar_campo(campo)
+                condicion = normalizar_condicion(condicion)
+                valor = valor or ''
+                clave = None
+                if valor and condicion in (TipoCondicion.CONTIENE, TipoCondicion.NO_CONTIENE):
+                    clave = self.registro.registrar(campo, normalizar_texto(valor))
+                especificacion.append((campo, condicion, valor, clave))
+            self.especificaciones.append((operador, especificacion))
+
+            self.vigentes.append(
+                not (regla.fecha_inicio and ahora < regla.fecha_inicio)
+                and not (regla.fecha_fin and ahora > regla.fecha_fin)
+            )
+
+        self.registro.construir()
+        self.total_claves = sum(len(patrones) for patrones in self.registro.patrones.values())
+        self._motor = None
+
+    def ganadoras(self, instantaneas):
+        """
+        Índice en self.reglas de la regla que se aplica a cada correo, o -1 si ninguna.
+
+        Args:
+            instantaneas: Lista de InstantaneaCorreo del trozo
+
+        Returns:
+            list: Un índice por correo
+        """
+        if not instantaneas or not self.reglas:
+            return [-1] * len(instantaneas)
+        if np is None:
+            return self._ganadoras_motor(instantaneas)
+
+        n = len(instantaneas)
+        columnas = {}
+        encontrados = np.zeros((self.total_claves, n), dtype=bool)
+        for j, instantanea in enumerate(instantaneas):
+            for clave in self.registro.buscar(instantanea):
+                encontrados[clave, j] = True
+
+        # Las condiciones repetidas entre reglas se evalúan una sola vez por trozo
+        parciales_por_condicion = {}
+        mascaras = np.zeros((len(self.reglas), n), dtype=bool)
+        for i, (operador, condiciones) in enumerate(self.especificaciones):
+            if not self.vigentes[i] or not condiciones:
+                continue
+            parciales = []
+            for especificacion in condiciones:
+                if especificacion not in parciales_por_condicion:
+                    parciales_por_condicion[especificacion] = self._mascara(
+                        *especificacion, instantaneas, columnas, encontrados
+                    )
+                parciales.append(parciales_por_condicion[especificacion])
+            if operador == ReglaFiltrado.TipoOperador.Y:
+                mascaras[i] = np.logical_and.reduce(parciales)
+            else:
+                mascaras[i] = np.logical_or.reduce(parciales)
+
+        # argmax devuelve la primera fila (mayor prioridad) con True en cada columna
+        return np.where(mascaras.any(axis=0), mascaras.argmax(axis=0), -1).tolist()
+
+    def _columna(self, campo, instantaneas, columnas):
+        if campo not in columnas:
+            columnas[campo] = np.array([instantanea.get(campo, '') for instantanea in instantaneas], dtype=object)
+        return columnas[campo]
+
+    def _columna_str(self, campo, instantaneas, columnas):
+        """Columna como array np.str_ para las funciones np.char, o None si el campo es demasiado largo."""
+        clave = (campo, str)
+        if clave not in columnas:
+            columna = self._columna(campo, instantaneas, columnas)
+            longitud = max(map(len, columna), default=0)
+            columnas[clave] = columna.astype(str) if longitud <= LONGITUD_MAXIMA_STR else None
+        return columnas[clave]
+
+    def _columna_numerica(self, campo, instantaneas, columnas):
+        clave = (campo, float)
+        if clave not in columnas:
+            if campo == TipoCampo.ADJUNTO_TAMAÑO:
+                valores = [instantanea.tamaño_adjuntos / 1024 for instantanea in instantaneas]
+            else:
+                valores = [_a_numero(instantanea.get(campo)) for instantanea in instantaneas]
+            columnas[clave] = np.array([np.nan if valor is None else valor for valor in valores], dtype=float)
+        return columnas[clave]
+
+    def _mascara(self, campo, condicion, valor, clave, instantaneas, columnas, encontrados):
+        """Máscara booleana de una condición sobre todo el trozo."""
+        n = len(instantaneas)
+        valor_normalizado = normalizar_texto(valor)
+
+        if condicion == TipoCondicion.CONTIENE:
+            return encontrados[clave] if clave is not None else np.ones(n, dtype=bool)
+        if condicion == TipoCondicion.NO_CONTIENE:
+            return ~encontrados[clave] if clave is not None else np.zeros(n, dtype=bool)
+        if condicion in (TipoCondicion.MAYOR_QUE, TipoCondicion.MENOR_QUE):
+            umbral = _a_numero(valor)
+            if umbral is None:
+                return np.zeros(n, dtype=bool)
+            numeros = self._columna_numerica(campo, instantaneas, columnas)
+            # Las comparaciones con NaN (valor no numérico) son False
+            with np.errstate(invalid='ignore'):
+                return numeros > umbral if condicion == TipoCondicion.MAYOR_QUE else numeros < umbral
+
+        columna = self._columna(campo, instantaneas, columnas)
+        if condicion == TipoCondicion.ES_IGUAL:
+            return (columna == valor_normalizado).astype(bool)
+        if condicion == TipoCondicion.NO_ES_IGUAL:
+            return (columna != valor_normalizado).astype(bool)
+        if condicion == TipoCondicion.ES_VERDADERO:
+            return np.isin(columna, VALORES_VERDADEROS)
+        if condicion == TipoCondicion.ES_FALSO:
+            return np.isin(columna, VALORES_FALSOS)
+        if condicion in (TipoCondicion.EMPIEZA_CON, TipoCondicion.TERMINA_CON):
+            columna_str = self._columna_str(campo, instantaneas, columnas)
+            if condicion == TipoCondicion.EMPIEZA_CON:
+                if columna_str is not None:
+                    return np.char.startswith(columna_str, valor_normalizado)
+                funcion = lambda texto: texto.startswith(valor_normalizado)
+            else:
+                if columna_str is not None:
+                    return np.char.endswith(columna_str, valor_normalizado)
+                funcion = lambda texto: texto.endswith(valor_normalizado)
+        elif condicion == TipoCondicion.REGEX:
+            try:
+                patron = re.compile(valor, re.IGNORECASE)
+            except re.error:
+                return np.zeros(n, dtype=bool)
+            funcion = lambda texto: patron.search(texto) is not None
+        else:
+            return np.zeros(n, dtype=bool)
+        return np.fromiter(map(funcion, columna), dtype=bool, count=n)
+
+    def _ganadoras_motor(self, instantaneas):
+        """Alternativa sin NumPy: el motor compilado correo a correo."""
+        if self._motor is None:
+            registro = RegistroPatrones()
+            self._motor = MotorReglas(
+                [ReglaMotorService.compilar_regla(regla, registro=registro) for regla in self.reglas],
+                registro=registro,
+            )
+            self._indices = {regla.id: indice for indice, regla in enumerate(self.reglas)}
+        ganadoras = []
+        for instantanea in instantaneas:
+            compilada = self._motor.primera_coincidencia(instantanea)
+            ganadoras.append(self._indices[compilada.id] if compilada else -1)
+        return ganadoras
+
+
+class ReclasificacionService:
+    """Reaplica las reglas activas de un servicio a sus correos ya ingeridos."""
+
+    CAMPOS_CORREO = ('id', 'remitente', 'destinatarios', 'asunto', 'contenido_plano',
+                     'fecha_recepcion', 'estado', 'fecha_procesamiento')
+
+    @classmethod
+    def reclasificar(cls, servicio_id, dias=None, tamaño_trozo=2000, dry_run=False):
+        """
+        Reclasifica los correos del servicio con sus reglas activas actuales.
+
+        Los correos en estado ERROR no se tocan, ni los ignorados por el
+        prefiltro IMAP, cuyo cuerpo y destinatarios nunca se descargaron y
+        evaluarlos como vacíos podría cambiarlos por error. Solo se escriben los correos
+        cuyo estado cambia, con un bulk_update y un bulk_create del historial
+        por trozo.
+
+        Args:
+            servicio_id: ID del ServicioIngesta
+            dias: Solo correos recibidos en los últimos N días (opcional)
+            tamaño_trozo: Correos evaluados por trozo
+            dry_run: Evaluar sin guardar cambios
+
+        Returns:
+            dict: 'correos_evaluados', 'correos_cambiados' y 'por_estado' (nuevo estado -> correos)
+        """
+        ahora = timezone.now()
+        reglas = list(
+            ReglaFiltrado.objects.filter(servicio_id=servicio_id, activa=True)
+            .order_by('prioridad', 'id')
+            .prefetch_related('condiciones')
+        )
+        evaluador = EvaluadorVectorizado(reglas, ahora)
+
+        correos = CorreoIngesta.objects.filter(servicio_id=servicio_id, prefiltro_imap=False).exclude(
+            estado=CorreoIngesta.Estado.ERROR
+        )
+        if dias:
+            correos = correos.filter(fecha_recepcion__gte=ahora - timezone.timedelta(days=dias))
+        correos = correos.only(*cls.CAMPOS_CORREO).order_by('id')
+
+        resultado = {'correos_evaluados': 0, 'correos_cambiados': 0, 'por_estado': {}}
+        ultimo_id = 0
+        while True:
+            # Paginación por id: no se mantiene un cursor abierto mientras se escribe
+            trozo = list(correos.filter(id__gt=ultimo_id)[:tamaño_trozo])
+            if not trozo:
+                break
+            ultimo_id = trozo[-1].id
+
+            cambiados = cls._reclasificar_trozo(trozo, reglas, evaluador, ahora, dry_run)
+            resultado['correos_evaluados'] += len(trozo)
+            resultado['correos_cambiados'] += len(cambiados)
+            for correo in cambiados:
+                estado = str(correo.estado)
+                resultado['por_estado'][estado] = resultado['por_estado'].get(estado, 0) + 1
+
+        logger.info(
+            f"Reclasificación del servicio {servicio_id}: {resultado['correos_cambiados']} de "
+            f"{resultado['correos_evaluados']} correos cambian de estado"
+        )
+        return resultado
+
+    @staticmethod
+    def _reclasificar_trozo(trozo, reglas, evaluador, ahora, dry_run):
+        adjuntos = {}
+        # Por los id del trozo: en un rango de id se intercalan los correos de otros servicios
+        for correo_id, nombre, tipo, tamaño in ArchivoAdjunto.objects.filter(
+            correo_id__in=[correo.id for correo in trozo]
+        ).values_list('correo_id', 'nombre_archivo', 'tipo_contenido', 'tamaño'):
+            adjuntos.setdefault(correo_id, []).append((nombre, tipo, tamaño))
+
+        instantaneas = [
+            InstantaneaCorreo.construir(
+                remitente=correo.remitente,
+                asunto=correo.asunto,
+                contenido=correo.contenido_plano,
+                destinatarios=correo.destinatarios,
+                fecha_recepcion=correo.fecha_recepcion,
+                adjuntos=adjuntos.get(correo.id, []),
+                correo_id=correo.id,
+            )
+            for correo in trozo
+        ]
+
+        cambiados = []
+        historial = []
+        for correo, indice in zip(trozo, evaluador.ganadoras(instantaneas)):
+            estado_anterior = correo.estado
+            regla = reglas[indice] if indice >= 0 else None
+            try:
+                if regla:
+                    regla.aplicar_accion(correo)
+                else:
+                    correo.estado = CorreoIngesta.Estado.PROCESADO
+            except Exception as e:
+                logger.error(f"Error al reclasificar el correo {correo.id} con la regla {regla.id}: {str(e)}")
+                correo.estado = estado_anterior
+                continue
+
+            if correo.estado == estado_anterior:
+                continue
+            correo.fecha_procesamiento = ahora
+            cambiados.append(correo)
+            if regla:
+                historial.append(HistorialAplicacionRegla(
+                    regla=regla,
+                    correo=correo,
+                    resultado=True,
+                    accion_ejecutada=regla.accion,
+                    detalles={'reclasificacion': True, 'estado_anterior': estado_anterior},
+                ))
+
+        if cambiados and not dry_run:
+            with transaction.atomic():
+                CorreoIngesta.objects.bulk_update(cambiados, ['estado', 'fecha_procesamiento'])
+                HistorialAplicacionRegla.objects.bulk_create(historial)
+        return cambiados
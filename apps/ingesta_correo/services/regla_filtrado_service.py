@@ -9,7 +9,9 @@ from django.db import transaction
 from django.utils import timezone
 from django.forms import ValidationError
 from apps.ingesta_correo.models import ReglaFiltrado, ServicioIngesta, LogActividad, RegistroLogRegla
-from apps.ingesta_correo.services.regla_test_service import ReglaTestService
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_motor_service import ReglaMotorService
+from apps.ingesta_correo.services.traza_reglas_service import TrazaReglasService
 
 logger = logging.getLogger(__name__)
 
@@ -368,167 +370,135 @@ class ReglaFiltradoService:
             raise ValidationError(f"Error al reordenar las reglas: {str(e)}")
     
     @staticmethod
-    def aplicar_reglas(correo):
+    def evaluar_reglas(correo, motor=None, traza=None, instantanea=None, perfil=None):
         """
-        Aplica las reglas de filtrado a un correo.
+        Busca la primera regla que coincide con un correo, sin efectos secundarios.
         
         Args:
             correo: Objeto CorreoIngesta a evaluar
+            motor: MotorReglas del servicio (opcional); si se omite se obtiene de la
+                caché de reglas compiladas
+            traza: TrazaReglas donde se acumulan los eventos de la evaluación
+                (opcional); no se guarda aquí, quien la crea hace flush()
+            instantanea: InstantaneaCorreo ya construida (opcional); si se omite
+                se construye a partir del correo y sus adjuntos
+            perfil: PerfilReglas del tenant (opcional); si el correo sale en su
+                muestreo se cronometra cada regla evaluada
             
         Returns:
             ReglaFiltrado: La primera regla que coincide con el correo, o None si ninguna coincide
         """
         try:
-            # Registrar inicio de evaluación en el log
-            logger.info(f"Iniciando evaluación de reglas para correo {correo.id} (asunto: '{correo.asunto}')")
-            
-            # Registrar en el modelo de log detallado
-            RegistroLogRegla.log(
-                tenant=correo.servicio.tenant,
-                nivel=RegistroLogRegla.TipoLog.INFO,
-                mensaje=f"Iniciando evaluación de reglas para correo (asunto: '{correo.asunto}')",
-                correo=correo,
-                datos_contexto={
-                    'correo_id': correo.id,
-                    'asunto': correo.asunto,
-                    'remitente': correo.remitente,
-                    'fecha_recepcion': correo.fecha_recepcion.isoformat()
-                }
-            )
-            
-            # Obtener reglas activas ordenadas por prioridad
-            reglas = ReglaFiltrado.objects.filter(
-                servicio=correo.servicio,
-                activa=True
-            ).order_by('prioridad')
+            if motor is None:
+                motor = ReglaMotorService.obtener_motor(correo.servicio_id)
             
-            # Si no hay reglas, registrar y retornar
-            if not reglas.exists():
-                mensaje = f"No hay reglas activas para el servicio {correo.servicio.id}"
-                logger.info(mensaje)
-                
-                # Registrar en el modelo de log detallado
-                RegistroLogRegla.log(
-                    tenant=correo.servicio.tenant,
-                    nivel=RegistroLogRegla.TipoLog.INFO,
-                    mensaje=mensaje,
-                    correo=correo
-                )
-                
-                return None
-                
-            # Registrar número de reglas encontradas
-            mensaje = f"Se encontraron {reglas.count()} reglas activas para evaluar"
-            logger.info(mensaje)
-            
-            # Registrar en el modelo de log detallado
-            RegistroLogRegla.log(
-                tenant=correo.servicio.tenant,
-                nivel=RegistroLogRegla.TipoLog.INFO,
-                mensaje=mensaje,
-                correo=correo,
-                datos_contexto={'num_reglas': reglas.count()}
-            )
+            muestreado = traza is not None and traza.iniciar_correo()
+            completa = muestreado and traza.completa
             
-            # Preparar datos para evaluación
-            datos_correo = {
-                'asunto': correo.asunto or '',
-                'remitente': correo.remitente or '',
-                'destinatario': correo.destinatarios or '',
-                'contenido': correo.contenido_plano or '',
-                'adjunto': ', '.join([adj.nombre_archivo for adj in correo.adjuntos.all()]) if correo.adjuntos.exists() else ''
-            }
-            
-            # Evaluar cada regla en orden
-            for regla in reglas:
-                mensaje_debug = f"Evaluando regla '{regla.nombre}' (ID: {regla.id}, prioridad: {regla.prioridad})"
-                logger.info(mensaje_debug)
-                
-                # Registrar inicio de evaluación de esta regla específica
-                RegistroLogRegla.log(
-                    tenant=correo.servicio.tenant,
-                    nivel=RegistroLogRegla.TipoLog.INFO,
-                    mensaje=mensaje_debug,
-                    regla=regla,
+            if completa:
+                traza.registrar(
+                    RegistroLogRegla.TipoLog.INFO,
+                    f"Iniciando evaluación de reglas para correo (asunto: '{correo.asunto}')",
                     correo=correo,
                     datos_contexto={
-                        'regla_id': regla.id,
-                        'regla_nombre': regla.nombre,
-                        'regla_prioridad': regla.prioridad
+                        'correo_id': correo.id,
+                        'asunto': correo.asunto,
+                        'remitente': correo.remitente,
+                        'fecha_recepcion': correo.fecha_recepcion.isoformat(),
+                        'num_reglas': len(motor)
                     }
                 )
-                
-                # Registrar detalles de la regla para diagnóstico
-                logger.debug(f"Regla simple: campo='{regla.campo}', condición='{regla.condicion}', valor='{regla.valor}'")
-                
-                # Registrar los datos de prueba para diagnóstico
-                logger.debug(f"Datos de correo para evaluación: asunto='{datos_correo['asunto'][:50]}...' si es más largo")
-                
-                resultado = ReglaTestService.evaluar_regla_completa(regla, datos_correo)
-                
-                # Registro detallado de la evaluación
-                if resultado['cumple']:
-                    mensaje_info = f"Regla '{regla.nombre}' coincide con correo {correo.id}: {resultado['mensaje']}"
-                    logger.info(mensaje_info)
-                    
-                    # Registrar resultado positivo en el modelo de log detallado
-                    RegistroLogRegla.log(
-                        tenant=correo.servicio.tenant,
-                        nivel=RegistroLogRegla.TipoLog.INFO,
-                        mensaje=mensaje_info,
+            
+            if not len(motor):
+                logger.debug(f"No hay reglas activas para el servicio {correo.servicio_id}")
+                return None
+            
+            valores = instantanea if instantanea is not None else InstantaneaCorreo.desde_correo(correo)
+            
+            if not completa:
+                # Sin traza detallada basta con la búsqueda de candidatas del motor
+                if perfil is not None and not perfil.muestrear():
+                    perfil = None
+                compilada = motor.primera_coincidencia(valores, perfil=perfil)
+                if compilada is None:
+                    return None
+                regla = compilada.regla
+                if muestreado:
+                    traza.registrar(
+                        RegistroLogRegla.TipoLog.INFO,
+                        f"Regla '{regla.nombre}' coincide con correo {correo.id}",
                         regla=regla,
                         correo=correo,
-                        datos_contexto={
-                            'resultado': resultado,
-                            'coincidencia': True
-                        }
+                        datos_contexto={'coincidencia': True}
                     )
-                    
-                    # Registrar la coincidencia en las estadísticas de la regla
-                    regla.registrar_uso()
-                    
-                    return regla
-                else:
-                    mensaje_debug = f"Regla '{regla.nombre}' no coincide: {resultado['mensaje']}"
-                    logger.debug(mensaje_debug)
-                    
-                    # Registrar resultado negativo en el modelo de log detallado
-                    RegistroLogRegla.log(
-                        tenant=correo.servicio.tenant,
-                        nivel=RegistroLogRegla.TipoLog.DEBUG,
-                        mensaje=mensaje_debug,
+                return regla
+            
+            # Traza completa: evaluar en orden registrando el resultado de cada regla
+            for compilada, cumple in motor.evaluar(valores):
+                regla = compilada.regla
+                if cumple:
+                    traza.registrar(
+                        RegistroLogRegla.TipoLog.INFO,
+                        f"Regla '{regla.nombre}' coincide con correo {correo.id}",
                         regla=regla,
                         correo=correo,
-                        datos_contexto={
-                            'resultado': resultado,
-                            'coincidencia': False
-                        }
+                        datos_contexto={'coincidencia': True, 'regla_prioridad': regla.prioridad}
                     )
+                    return regla
+                traza.registrar(
+                    RegistroLogRegla.TipoLog.DEBUG,
+                    f"Regla '{regla.nombre}' no coincide",
+                    regla=regla,
+                    correo=correo,
+                    datos_contexto={'coincidencia': False, 'regla_prioridad': regla.prioridad}
+                )
             
-            mensaje_info = f"Ninguna regla coincide con el correo {correo.id}"
-            logger.info(mensaje_info)
-            
-            # Registrar que no hubo coincidencias
-            RegistroLogRegla.log(
-                tenant=correo.servicio.tenant,
-                nivel=RegistroLogRegla.TipoLog.INFO,
-                mensaje=mensaje_info,
+            traza.registrar(
+                RegistroLogRegla.TipoLog.INFO,
+                f"Ninguna regla coincide con el correo {correo.id}",
                 correo=correo
             )
-            
             return None
             
         except Exception as e:
             mensaje_error = f"Error al aplicar reglas a correo {correo.id}: {str(e)}"
             logger.error(mensaje_error)
+            if traza is not None:
+                traza.error(mensaje_error, correo=correo, datos_contexto={'error': str(e)})
+            return None
+    
+    @staticmethod
+    def aplicar_reglas(correo, motor=None, traza=None, contador=None, perfil=None):
+        """
+        Aplica las reglas de filtrado a un correo.
+        
+        Args:
+            correo: Objeto CorreoIngesta a evaluar
+            motor: MotorReglas del servicio (opcional); si se omite se obtiene de la
+                caché de reglas compiladas. Al procesar lotes conviene obtenerlo una
+                vez y reutilizarlo.
+            traza: TrazaReglas compartida por el lote (opcional). Si se omite se crea
+                una con la configuración del tenant y se guarda al terminar.
+            contador: ContadorUsosReglas del lote (opcional). Si se omite el uso de
+                la regla se escribe de inmediato.
+            perfil: PerfilReglas del tenant (opcional), ver evaluar_reglas
             
-            # Registrar el error en el log detallado
-            RegistroLogRegla.log(
-                tenant=correo.servicio.tenant,
-                nivel=RegistroLogRegla.TipoLog.ERROR,
-                mensaje=mensaje_error,
-                correo=correo,
-                datos_contexto={'error': str(e)}
-            )
-            
-            return None
\ No newline at end of file
+        Returns:
+            ReglaFiltrado: La primera regla que coincide con el correo, o None si ninguna coincide
+        """
+        traza_propia = traza is None
+        if traza_propia:
+            traza = TrazaReglasService.para_tenant(correo.servicio.tenant_id)
+        
+        regla = ReglaFiltradoService.evaluar_reglas(correo, motor=motor, traza=traza, perfil=perfil)
+        if regla:
+            logger.info(f"Regla '{regla.nombre}' coincide con correo {correo.id}")
+            # Registrar la coincidencia en las estadísticas de la regla
+            if contador is not None:
+                contador.registrar(regla)
+            else:
+                regla.registrar_uso()
+        
+        if traza_propia:
+            traza.flush()
+        return regla
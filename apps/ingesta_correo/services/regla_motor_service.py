@@ -0,0 +1,553 @@
+"""
+Motor compilado de reglas de filtrado.
+
+Convierte las reglas activas de un servicio en predicados (closures) con los
+valores ya normalizados y las expresiones regulares precompiladas, y los
+mantiene en una caché del proceso asociada a la versión de reglas del servicio.
+Las subcadenas de las condiciones CONTIENE/NO_CONTIENE se buscan con un
+autómata de Aho-Corasick por campo. Evaluar un correo contra el motor no
+realiza consultas a la base de datos.
+
+Las condiciones de una regla compuesta se evalúan en el orden que minimiza el
+coste esperado hasta decidir el resultado (cortocircuito), estimado con su
+coste y su tasa de aciertos observados. Las condiciones son puras, así que el
+orden no cambia el resultado de la regla ni cuál regla gana.
+"""
+
+import logging
+import re
+import threading
+import time
+
+from django.db.models import F
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ReglaFiltrado, ServicioIngesta
+from apps.ingesta_correo.services.aho_corasick import construir_automata
+from apps.ingesta_correo.services.instantanea_correo import normalizar_texto
+
+logger = logging.getLogger(__name__)
+
+TipoCampo = ReglaFiltrado.TipoCampo
+TipoCondicion = ReglaFiltrado.TipoCondicion
+
+# Nombres de campo y condición usados por el probador de reglas
+ALIAS_CAMPOS = {
+    'adjunto': TipoCampo.ADJUNTO_NOMBRE,
+    'destinatarios': 'destinatario',
+}
+ALIAS_CONDICIONES = {
+    'coincide_regex': TipoCondicion.REGEX,
+}
+
+VALORES_VERDADEROS = ('true', 'verdadero', 'si', 'yes', '1')
+VALORES_FALSOS = ('false', 'falso', 'no', '0')
+
+
+def normalizar_campo(campo):
+    campo = (campo or '').lower()
+    return ALIAS_CAMPOS.get(campo, campo)
+
+
+def normalizar_condicion(condicion):
+    condicion = (condicion or '').lower()
+    return ALIAS_CONDICIONES.get(condicion, condicion)
+
+
+# Coste relativo estimado de cada condición, usado mientras no hay mediciones.
+# Las que recorren el texto se multiplican por el coste del campo
+COSTE_CONDICION = {
+    TipoCondicion.ES_IGUAL: 1,
+    TipoCondicion.NO_ES_IGUAL: 1,
+    TipoCondicion.EMPIEZA_CON: 1,
+    TipoCondicion.TERMINA_CON: 1,
+    TipoCondicion.ES_VERDADERO: 1,
+    TipoCondicion.ES_FALSO: 1,
+    TipoCondicion.MAYOR_QUE: 2,
+    TipoCondicion.MENOR_QUE: 2,
+    TipoCondicion.CONTIENE: 2,
+    TipoCondicion.NO_CONTIENE: 2,
+    TipoCondicion.REGEX: 5,
+}
+CONDICIONES_RECORREN_TEXTO = (TipoCondicion.CONTIENE, TipoCondicion.NO_CONTIENE, TipoCondicion.REGEX)
+COSTE_CAMPO = {TipoCampo.CONTENIDO: 20}
+# Una condición resuelta por el autómata es una consulta a un conjunto
+COSTE_PATRON = 0.5
+
+# Las condiciones de una regla compuesta se miden de una en una, rotando: en
+# cada llamada hasta tener MUESTRAS_INICIALES de cada condición y después en
+# una de cada MUESTREO llamadas
+MUESTREO = 128
+MUESTRAS_INICIALES = 8
+# Las estadísticas se reducen a la mitad al llegar a VENTANA muestras
+VENTANA = 512
+# Rondas de medición (una muestra de cada condición) entre reordenaciones
+REORDENAR_CADA = 4
+
+
+def _a_numero(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+class RegistroPatrones:
+    """
+    Agrupa por campo las subcadenas de las condiciones CONTIENE/NO_CONTIENE para
+    buscarlas todas con un único autómata de Aho-Corasick por campo.
+    """
+
+    def __init__(self):
+        self.patrones = {}
+        self.automatas = {}
+
+    def registrar(self, campo, patron):
+        """Devuelve la clave del patrón en el campo, reutilizándola si ya existía."""
+        por_campo = self.patrones.setdefault(campo, {})
+        if patron not in por_campo:
+            por_campo[patron] = sum(len(patrones) for patrones in self.patrones.values())
+        return por_campo[patron]
+
+    def construir(self):
+        self.automatas = {campo: construir_automata(patrones) for campo, patrones in self.patrones.items()}
+
+    def buscar(self, valores):
+        """Recorre una sola vez cada campo y devuelve las claves de los patrones encontrados."""
+        encontrados = set()
+        for campo, automata in self.automatas.items():
+            texto = valores.get(campo, '')
+            if texto:
+                encontrados |= automata.buscar(texto)
+        return encontrados
+
+
+def coste_estimado(campo, condicion, valor, registro=None):
+    """Coste relativo de evaluar una condición antes de haberla medido."""
+    campo = normalizar_campo(campo)
+    condicion = normalizar_condicion(condicion)
+    if registro is not None and valor and condicion in (TipoCondicion.CONTIENE, TipoCondicion.NO_CONTIENE):
+        return COSTE_PATRON
+    coste = COSTE_CONDICION.get(condicion, 1)
+    if condicion in CONDICIONES_RECORREN_TEXTO:
+        coste *= COSTE_CAMPO.get(campo, 1)
+    return coste
+
+
+def compilar_condicion(campo, condicion, valor, registro=None):
+    """
+    Construye el predicado de una condición (campo, condición, valor).
+
+    Args:
+        registro: RegistroPatrones opcional; si se indica, las condiciones
+            CONTIENE/NO_CONTIENE consultan el resultado del autómata del campo
+            en lugar de recorrer el texto
+
+    Returns:
+        callable: función (valores, encontrados) -> bool, donde valores es la
+        InstantaneaCorreo del correo y encontrados el conjunto
+        de claves devuelto por registro.buscar
+    """
+    campo = normalizar_campo(campo)
+    condicion = normalizar_condicion(condicion)
+    valor = valor or ''
+    valor_lower = normalizar_texto(valor)
+
+    if registro is not None and valor_lower and condicion in (TipoCondicion.CONTIENE, TipoCondicion.NO_CONTIENE):
+        clave = registro.registrar(campo, valor_lower)
+        if condicion == TipoCondicion.CONTIENE:
+            return lambda valores, encontrados=None: clave in encontrados
+        return lambda valores, encontrados=None: clave not in encontrados
+
+    if condicion == TipoCondicion.CONTIENE:
+        return lambda valores, encontrados=None: valor_lower in valores.get(campo, '')
+    if condicion == TipoCondicion.NO_CONTIENE:
+        return lambda valores, encontrados=None: valor_lower not in valores.get(campo, '')
+    if condicion == TipoCondicion.ES_IGUAL:
+        return lambda valores, encontrados=None: valores.get(campo, '') == valor_lower
+    if condicion == TipoCondicion.NO_ES_IGUAL:
+        return lambda valores, encontrados=None: valores.get(campo, '') != valor_lower
+    if condicion == TipoCondicion.EMPIEZA_CON:
+        return lambda valores, encontrados=None: valores.get(campo, '').startswith(valor_lower)
+    if condicion == TipoCondicion.TERMINA_CON:
+        return lambda valores, encontrados=None: valores.get(campo, '').endswith(valor_lower)
+    if condicion == TipoCondicion.REGEX:
+        try:
+            patron = re.compile(valor, re.IGNORECASE)
+        except re.error as e:
+            logger.warning(f"Expresión regular inválida '{valor}': {str(e)}")
+            return lambda valores, encontrados=None: False
+        return lambda valores, encontrados=None: patron.search(valores.get(campo, '')) is not None
+    if condicion in (TipoCondicion.MAYOR_QUE, TipoCondicion.MENOR_QUE):
+        umbral = _a_numero(valor)
+        if umbral is None:
+            return lambda valores, encontrados=None: False
+        if condicion == TipoCondicion.MAYOR_QUE:
+            def mayor_que(valores, encontrados=None):
+                numero = _a_numero(valores.get(campo))
+                return numero is not None and numero > umbral
+            return mayor_que
+
+        def menor_que(valores, encontrados=None):
+            numero = _a_numero(valores.get(campo))
+            return numero is not None and numero < umbral
+        return menor_que
+    if condicion == TipoCondicion.ES_VERDADERO:
+        return lambda valores, encontrados=None: valores.get(campo, '') in VALORES_VERDADEROS
+    if condicion == TipoCondicion.ES_FALSO:
+        return lambda valores, encontrados=None: valores.get(campo, '') in VALORES_FALSOS
+
+    return lambda valores, encontrados=None: False
+
+
+class CondicionCompilada:
+    """Predicado de una condición de regla compuesta con sus estadísticas de evaluación."""
+
+    __slots__ = ('id', 'orden', 'descripcion', 'predicado', 'coste', 'muestras', 'aciertos', 'nanosegundos')
+
+    def __init__(self, condicion, registro=None):
+        self.id = getattr(condicion, 'id', None)
+        self.orden = condicion.orden
+        self.descripcion = f"{normalizar_campo(condicion.campo)} {normalizar_condicion(condicion.condicion)} '{condicion.valor}'"
+        self.predicado = compilar_condicion(condicion.campo, condicion.condicion, condicion.valor, registro)
+        self.coste = coste_estimado(condicion.campo, condicion.condicion, condicion.valor, registro)
+        self.muestras = 0
+        self.aciertos = 0
+        self.nanosegundos = 0
+
+    def tasa_aciertos(self):
+        """Probabilidad de cumplirse, suavizada (Laplace) para las pocas muestras."""
+        return (self.aciertos + 1) / (self.muestras + 2)
+
+    def coste_medio(self):
+        """Nanosegundos por evaluación medidos, o None sin muestras."""
+        return self.nanosegundos / self.muestras if self.muestras else None
+
+    def medir(self, valores, encontrados):
+        inicio = time.perf_counter_ns()
+        cumple = self.predicado(valores, encontrados)
+        self.nanosegundos += time.perf_counter_ns() - inicio
+        self.muestras += 1
+        self.aciertos += cumple
+        if self.muestras >= VENTANA:
+            self.muestras //= 2
+            self.aciertos //= 2
+            self.nanosegundos //= 2
+        return cumple
+
+    def estadisticas(self):
+        coste_medio = self.coste_medio()
+        return {
+            'orden': self.orden,
+            'condicion': self.descripcion,
+            'coste_estimado': self.coste,
+            'muestras': self.muestras,
+            'tasa_aciertos': round(self.aciertos / self.muestras, 4) if self.muestras else None,
+            'ns_medio': round(coste_medio) if coste_medio is not None else None,
+        }
+
+
+class PredicadoCompuesto:
+    """
+    Predicado Y/O de una regla compuesta que reordena sus condiciones.
+
+    Para Y conviene evaluar primero la condición con menor coste / P(falso), y
+    para O la de menor coste / P(verdadero): es el orden que minimiza el coste
+    esperado hasta el cortocircuito. Hasta tener MUESTRAS_INICIALES de cada
+    condición se ordena por coste estimado. Las muestras se toman evaluando
+    una condición aparte del cortocircuito, de modo que su tasa de aciertos no
+    depende de las que la preceden. Las estadísticas se comparten sin bloqueo
+    entre hilos: son aproximadas, pero el resultado no depende de ellas.
+    """
+
+    def __init__(self, condiciones, conjuncion):
+        self.condiciones = condiciones
+        self.conjuncion = conjuncion
+        self.llamadas = 0
+        self.muestreadas = 0
+        self.calentando = True
+        self.reordenar()
+
+    def __call__(self, valores, encontrados=None):
+        self.llamadas += 1
+        if self.calentando or self.llamadas % MUESTREO == 0:
+            self._muestrear(valores, encontrados)
+        if self.conjuncion:
+            for predicado in self.predicados:
+                if not predicado(valores, encontrados):
+                    return False
+            return True
+        for predicado in self.predicados:
+            if predicado(valores, encontrados):
+                return True
+        return False
+
+    def perfilar(self, valores, encontrados, perfil, regla_id):
+        """Evalúa como __call__ cronometrando cada condición evaluada para el PerfilReglas."""
+        for condicion in self.secuencia:
+            inicio = time.perf_counter_ns()
+            cumple = condicion.predicado(valores, encontrados)
+            perfil.registrar(regla_id, condicion.id, time.perf_counter_ns() - inicio, cumple)
+            if cumple != self.conjuncion:
+                return cumple
+        return self.conjuncion
+
+    def _muestrear(self, valores, encontrados):
+        self.condiciones[self.muestreadas % len(self.condiciones)].medir(valores, encontrados)
+        self.muestreadas += 1
+        if self.calentando:
+            if all(condicion.muestras >= MUESTRAS_INICIALES for condicion in self.condiciones):
+                self.calentando = False
+                self.reordenar()
+        elif self.muestreadas % (REORDENAR_CADA * len(self.condiciones)) == 0:
+            self.reordenar()
+
+    def reordenar(self):
+        medidas = not self.calentando
+
+        def clave(condicion):
+            coste = condicion.coste_medio() if medidas else condicion.coste
+            decide = 1 - condicion.tasa_aciertos() if self.conjuncion else condicion.tasa_aciertos()
+            return (coste / decide, condicion.orden)
+
+        self.secuencia = tuple(sorted(self.condiciones, key=clave))
+        self.predicados = tuple(condicion.predicado for condicion in self.secuencia)
+
+    def estadisticas(self):
+        """Estadísticas por condición en el orden de evaluación actual."""
+        return [condicion.estadisticas() for condicion in self.secuencia]
+
+
+class ReglaCompilada:
+    """Regla de filtrado lista para evaluarse sin acceso a la base de datos."""
+
+    __slots__ = ('id', 'nombre', 'prioridad', 'accion', 'regla', 'predicado', 'fecha_inicio', 'fecha_fin', 'patron')
+
+    def __init__(self, regla, predicado, patron=None):
+        self.id = regla.id
+        self.nombre = regla.nombre
+        self.prioridad = regla.prioridad
+        self.accion = regla.accion
+        self.regla = regla
+        self.predicado = predicado
+        self.fecha_inicio = regla.fecha_inicio
+        self.fecha_fin = regla.fecha_fin
+        # Clave del patrón si es una regla simple CONTIENE resuelta por el autómata
+        self.patron = patron
+
+    def vigente(self, ahora):
+        """Equivalente a ReglaFiltrado.esta_activa para una regla ya filtrada por activa=True."""
+        if self.fecha_inicio and ahora < self.fecha_inicio:
+            return False
+        if self.fecha_fin and ahora > self.fecha_fin:
+            return False
+        return True
+
+    def cumple(self, valores, encontrados=None):
+        return self.predicado(valores, encontrados)
+
+
+class MotorReglas:
+    """Conjunto ordenado por prioridad de las reglas compiladas de un servicio."""
+
+    def __init__(self, reglas, version=None, registro=None):
+        self.reglas = reglas
+        self.version = version
+        self.registro = registro
+        if registro is not None:
+            registro.construir()
+
+        # Las reglas simples CONTIENE solo son candidatas si el autómata encontró
+        # su patrón; el resto se evalúa siempre
+        self._por_patron = {}
+        self._siempre = []
+        for indice, regla in enumerate(reglas):
+            if regla.patron is not None:
+                self._por_patron.setdefault(regla.patron, []).append(indice)
+            else:
+                self._siempre.append(indice)
+
+    def __len__(self):
+        return len(self.reglas)
+
+    def buscar_patrones(self, valores):
+        """Claves de los patrones CONTIENE/NO_CONTIENE presentes en el correo."""
+        if self.registro is None:
+            return set()
+        return self.registro.buscar(valores)
+
+    def evaluar(self, valores, ahora=None):
+        """
+        Evalúa las reglas en orden de prioridad hasta la primera coincidencia.
+
+        Returns:
+            list: Tuplas (ReglaCompilada, cumple) de las reglas evaluadas; si
+            hubo coincidencia es la última de la lista
+        """
+        ahora = ahora or timezone.now()
+        encontrados = self.buscar_patrones(valores)
+        evaluadas = []
+        for regla in self.reglas:
+            if not regla.vigente(ahora):
+                continue
+            cumple = regla.predicado(valores, encontrados)
+            evaluadas.append((regla, cumple))
+            if cumple:
+                break
+        return evaluadas
+
+    def primera_coincidencia(self, valores, ahora=None, perfil=None):
+        """
+        Devuelve la ReglaCompilada de mayor prioridad que cumple, o None.
+
+        Cada campo se recorre una sola vez con su autómata; las reglas simples
+        CONTIENE cuyo patrón no apareció se descartan sin evaluarse y las
+        candidatas se resuelven en orden de prioridad.
+
+        Args:
+            perfil: PerfilReglas opcional en el que se registra el tiempo de
+                cada regla y condición evaluada
+        """
+        ahora = ahora or timezone.now()
+        encontrados = self.buscar_patrones(valores)
+
+        candidatas = self._siempre
+        if encontrados and self._por_patron:
+            candidatas = set(self._siempre)
+            for clave in encontrados:
+                candidatas.update(self._por_patron.get(clave, ()))
+            candidatas = sorted(candidatas)
+
+        if perfil is not None:
+            return self._primera_perfilada(candidatas, valores, encontrados, ahora, perfil)
+        for indice in candidatas:
+            regla = self.reglas[indice]
+            if regla.vigente(ahora) and regla.predicado(valores, encontrados):
+                return regla
+        return None
+
+    def _primera_perfilada(self, candidatas, valores, encontrados, ahora, perfil):
+        for indice in candidatas:
+            regla = self.reglas[indice]
+            if not regla.vigente(ahora):
+                continue
+            inicio = time.perf_counter_ns()
+            if isinstance(regla.predicado, PredicadoCompuesto):
+                cumple = regla.predicado.perfilar(valores, encontrados, perfil, regla.id)
+            else:
+                cumple = regla.predicado(valores, encontrados)
+            perfil.registrar(regla.id, None, time.perf_counter_ns() - inicio, cumple)
+            if cumple:
+                return regla
+        return None
+
+    def coincidencias(self, valores, ahora=None):
+        """
+        Todas las ReglaCompilada que cumple el correo, en orden de prioridad
+        (la primera es la que se aplicaría). Lo usa el backtest de reglas.
+        """
+        ahora = ahora or timezone.now()
+        encontrados = self.buscar_patrones(valores)
+        return [
+            regla for regla in self.reglas
+            if regla.vigente(ahora) and regla.predicado(valores, encontrados)
+        ]
+
+    def estadisticas_condiciones(self):
+        """
+        Estadísticas de evaluación de las condiciones de las reglas compuestas,
+        cada una con sus condiciones en el orden en que se evalúan ahora.
+        """
+        return [
+            {
+                'id': regla.id,
+                'nombre': regla.nombre,
+                'llamadas': regla.predicado.llamadas,
+                'condiciones': regla.predicado.estadisticas(),
+            }
+            for regla in self.reglas
+            if isinstance(regla.predicado, PredicadoCompuesto)
+        ]
+
+
+class ReglaMotorService:
+    """Compilación y caché en proceso de las reglas de filtrado por servicio."""
+
+    _motores = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def compilar_regla(regla, condiciones=None, registro=None):
+        """
+        Compila una regla simple o compuesta en una ReglaCompilada.
+
+        Args:
+            regla: Objeto ReglaFiltrado
+            condiciones: Condiciones de la regla compuesta; si se omiten se usan
+                las de regla.condiciones (prefetch si está disponible)
+            registro: RegistroPatrones compartido por las reglas del servicio
+        """
+        if not regla.es_compuesta:
+            patron = None
+            condicion = normalizar_condicion(regla.condicion)
+            if registro is not None and regla.valor and condicion == TipoCondicion.CONTIENE:
+                patron = registro.registrar(normalizar_campo(regla.campo), normalizar_texto(regla.valor))
+            predicado = compilar_condicion(regla.campo, regla.condicion, regla.valor, registro)
+            return ReglaCompilada(regla, predicado, patron)
+
+        if condiciones is None:
+            condiciones = sorted(regla.condiciones.all(), key=lambda condicion: condicion.orden)
+        if not condiciones:
+            return ReglaCompilada(regla, lambda valores, encontrados=None: False)
+
+        compiladas = [CondicionCompilada(condicion, registro) for condicion in condiciones]
+        if len(compiladas) == 1:
+            return ReglaCompilada(regla, compiladas[0].predicado)
+        conjuncion = regla.operador_logico == ReglaFiltrado.TipoOperador.Y
+        return ReglaCompilada(regla, PredicadoCompuesto(compiladas, conjuncion))
+
+    @classmethod
+    def compilar_servicio(cls, servicio_id, version=None):
+        """Compila todas las reglas activas de un servicio con dos consultas."""
+        reglas = (
+            ReglaFiltrado.objects
+            .filter(servicio_id=servicio_id, activa=True)
+            .order_by('prioridad', 'id')
+            .prefetch_related('condiciones')
+        )
+        registro = RegistroPatrones()
+        compiladas = [cls.compilar_regla(regla, registro=registro) for regla in reglas]
+        return MotorReglas(compiladas, version, registro)
+
+    @classmethod
+    def obtener_motor(cls, servicio_id):
+        """
+        Devuelve el motor de reglas del servicio, recompilándolo solo si su versión cambió.
+        Cuesta una consulta para leer la versión; se recomienda obtenerlo una vez por lote.
+        """
+        version = (
+            ServicioIngesta.objects.filter(id=servicio_id)
+            .values_list('version_reglas', flat=True)
+            .first()
+        )
+        with cls._lock:
+            en_cache = cls._motores.get(servicio_id)
+        if en_cache is not None and en_cache.version == version:
+            return en_cache
+
+        motor = cls.compilar_servicio(servicio_id, version)
+        with cls._lock:
+            cls._motores[servicio_id] = motor
+        logger.debug(f"Reglas del servicio {servicio_id} compiladas (versión {version}, {len(motor)} reglas)")
+        return motor
+
+    @classmethod
+    def invalidar(cls, servicio_id):
+        """
+        Incrementa la versión de reglas del servicio y descarta su motor en caché.
+        La versión se guarda en la base de datos para que los demás procesos
+        también recompilen.
+        """
+        ServicioIngesta.objects.filter(id=servicio_id).update(version_reglas=F('version_reglas') + 1)
+        with cls._lock:
+            cls._motores.pop(servicio_id, None)
@@ -7,6 +7,12 @@ Permite evaluar si un correo cumple con una regla antes de guardarla.
 import re
 import logging
 
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_motor_service import (
+    ReglaMotorService, compilar_condicion, normalizar_campo, normalizar_condicion
+)
+
 logger = logging.getLogger(__name__)
 
 class ReglaTestService:
@@ -34,104 +40,9 @@ class ReglaTestService:
                     'mensaje': 'Parámetros incompletos para evaluar la regla.'
                 }
             
-            # Convertir campo a mayúsculas para evitar problemas con capitalización
-            campo_upper = campo.upper()
-            
-            # Obtener el valor del campo en los datos de prueba
-            valor_campo = None
-            
-            if campo_upper == 'ASUNTO':
-                valor_campo = datos_prueba.get('asunto', '')
-            elif campo_upper == 'REMITENTE':
-                valor_campo = datos_prueba.get('remitente', '')
-            elif campo_upper == 'DESTINATARIO':
-                valor_campo = datos_prueba.get('destinatario', '')
-            elif campo_upper == 'CONTENIDO':
-                valor_campo = datos_prueba.get('contenido', '')
-            elif campo_upper == 'ADJUNTO':
-                valor_campo = datos_prueba.get('adjunto', '')
-            else:
-                return {
-                    'cumple': False,
-                    'mensaje': f'Campo "{campo}" no reconocido.'
-                }
-            
-            # Si el valor del campo no existe en los datos de prueba
-            if valor_campo is None:
-                return {
-                    'cumple': False,
-                    'mensaje': f'No se proporcionó valor para el campo "{campo}".'
-                }
-            
-            # Convertir a string para la comparación
-            if not isinstance(valor_campo, str):
-                valor_campo = str(valor_campo)
-            
-            # Convertir condición a mayúsculas para evitar problemas con capitalización
-            condicion_upper = condicion.upper()
-            
-            # Convertir a minúsculas para comparaciones insensibles a mayúsculas/minúsculas
-            valor_campo_lower = valor_campo.lower()
-            valor_lower = valor.lower()
-            
-            # Evaluar la condición
-            cumple = False
-            
-            if condicion_upper == 'CONTIENE':
-                # Buscar la cadena ignorando mayúsculas/minúsculas
-                cumple = valor_lower in valor_campo_lower
-            elif condicion_upper == 'NO_CONTIENE':
-                # Verificar que la cadena no está presente, ignorando mayúsculas/minúsculas
-                cumple = valor_lower not in valor_campo_lower
-            elif condicion_upper == 'ES_IGUAL':
-                # Comparación ignorando mayúsculas/minúsculas
-                cumple = valor_lower == valor_campo_lower
-            elif condicion_upper == 'EMPIEZA_CON':
-                # Verificar inicio ignorando mayúsculas/minúsculas
-                cumple = valor_campo_lower.startswith(valor_lower)
-            elif condicion_upper == 'TERMINA_CON':
-                # Verificar final ignorando mayúsculas/minúsculas
-                cumple = valor_campo_lower.endswith(valor_lower)
-            elif condicion_upper == 'COINCIDE_REGEX':
-                # Aplicar expresión regular con bandera de ignorar mayúsculas/minúsculas
-                try:
-                    regex = re.compile(valor, re.IGNORECASE)
-                    cumple = bool(regex.search(valor_campo))
-                except re.error as e:
-                    return {
-                        'cumple': False,
-                        'mensaje': f'Error en la expresión regular: {str(e)}'
-                    }
-            else:
-                return {
-                    'cumple': False,
-                    'mensaje': f'Condición "{condicion}" no reconocida.'
-                }
-            
-            # Construir mensaje descriptivo
-            campo_display = {
-                'ASUNTO': 'asunto',
-                'REMITENTE': 'remitente',
-                'DESTINATARIO': 'destinatario',
-                'CONTENIDO': 'contenido',
-                'ADJUNTO': 'nombre de adjunto'
-            }.get(campo_upper, campo)
-            
-            condicion_display = {
-                'CONTIENE': 'contiene',
-                'NO_CONTIENE': 'no contiene',
-                'ES_IGUAL': 'es igual a',
-                'EMPIEZA_CON': 'empieza con',
-                'TERMINA_CON': 'termina con',
-                'COINCIDE_REGEX': 'coincide con la expresión'
-            }.get(condicion_upper, condicion)
-            
-            mensaje = f'El {campo_display} "{valor_campo}" {condicion_display} "{valor}" (comparación insensible a mayúsculas/minúsculas).'
-            
-            return {
-                'cumple': cumple,
-                'mensaje': mensaje
-            }
+            return ReglaTestService._evaluar_condicion(
+                campo, condicion, valor, InstantaneaCorreo.desde_datos_prueba(datos_prueba)
+            )
             
         except Exception as e:
             logger.error(f"Error al evaluar regla: {str(e)}")
@@ -140,21 +51,100 @@ class ReglaTestService:
                 'mensaje': f'Error al evaluar la regla: {str(e)}'
             }
     
+    @staticmethod
+    def _evaluar_condicion(campo, condicion, valor, instantanea):
+        """Evalúa una condición contra la instantánea de los datos de prueba."""
+        campo_normalizado = normalizar_campo(campo)
+        condicion_normalizada = normalizar_condicion(condicion)
+        campo_upper = campo.upper()
+        condicion_upper = condicion.upper()
+        
+        if campo_normalizado not in instantanea:
+            return {
+                'cumple': False,
+                'mensaje': f'Campo "{campo}" no reconocido.'
+            }
+        
+        if condicion_normalizada not in ReglaFiltrado.TipoCondicion.values:
+            return {
+                'cumple': False,
+                'mensaje': f'Condición "{condicion}" no reconocida.'
+            }
+        
+        if condicion_normalizada == ReglaFiltrado.TipoCondicion.REGEX:
+            try:
+                re.compile(valor, re.IGNORECASE)
+            except re.error as e:
+                return {
+                    'cumple': False,
+                    'mensaje': f'Error en la expresión regular: {str(e)}'
+                }
+        
+        # Mismo predicado compilado que usa la ingesta
+        cumple = compilar_condicion(campo_normalizado, condicion_normalizada, valor)(instantanea)
+        valor_campo = instantanea[campo_normalizado]
+        
+        # Construir mensaje descriptivo
+        campo_display = {
+            'ASUNTO': 'asunto',
+            'REMITENTE': 'remitente',
+            'DESTINATARIO': 'destinatario',
+            'CONTENIDO': 'contenido',
+            'ADJUNTO': 'nombre de adjunto'
+        }.get(campo_upper, campo)
+        
+        condicion_display = {
+            'CONTIENE': 'contiene',
+            'NO_CONTIENE': 'no contiene',
+            'ES_IGUAL': 'es igual a',
+            'EMPIEZA_CON': 'empieza con',
+            'TERMINA_CON': 'termina con',
+            'COINCIDE_REGEX': 'coincide con la expresión'
+        }.get(condicion_upper, condicion)
+        
+        mensaje = f'El {campo_display} "{valor_campo}" {condicion_display} "{valor}" (comparación insensible a mayúsculas/minúsculas).'
+        
+        return {
+            'cumple': cumple,
+            'mensaje': mensaje
+        }
+    
     @staticmethod
     def evaluar_regla_completa(regla, datos_prueba):
         """
-        Evalúa una regla completa contra datos de prueba.
+        Evalúa una regla completa (simple o compuesta) contra datos de prueba.
         
         Args:
             regla: Objeto ReglaFiltrado a evaluar
             datos_prueba: Diccionario con datos de prueba
             
         Returns:
-            dict: Resultado de la evaluación
+            dict: Resultado de la evaluación con 'cumple', 'mensaje' y 'accion'
         """
-        return ReglaTestService.evaluar_regla(
-            regla.campo,
-            regla.condicion,
-            regla.valor,
-            datos_prueba
-        )
\ No newline at end of file
+        try:
+            instantanea = InstantaneaCorreo.desde_datos_prueba(datos_prueba)
+            
+            if not regla.es_compuesta:
+                resultado = ReglaTestService._evaluar_condicion(regla.campo, regla.condicion, regla.valor, instantanea)
+            else:
+                condiciones = sorted(regla.condiciones.all(), key=lambda condicion: condicion.orden)
+                mensajes = [
+                    ReglaTestService._evaluar_condicion(
+                        condicion.campo, condicion.condicion, condicion.valor, instantanea
+                    )['mensaje']
+                    for condicion in condiciones
+                ]
+                union = ' Y ' if regla.operador_logico == ReglaFiltrado.TipoOperador.Y else ' O '
+                resultado = {
+                    'cumple': ReglaMotorService.compilar_regla(regla, condiciones).cumple(instantanea),
+                    'mensaje': union.join(mensajes)
+                }
+        except Exception as e:
+            logger.error(f"Error al evaluar regla {regla.id}: {str(e)}")
+            resultado = {
+                'cumple': False,
+                'mensaje': f'Error al evaluar la regla: {str(e)}'
+            }
+        
+        resultado['accion'] = regla.accion if resultado['cumple'] else None
+        return resultado
@@ -0,0 +1,138 @@
+"""
+Traza de la evaluación de reglas de filtrado.
+
+Los eventos se acumulan en memoria y se guardan con un único bulk_create al
+final de cada lote, en lugar de un INSERT en RegistroLogRegla por evento.
+El nivel y el muestreo se configuran por tenant en EmailConfig.
+"""
+
+import logging
+import random
+
+from django.db import transaction
+
+from apps.configuracion.models import EmailConfig
+from apps.ingesta_correo.models import RegistroLogRegla
+
+logger = logging.getLogger(__name__)
+
+
+class TrazaReglas:
+    """Buffer de eventos de evaluación de reglas de un tenant."""
+
+    NIVEL_OFF = 'off'
+    NIVEL_ERRORES = 'errores'
+    NIVEL_COINCIDENCIAS = 'coincidencias'
+    NIVEL_COMPLETO = 'completo'
+
+    _ORDEN = {NIVEL_OFF: 0, NIVEL_ERRORES: 1, NIVEL_COINCIDENCIAS: 2, NIVEL_COMPLETO: 3}
+
+    def __init__(self, tenant_id, nivel=NIVEL_COINCIDENCIAS, muestreo=1.0, persistir=True, aleatorio=None):
+        """
+        Args:
+            tenant_id: ID del tenant al que pertenecen los eventos
+            nivel: 'off', 'errores', 'coincidencias' o 'completo'
+            muestreo: Fracción de correos (0 a 1) cuya evaluación se traza;
+                no se aplica a los errores
+            persistir: Si es False, flush() no escribe en la base de datos y
+                los eventos solo quedan disponibles en memoria
+            aleatorio: Generador random.Random (para pruebas reproducibles)
+        """
+        self.tenant_id = tenant_id
+        self.nivel = self._ORDEN.get(nivel, self._ORDEN[self.NIVEL_COINCIDENCIAS])
+        self.muestreo = min(max(muestreo, 0.0), 1.0)
+        self.persistir = persistir
+        self.aleatorio = aleatorio or random
+        self.eventos = []
+        self._muestreado = False
+
+    @property
+    def activa(self):
+        return self.nivel > self._ORDEN[self.NIVEL_OFF]
+
+    @property
+    def coincidencias(self):
+        """True si se deben trazar las coincidencias del correo actual."""
+        return self._muestreado and self.nivel >= self._ORDEN[self.NIVEL_COINCIDENCIAS]
+
+    @property
+    def completa(self):
+        """True si se debe trazar cada regla evaluada del correo actual."""
+        return self._muestreado and self.nivel >= self._ORDEN[self.NIVEL_COMPLETO]
+
+    def iniciar_correo(self):
+        """Decide si la evaluación del siguiente correo entra en la muestra."""
+        self._muestreado = (
+            self.nivel >= self._ORDEN[self.NIVEL_COINCIDENCIAS]
+            and (self.muestreo >= 1.0 or self.aleatorio.random() < self.muestreo)
+        )
+        return self._muestreado
+
+    def registrar(self, nivel, mensaje, regla=None, correo=None, datos_contexto=None):
+        """Añade un evento al buffer; quien llama decide si el nivel de traza lo incluye."""
+        self.eventos.append(RegistroLogRegla(
+            tenant_id=self.tenant_id,
+            nivel=nivel,
+            mensaje=mensaje,
+            regla=regla,
+            correo=correo,
+            datos_contexto=datos_contexto,
+        ))
+
+    def error(self, mensaje, correo=None, datos_contexto=None):
+        """Registra un error; se guarda siempre salvo con la traza desactivada."""
+        if self.activa:
+            self.registrar(RegistroLogRegla.TipoLog.ERROR, mensaje, correo=correo, datos_contexto=datos_contexto)
+
+    def como_lista(self):
+        """Eventos del buffer serializables a JSON, para las vistas de prueba de reglas."""
+        return [
+            {
+                'nivel': evento.nivel,
+                'mensaje': evento.mensaje,
+                'regla_id': evento.regla_id,
+                'correo_id': evento.correo_id,
+                'datos_contexto': evento.datos_contexto,
+            }
+            for evento in self.eventos
+        ]
+
+    def flush(self):
+        """
+        Guarda los eventos acumulados con un único bulk_create y vacía el buffer.
+
+        Returns:
+            int: Número de eventos guardados
+        """
+        eventos, self.eventos = self.eventos, []
+        if not eventos or not self.persistir:
+            return 0
+        try:
+            # Savepoint: un fallo de la traza no invalida la transacción del lote
+            with transaction.atomic():
+                RegistroLogRegla.objects.bulk_create(eventos)
+        except Exception as e:
+            # La traza nunca debe interrumpir la ingesta
+            logger.error(f"Error al guardar la traza de reglas del tenant {self.tenant_id}: {str(e)}")
+            return 0
+        return len(eventos)
+
+
+class TrazaReglasService:
+    """Creación de trazas de reglas según la configuración del tenant."""
+
+    @staticmethod
+    def para_tenant(tenant_id):
+        """Traza con el nivel y el muestreo configurados en el EmailConfig del tenant."""
+        config = EmailConfig.objects.filter(tenant_id=tenant_id).values_list(
+            'rule_trace_level', 'rule_trace_sample_rate'
+        ).first()
+        if config is None:
+            return TrazaReglas(tenant_id)
+        nivel, muestreo = config
+        return TrazaReglas(tenant_id, nivel=nivel, muestreo=muestreo)
+
+    @staticmethod
+    def bajo_demanda(tenant_id):
+        """Traza completa sin muestreo ni escritura, para las vistas de prueba de reglas."""
+        return TrazaReglas(tenant_id, nivel=TrazaReglas.NIVEL_COMPLETO, muestreo=1.0, persistir=False)
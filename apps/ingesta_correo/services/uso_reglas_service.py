@@ -0,0 +1,89 @@
+"""
+Acumulador en proceso de los usos de las reglas de filtrado.
+
+En lugar de un UPDATE por coincidencia sobre la fila de la regla (la misma fila
+para todas las coincidencias de una regla popular), los usos se cuentan en
+memoria y se escriben una vez por lote con UPDATE relativos:
+conteo_usos = conteo_usos + n y ultima_aplicacion = GREATEST(...). Los UPDATE
+relativos son exactos aunque varios workers escriban a la vez.
+"""
+
+import logging
+
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ReglaFiltrado
+
+logger = logging.getLogger(__name__)
+
+
+class ContadorUsosReglas:
+    """Usos de reglas pendientes de escribir: {regla_id: [usos, última aplicación]}."""
+
+    def __init__(self, momento=None):
+        """
+        Args:
+            momento: Fecha de aplicación común a todos los usos (p. ej. la del
+                lote), lo que permite agrupar reglas en un mismo UPDATE; si se
+                omite se usa la hora de cada registro
+        """
+        self.momento = momento
+        self.usos = {}
+
+    def __len__(self):
+        return len(self.usos)
+
+    def registrar(self, regla, momento=None):
+        """Cuenta una aplicación de la regla y actualiza sus estadísticas en memoria."""
+        momento = momento or self.momento or timezone.now()
+        regla.conteo_usos += 1
+        regla.ultima_aplicacion = momento
+
+        pendiente = self.usos.get(regla.id)
+        if pendiente is None:
+            self.usos[regla.id] = [1, momento]
+        else:
+            pendiente[0] += 1
+            if momento > pendiente[1]:
+                pendiente[1] = momento
+
+    def flush(self):
+        """
+        Escribe los usos acumulados y vacía el acumulador.
+
+        Las reglas con el mismo número de usos y la misma última aplicación se
+        actualizan con un solo UPDATE; los UPDATE se emiten en orden de id para
+        que workers concurrentes bloqueen las filas siempre en el mismo orden.
+
+        Returns:
+            int: Número de UPDATE ejecutados
+        """
+        usos, self.usos = self.usos, {}
+        grupos = {}
+        for regla_id, (cantidad, ultima) in sorted(usos.items()):
+            grupos.setdefault((cantidad, ultima), []).append(regla_id)
+
+        for (cantidad, ultima), ids in grupos.items():
+            try:
+                ReglaFiltrado.objects.filter(id__in=ids).update(
+                    conteo_usos=F('conteo_usos') + cantidad,
+                    # GREATEST con NULL devuelve NULL en SQLite y Oracle
+                    ultima_aplicacion=Greatest(Coalesce(F('ultima_aplicacion'), Value(ultima)), Value(ultima)),
+                )
+            except Exception as e:
+                logger.error(f"Error al registrar el uso de las reglas {ids}: {str(e)}")
+        return len(grupos)
+
+    def flush_al_confirmar(self):
+        """
+        Programa el flush para después del commit de la transacción actual.
+
+        Así los usos solo cuentan si el lote se confirma, y el UPDATE corre en
+        su propia transacción corta sin mantener bloqueada la fila de la regla
+        mientras se guarda el resto del lote.
+        """
+        if self.usos:
+            transaction.on_commit(self.flush)
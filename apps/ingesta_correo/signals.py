@@ -0,0 +1,46 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.ingesta_correo.models import ArchivoAdjunto, BlobAdjunto, CategoriaRegla, CondicionRegla, ReglaFiltrado
+from apps.ingesta_correo.services.adjunto_storage_service import AdjuntoStorageService
+from apps.ingesta_correo.services.regla_motor_service import ReglaMotorService
+
+
+@receiver(post_delete, sender=ArchivoAdjunto)
+def liberar_blob_adjunto(sender, instance, **kwargs):
+    """Descuenta la referencia al blob del adjunto eliminado; el último en irse lo elimina."""
+    if instance.blob_id:
+        AdjuntoStorageService.liberar_referencia(instance.blob_id)
+
+
+@receiver(post_delete, sender=BlobAdjunto)
+def eliminar_archivo_blob(sender, instance, **kwargs):
+    """Elimina el archivo físico del blob una vez confirmada la transacción."""
+    nombre = instance.archivo.name
+    if nombre:
+        transaction.on_commit(lambda: AdjuntoStorageService.eliminar_archivo_blob(nombre))
+
+
+@receiver([post_save, post_delete], sender=ReglaFiltrado)
+def invalidar_reglas_por_regla(sender, instance, **kwargs):
+    """Invalida las reglas compiladas del servicio cuando cambia una regla."""
+    update_fields = kwargs.get('update_fields')
+    # Los contadores de uso no afectan la evaluación
+    if update_fields and set(update_fields) <= {'conteo_usos', 'ultima_aplicacion'}:
+        return
+    ReglaMotorService.invalidar(instance.servicio_id)
+
+
+@receiver([post_save, post_delete], sender=CondicionRegla)
+def invalidar_reglas_por_condicion(sender, instance, **kwargs):
+    """Invalida las reglas compiladas del servicio cuando cambia una condición."""
+    servicio_id = ReglaFiltrado.objects.filter(id=instance.regla_id).values_list('servicio_id', flat=True).first()
+    if servicio_id:
+        ReglaMotorService.invalidar(servicio_id)
+
+
+@receiver([post_save, post_delete], sender=CategoriaRegla)
+def invalidar_reglas_por_categoria(sender, instance, **kwargs):
+    """Invalida las reglas compiladas del servicio cuando cambia una categoría."""
+    ReglaMotorService.invalidar(instance.servicio_id)
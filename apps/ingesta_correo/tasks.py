@@ -1,21 +1,29 @@
 from celery import shared_task
+from django.conf import settings
 from apps.tenants.models import Tenant
 import logging
 from django.utils import timezone
 from apps.ingesta_correo.services.ingesta_scheduler_service import IngestaSchedulerService
-from apps.ingesta_correo.models import ArchivoAdjunto, CorreoIngesta, ServicioIngesta, HistorialEjecucion, LogActividad, HistorialAplicacionRegla
+from apps.ingesta_correo.services.despacho_ingesta_service import DespachoIngestaService
+from apps.ingesta_correo.services.lease_ingesta_service import LeaseIngesta
+from apps.ingesta_correo.services.presupuesto_ingesta_service import PresupuestoIngesta
+from apps.ingesta_correo.services.cancelacion_ingesta_service import IngestaCancelada, TokenCancelacion
+from apps.ingesta_correo.models import ServicioIngesta, HistorialEjecucion, LogActividad
 from apps.configuracion.models import EmailConfig
-from apps.ingesta_correo.services.regla_filtrado_service import ReglaFiltradoService
-import imaplib
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+from apps.ingesta_correo.services.ingesta_persistencia_service import IngestaPersistenciaService
+from apps.ingesta_correo.services.prefiltro_imap_service import PrefiltroImap
+from apps.ingesta_correo.services.backtest_reglas_service import BacktestReglasService
+from apps.ingesta_correo.services.reclasificacion_service import ReclasificacionService
 import poplib
 import email
-from email.header import decode_header, make_header
-import os
-import tempfile
-import base64
 
 logger = logging.getLogger(__name__)
 
+# Lo que cubre cada check_scheduled_services: el periodo del beat que lo lanza
+HORIZONTE_DESPACHO_SEGUNDOS = getattr(settings, 'INGESTA_HORIZONTE_DESPACHO_SEGUNDOS', 60)
+
 @shared_task
 def sync_email_status():
     """Tarea programada para sincronizar el estado de conexión de correo."""
@@ -44,14 +52,12 @@ def check_scheduled_services():
     Esta tarea se ejecuta cada minuto.
     """
     try:
-        # Buscar servicios pendientes de ejecución
-        servicios_pendientes = IngestaSchedulerService.verificar_servicios_pendientes()
-        
-        # Si hay servicios pendientes, programar tareas para cada uno
-        for servicio in servicios_pendientes:
-            process_email_ingestion.delay(servicio.id)
+        # Encolar los servicios que vencen antes del siguiente despacho y caben
+        # en los cupos por servidor de correo y por tenant, cada uno con espera
+        # hasta su turno para no arrancar todos a la vez
+        despachados = DespachoIngestaService.despachar(horizonte=HORIZONTE_DESPACHO_SEGUNDOS)
         
-        return f"Verificación completada: {servicios_pendientes.count()} servicios programados para ejecución"
+        return f"Verificación completada: {len(despachados)} servicios programados para ejecución"
     except Exception as e:
         logger.error(f"Error en la verificación de servicios programados: {str(e)}")
         return f"Error en la verificación: {str(e)}"
@@ -60,11 +66,60 @@ def check_scheduled_services():
 @shared_task
 def process_email_ingestion(servicio_id):
     """
-    Procesa la ingesta de correos para un servicio específico.
+    Procesa la ingesta de correos para un servicio específico y, al terminar,
+    libera su cupo de concurrencia y despacha los servicios que esperaban.
+    Si otra ejecución del mismo servicio tiene el lease vigente, no hace nada.
+    
+    Cada ejecución tiene un presupuesto de mensajes y de tiempo
+    (PresupuestoIngesta); si el buzón tiene más, deja una continuación que el
+    despacho encola como un servicio vencido más. Entre lotes comprueba si se
+    pidió cancelarla (TokenCancelacion).
     
     Args:
         servicio_id: ID del servicio de ingesta a ejecutar
     """
+    lease = LeaseIngesta.adquirir(servicio_id)
+    if lease is None:
+        logger.warning(f"El servicio {servicio_id} ya tiene una ejecución en curso; se omite esta")
+        return f"Omitido: el servicio {servicio_id} ya está en ejecución"
+    
+    try:
+        DespachoIngestaService.ocupar(servicio_id)
+        return _procesar_ingesta(servicio_id, lease, PresupuestoIngesta(), TokenCancelacion(servicio_id))
+    finally:
+        lease.liberar()
+        try:
+            DespachoIngestaService.liberar(servicio_id)
+            if DespachoIngestaService.en_espera():
+                check_scheduled_services.delay()
+        except Exception as e:
+            logger.error(f"Error al liberar el cupo del servicio {servicio_id}: {str(e)}")
+
+
+def _cerrar_conexion(server, protocolo):
+    """Cierra la sesión con el servidor de correo sin propagar errores (al cancelar)."""
+    try:
+        if protocolo == 'imap':
+            server.close()
+            server.logout()
+        else:
+            # QUIT aplica los borrados de los correos ya guardados
+            server.quit()
+    except Exception as e:
+        logger.warning(f"Error al cerrar la conexión con el servidor de correo: {str(e)}")
+
+
+def _acumular_tramo(historial, errores, correos_procesados, correos_nuevos, archivos_procesados, glosas_extraidas):
+    """Suma los totales y errores del tramo al historial (que puede venir de tramos anteriores)."""
+    historial.correos_procesados += correos_procesados
+    historial.correos_nuevos += correos_nuevos
+    historial.archivos_procesados += archivos_procesados
+    historial.glosas_extraidas += glosas_extraidas
+    if errores:
+        historial.mensaje_error = '\n'.join(([historial.mensaje_error] if historial.mensaje_error else []) + errores)
+
+
+def _procesar_ingesta(servicio_id, lease, presupuesto, token):
     logger.info(f"Iniciando proceso de ingesta para servicio {servicio_id}")
     
     # Variables para estadísticas
@@ -78,17 +133,35 @@ def process_email_ingestion(servicio_id):
         # Obtener el servicio
         servicio = ServicioIngesta.objects.get(id=servicio_id)
         
+        # Una continuación sigue en el historial del tramo anterior, desde su último mensaje
+        continuacion = servicio.continuacion or {}
+        historial = None
+        if continuacion:
+            historial = HistorialEjecucion.objects.filter(
+                id=continuacion.get('historial_id'), servicio=servicio,
+                estado=HistorialEjecucion.EstadoEjecucion.EN_PROCESO
+            ).first()
+            if historial is None:
+                continuacion = {}
+        
         # Iniciar la ejecución y obtener el registro de historial
-        historial = HistorialEjecucion.objects.create(
-            servicio=servicio,
-            tenant=servicio.tenant,  # Asegurar que se incluye el tenant
-            estado=HistorialEjecucion.EstadoEjecucion.EN_PROCESO,
-            fecha_inicio=timezone.now()
-        )
+        if historial is None:
+            historial = HistorialEjecucion.objects.create(
+                servicio=servicio,
+                tenant=servicio.tenant,  # Asegurar que se incluye el tenant
+                estado=HistorialEjecucion.EstadoEjecucion.EN_PROCESO,
+                fecha_inicio=timezone.now()
+            )
+        inicio_tramo = timezone.now()
+        siguiente_tramo = None
         
         # Marcar servicio como en ejecución
         servicio.en_ejecucion = True
-        servicio.save(update_fields=['en_ejecucion'])
+        servicio.continuacion = None
+        servicio.save(update_fields=['en_ejecucion', 'continuacion'])
+        
+        # Cancelada mientras esperaba en la cola
+        token.comprobar()
         
         # Obtener la configuración de correo
         try:
@@ -112,190 +185,107 @@ def process_email_ingestion(servicio_id):
         # Conectar al servidor de correo
         try:
             if config.protocol == 'imap':
-                if config.use_ssl:
-                    server = imaplib.IMAP4_SSL(config.server_host, config.server_port)
-                else:
-                    server = imaplib.IMAP4(config.server_host, config.server_port)
+                server = ImapSyncService.conectar(config)
                 
-                server.login(config.username, config.password)
-                server.select(config.folder_to_monitor)
+                # Buscar los UID a procesar según el modo de sincronización
+                checkpoint = None
+                uid_validity = ImapSyncService.seleccionar_carpeta(server, config.folder_to_monitor)
+                if config.sync_mode == ImapSyncService.MODO_INCREMENTAL:
+                    checkpoint = ImapSyncService.obtener_checkpoint(servicio, config.folder_to_monitor)
+                    message_uids = ImapSyncService.buscar_uids_nuevos(server, checkpoint, uid_validity)
+                else:
+                    message_uids = ImapSyncService.buscar_uids_no_leidos(server)
+                    # Sin punto de control, una continuación retoma tras el último UID del tramo anterior
+                    if continuacion.get('protocolo') == 'imap' and continuacion.get('uid_validity') == uid_validity:
+                        message_uids = [uid for uid in message_uids if uid > continuacion['ultimo']]
                 
-                # Buscar correos no leídos
-                result, messages = server.search(None, 'UNSEEN')
-                if result != 'OK':
-                    raise Exception("No se pudo buscar correos no leídos")
+                logger.info(f"Se encontraron {len(message_uids)} mensajes por procesar")
+                # Lo que no cabe en el presupuesto queda para una continuación
+                message_uids = presupuesto.recortar(sorted(message_uids))
                 
-                message_nums = messages[0].split()
-                logger.info(f"Se encontraron {len(message_nums)} mensajes no leídos")
+                # Las reglas IGNORAR traducibles a SEARCH señalan en el servidor los
+                # mensajes que no hace falta descargar
+                prefiltro = PrefiltroImap.para_servicio(servicio.id) if message_uids else None
+                if prefiltro is not None:
+                    prefiltro.buscar(server, message_uids)
                 
-                # Procesar cada mensaje
-                for num in message_nums:
-                    try:
-                        # Obtener el mensaje
-                        result, msg_data = server.fetch(num, '(RFC822)')
-                        if result != 'OK':
-                            continue
-                        
-                        email_body = msg_data[0][1]
-                        email_message = email.message_from_bytes(email_body)
-                        
-                        # Verificar si el mensaje ya fue procesado
-                        message_id = email_message.get('Message-ID', num.decode())
-                        if CorreoIngesta.objects.filter(mensaje_id=message_id).exists():
-                            continue
-                        
-                        # Incrementar contador de correos nuevos
-                        correos_nuevos += 1
-                        
-                        # Procesar encabezados
-                        subject = str(make_header(decode_header(email_message['Subject'])))
-                        from_email = str(make_header(decode_header(email_message['From'])))
-                        to_email = str(make_header(decode_header(email_message['To'])))
-                        date = email_message['Date']
-                        
-                        # Convertir fecha a datetime
-                        from email.utils import parsedate_to_datetime
-                        received_date = parsedate_to_datetime(date)
-                        
-                        # Extraer contenido del correo
-                        plain_content = ""
-                        html_content = ""
-                        
-                        if email_message.is_multipart():
-                            for part in email_message.walk():
-                                if part.get_content_type() == "text/plain":
-                                    plain_content = part.get_payload(decode=True).decode()
-                                elif part.get_content_type() == "text/html":
-                                    html_content = part.get_payload(decode=True).decode()
-                        else:
-                            content = email_message.get_payload(decode=True).decode()
-                            if email_message.get_content_type() == "text/html":
-                                html_content = content
-                            else:
-                                plain_content = content
-                        
-                        # Crear registro de correo
-                        correo = CorreoIngesta.objects.create(
-                            servicio=servicio,
-                            mensaje_id=message_id,
-                            remitente=from_email,
-                            destinatarios=to_email,
-                            asunto=subject,
-                            fecha_recepcion=received_date,
-                            contenido_plano=plain_content,
-                            contenido_html=html_content,
-                            estado=CorreoIngesta.Estado.PENDIENTE
-                        )
-                        
-                        # Incrementar contador de correos procesados
-                        correos_procesados += 1
-                        
-                        # Procesar adjuntos
-                        for part in email_message.walk():
-                            if part.get_content_maintype() == 'multipart':
-                                continue
-                            if not part.get('Content-Disposition'):
-                                continue
-                            
-                            try:
-                                # Hay un adjunto
-                                filename = part.get_filename()
-                                if not filename:
-                                    continue
-                                
-                                # Decodificar nombre del archivo si es necesario
-                                filename = str(make_header(decode_header(filename)))
-                                
-                                # Guardar temporalmente el archivo
-                                temp_dir = tempfile.mkdtemp()
-                                temp_file_path = os.path.join(temp_dir, filename)
-                                
-                                with open(temp_file_path, 'wb') as f:
-                                    f.write(part.get_payload(decode=True))
-                                
-                                # Crear registro de archivo adjunto
-                                from django.core.files.base import ContentFile
-                                adjunto = ArchivoAdjunto(
-                                    correo=correo,
-                                    nombre_archivo=filename,
-                                    tipo_contenido=part.get_content_type(),
-                                    tamaño=os.path.getsize(temp_file_path)
-                                )
-                                
-                                # Guardar el archivo en el campo FileField
-                                tenant_id = correo.servicio.tenant.id
-                                fecha_actual = timezone.now().strftime("%Y/%m/%d")
-                                ruta_adjunto = f'adjuntos_correo/tenant_{tenant_id}/{fecha_actual}/{filename}'
-                                
-                                with open(temp_file_path, 'rb') as f:
-                                    contenido = ContentFile(f.read())
-                                    adjunto.archivo.save(ruta_adjunto, contenido, save=True)
-                                
-                                # Incrementar contador
-                                archivos_procesados += 1
-                                
-                                # Aquí procesarías el documento para extraer glosas
-                                # Por ahora, simulamos algunas glosas extraídas
-                                import random
-                                num_glosas = random.randint(1, 5)  # Reemplazar con lógica real
-                                glosas_extraidas += num_glosas
-                                
-                                # Eliminar archivo temporal
-                                os.remove(temp_file_path)
-                                os.rmdir(temp_dir)
-                            except Exception as e:
-                                error_msg = f"Error al procesar adjunto {filename}: {str(e)}"
-                                logger.error(f"Error al procesar adjunto para correo {message_id}: {str(e)}")
-                                errores.append(error_msg)
-                                continue
-                        
-                        # NUEVO: Aplicar reglas de filtrado al correo
+                # Procesar los mensajes a medida que llegan los lotes de UID FETCH.
+                # Los mensajes ya ingeridos se descartan por lote antes de descargar su cuerpo,
+                # los adjuntos irrelevantes para las glosas se dejan en el servidor
+                # y cada lote se persiste en una sola transacción.
+                for lote, mensajes in ImapSyncService.fetch_lotes(
+                    server, message_uids, config.fetch_batch_size, prefiltro=prefiltro,
+                    parcial=True, carpeta=config.folder_to_monitor, uid_validity=uid_validity
+                ):
+                    lease.latido()
+                    correos_parseados = []
+                    uids_por_mensaje = {}
+                    for uid, email_message in mensajes:
+                        token.comprobar()
                         try:
-                            # Aplicar el motor de evaluación de reglas
-                            regla_aplicada = ReglaFiltradoService.aplicar_reglas(correo)
-                            
-                            if regla_aplicada:
-                                # Registrar en el historial que se aplicó una regla
-                                HistorialAplicacionRegla.objects.create(
-                                    regla=regla_aplicada,
-                                    correo=correo,
-                                    fecha_aplicacion=timezone.now(),
-                                    resultado=True,
-                                    accion_ejecutada=regla_aplicada.accion
-                                )
-                                
-                                # Ejecutar la acción de la regla sobre el correo
-                                regla_aplicada.ejecutar_accion(correo)
-                                
-                                logger.info(f"Regla '{regla_aplicada.nombre}' aplicada al correo {correo.id}")
-                            else:
-                                # No se encontró una regla aplicable, procesar normalmente
-                                correo.estado = CorreoIngesta.Estado.PROCESADO
-                                correo.fecha_procesamiento = timezone.now()
-                                correo.glosas_extraidas = num_glosas  # Actualizar con el número real de glosas
-                                correo.save()
-                                
-                                logger.info(f"No se encontraron reglas aplicables para el correo {correo.id}")
+                            message_id = ImapSyncService.obtener_mensaje_id(uid, email_message)
+                            correos_parseados.append(CorreoParserService.parsear(email_message, message_id))
+                            uids_por_mensaje[message_id] = uid
                         except Exception as e:
-                            error_msg = f"Error al aplicar reglas de filtrado: {str(e)}"
-                            logger.error(f"Error al aplicar reglas para correo {correo.id}: {str(e)}")
+                            error_msg = f"Error al procesar correo: {str(e)}"
+                            logger.error(f"Error al procesar correo para servicio {servicio_id}: {str(e)}")
                             errores.append(error_msg)
-                            
-                            # En caso de error, procesar el correo normalmente
-                            correo.estado = CorreoIngesta.Estado.PROCESADO
-                            correo.fecha_procesamiento = timezone.now()
-                            correo.glosas_extraidas = num_glosas
-                            correo.save()
-                        
-                        # Marcar como leído en el servidor si está configurado
-                        if config.mark_as_read:
-                            server.store(num, '+FLAGS', '\\Seen')
-                        
+                    
+                    # Un lote cancelado antes de persistirse no avanza el punto de control
+                    token.comprobar()
+                    try:
+                        resultado = IngestaPersistenciaService.persistir_lote(servicio, correos_parseados)
                     except Exception as e:
-                        error_msg = f"Error al procesar correo: {str(e)}"
-                        logger.error(f"Error al procesar correo para servicio {servicio_id}: {str(e)}")
+                        error_msg = f"Error al guardar lote de correos: {str(e)}"
+                        logger.error(f"Error al guardar lote UID {lote[0]}-{lote[-1]} para servicio {servicio_id}: {str(e)}")
                         errores.append(error_msg)
-                        continue
+                        # El lote no se guardó: se detiene el tramo sin avanzar el punto de
+                        # control, para que la siguiente ejecución lo vuelva a descargar
+                        presupuesto.pendiente = False
+                        break
+                    
+                    correos_nuevos += resultado['correos_nuevos']
+                    correos_procesados += resultado['correos_procesados']
+                    archivos_procesados += resultado['archivos_procesados']
+                    glosas_extraidas += resultado['glosas_extraidas']
+                    errores.extend(resultado['errores'])
+                    guardados = [uids_por_mensaje[m] for m in resultado['mensajes_guardados'] if m in uids_por_mensaje]
+                    
+                    ignorados_guardados = True
+                    if prefiltro is not None and prefiltro.omitidos:
+                        try:
+                            ignorados = IngestaPersistenciaService.registrar_ignorados(servicio, prefiltro.omitidos)
+                            correos_nuevos += ignorados['correos_nuevos']
+                            correos_procesados += ignorados['correos_procesados']
+                            uids_omitidos = {cabecera['mensaje_id']: uid for uid, cabecera, _ in prefiltro.omitidos}
+                            guardados.extend(uids_omitidos[m] for m in ignorados['mensajes_guardados'] if m in uids_omitidos)
+                        except Exception as e:
+                            error_msg = f"Error al guardar correos ignorados por el prefiltro: {str(e)}"
+                            logger.error(f"Error al guardar ignorados del lote UID {lote[0]}-{lote[-1]} para servicio {servicio_id}: {str(e)}")
+                            errores.append(error_msg)
+                            ignorados_guardados = False
+                    
+                    # Marcar como leídos en el servidor, en un solo STORE por lote
+                    if config.mark_as_read and guardados:
+                        server.uid('STORE', ImapSyncService.formatear_conjunto(guardados), '+FLAGS', '(\\Seen)')
+                    
+                    if not ignorados_guardados:
+                        # Los ignorados sin registrar se vuelven a descargar en la siguiente
+                        # ejecución; los ya guardados del lote se descartan como repetidos
+                        presupuesto.pendiente = False
+                        break
+                    
+                    # Avanzar el punto de control aunque algún correo no se haya podido
+                    # parsear, para no reintentar indefinidamente un mensaje defectuoso
+                    ImapSyncService.registrar_progreso(checkpoint, lote[-1])
+                    token.comprobar()
+                    
+                    if lote[-1] != message_uids[-1] and presupuesto.agotado():
+                        presupuesto.pendiente = True
+                        break
+                
+                if presupuesto.pendiente:
+                    siguiente_tramo = {'protocolo': 'imap', 'uid_validity': uid_validity, 'ultimo': lote[-1]}
                 
                 server.close()
                 server.logout()
@@ -313,186 +303,105 @@ def process_email_ingestion(servicio_id):
                 num_messages = len(server.list()[1])
                 logger.info(f"Se encontraron {num_messages} mensajes")
                 
-                # Procesar cada mensaje
-                for i in range(num_messages):
-                    try:
-                        # Obtener el mensaje
-                        lines = server.retr(i+1)[1]
-                        msg_content = b'\n'.join(lines).decode('utf-8')
-                        email_message = email.message_from_string(msg_content)
-                        
-                        # Verificar si el mensaje ya fue procesado
-                        message_id = email_message.get('Message-ID', f'POP3-{i+1}')
-                        if CorreoIngesta.objects.filter(mensaje_id=message_id).exists():
-                            continue
-                        
-                        # El resto del procesamiento es igual que en IMAP
-                        # Incrementar contador de correos nuevos
-                        correos_nuevos += 1
-                        
-                        # Procesar encabezados
-                        subject = str(make_header(decode_header(email_message.get('Subject', ''))))
-                        from_email = str(make_header(decode_header(email_message.get('From', ''))))
-                        to_email = str(make_header(decode_header(email_message.get('To', ''))))
-                        date = email_message.get('Date')
-                        
-                        # Convertir fecha a datetime
-                        from email.utils import parsedate_to_datetime
-                        received_date = parsedate_to_datetime(date) if date else timezone.now()
-                        
-                        # Extraer contenido del correo
-                        plain_content = ""
-                        html_content = ""
-                        
-                        if email_message.is_multipart():
-                            for part in email_message.walk():
-                                if part.get_content_type() == "text/plain":
-                                    plain_content = part.get_payload(decode=True).decode()
-                                elif part.get_content_type() == "text/html":
-                                    html_content = part.get_payload(decode=True).decode()
-                        else:
-                            content = email_message.get_payload(decode=True).decode()
-                            if email_message.get_content_type() == "text/html":
-                                html_content = content
-                            else:
-                                plain_content = content
-                        
-                        # Crear registro de correo
-                        correo = CorreoIngesta.objects.create(
-                            servicio=servicio,
-                            mensaje_id=message_id,
-                            remitente=from_email,
-                            destinatarios=to_email,
-                            asunto=subject,
-                            fecha_recepcion=received_date,
-                            contenido_plano=plain_content,
-                            contenido_html=html_content,
-                            estado=CorreoIngesta.Estado.PENDIENTE
-                        )
-                        
-                        # Incrementar contador de correos procesados
-                        correos_procesados += 1
-                        
-                        # Procesar adjuntos
-                        num_glosas = 0
-                        for part in email_message.walk():
-                            if part.get_content_maintype() == 'multipart':
-                                continue
-                            if not part.get('Content-Disposition'):
-                                continue
-                            
-                            try:
-                                # Hay un adjunto
-                                filename = part.get_filename()
-                                if not filename:
-                                    continue
-                                
-                                # Decodificar nombre del archivo si es necesario
-                                filename = str(make_header(decode_header(filename)))
-                                
-                                # Guardar temporalmente el archivo
-                                temp_dir = tempfile.mkdtemp()
-                                temp_file_path = os.path.join(temp_dir, filename)
-                                
-                                with open(temp_file_path, 'wb') as f:
-                                    f.write(part.get_payload(decode=True))
-                                
-                                # Crear registro de archivo adjunto
-                                from django.core.files.base import ContentFile
-                                adjunto = ArchivoAdjunto(
-                                    correo=correo,
-                                    nombre_archivo=filename,
-                                    tipo_contenido=part.get_content_type(),
-                                    tamaño=os.path.getsize(temp_file_path)
-                                )
-                                
-                                # Guardar el archivo en el campo FileField
-                                tenant_id = correo.servicio.tenant.id
-                                fecha_actual = timezone.now().strftime("%Y/%m/%d")
-                                ruta_adjunto = f'adjuntos_correo/tenant_{tenant_id}/{fecha_actual}/{filename}'
-                                
-                                with open(temp_file_path, 'rb') as f:
-                                    contenido = ContentFile(f.read())
-                                    adjunto.archivo.save(ruta_adjunto, contenido, save=True)
-                                
-                                # Incrementar contador
-                                archivos_procesados += 1
-                                
-                                # Aquí procesarías el documento para extraer glosas
-                                # Por ahora, simulamos algunas glosas extraídas
-                                import random
-                                num_glosas = random.randint(1, 5)  # Reemplazar con lógica real
-                                glosas_extraidas += num_glosas
-                                
-                                # Eliminar archivo temporal
-                                os.remove(temp_file_path)
-                                os.rmdir(temp_dir)
-                            except Exception as e:
-                                error_msg = f"Error al procesar adjunto {filename}: {str(e)}"
-                                logger.error(f"Error al procesar adjunto para correo POP3 {message_id}: {str(e)}")
-                                errores.append(error_msg)
-                                continue
-                        
-                        # NUEVO: Aplicar reglas de filtrado al correo
+                # Una continuación retoma tras el último mensaje del tramo anterior
+                primero = continuacion['ultimo'] + 1 if continuacion.get('protocolo') == 'pop3' else 1
+                numeros = presupuesto.recortar(range(primero, num_messages + 1))
+                ultimo = primero - 1
+                eliminados = 0
+                
+                # Procesar los mensajes en lotes del mismo tamaño que en IMAP
+                tamaño_lote = max(1, config.fetch_batch_size or 1)
+                for inicio in numeros[::tamaño_lote]:
+                    if ultimo >= primero and presupuesto.agotado():
+                        presupuesto.pendiente = True
+                        break
+                    lease.latido()
+                    correos_parseados = []
+                    numeros_por_mensaje = {}
+                    ultimo = min(inicio + tamaño_lote, numeros.stop) - 1
+                    for numero in range(inicio, ultimo + 1):
+                        token.comprobar()
                         try:
-                            # Aplicar el motor de evaluación de reglas
-                            regla_aplicada = ReglaFiltradoService.aplicar_reglas(correo)
+                            # Obtener el mensaje
+                            lines = server.retr(numero)[1]
+                            email_message = email.message_from_bytes(b'\r\n'.join(lines))
                             
-                            if regla_aplicada:
-                                # Registrar en el historial que se aplicó una regla
-                                HistorialAplicacionRegla.objects.create(
-                                    regla=regla_aplicada,
-                                    correo=correo,
-                                    fecha_aplicacion=timezone.now(),
-                                    resultado=True,
-                                    accion_ejecutada=regla_aplicada.accion
-                                )
-                                
-                                # Ejecutar la acción de la regla sobre el correo
-                                regla_aplicada.ejecutar_accion(correo)
-                                
-                                logger.info(f"Regla '{regla_aplicada.nombre}' aplicada al correo POP3 {correo.id}")
-                            else:
-                                # No se encontró una regla aplicable, procesar normalmente
-                                correo.estado = CorreoIngesta.Estado.PROCESADO
-                                correo.fecha_procesamiento = timezone.now()
-                                correo.glosas_extraidas = num_glosas
-                                correo.save()
-                                
-                                logger.info(f"No se encontraron reglas aplicables para el correo POP3 {correo.id}")
+                            message_id = CorreoParserService.normalizar_mensaje_id(
+                                email_message.get('Message-ID'), f'POP3-{numero}'
+                            )
+                            correos_parseados.append(CorreoParserService.parsear(email_message, message_id))
+                            numeros_por_mensaje[message_id] = numero
                         except Exception as e:
-                            error_msg = f"Error al aplicar reglas de filtrado: {str(e)}"
-                            logger.error(f"Error al aplicar reglas para correo POP3 {correo.id}: {str(e)}")
+                            error_msg = f"Error al procesar correo POP3: {str(e)}"
+                            logger.error(f"Error al procesar correo POP3 para servicio {servicio_id}: {str(e)}")
                             errores.append(error_msg)
-                            
-                            # En caso de error, procesar el correo normalmente
-                            correo.estado = CorreoIngesta.Estado.PROCESADO
-                            correo.fecha_procesamiento = timezone.now()
-                            correo.glosas_extraidas = num_glosas
-                            correo.save()
-                        
-                        # Marcar para eliminar si está configurado
-                        if config.mark_as_read:
-                            server.dele(i+1)
-                        
+                    
+                    token.comprobar()
+                    try:
+                        resultado = IngestaPersistenciaService.persistir_lote(servicio, correos_parseados)
                     except Exception as e:
-                        error_msg = f"Error al procesar correo POP3: {str(e)}"
-                        logger.error(f"Error al procesar correo POP3 para servicio {servicio_id}: {str(e)}")
+                        error_msg = f"Error al guardar lote de correos POP3: {str(e)}"
+                        logger.error(f"Error al guardar lote POP3 para servicio {servicio_id}: {str(e)}")
                         errores.append(error_msg)
                         continue
+                    
+                    correos_nuevos += resultado['correos_nuevos']
+                    correos_procesados += resultado['correos_procesados']
+                    archivos_procesados += resultado['archivos_procesados']
+                    glosas_extraidas += resultado['glosas_extraidas']
+                    errores.extend(resultado['errores'])
+                    
+                    # Marcar para eliminar si está configurado
+                    if config.mark_as_read:
+                        for message_id in resultado['mensajes_guardados']:
+                            server.dele(numeros_por_mensaje[message_id])
+                            eliminados += 1
+                    token.comprobar()
                 
                 server.quit()
+                
+                if presupuesto.pendiente:
+                    # Los borrados se aplican al cerrar la sesión y corren la numeración
+                    siguiente_tramo = {'protocolo': 'pop3', 'ultimo': ultimo - eliminados}
             
+        except IngestaCancelada:
+            _cerrar_conexion(server, config.protocol)
+            raise
+        
         except Exception as e:
             error_msg = f"Error al conectar con el servidor de correo: {str(e)}"
             logger.error(f"Error al conectar con el servidor para servicio {servicio_id}: {str(e)}")
             errores.append(error_msg)
             raise
         
+        # Acumular el tramo en el historial: una cadena de continuaciones es una sola ejecución
+        _acumular_tramo(historial, errores, correos_procesados, correos_nuevos, archivos_procesados, glosas_extraidas)
+        if siguiente_tramo or continuacion:
+            detalles = historial.detalles or {}
+            detalles.setdefault('tramos', []).append({
+                'inicio': inicio_tramo.isoformat(),
+                'fin': timezone.now().isoformat(),
+                'correos_procesados': correos_procesados,
+                'correos_nuevos': correos_nuevos,
+            })
+            historial.detalles = detalles
+        
+        if siguiente_tramo:
+            # Quedan mensajes: el historial sigue en proceso hasta el último tramo
+            historial.save()
+            servicio.en_ejecucion = False
+            servicio.continuacion = dict(siguiente_tramo, historial_id=historial.id)
+            servicio.save(update_fields=['en_ejecucion', 'continuacion'])
+            logger.info(
+                f"Ingesta del servicio {servicio_id} agotó su presupuesto tras {correos_procesados} correos; "
+                f"continúa en otro tramo"
+            )
+            return f"Ingesta parcial: {correos_procesados} correos procesados, el resto continúa en otro tramo"
+        
         # Determinar estado final
         estado_final = HistorialEjecucion.EstadoEjecucion.EXITOSO
-        if len(errores) > 0:
-            if correos_procesados > 0:
+        if historial.mensaje_error:
+            if historial.correos_procesados > 0:
                 estado_final = HistorialEjecucion.EstadoEjecucion.PARCIAL
             else:
                 estado_final = HistorialEjecucion.EstadoEjecucion.ERROR
@@ -500,7 +409,6 @@ def process_email_ingestion(servicio_id):
         # Registrar finalización
         historial.estado = estado_final
         historial.fecha_fin = timezone.now()
-        historial.mensaje_error = '\n'.join(errores) if errores else None
         historial.save()
         
         # Actualizar servicio
@@ -515,16 +423,39 @@ def process_email_ingestion(servicio_id):
         logger.error(error_msg)
         return f"Error: {error_msg}"
     
+    except IngestaCancelada:
+        logger.warning(f"Ingesta del servicio {servicio_id} cancelada tras {correos_procesados} correos procesados")
+        
+        # Lo ya persistido se conserva en el historial
+        historial.estado = HistorialEjecucion.EstadoEjecucion.CANCELADO
+        historial.fecha_fin = timezone.now()
+        _acumular_tramo(
+            historial, errores + ["Ejecución cancelada"],
+            correos_procesados, correos_nuevos, archivos_procesados, glosas_extraidas
+        )
+        historial.save()
+        
+        servicio.en_ejecucion = False
+        servicio.save(update_fields=['en_ejecucion'])
+        
+        return f"Ingesta cancelada: {correos_procesados} correos procesados"
+    
     except Exception as e:
         error_msg = f"Error general al procesar ingesta: {str(e)}"
         logger.error(error_msg)
         
-        # Si hay historial, finalizarlo con error
+        # Si hay historial, finalizarlo con lo que este tramo y los anteriores ya guardaron
         try:
-            if 'historial' in locals():
-                historial.estado = HistorialEjecucion.EstadoEjecucion.ERROR
+            if locals().get('historial') is not None:
+                _acumular_tramo(
+                    historial, errores + [error_msg],
+                    correos_procesados, correos_nuevos, archivos_procesados, glosas_extraidas
+                )
+                if historial.correos_procesados > 0:
+                    historial.estado = HistorialEjecucion.EstadoEjecucion.PARCIAL
+                else:
+                    historial.estado = HistorialEjecucion.EstadoEjecucion.ERROR
                 historial.fecha_fin = timezone.now()
-                historial.mensaje_error = error_msg
                 historial.save()
         except Exception as e2:
             logger.error(f"Error al actualizar historial: {str(e2)}")
@@ -581,4 +512,39 @@ def sync_service_status():
             logger.error(f"Error al sincronizar estado del servicio para {tenant}: {str(e)}")
             continue
     
-    return "Sincronización de estado del servicio completada"
\ No newline at end of file
+    return "Sincronización de estado del servicio completada"
+
+@shared_task
+def backtest_reglas(servicio_id, dias=30, incluir=None, excluir=None):
+    """
+    Reproduce las reglas de filtrado de un servicio sobre los correos de los últimos días.
+    
+    Args:
+        servicio_id: ID del servicio de ingesta
+        dias: Antigüedad máxima de los correos (días)
+        incluir: IDs de reglas a añadir a las activas
+        excluir: IDs de reglas activas a quitar
+    
+    Returns:
+        dict: Informe de BacktestReglasService.ejecutar
+    """
+    try:
+        return BacktestReglasService.ejecutar(servicio_id, dias=dias, incluir=incluir, excluir=excluir)
+    except Exception as e:
+        logger.error(f"Error en el backtest de reglas del servicio {servicio_id}: {str(e)}")
+        return {'servicio_id': servicio_id, 'error': str(e)}
+
+@shared_task
+def reclasificar_correos(servicio_id, dias=None):
+    """
+    Reaplica las reglas activas de un servicio a sus correos ya ingeridos.
+    
+    Args:
+        servicio_id: ID del servicio de ingesta
+        dias: Solo correos de los últimos N días (opcional)
+    """
+    try:
+        return ReclasificacionService.reclasificar(servicio_id, dias=dias)
+    except Exception as e:
+        logger.error(f"Error al reclasificar correos del servicio {servicio_id}: {str(e)}")
+        return {'servicio_id': servicio_id, 'error': str(e)}
@@ -1,7 +1,7 @@
 # apps/ingesta_correo/urls.py - Actualizado para incluir rutas de ingesta programada
 
 from django.urls import path, include
-from .views import DashboardIngestaView, ApiDashboardIngestaView, ToggleServicioView, CorreosListView, VerifyConnectionView
+from .views import DashboardIngestaView, ApiDashboardIngestaView, ToggleServicioView, CorreosListView, VerifyConnectionView, AdjuntoDescargaView
 # Comentado temporalmente hasta implementar el modelo ReglaFiltrado
 # from .views_reglas import ReglasFiltradoView, ReglaFiltradoApiView, ReglaEstadoView, ReglasReordenarView
 # from .views_reglas_test import TestReglaView, TestReglaExistenteView
@@ -13,6 +13,7 @@ urlpatterns = [
     # Vistas web
     path('', DashboardIngestaView.as_view(), name='dashboard'),
     path('correos/', CorreosListView.as_view(), name='correos_list'),
+    path('adjuntos/<int:adjunto_id>/descargar/', AdjuntoDescargaView.as_view(), name='adjunto_descargar'),
     # Comentado temporalmente hasta implementar el modelo ReglaFiltrado
     # path('reglas/', ReglasFiltradoView.as_view(), name='reglas'),
     
@@ -5,7 +5,8 @@ from .views_ingesta import (
     IngestaControlPanelView,
     ApiServicioIngestaView,
     HistorialIngestaView,
-    ApiHistorialDetalleView
+    ApiHistorialDetalleView,
+    ApiHistogramaDespachoView
 )
 
 urlpatterns = [
@@ -16,4 +17,5 @@ urlpatterns = [
     # API endpoints
     path('api/servicio/', ApiServicioIngestaView.as_view(), name='api_servicio_ingesta'),
     path('api/historial/<int:historial_id>/', ApiHistorialDetalleView.as_view(), name='api_historial_detalle'),
+    path('api/despacho/histograma/', ApiHistogramaDespachoView.as_view(), name='api_histograma_despacho'),
 ]
\ No newline at end of file
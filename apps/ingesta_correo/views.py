@@ -2,7 +2,7 @@ import logging
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.generic import TemplateView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import JsonResponse
+from django.http import FileResponse, JsonResponse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_protect
@@ -11,7 +11,8 @@ from django.db.models import Q
 
 from apps.ingesta_correo.services.dashboard_service import DashboardService
 
-from .models import ServicioIngesta, HistorialEjecucion, LogActividad, CorreoIngesta
+from .models import ServicioIngesta, HistorialEjecucion, LogActividad, CorreoIngesta, ArchivoAdjunto
+from .services.adjunto_diferido_service import AdjuntoDiferidoService
 from .services.ingesta_scheduler_service import IngestaSchedulerService
 from apps.configuracion.models import EmailConfig
 from .tasks import execute_ingestion_now
@@ -174,6 +175,40 @@ class CorreosListView(LoginRequiredMixin, TemplateView):
         
         return context
     
+class AdjuntoDescargaView(LoginRequiredMixin, View):
+    """Descarga un adjunto; los que la ingesta dejó en el servidor se traen en ese momento."""
+    login_url = '/auth/login/'
+
+    def get(self, request, adjunto_id):
+        adjunto = get_object_or_404(
+            ArchivoAdjunto.objects.select_related('correo__servicio'),
+            id=adjunto_id, correo__servicio__tenant=request.user.tenant
+        )
+        if adjunto.pendiente_descarga:
+            try:
+                adjunto = AdjuntoDiferidoService.descargar(adjunto)
+            except Exception as e:
+                logger.error(f"Error al descargar el adjunto diferido {adjunto_id}: {str(e)}")
+                return JsonResponse({
+                    'success': False,
+                    'message': f'No se pudo descargar el adjunto del servidor de correo: {str(e)}'
+                }, status=502)
+
+        # Diferido sin origen IMAP utilizable, o filas antiguas sin archivo
+        if not adjunto.archivo:
+            return JsonResponse({
+                'success': False,
+                'message': 'El adjunto no tiene un archivo almacenado'
+            }, status=404)
+
+        return FileResponse(
+            adjunto.archivo.open('rb'),
+            as_attachment=True,
+            filename=adjunto.nombre_archivo,
+            content_type=adjunto.tipo_contenido or None
+        )
+
+
 class VerifyConnectionView(LoginRequiredMixin, View):
     """Vista para verificar la conexión al servidor de correo."""
     
@@ -12,6 +12,7 @@ from django.db import transaction
 
 from .models import ServicioIngesta, HistorialEjecucion, LogActividad
 from .services.ingesta_scheduler_service import IngestaSchedulerService
+from .services.despacho_ingesta_service import DespachoIngestaService
 from .tasks import execute_ingestion_now
 from apps.configuracion.models import EmailConfig
 
@@ -154,10 +155,15 @@ class ApiServicioIngestaView(LoginRequiredMixin, View):
                     'id': servicio.id,
                     'activo': servicio.activo,
                     'intervalo_minutos': servicio.intervalo_minutos,
+                    'intervalo_adaptativo': servicio.intervalo_adaptativo,
+                    'intervalo_minimo_minutos': servicio.intervalo_minimo_minutos,
+                    'intervalo_maximo_minutos': servicio.intervalo_maximo_minutos,
+                    'intervalo_efectivo': servicio.intervalo_efectivo,
                     'proxima_ejecucion': servicio.proxima_ejecucion.isoformat() if servicio.proxima_ejecucion else None,
                     'ultima_ejecucion': servicio.ultima_ejecucion.isoformat() if servicio.ultima_ejecucion else None,
                     'ultima_verificacion': servicio.ultima_verificacion.isoformat() if servicio.ultima_verificacion else None,
                     'en_ejecucion': servicio.en_ejecucion,
+                    'cancelacion_solicitada': servicio.cancelacion_solicitada is not None,
                     'tiempo_restante': servicio.tiempo_hasta_proxima_ejecucion(),
                     'correos_procesados_total': servicio.correos_procesados_total,
                     'correos_ultima_ejecucion': servicio.correos_ultima_ejecucion
@@ -192,6 +198,7 @@ class ApiServicioIngestaView(LoginRequiredMixin, View):
                     'ultima_ejecucion': None,
                     'ultima_verificacion': None,
                     'en_ejecucion': False,
+                    'cancelacion_solicitada': False,
                     'tiempo_restante': "No programado",
                     'correos_procesados_total': 0,
                     'correos_ultima_ejecucion': 0
@@ -246,6 +253,14 @@ class ApiServicioIngestaView(LoginRequiredMixin, View):
                 
                 return JsonResponse(result)
             
+            elif action == 'cancel_run':
+                # Detener la ejecución en curso sin matar el worker
+                result = IngestaSchedulerService.cancelar_ejecucion(
+                    servicio.id,
+                    request.user
+                )
+                return JsonResponse(result)
+            
             elif action == 'update_interval':
                 # Cambiar intervalo de ejecución
                 intervalo = request.POST.get('interval')
@@ -262,6 +277,17 @@ class ApiServicioIngestaView(LoginRequiredMixin, View):
                 )
                 return JsonResponse(result)
             
+            elif action == 'update_adaptive':
+                # Activar o desactivar el intervalo adaptativo y fijar sus límites
+                result = IngestaSchedulerService.configurar_intervalo_adaptativo(
+                    servicio.id,
+                    request.POST.get('adaptive', '').lower() == 'true',
+                    request.POST.get('min_interval'),
+                    request.POST.get('max_interval'),
+                    request.user
+                )
+                return JsonResponse(result)
+            
             else:
                 return JsonResponse({
                     'success': False,
@@ -388,4 +414,44 @@ class ApiHistorialDetalleView(LoginRequiredMixin, View):
             return JsonResponse({
                 'success': False,
                 'message': f"Error al obtener detalles: {str(e)}"
-            }, status=500)
\ No newline at end of file
+            }, status=500)
+
+
+class ApiHistogramaDespachoView(LoginRequiredMixin, View):
+    """API con la carga programada de ingesta a lo largo del intervalo (todos los tenants)."""
+    
+    def get(self, request):
+        """Histograma de ejecuciones programadas por cubo de tiempo."""
+        # Reúne los servicios de todos los tenants: solo para superusuarios
+        if not request.user.is_superuser:
+            return JsonResponse({
+                'success': False,
+                'message': "No tiene permisos para ver la carga del despacho"
+            }, status=403)
+        
+        try:
+            ventana = request.GET.get('window')
+            cubo = int(request.GET.get('bucket', 60))
+            ventana = min(int(ventana), 24 * 60) if ventana else None
+            if cubo < 1 or (ventana is not None and ventana < 1):
+                raise ValueError()
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': "La ventana y el cubo deben ser enteros positivos"
+            }, status=400)
+        
+        try:
+            histograma = DespachoIngestaService.histograma_carga(ventana_minutos=ventana, cubo_segundos=cubo)
+            histograma['inicio'] = histograma['inicio'].isoformat()
+            return JsonResponse({
+                'success': True,
+                'histograma': histograma
+            })
+        
+        except Exception as e:
+            logger.error(f"Error al calcular el histograma de carga del despacho: {str(e)}")
+            return JsonResponse({
+                'success': False,
+                'message': f"Error al calcular el histograma: {str(e)}"
+            }, status=500)
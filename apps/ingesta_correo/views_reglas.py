@@ -22,12 +22,40 @@ from django.template.loader import render_to_string
 
 from apps.ingesta_correo.models import ReglaFiltrado, ServicioIngesta, CondicionRegla, CategoriaRegla, CorreoIngesta, HistorialAplicacionRegla
 from apps.ingesta_correo.services.regla_filtrado_service import ReglaFiltradoService
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.perfil_reglas_service import PerfilReglasService
+from apps.ingesta_correo.services.regla_motor_service import ReglaMotorService, normalizar_campo
 from apps.ingesta_correo.services.regla_test_service import ReglaTestService
+from apps.ingesta_correo.services.traza_reglas_service import TrazaReglasService
 from apps.tenants.utils import get_tenant_for_user
 from .forms import ReglaFiltradoForm, CondicionReglaInlineFormSet, CategoriaReglaForm
 
 logger = logging.getLogger(__name__)
 
+
+def _con_perfil(reglas):
+    """Añade a cada regla su coste de evaluación de los últimos días (atributo perfil, o None)."""
+    reglas = list(reglas)
+    resumen = PerfilReglasService.resumen([regla.id for regla in reglas])
+    for regla in reglas:
+        regla.perfil = resumen.get(regla.id)
+    return reglas
+
+
+def _perfil_regla(regla, condiciones=None):
+    """Coste de evaluación de una regla con el de cada condición (atributo perfil de cada una)."""
+    perfil = PerfilReglasService.resumen([regla.id]).get(regla.id)
+    if condiciones is not None:
+        condiciones = list(condiciones)
+        for condicion in condiciones:
+            condicion.perfil = perfil['condiciones'].get(condicion.id) if perfil else None
+    return perfil, condiciones
+
+
+def _ids_costosas(servicio_id, limite=5):
+    return [fila['regla_id'] for fila in PerfilReglasService.reglas_mas_costosas(servicio_id, limite=limite)]
+
+
 class ReglasFiltradoView(LoginRequiredMixin, TemplateView):
     """Vista para la página de gestión de reglas de filtrado."""
     template_name = 'ingesta_correo/reglas_list.html'
@@ -42,8 +70,10 @@ class ReglasFiltradoView(LoginRequiredMixin, TemplateView):
         context['active_menu'] = 'ingesta_correo'
         context['active_submenu'] = 'reglas'
         
-        # Obtener las reglas de filtrado para este tenant
-        context['reglas'] = ReglaFiltradoService.get_reglas_for_tenant(tenant)
+        # Obtener las reglas de filtrado para este tenant con su coste de evaluación
+        context['reglas'] = _con_perfil(ReglaFiltradoService.get_reglas_for_tenant(tenant))
+        servicio = ServicioIngesta.objects.filter(tenant=tenant).first()
+        context['reglas_costosas'] = _ids_costosas(servicio.id) if servicio else []
         
         # Obtener los campos, condiciones y acciones disponibles para reglas
         context['campos'] = ReglaFiltrado.TipoCampo.choices
@@ -155,6 +185,9 @@ class ReglaEditarView(LoginRequiredMixin, UpdateView):
         
         context['es_creacion'] = False
         context['regla'] = self.object
+        context['perfil'], context['condiciones_perfil'] = _perfil_regla(
+            self.object, self.object.condiciones.order_by('orden') if self.object.es_compuesta else None
+        )
         context['active_menu'] = 'ingesta_correo'
         context['active_submenu'] = 'reglas'
         return context
@@ -592,12 +625,14 @@ def reglas_list(request):
         'reglas_simples': reglas.filter(es_compuesta=False).count(),
         'reglas_compuestas': reglas.filter(es_compuesta=True).count(),
     }
+    reglas = _con_perfil(reglas)
+    reglas_costosas = _ids_costosas(servicio.id)
     
     # Si es una petición AJAX, devolver sólo la tabla
     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
         html = render_to_string(
             'ingesta_correo/reglas/reglas_table.html', 
-            {'reglas': reglas, 'estadisticas': estadisticas}
+            {'reglas': reglas, 'estadisticas': estadisticas, 'reglas_costosas': reglas_costosas}
         )
         return JsonResponse({'html': html})
     
@@ -605,6 +640,7 @@ def reglas_list(request):
         'reglas': reglas,
         'categorias': categorias,
         'estadisticas': estadisticas,
+        'reglas_costosas': reglas_costosas,
         'tipo_acciones': ReglaFiltrado.TipoAccion.choices,
         'filtros': {
             'categoria': categoria_id,
@@ -632,12 +668,17 @@ def regla_detail(request, regla_id):
     if regla.es_compuesta:
         condiciones = regla.condiciones.all().order_by('orden')
     
+    # Coste de evaluación medido por el perfil de reglas
+    perfil, condiciones_perfil = _perfil_regla(regla, condiciones)
+    
     # Obtener historial de aplicación
     historial = HistorialAplicacionRegla.objects.filter(regla=regla).order_by('-fecha_aplicacion')[:20]
     
     return render(request, 'ingesta_correo/reglas/regla_detail.html', {
         'regla': regla,
         'condiciones': condiciones,
+        'perfil': perfil,
+        'condiciones_perfil': condiciones_perfil,
         'historial': historial
     })
 
@@ -941,10 +982,13 @@ def regla_test(request, regla_id=None):
         
         try:
             regla = ReglaFiltrado.objects.get(id=regla_id, servicio=servicio)
-            correo = CorreoIngesta.objects.get(id=correo_id, servicio=servicio)
+            correo = CorreoIngesta.objects.prefetch_related('adjuntos').get(id=correo_id, servicio=servicio)
+            
+            # Una sola instantánea para la regla, sus condiciones y la traza
+            instantanea = InstantaneaCorreo.desde_correo(correo)
             
             # Evaluar la regla
-            resultado = regla.evaluar(correo)
+            resultado = regla.evaluar(correo, instantanea=instantanea)
             
             # Detalles de evaluación
             detalles = {
@@ -958,7 +1002,7 @@ def regla_test(request, regla_id=None):
             if regla.es_compuesta:
                 condiciones_detalle = []
                 for condicion in regla.condiciones.all():
-                    resultado_condicion = condicion.evaluar(correo)
+                    resultado_condicion = condicion.evaluar(correo, instantanea=instantanea)
                     condiciones_detalle.append({
                         'campo': condicion.get_campo_display(),
                         'condicion': condicion.get_condicion_display(),
@@ -969,7 +1013,7 @@ def regla_test(request, regla_id=None):
                 detalles['detalles']['operador'] = regla.get_operador_logico_display()
             else:
                 # Detalles para regla simple
-                valor_campo = regla._obtener_valor_campo(correo, regla.campo)
+                valor_campo = instantanea.get(normalizar_campo(regla.campo), '')
                 detalles['detalles'] = {
                     'campo': regla.get_campo_display(),
                     'condicion': regla.get_condicion_display(),
@@ -977,6 +1021,12 @@ def regla_test(request, regla_id=None):
                     'valor_encontrado': valor_campo
                 }
             
+            # Traza completa de todas las reglas del servicio, solo bajo demanda
+            if request.POST.get('traza') == 'true':
+                traza = TrazaReglasService.bajo_demanda(tenant.id)
+                ReglaFiltradoService.evaluar_reglas(correo, traza=traza, instantanea=instantanea)
+                detalles['traza'] = traza.como_lista()
+            
             # Guardar el historial de prueba
             HistorialAplicacionRegla.objects.create(
                 regla=regla,
@@ -1019,11 +1069,18 @@ def batch_test(request):
     if request.method == 'POST' and request.headers.get('x-requested-with') == 'XMLHttpRequest':
         correo_ids = request.POST.getlist('correo_ids[]')
         
+        # Cada regla se compila una sola vez para todos los correos
+        compiladas = [
+            (regla, ReglaMotorService.compilar_regla(regla))
+            for regla in reglas.prefetch_related('condiciones')
+        ]
+        
         resultados = []
         
         for correo_id in correo_ids:
             try:
-                correo = CorreoIngesta.objects.get(id=correo_id, servicio=servicio)
+                correo = CorreoIngesta.objects.prefetch_related('adjuntos').get(id=correo_id, servicio=servicio)
+                instantanea = InstantaneaCorreo.desde_correo(correo)
                 correo_resultado = {
                     'correo_id': correo.id,
                     'asunto': correo.asunto,
@@ -1031,9 +1088,9 @@ def batch_test(request):
                     'resultados': []
                 }
                 
-                for regla in reglas:
+                for regla, compilada in compiladas:
                     # Evaluar la regla
-                    resultado = regla.evaluar(correo)
+                    resultado = compilada.cumple(instantanea)
                     correo_resultado['resultados'].append({
                         'regla_id': regla.id,
                         'nombre': regla.nombre,
@@ -12,8 +12,10 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_protect
 
-from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.models import CorreoIngesta, ReglaFiltrado
+from apps.ingesta_correo.services.regla_filtrado_service import ReglaFiltradoService
 from apps.ingesta_correo.services.regla_test_service import ReglaTestService
+from apps.ingesta_correo.services.traza_reglas_service import TrazaReglasService
 
 logger = logging.getLogger(__name__)
 
@@ -97,6 +99,10 @@ class TestReglaExistenteView(LoginRequiredMixin, View):
         """
         Evalúa si los datos de prueba cumplen con una regla existente.
         
+        Con {"correo_id": id, "traza": true} se evalúan además todas las reglas
+        del servicio contra ese correo ya ingerido y se devuelve la traza
+        completa, sin muestreo y sin guardarla.
+        
         Args:
             request: Solicitud HTTP con datos de prueba
             regla_id: ID de la regla a probar
@@ -131,6 +137,9 @@ class TestReglaExistenteView(LoginRequiredMixin, View):
                     'message': 'Formato de datos inválido. Se esperaba JSON.'
                 }, status=400)
             
+            if data.get('traza') and data.get('correo_id'):
+                return self._traza_correo(regla, data['correo_id'])
+            
             # Validar que hay datos suficientes
             if not datos_prueba:
                 return JsonResponse({
@@ -156,4 +165,28 @@ class TestReglaExistenteView(LoginRequiredMixin, View):
             return JsonResponse({
                 'success': False,
                 'message': f'Error al probar la regla: {str(e)}'
-            }, status=500)
\ No newline at end of file
+            }, status=500)
+    
+    @staticmethod
+    def _traza_correo(regla, correo_id):
+        """Evalúa las reglas del servicio contra un correo ingerido con traza completa."""
+        try:
+            correo = CorreoIngesta.objects.select_related('servicio').get(id=correo_id, servicio_id=regla.servicio_id)
+        except CorreoIngesta.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'message': 'El correo no existe.'
+            }, status=404)
+        
+        traza = TrazaReglasService.bajo_demanda(regla.servicio.tenant_id)
+        regla_aplicada = ReglaFiltradoService.evaluar_reglas(correo, traza=traza)
+        
+        return JsonResponse({
+            'success': True,
+            'resultado': {
+                'cumple': regla_aplicada is not None and regla_aplicada.id == regla.id,
+                'regla_aplicada': regla_aplicada.id if regla_aplicada else None,
+                'accion': regla_aplicada.accion if regla_aplicada else None
+            },
+            'traza': traza.como_lista()
+        })
\ No newline at end of file
@@ -0,0 +1,61 @@
+import email
+import hashlib
+import os
+from email.message import EmailMessage
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.services.adjunto_storage_service import AdjuntoStorageService, ArchivoAdjuntoStream
+
+
+def _parte_adjunta(contenido, cte):
+    mensaje = EmailMessage()
+    mensaje.set_content('cuerpo')
+    mensaje.add_attachment(contenido, maintype='application', subtype='octet-stream', filename='glosa.bin', cte=cte)
+    return [parte for parte in email.message_from_bytes(mensaje.as_bytes()).walk() if parte.get_filename()][0]
+
+
+class ArchivoAdjuntoStreamTests(SimpleTestCase):
+    """Pruebas de la decodificación por trozos de adjuntos."""
+
+    def _verificar(self, parte):
+        esperado = parte.get_payload(decode=True)
+        stream = ArchivoAdjuntoStream(parte, 'glosa.bin', tamaño_trozo=97)
+
+        decodificado = b''.join(stream.chunks())
+
+        self.assertEqual(decodificado, esperado)
+        self.assertEqual(stream.tamaño, len(esperado))
+        self.assertEqual(stream.hash.hexdigest(), hashlib.sha256(esperado).hexdigest())
+
+    def test_base64_por_trozos(self):
+        self._verificar(_parte_adjunta(os.urandom(5000), 'base64'))
+
+    def test_quoted_printable_por_trozos(self):
+        contenido = ('Glosa con tildes: año, acción = valor ' * 80).encode('latin-1') + b'\x00\xff'
+        self._verificar(_parte_adjunta(contenido, 'quoted-printable'))
+
+
+class TransaccionBlobsTests(SimpleTestCase):
+    """Los archivos de blobs creados en una transacción revertida no quedan huérfanos."""
+
+    def setUp(self):
+        atomic = mock.patch('apps.ingesta_correo.services.adjunto_storage_service.transaction.atomic')
+        atomic.start()
+        self.addCleanup(atomic.stop)
+        eliminar = mock.patch.object(AdjuntoStorageService, 'eliminar_archivo_blob')
+        self.eliminar = eliminar.start()
+        self.addCleanup(eliminar.stop)
+
+    def test_revertida_borra_los_blobs_nuevos(self):
+        with self.assertRaises(ValueError):
+            with AdjuntoStorageService.transaccion() as nuevos:
+                nuevos.append('adjuntos_correo/tenant_1/blobs/ab/cd/abcd')
+                raise ValueError('fallo del lote')
+        self.eliminar.assert_called_once_with('adjuntos_correo/tenant_1/blobs/ab/cd/abcd')
+
+    def test_confirmada_conserva_los_blobs(self):
+        with AdjuntoStorageService.transaccion() as nuevos:
+            nuevos.append('adjuntos_correo/tenant_1/blobs/ab/cd/abcd')
+        self.eliminar.assert_not_called()
@@ -0,0 +1,43 @@
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services import backtest_reglas_service
+from apps.ingesta_correo.services.backtest_reglas_service import BacktestReglasService
+
+
+def _regla(id, valor, accion, prioridad):
+    return ReglaFiltrado(id=id, nombre=f'Regla {id}', campo='asunto', condicion='contiene', valor=valor,
+                         accion=accion, prioridad=prioridad)
+
+
+def _fila(id, asunto):
+    return {'id': id, 'remitente': 'glosas@eps.example.com', 'destinatarios': '', 'asunto': asunto,
+            'contenido_plano': '', 'fecha_recepcion': timezone.now()}
+
+
+class BacktestReglasTests(SimpleTestCase):
+    """Pruebas de la evaluación por trozos del backtest de reglas."""
+
+    def test_coincidencias_primera_regla_y_cambios(self):
+        Accion = ReglaFiltrado.TipoAccion
+        reglas = [
+            _regla(1, 'urgente', Accion.PRIORIDAD_ALTA, 1),
+            _regla(2, 'glosa', Accion.PROCESAR, 2),
+            _regla(3, 'adjunto', Accion.IGNORAR, 3),
+        ]
+        backtest_reglas_service._inicializar_trabajador(
+            BacktestReglasService._especificacion(reglas), timezone.now()
+        )
+        trozo = [
+            (_fila(1, 'Glosa URGENTE'), [], Accion.PROCESAR),
+            (_fila(2, 'Glosa factura'), [], Accion.PROCESAR),
+            (_fila(3, 'Otro asunto'), [('a.pdf', 'application/pdf', 10)], None),
+        ]
+        resultado = backtest_reglas_service._evaluar_trozo(trozo, max_muestra=10)
+
+        self.assertEqual(resultado['correos'], 3)
+        self.assertEqual(resultado['coincidencias'], {1: 1, 2: 2})
+        self.assertEqual(resultado['primeras'], {1: 1, 2: 1, None: 1})
+        self.assertEqual(resultado['transiciones'], {(Accion.PROCESAR, Accion.PRIORIDAD_ALTA): 1})
+        self.assertEqual([cambio['correo_id'] for cambio in resultado['muestra']], [1])
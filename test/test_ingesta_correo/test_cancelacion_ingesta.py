@@ -0,0 +1,56 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.cancelacion_ingesta_service import IngestaCancelada, TokenCancelacion
+
+RELOJ = 'apps.ingesta_correo.services.cancelacion_ingesta_service.time.monotonic'
+VIGENTES = 'apps.ingesta_correo.services.cancelacion_ingesta_service.LeaseIngesta.vigentes'
+
+
+class TokenCancelacionTests(SimpleTestCase):
+    """Pruebas del token de cancelación cooperativa de la ingesta."""
+
+    def _marca(self, *valores):
+        consulta = mock.patch.object(ServicioIngesta.objects, 'filter')
+        filtro = consulta.start()
+        self.addCleanup(consulta.stop)
+        filtro.return_value.exists.side_effect = list(valores)
+        return filtro
+
+    def test_consulta_la_marca_como_mucho_cada_intervalo(self):
+        filtro = self._marca(False, True)
+        token = TokenCancelacion(7, intervalo=2)
+        with mock.patch(RELOJ, return_value=100):
+            self.assertFalse(token.solicitada())
+        with mock.patch(RELOJ, return_value=101):
+            self.assertFalse(token.solicitada())
+        self.assertEqual(filtro.call_count, 1)
+        with mock.patch(RELOJ, return_value=102):
+            self.assertTrue(token.solicitada())
+        filtro.assert_called_with(id=7, cancelacion_solicitada__isnull=False)
+
+    def test_comprobar_lanza_y_la_cancelacion_no_se_olvida(self):
+        filtro = self._marca(True)
+        token = TokenCancelacion(7, intervalo=0)
+        with self.assertRaises(IngestaCancelada):
+            token.comprobar()
+        with self.assertRaises(IngestaCancelada):
+            token.comprobar()
+        self.assertEqual(filtro.call_count, 1)
+
+    def test_solo_se_solicita_con_una_ejecucion_viva(self):
+        filtro = self._marca()
+        filtro.return_value.update.return_value = 0
+        # Sin lease vigente solo cuenta una reserva de despacho vigente, no en_ejecucion
+        with mock.patch(VIGENTES, return_value=set()):
+            self.assertFalse(TokenCancelacion.solicitar(7, timezone.now()))
+        self.assertIn('despachado_en__gt', filtro.call_args.kwargs)
+        self.assertNotIn('en_ejecucion', filtro.call_args.kwargs)
+
+        filtro.return_value.update.return_value = 1
+        with mock.patch(VIGENTES, return_value={7}):
+            self.assertTrue(TokenCancelacion.solicitar(7, timezone.now()))
+        filtro.assert_called_with(id=7)
@@ -0,0 +1,43 @@
+import email
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.management.commands._imap_simulado import generar_mensaje
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+
+
+class CorreoParserServiceTests(SimpleTestCase):
+    """Pruebas de la extracción de datos de un correo antes de persistirlo."""
+
+    def test_separa_cuerpo_y_adjuntos(self):
+        mensaje = email.message_from_bytes(generar_mensaje(3, 1024, tamaño_adjunto=2048))
+
+        datos = CorreoParserService.parsear(mensaje, '<bench-3@zentraflow.local>')
+
+        self.assertEqual(datos['asunto'], 'Glosa 3')
+        self.assertTrue(datos['contenido_plano'].startswith('Contenido de la glosa'))
+        self.assertEqual([adjunto['nombre_archivo'] for adjunto in datos['adjuntos']], ['glosa_3.pdf'])
+        self.assertEqual(len(datos['adjuntos'][0]['parte'].get_payload(decode=True)), 2048)
+
+    def test_cabeceras_ausentes_y_nombre_con_ruta(self):
+        mensaje = email.message_from_string(
+            'Content-Type: multipart/mixed; boundary="b"\n\n'
+            '--b\nContent-Type: text/plain; charset=latin-1\nContent-Transfer-Encoding: 8bit\n\nA\xf1o\n'
+            '--b\nContent-Type: application/pdf\nContent-Disposition: attachment; filename="../../x.pdf"\n\nPDF\n'
+            '--b--\n'
+        )
+
+        datos = CorreoParserService.parsear(mensaje, 'POP3-1')
+
+        self.assertEqual(datos['remitente'], '')
+        self.assertEqual(datos['asunto'], '')
+        self.assertIsNotNone(datos['fecha_recepcion'])
+        self.assertEqual(datos['adjuntos'][0]['nombre_archivo'], 'x.pdf')
+
+    def test_normalizar_mensaje_id(self):
+        largo = '<' + 'x' * 300 + '@zentraflow.local>'
+        normalizado = CorreoParserService.normalizar_mensaje_id(f'  {largo} ', 'IMAP-7')
+        self.assertEqual(normalizado, largo[:255])
+        self.assertEqual(CorreoParserService.normalizar_mensaje_id(normalizado, 'IMAP-7'), normalizado)
+        self.assertEqual(CorreoParserService.normalizar_mensaje_id('  ', 'IMAP-7'), 'IMAP-7')
+        self.assertEqual(CorreoParserService.normalizar_mensaje_id(None, 'POP3-2'), 'POP3-2')
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.services.despacho_ingesta_service import (
+    Candidato, DespachoIngestaService, normalizar_host, planificar
+)
+
+
+def _ids(elegidos):
+    return [candidato.servicio_id for candidato in elegidos]
+
+
+class PlanificarTests(SimpleTestCase):
+    """Pruebas del reparto de cupos del despacho de ingesta."""
+
+    def test_alterna_entre_tenants(self):
+        candidatos = [
+            Candidato(1, 'a', 'imap.a'), Candidato(2, 'a', 'imap.a'), Candidato(3, 'a', 'imap.a'),
+            Candidato(4, 'b', 'imap.b'), Candidato(5, 'c', 'imap.c'), Candidato(6, 'b', 'imap.b'),
+        ]
+        elegidos = planificar(candidatos, max_por_host=None, max_por_tenant=None)
+        self.assertEqual(_ids(elegidos), [1, 4, 5, 2, 6, 3])
+
+        self.assertEqual(_ids(planificar(candidatos, max_por_host=None, max_por_tenant=1)), [1, 4, 5])
+        self.assertEqual(_ids(planificar(candidatos, max_por_host=None, max_por_tenant=None, limite=2)), [1, 4])
+
+    def test_respeta_cupo_por_host_con_ejecuciones_en_curso(self):
+        candidatos = [Candidato(servicio_id, servicio_id, 'imap.compartido') for servicio_id in range(1, 6)]
+        candidatos.append(Candidato(6, 6, 'imap.propio'))
+        ocupados = [(10, 'imap.compartido'), (11, 'imap.compartido')]
+
+        elegidos = planificar(candidatos, ocupados, max_por_host=3, max_por_tenant=1)
+        self.assertEqual(_ids(elegidos), [1, 6])
+
+    def test_cupo_por_tenant_cuenta_ejecuciones_en_curso(self):
+        candidatos = [Candidato(1, 'a', None), Candidato(2, 'a', None), Candidato(3, 'b', None)]
+        elegidos = planificar(candidatos, [('a', None)], max_por_host=1, max_por_tenant=2)
+        # Sin servidor conocido no se aplica el cupo por host
+        self.assertEqual(_ids(elegidos), [1, 3])
+
+    def test_normalizar_host(self):
+        self.assertEqual(normalizar_host(' IMAP.Gmail.com '), 'imap.gmail.com')
+        self.assertIsNone(normalizar_host(''))
+
+
+class RetrasoDespachoTests(SimpleTestCase):
+    """Pruebas de la espera con que se encola cada servicio despachado."""
+
+    def test_espera_hasta_el_turno_con_jitter(self):
+        ahora = datetime(2024, 5, 6, 8, 0, tzinfo=dt_timezone.utc)
+        retraso = DespachoIngestaService.retraso
+        self.assertEqual(retraso(ahora + timedelta(seconds=25), ahora, 60, jitter=0), 25)
+        # Vencido: ya; fuera del horizonte: no pasa de él
+        self.assertEqual(retraso(ahora - timedelta(minutes=3), ahora, 60, jitter=0), 0)
+        self.assertEqual(retraso(ahora + timedelta(minutes=5), ahora, 60, jitter=0), 60)
+        esperas = {retraso(ahora + timedelta(seconds=25), ahora, 60, jitter=10) for _ in range(20)}
+        self.assertTrue(all(25 <= espera <= 35 for espera in esperas))
+        self.assertGreater(len(esperas), 1)
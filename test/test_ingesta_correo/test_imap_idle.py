@@ -0,0 +1,128 @@
+import queue
+import select
+import socketserver
+import threading
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.services.imap_idle_service import EscuchaIdle
+
+
+class ManejadorImap(socketserver.StreamRequestHandler):
+    """Servidor IMAP mínimo: CAPABILITY, LOGIN, SELECT, IDLE/DONE y LOGOUT."""
+
+    def enviar(self, linea):
+        self.wfile.write(linea.encode() + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        servidor = self.server
+        servidor.conexiones += 1
+        self.enviar('* OK IMAP de prueba listo')
+        while True:
+            linea = self.rfile.readline()
+            if not linea:
+                return
+            tag, comando = linea.decode().strip().split(' ', 1)
+            comando = comando.upper()
+            if comando.startswith('CAPABILITY'):
+                self.enviar('* CAPABILITY IMAP4rev1 IDLE')
+                self.enviar(f'{tag} OK CAPABILITY completado')
+            elif comando.startswith('LOGIN'):
+                self.enviar(f'{tag} OK LOGIN completado')
+            elif comando.startswith('SELECT'):
+                self.enviar(f'* {servidor.existentes} EXISTS')
+                self.enviar('* OK [UIDVALIDITY 7] UIDs válidos')
+                self.enviar(f'{tag} OK [READ-WRITE] SELECT completado')
+            elif comando == 'IDLE':
+                self.enviar('+ idling')
+                if not self.idle(tag):
+                    return
+            elif comando.startswith('LOGOUT'):
+                self.enviar('* BYE adiós')
+                self.enviar(f'{tag} OK LOGOUT completado')
+                return
+            else:
+                self.enviar(f'{tag} BAD comando desconocido')
+
+    def idle(self, tag):
+        """Reenvía los avisos encolados hasta recibir DONE; False si se corta la conexión."""
+        servidor = self.server
+        while True:
+            try:
+                aviso = servidor.avisos.get_nowait()
+            except queue.Empty:
+                aviso = None
+            if aviso == 'cortar':
+                return False
+            if aviso:
+                servidor.existentes += 1
+                self.enviar(f'* {servidor.existentes} EXISTS')
+            legibles, _, _ = select.select([self.connection], [], [], 0.02)
+            if legibles:
+                self.rfile.readline()
+                self.enviar(f'{tag} OK IDLE terminado')
+                return True
+
+
+class ServidorImapPrueba(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ManejadorImap)
+        self.existentes = 3
+        self.conexiones = 0
+        self.avisos = queue.Queue()
+
+
+class EscuchaIdleTests(SimpleTestCase):
+    """Pruebas del listener IMAP IDLE contra un servidor IMAP local."""
+
+    def setUp(self):
+        self.servidor = ServidorImapPrueba()
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        self.addCleanup(self.servidor.server_close)
+        self.addCleanup(self.servidor.shutdown)
+
+        config = SimpleNamespace(
+            server_host='127.0.0.1', server_port=self.servidor.server_address[1], use_ssl=False,
+            username='glosas', password='secreto', folder_to_monitor='INBOX',
+            email_address='glosas@example.com', tenant_id=1,
+        )
+        self.recibidos = queue.Queue()
+        self.escucha = EscuchaIdle(
+            config, self.recibidos.put, espera_inicial=0.05, espera_maxima=0.2, agrupar=0.1
+        )
+        self.hilo = threading.Thread(target=self.escucha.ejecutar, daemon=True)
+        self.hilo.start()
+        self.addCleanup(self.hilo.join, 5)
+        self.addCleanup(self.escucha.detener)
+
+    def esperar_notificacion(self):
+        return self.recibidos.get(timeout=5)
+
+    def test_notifica_al_conectar_y_con_exists(self):
+        # Al conectar se notifica una vez por lo que llegó sin conexión
+        self.esperar_notificacion()
+        self.servidor.avisos.put('nuevo')
+        self.servidor.avisos.put('nuevo')
+        self.esperar_notificacion()
+        self.assertEqual(self.escucha.existentes, 5)
+        # Los dos EXISTS seguidos se agrupan en una sola notificación
+        with self.assertRaises(queue.Empty):
+            self.recibidos.get(timeout=0.3)
+
+    def test_reconecta_si_se_corta_la_conexion(self):
+        self.esperar_notificacion()
+        with self.assertLogs('apps.ingesta_correo.services.imap_idle_service', 'WARNING'):
+            self.servidor.avisos.put('cortar')
+            # Tras reconectar se vuelve a notificar para recoger lo perdido
+            self.esperar_notificacion()
+        self.assertEqual(self.servidor.conexiones, 2)
+        self.assertEqual(self.escucha.reconexiones, 1)
+
+        self.servidor.avisos.put('nuevo')
+        self.esperar_notificacion()
+        self.assertEqual(self.escucha.existentes, 4)
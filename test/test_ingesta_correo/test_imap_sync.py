@@ -0,0 +1,197 @@
+import email
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.management.commands._imap_simulado import ServidorImapSimulado, generar_mensaje
+from apps.ingesta_correo.services import estructura_imap
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+
+
+class CheckpointFalso:
+    """Punto de control en memoria con la misma interfaz que SincronizacionCarpeta."""
+
+    def __init__(self, uid_validity=None, ultimo_uid=0):
+        self.servicio_id = 1
+        self.carpeta = 'INBOX'
+        self.uid_validity = uid_validity
+        self.ultimo_uid = ultimo_uid
+        self.resincronizaciones = 0
+        self.fecha_ultima_resincronizacion = None
+        self.guardados = 0
+
+    def save(self, update_fields=None):
+        self.guardados += 1
+
+
+class ServidorImapFalso:
+    """Simula las respuestas de imaplib para UID SEARCH sobre un conjunto de UID."""
+
+    def __init__(self, uids):
+        self.uids = uids
+        self.busquedas = []
+
+    def uid(self, comando, charset, criterio):
+        self.busquedas.append(criterio)
+        desde = int(criterio.split()[1].split(':')[0])
+        encontrados = [uid for uid in self.uids if uid >= desde]
+        # "n:*" incluye siempre el mayor UID existente
+        if not encontrados and self.uids:
+            encontrados = [max(self.uids)]
+        return 'OK', [' '.join(str(uid) for uid in encontrados).encode()]
+
+
+class ImapSyncServiceTests(SimpleTestCase):
+    """Pruebas de la sincronización incremental por UID."""
+
+    def test_primera_sincronizacion_solicita_todo(self):
+        """Sin punto de control se solicitan todos los UID desde 1."""
+        checkpoint = CheckpointFalso()
+        servidor = ServidorImapFalso([3, 7, 9])
+
+        uids = ImapSyncService.buscar_uids_nuevos(servidor, checkpoint, 100)
+
+        self.assertEqual(uids, [3, 7, 9])
+        self.assertEqual(servidor.busquedas, ['UID 1:*'])
+        self.assertEqual(checkpoint.uid_validity, 100)
+
+    def test_solo_solicita_uids_posteriores(self):
+        """Con punto de control solo se solicitan los UID mayores al último procesado."""
+        checkpoint = CheckpointFalso(uid_validity=100, ultimo_uid=7)
+        servidor = ServidorImapFalso([3, 7, 9, 12])
+
+        uids = ImapSyncService.buscar_uids_nuevos(servidor, checkpoint, 100)
+
+        self.assertEqual(uids, [9, 12])
+        self.assertEqual(servidor.busquedas, ['UID 8:*'])
+
+    def test_sin_correo_nuevo_descarta_el_mayor_uid(self):
+        """La respuesta de "n:*" con el último UID ya procesado no genera trabajo."""
+        checkpoint = CheckpointFalso(uid_validity=100, ultimo_uid=9)
+        servidor = ServidorImapFalso([3, 7, 9])
+
+        self.assertEqual(ImapSyncService.buscar_uids_nuevos(servidor, checkpoint, 100), [])
+
+    def test_cambio_de_uidvalidity_fuerza_resincronizacion(self):
+        """Un UIDVALIDITY distinto reinicia el punto de control y lo registra."""
+        checkpoint = CheckpointFalso(uid_validity=100, ultimo_uid=9)
+        servidor = ServidorImapFalso([1, 2])
+
+        with mock.patch.object(ImapSyncService, '_registrar_resincronizacion') as registrar:
+            uids = ImapSyncService.buscar_uids_nuevos(servidor, checkpoint, 200)
+
+        registrar.assert_called_once_with(checkpoint, 200)
+        self.assertEqual(uids, [1, 2])
+        self.assertEqual(checkpoint.uid_validity, 200)
+        self.assertEqual(servidor.busquedas, ['UID 1:*'])
+
+    def test_registrar_progreso_solo_avanza(self):
+        """El punto de control nunca retrocede."""
+        checkpoint = CheckpointFalso(uid_validity=100, ultimo_uid=10)
+
+        ImapSyncService.registrar_progreso(checkpoint, 5)
+        self.assertEqual(checkpoint.ultimo_uid, 10)
+        self.assertEqual(checkpoint.guardados, 0)
+
+        ImapSyncService.registrar_progreso(checkpoint, 15)
+        self.assertEqual(checkpoint.ultimo_uid, 15)
+        self.assertEqual(checkpoint.guardados, 1)
+
+
+class FetchPorLotesTests(SimpleTestCase):
+    """Pruebas de la descarga por lotes con UID FETCH."""
+
+    def test_formatear_conjunto_compacta_rangos(self):
+        self.assertEqual(ImapSyncService.formatear_conjunto([9, 1, 2, 3, 7, 10]), '1:3,7,9:10')
+        self.assertEqual(ImapSyncService.formatear_conjunto([4]), '4')
+        self.assertEqual(ImapSyncService.formatear_conjunto([]), '')
+
+    def test_uid_despues_del_literal(self):
+        """Algunos servidores envían el UID después del literal del mensaje."""
+        data = [(b'1 (BODY[] {3}', b'abc'), b' UID 42)']
+        respuestas = ImapSyncService._parsear_respuesta_fetch(data)
+        self.assertEqual([(uid, contenido) for uid, _, contenido in respuestas], [(42, b'abc')])
+
+    def test_fetch_lotes_agrupa_idas_y_vueltas(self):
+        mensajes = {uid: generar_mensaje(uid, 1024) for uid in range(1, 26)}
+        servidor = ServidorImapSimulado(mensajes, rtt=0)
+
+        lotes = list(ImapSyncService.fetch_lotes(servidor, list(mensajes), 10, deduplicar=False))
+        recibidos = [mensaje for _, mensajes_lote in lotes for mensaje in mensajes_lote]
+
+        self.assertEqual([lote[-1] for lote, _ in lotes], [10, 20, 25])
+        self.assertEqual([uid for uid, _ in recibidos], list(range(1, 26)))
+        self.assertEqual(servidor.idas_y_vueltas, 3)
+        self.assertEqual(recibidos[0][1]['Message-ID'], '<bench-1@zentraflow.local>')
+
+    def test_dedup_descarga_solo_cuerpos_nuevos(self):
+        """Los mensajes ya ingeridos se descartan tras descargar solo sus cabeceras."""
+        mensajes = {uid: generar_mensaje(uid, 50 * 1024) for uid in range(1, 11)}
+        servidor = ServidorImapSimulado(mensajes, rtt=0)
+        existentes = {f'<bench-{uid}@zentraflow.local>' for uid in range(1, 8)}
+
+        def filtrar_nuevos(cabeceras):
+            return [uid for uid in sorted(cabeceras) if cabeceras[uid]['mensaje_id'] not in existentes]
+
+        with mock.patch.object(ImapSyncService, 'filtrar_nuevos', side_effect=filtrar_nuevos):
+            lotes = list(ImapSyncService.fetch_lotes(servidor, list(mensajes), 10))
+
+        lote, recibidos = lotes[0]
+        self.assertEqual(lote, list(range(1, 11)))
+        self.assertEqual([uid for uid, _ in recibidos], [8, 9, 10])
+        # Una ida y vuelta para cabeceras y otra para los tres cuerpos nuevos
+        self.assertEqual(servidor.idas_y_vueltas, 2)
+
+    def test_fetch_cabeceras_incluye_tamano(self):
+        mensajes = {5: generar_mensaje(5, 4096)}
+        servidor = ServidorImapSimulado(mensajes, rtt=0)
+
+        cabeceras = ImapSyncService.fetch_cabeceras(servidor, [5])
+
+        self.assertEqual(cabeceras[5]['mensaje_id'], '<bench-5@zentraflow.local>')
+        self.assertEqual(cabeceras[5]['tamaño'], len(mensajes[5]))
+        self.assertEqual(cabeceras[5]['asunto'], 'Glosa 5')
+
+
+class FetchParcialTests(SimpleTestCase):
+    """Pruebas de la descarga guiada por BODYSTRUCTURE."""
+
+    def test_bodystructure_con_literal(self):
+        """Las secciones se numeran como en IMAP y los literales {n} se interpretan como cadenas."""
+        data = [
+            (b'7 (UID 42 BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 10 1 NIL NIL NIL NIL)'
+             b'("text" "html" ("charset" "utf-8") NIL NIL "7bit" 20 1 NIL NIL NIL NIL) "alternative")'
+             b'("image" "png" NIL NIL NIL "base64" 1000 NIL ("attachment" ("filename" {10}',
+             b'"logo".png'),
+            b')) NIL NIL) "mixed"))',
+        ]
+        partes = estructura_imap.estructuras_por_mensaje(data)[42]
+
+        self.assertEqual([(p.seccion, p.tipo) for p in partes], [('1.1', 'text/plain'), ('1.2', 'text/html'), ('2', 'image/png')])
+        self.assertEqual(partes[2].parametros_disposicion, {'filename': '"logo".png'})
+        self.assertEqual(estructura_imap.plan_descarga(partes), ('1.1', '1.2'))
+
+    def test_solo_descarga_partes_necesarias(self):
+        mensajes = {
+            1: generar_mensaje(1, 2048, tamaño_adjunto=4000, tamaño_imagen=200 * 1024),
+            2: generar_mensaje(2, 2048),
+        }
+        servidor = ServidorImapSimulado(mensajes, rtt=0)
+
+        recibidos = dict(ImapSyncService.fetch_parcial(servidor, [1, 2], {'carpeta': 'INBOX', 'uid_validity': 9}))
+        parseado = CorreoParserService.parsear(recibidos[1], 'x')
+        completo = CorreoParserService.parsear(email.message_from_bytes(mensajes[1]), 'x')
+
+        self.assertLess(servidor.bytes_transferidos, 20 * 1024)
+        self.assertEqual(parseado['contenido_plano'], completo['contenido_plano'])
+        pdf, imagen = parseado['adjuntos']
+        self.assertEqual(pdf['parte'].get_payload(decode=True), completo['adjuntos'][0]['parte'].get_payload(decode=True))
+        self.assertNotIn('origen_imap', pdf)
+        self.assertEqual(imagen['nombre_archivo'], 'firma.png')
+        self.assertEqual(
+            {clave: imagen['origen_imap'][clave] for clave in ('carpeta', 'uid_validity', 'uid', 'seccion')},
+            {'carpeta': 'INBOX', 'uid_validity': 9, 'uid': 1, 'seccion': '3'}
+        )
+        # Sin adjuntos que omitir el mensaje se descarga completo
+        self.assertEqual(recibidos[2].as_bytes(), email.message_from_bytes(mensajes[2]).as_bytes())
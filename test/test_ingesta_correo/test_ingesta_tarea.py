@@ -0,0 +1,118 @@
+from contextlib import ExitStack
+from email.message import EmailMessage
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from apps.configuracion.models import EmailConfig
+from apps.ingesta_correo import tasks
+from apps.ingesta_correo.models import (
+    CorreoIngesta, HistorialAplicacionRegla, HistorialEjecucion, ServicioIngesta, SincronizacionCarpeta,
+)
+from apps.ingesta_correo.services.correo_parser_service import CorreoParserService
+from apps.ingesta_correo.services.ingesta_persistencia_service import IngestaPersistenciaService
+from apps.ingesta_correo.services.presupuesto_ingesta_service import PresupuestoIngesta
+from apps.tenants.models import Tenant
+
+persistir_lote = IngestaPersistenciaService.persistir_lote
+
+
+def mensaje(uid):
+    correo = EmailMessage()
+    correo['Message-ID'] = f'<{uid}@prueba>'
+    correo['From'] = 'glosas@prueba.com'
+    correo['Subject'] = f'Correo {uid}'
+    correo.set_content('Sin adjuntos')
+    return correo
+
+
+def lotes(*uids_por_lote):
+    """Sustituto de ImapSyncService.fetch_lotes que entrega los lotes indicados."""
+    def fetch_lotes(server, uids, tamaño_lote, **kwargs):
+        for lote in uids_por_lote:
+            yield lote, [(uid, mensaje(uid)) for uid in lote]
+    return fetch_lotes
+
+
+class IngestaImapTests(TestCase):
+    """Pruebas del punto de control IMAP cuando un lote no se puede guardar."""
+
+    def setUp(self):
+        self.tenant = Tenant.objects.create(name="Tenant Ingesta", domain="ingesta.com")
+        EmailConfig.objects.create(
+            tenant=self.tenant, email_address='glosas@ingesta.com', server_host='imap.ingesta.com',
+            server_port=993, username='glosas', password='secreto', fetch_batch_size=2,
+        )
+        self.servicio = ServicioIngesta.objects.create(tenant=self.tenant, nombre="Servicio IMAP")
+
+    def procesar(self, fetch_lotes, **parches):
+        with ExitStack() as pila:
+            pila.enter_context(mock.patch.object(tasks.ImapSyncService, 'conectar'))
+            pila.enter_context(mock.patch.object(tasks.ImapSyncService, 'seleccionar_carpeta', return_value=7))
+            pila.enter_context(mock.patch.object(tasks.ImapSyncService, 'buscar_uids_nuevos', return_value=[1, 2, 3, 4]))
+            pila.enter_context(mock.patch.object(tasks.ImapSyncService, 'fetch_lotes', side_effect=fetch_lotes))
+            for nombre, parche in parches.items():
+                pila.enter_context(mock.patch.object(tasks.IngestaPersistenciaService, nombre, parche))
+            tasks._procesar_ingesta(self.servicio.id, mock.Mock(), PresupuestoIngesta(mensajes=0, segundos=0), mock.Mock())
+        return SincronizacionCarpeta.objects.get(servicio=self.servicio).ultimo_uid
+
+    def test_un_lote_sin_guardar_no_avanza_el_punto_de_control(self):
+        def falla_segundo_lote(servicio, correos):
+            if any(correo['mensaje_id'] == '<3@prueba>' for correo in correos):
+                raise Exception("database is locked")
+            return persistir_lote(servicio, correos)
+
+        ultimo_uid = self.procesar(lotes([1, 2], [3, 4]), persistir_lote=mock.Mock(side_effect=falla_segundo_lote))
+
+        self.assertEqual(ultimo_uid, 2)
+        self.assertEqual(CorreoIngesta.objects.filter(servicio=self.servicio).count(), 2)
+        historial = HistorialEjecucion.objects.get(servicio=self.servicio)
+        self.assertEqual(historial.estado, HistorialEjecucion.EstadoEjecucion.PARCIAL)
+        self.assertIn("database is locked", historial.mensaje_error)
+
+        # La siguiente ejecución vuelve a descargar el lote que no se guardó
+        ultimo_uid = self.procesar(lotes([3, 4]))
+        self.assertEqual(ultimo_uid, 4)
+        self.assertEqual(CorreoIngesta.objects.filter(servicio=self.servicio).count(), 4)
+
+    def test_ignorados_sin_registrar_no_avanzan_el_punto_de_control(self):
+        prefiltro = mock.Mock(omitidos=[(2, {'mensaje_id': '<2@prueba>'}, mock.Mock())])
+        with mock.patch.object(tasks.PrefiltroImap, 'para_servicio', return_value=prefiltro):
+            ultimo_uid = self.procesar(
+                lotes([1]), registrar_ignorados=mock.Mock(side_effect=Exception("database is locked"))
+            )
+
+        self.assertEqual(ultimo_uid, 0)
+        # El correo guardado del lote se conserva y se descarta como repetido al reintentar
+        self.assertTrue(CorreoIngesta.objects.filter(servicio=self.servicio, mensaje_id='<1@prueba>').exists())
+
+
+class PersistenciaConcurrenteTests(TestCase):
+    """Pruebas de persistir_lote cuando otra ejecución guarda el mismo correo a la vez."""
+
+    def setUp(self):
+        tenant = Tenant.objects.create(name="Tenant Lote", domain="lote.com")
+        self.servicio = ServicioIngesta.objects.create(tenant=tenant, nombre="Servicio Lote")
+
+    def test_no_se_apropia_de_los_correos_de_otra_ejecucion(self):
+        insertar = IngestaPersistenciaService._insertar_correos
+        otro = CorreoIngesta(
+            servicio=self.servicio, mensaje_id='<2@prueba>', remitente='otro', destinatarios='',
+            asunto='Otra ejecución', fecha_recepcion=timezone.now(),
+        )
+
+        def otra_ejecucion_primero(servicio, correos):
+            # La otra ejecución guarda el correo después de la consulta de existentes
+            otro.save()
+            return insertar(servicio, correos)
+
+        correos = [CorreoParserService.parsear(mensaje(uid), f'<{uid}@prueba>') for uid in (1, 2, 3)]
+        with mock.patch.object(IngestaPersistenciaService, '_insertar_correos', side_effect=otra_ejecucion_primero):
+            resultado = IngestaPersistenciaService.persistir_lote(self.servicio, correos)
+
+        self.assertEqual(resultado['correos_nuevos'], 2)
+        self.assertEqual(resultado['mensajes_guardados'], ['<1@prueba>', '<3@prueba>'])
+        self.assertEqual(CorreoIngesta.objects.filter(servicio=self.servicio).count(), 3)
+        self.assertFalse(HistorialAplicacionRegla.objects.filter(correo=otro).exists())
+        self.assertEqual(CorreoIngesta.objects.get(id=otro.id).asunto, 'Otra ejecución')
@@ -0,0 +1,60 @@
+import pickle
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ArchivoAdjunto, CorreoIngesta, ReglaFiltrado
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_test_service import ReglaTestService
+
+
+class InstantaneaCorreoTests(SimpleTestCase):
+    """Pruebas de la instantánea de campos evaluables de un correo."""
+
+    def test_inmutable_y_serializable(self):
+        instantanea = InstantaneaCorreo.construir(asunto='Glosa', adjuntos=[('a.pdf', 'application/pdf', 2048)])
+        with self.assertRaises(TypeError):
+            instantanea['asunto'] = 'otro'
+        with self.assertRaises(TypeError):
+            instantanea.update(asunto='otro')
+        with self.assertRaises(TypeError):
+            instantanea.num_adjuntos = 3
+
+        copia = pickle.loads(pickle.dumps(instantanea))
+        self.assertEqual(copia, instantanea)
+        self.assertEqual((copia.num_adjuntos, copia.tamaño_adjuntos), (1, 2048))
+
+    def test_mismos_valores_desde_correo_y_desde_parseado(self):
+        fecha = timezone.now()
+        datos = {
+            'remitente': 'Glosas@EPS.example.com', 'destinatarios': 'ingesta@ips.example.com',
+            'asunto': 'GLOSA Straße', 'fecha_recepcion': fecha, 'contenido_plano': 'Relación',
+            'adjuntos': [{'nombre_archivo': 'Glosa.XLSX', 'tipo_contenido': 'application/vnd.ms-excel'}],
+        }
+        correo = CorreoIngesta(
+            id=1, remitente=datos['remitente'], destinatarios=datos['destinatarios'], asunto=datos['asunto'],
+            fecha_recepcion=fecha, contenido_plano=datos['contenido_plano'],
+        )
+        # Adjuntos precargados: la instantánea no consulta la base de datos
+        correo._prefetched_objects_cache = {'adjuntos': [
+            ArchivoAdjunto(nombre_archivo='Glosa.XLSX', tipo_contenido='application/vnd.ms-excel', tamaño=3072)
+        ]}
+
+        desde_correo = InstantaneaCorreo.desde_correo(correo)
+        desde_parseado = InstantaneaCorreo.desde_parseado(datos, tamaños_adjuntos=[3072])
+        self.assertEqual(desde_correo, desde_parseado)
+        self.assertEqual(desde_correo['asunto'], 'glosa strasse')
+        self.assertEqual(desde_correo['adjunto_tamaño'], '3.0')
+        self.assertEqual(desde_correo['tiene_adjuntos'], 'true')
+
+    def test_probador_usa_los_predicados_de_la_ingesta(self):
+        datos = {'asunto': 'Glosa factura', 'adjunto': 'glosa.xlsx', 'adjunto_tamaño': '250'}
+        self.assertTrue(ReglaTestService.evaluar_regla('ADJUNTO', 'COINCIDE_REGEX', r'\.xlsx$', datos)['cumple'])
+        self.assertTrue(ReglaTestService.evaluar_regla('adjunto_tamaño', 'mayor_que', '100', datos)['cumple'])
+        self.assertTrue(ReglaTestService.evaluar_regla('tiene_adjuntos', 'es_verdadero', '', datos)['cumple'])
+        self.assertFalse(ReglaTestService.evaluar_regla('otro', 'contiene', 'x', datos)['cumple'])
+
+        regla = ReglaFiltrado(id=1, campo='asunto', condicion='contiene', valor='FACTURA',
+                              accion=ReglaFiltrado.TipoAccion.IGNORAR)
+        resultado = ReglaTestService.evaluar_regla_completa(regla, datos)
+        self.assertEqual((resultado['cumple'], resultado['accion']), (True, ReglaFiltrado.TipoAccion.IGNORAR))
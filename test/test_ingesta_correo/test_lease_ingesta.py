@@ -0,0 +1,64 @@
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.lease_ingesta_service import LeaseIngesta
+
+
+class LeaseCacheTests(SimpleTestCase):
+    """Pruebas del lease de ejecución sobre la caché de Django."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_una_sola_ejecucion_por_servicio(self):
+        lease = LeaseIngesta.adquirir(1, segundos=60, backend='cache')
+        self.assertIsNotNone(lease)
+        self.assertIsNone(LeaseIngesta.adquirir(1, segundos=60, backend='cache'))
+        self.assertIsNotNone(LeaseIngesta.adquirir(2, segundos=60, backend='cache'))
+        self.assertEqual(LeaseIngesta.vigentes([1, 2, 3], backend='cache'), {1, 2})
+
+        lease.liberar()
+        self.assertEqual(LeaseIngesta.vigentes([1, 2, 3], backend='cache'), {2})
+        self.assertIsNotNone(LeaseIngesta.adquirir(1, segundos=60, backend='cache'))
+
+    def test_lease_de_worker_caido_expira_y_se_recupera(self):
+        ahora = time.time()
+        caido = LeaseIngesta.adquirir(1, segundos=30, backend='cache')
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=ahora + 31):
+            nuevo = LeaseIngesta.adquirir(1, segundos=30, backend='cache')
+            self.assertIsNotNone(nuevo)
+
+            # El worker original ya no puede renovar ni liberar el lease ajeno
+            caido.renovado -= 30
+            with self.assertRaises(Exception):
+                caido.latido()
+            caido.liberar()
+            self.assertEqual(LeaseIngesta.vigentes([1], backend='cache'), {1})
+
+    def test_latido_renueva_solo_tras_un_tercio_de_la_duracion(self):
+        lease = LeaseIngesta.adquirir(1, segundos=30, backend='cache')
+        with mock.patch.object(lease.almacen, 'renovar', return_value=True) as renovar:
+            lease.latido()
+            renovar.assert_not_called()
+            lease.renovado -= 11
+            lease.latido()
+            renovar.assert_called_once_with(1, lease.token, 30)
+
+
+class GuardadoServicioTests(SimpleTestCase):
+    """Un save completo no revierte las columnas que solo cambian con UPDATE atómicos."""
+
+    def test_save_completo_omite_columnas_atomicas(self):
+        servicio = ServicioIngesta(id=1, intervalo_minutos=5, activo=False)
+        servicio._state.adding = False
+        with mock.patch('django.db.models.Model.save') as guardar:
+            servicio.save()
+        campos = guardar.call_args.kwargs['update_fields']
+        self.assertIn('intervalo_minutos', campos)
+        for campo in ServicioIngesta.CAMPOS_ATOMICOS:
+            self.assertNotIn(campo, campos)
@@ -0,0 +1,57 @@
+import random
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.perfil_reglas_service import CUBETAS, PerfilReglas, cubeta, percentil
+from apps.ingesta_correo.services.regla_motor_service import MotorReglas, ReglaMotorService, RegistroPatrones
+
+VALORES = {'asunto': 'glosa factura 123', 'remitente': 'glosas@eps.example.com', 'contenido': 'relación de glosas'}
+
+
+def _regla(id, prioridad, **kwargs):
+    return ReglaFiltrado(id=id, nombre=f'Regla {id}', prioridad=prioridad,
+                         accion=ReglaFiltrado.TipoAccion.PROCESAR, **kwargs)
+
+
+class PerfilReglasTests(SimpleTestCase):
+    """Pruebas del perfil de coste de evaluación de reglas."""
+
+    def test_percentiles_del_histograma(self):
+        histograma = [0] * CUBETAS
+        for nanosegundos in [300] * 90 + [70000] * 10:
+            histograma[cubeta(nanosegundos)] += 1
+        # 300 ns cae en [256, 512) y 70 µs en [65536, 131072)
+        self.assertTrue(256 <= percentil(histograma, 0.5) < 512)
+        self.assertTrue(65536 <= percentil(histograma, 0.95) < 131072)
+        self.assertIsNone(percentil([0] * CUBETAS, 0.5))
+
+    def test_motor_perfilado_registra_reglas_y_condiciones(self):
+        compuesta = _regla(2, 2, es_compuesta=True, operador_logico=ReglaFiltrado.TipoOperador.Y)
+        condiciones = [
+            SimpleNamespace(id=20, campo='contenido', condicion='regex', valor=r'glosas$', orden=0),
+            SimpleNamespace(id=21, campo='asunto', condicion='contiene', valor='factura', orden=1),
+        ]
+        registro = RegistroPatrones()
+        motor = MotorReglas([
+            ReglaMotorService.compilar_regla(_regla(1, 1, campo='asunto', condicion='empieza_con', valor='otra'), registro=registro),
+            ReglaMotorService.compilar_regla(compuesta, condiciones, registro),
+            ReglaMotorService.compilar_regla(_regla(3, 3, campo='asunto', condicion='contiene', valor='glosa'), registro=registro),
+        ], registro=registro)
+
+        perfil = PerfilReglas(tenant_id=1, muestreo=1.0, aleatorio=random.Random(0))
+        for _ in range(5):
+            self.assertEqual(motor.primera_coincidencia(VALORES, perfil=perfil).id, 2)
+        self.assertEqual(motor.primera_coincidencia(VALORES).id, 2)
+
+        self.assertEqual(set(perfil.mediciones), {(1, None), (2, None), (2, 20), (2, 21)})
+        evaluaciones, coincidencias, nanosegundos, histograma = perfil.mediciones[(2, None)]
+        self.assertEqual((evaluaciones, coincidencias, sum(histograma)), (5, 5, 5))
+        self.assertEqual(perfil.mediciones[(1, None)][:2], [5, 0])
+
+    def test_muestreo_por_correo(self):
+        perfil = PerfilReglas(tenant_id=1, muestreo=0.25, aleatorio=random.Random(3))
+        muestreados = sum(perfil.muestrear() for _ in range(4000))
+        self.assertAlmostEqual(muestreados / 4000, 0.25, delta=0.03)
+        self.assertFalse(any(PerfilReglas(1, 0.0).muestrear() for _ in range(100)))
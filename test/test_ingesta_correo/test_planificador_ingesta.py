@@ -0,0 +1,134 @@
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.models import ServicioIngesta
+from apps.ingesta_correo.services.ingesta_scheduler_service import (
+    fase_servicio, intervalo_adaptativo, siguiente_ejecucion, turno_siguiente
+)
+
+INICIO = datetime(2024, 5, 6, 8, 0, tzinfo=dt_timezone.utc)
+TICK = timedelta(minutes=1)
+
+
+class SiguienteEjecucionTests(SimpleTestCase):
+    """Pruebas del cálculo de la próxima ejecución de un servicio."""
+
+    def test_sin_programacion_previa(self):
+        inicio = INICIO + timedelta(seconds=40)
+        self.assertEqual(siguiente_ejecucion(None, inicio, 5), inicio + timedelta(minutes=5))
+
+    def test_conserva_la_cadencia_programada(self):
+        # Despachada 40 s tarde: la siguiente sigue en el turno original
+        self.assertEqual(
+            siguiente_ejecucion(INICIO, INICIO + timedelta(seconds=40), 5), INICIO + timedelta(minutes=5)
+        )
+        # Despachada después de varios turnos perdidos: no se acumulan
+        self.assertEqual(
+            siguiente_ejecucion(INICIO, INICIO + timedelta(minutes=12), 5), INICIO + timedelta(minutes=15)
+        )
+
+    def test_simulacion_de_muchos_ticks(self):
+        """
+        Un día de ticks de un minuto con servicios de intervalos distintos y
+        ejecuciones de duración variable: cada servicio conserva su cadencia,
+        no se solapa consigo mismo y tras una ejecución más larga que su
+        intervalo se ejecuta una sola vez al terminar.
+        """
+        aleatorio = random.Random(7)
+        servicios = [
+            {'intervalo': intervalo, 'proxima': None, 'en_curso': None, 'ejecuciones': []}
+            for intervalo in (1, 5, 5, 15, 60)
+        ]
+        ahora = INICIO
+        for _ in range(24 * 60):
+            for servicio in servicios:
+                en_curso = servicio['en_curso']
+                if en_curso and en_curso[2] <= ahora:
+                    programada, inicio, _ = en_curso
+                    servicio['proxima'] = siguiente_ejecucion(programada, inicio, servicio['intervalo'])
+                    servicio['en_curso'] = None
+                vencido = servicio['proxima'] is None or servicio['proxima'] <= ahora
+                if servicio['en_curso'] is None and vencido:
+                    # La mayoría termina en segundos; una de cada veinte tarda más que el intervalo
+                    duracion = timedelta(seconds=aleatorio.uniform(5, 50))
+                    if aleatorio.random() < 0.05:
+                        duracion += timedelta(minutes=servicio['intervalo'])
+                    servicio['en_curso'] = (servicio['proxima'], ahora, ahora + duracion)
+                    servicio['ejecuciones'].append((ahora, ahora + duracion))
+            ahora += TICK
+
+        for servicio in servicios:
+            intervalo = timedelta(minutes=servicio['intervalo'])
+            ejecuciones = servicio['ejecuciones']
+            ancla = ejecuciones[0][0] + intervalo
+            for (inicio_anterior, fin_anterior), (inicio, _) in zip(ejecuciones, ejecuciones[1:]):
+                self.assertGreaterEqual(inicio, fin_anterior)
+                if fin_anterior - inicio_anterior < intervalo:
+                    # Empieza en el primer tick de un turno de la cadencia original
+                    self.assertLess((inicio - ancla) % intervalo, TICK)
+                else:
+                    self.assertLess(inicio - fin_anterior, TICK)
+            esperados = 24 * 60 // servicio['intervalo']
+            self.assertGreater(len(ejecuciones), esperados * 0.9)
+            self.assertLessEqual(len(ejecuciones), esperados + 1)
+
+
+class TurnosDesfasadosTests(SimpleTestCase):
+    """Pruebas del reparto de los turnos de los servicios dentro de su intervalo."""
+
+    def test_fases_repartidas_en_el_intervalo(self):
+        # 900 servicios de 15 minutos: cada minuto recibe ~60 turnos, no 900 en el mismo
+        por_minuto = [0] * 15
+        for servicio_id in range(1, 901):
+            por_minuto[fase_servicio(servicio_id, 15) // 60] += 1
+        self.assertLessEqual(max(por_minuto), 66)
+        self.assertGreaterEqual(min(por_minuto), 54)
+        self.assertEqual(fase_servicio(42, 15), fase_servicio(42, 15))
+
+    def test_turno_siguiente_sigue_la_cuadricula_del_servicio(self):
+        primero = turno_siguiente(7, INICIO, 15)
+        self.assertGreater(primero, INICIO)
+        self.assertLessEqual(primero - INICIO, timedelta(minutes=15))
+        self.assertEqual(turno_siguiente(7, primero, 15), primero + timedelta(minutes=15))
+        self.assertEqual(turno_siguiente(7, primero - timedelta(seconds=1), 15), primero)
+        self.assertNotEqual(turno_siguiente(8, INICIO, 15), primero)
+
+    def test_despacho_anticipado_no_repite_el_turno(self):
+        programada = turno_siguiente(7, INICIO, 15)
+        # Despachada 40 s antes de su turno (horizonte del despacho)
+        inicio = programada - timedelta(seconds=40)
+        self.assertEqual(
+            siguiente_ejecucion(programada, inicio, 15, servicio_id=7), programada + timedelta(minutes=15)
+        )
+        # Una ejecución más larga que el intervalo salta al turno siguiente a su inicio
+        self.assertEqual(
+            siguiente_ejecucion(programada, programada + timedelta(minutes=20), 15, servicio_id=7),
+            programada + timedelta(minutes=30)
+        )
+
+
+class IntervaloAdaptativoTests(SimpleTestCase):
+    """Pruebas del modo de sondeo adaptativo."""
+
+    def test_duplica_tras_ejecuciones_vacias_hasta_el_maximo(self):
+        intervalos = []
+        actual = 2
+        for _ in range(6):
+            actual = intervalo_adaptativo(actual, 0, 2, 30)
+            intervalos.append(actual)
+        self.assertEqual(intervalos, [4, 8, 16, 30, 30, 30])
+
+    def test_vuelve_al_minimo_con_correo_nuevo(self):
+        self.assertEqual(intervalo_adaptativo(30, 3, 2, 30), 2)
+        # Sin intervalo vigente parte del mínimo
+        self.assertEqual(intervalo_adaptativo(None, 0, 2, 30), 4)
+
+    def test_intervalo_efectivo(self):
+        servicio = ServicioIngesta(intervalo_minutos=5)
+        self.assertEqual(servicio.intervalo_efectivo, 5)
+        servicio.intervalo_adaptativo = True
+        self.assertEqual(servicio.intervalo_efectivo, 5)
+        servicio.intervalo_actual_minutos = 90
+        self.assertEqual(servicio.intervalo_efectivo, 30)
@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.management.commands._imap_simulado import ServidorImapSimulado, generar_mensaje
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.imap_sync_service import ImapSyncService
+from apps.ingesta_correo.services.prefiltro_imap_service import (
+    PrefiltroImap, criterio_condicion, criterio_regla
+)
+from apps.ingesta_correo.services.regla_motor_service import MotorReglas, ReglaMotorService, RegistroPatrones
+
+TipoAccion = ReglaFiltrado.TipoAccion
+
+
+def _regla(id, campo, condicion, valor, accion=TipoAccion.IGNORAR):
+    return ReglaFiltrado(
+        id=id, nombre=f'Regla {id}', campo=campo, condicion=condicion, valor=valor,
+        prioridad=id, accion=accion,
+    )
+
+
+def _motor(*reglas):
+    registro = RegistroPatrones()
+    return MotorReglas([ReglaMotorService.compilar_regla(regla, registro=registro) for regla in reglas],
+                       registro=registro)
+
+
+class CriterioBusquedaTests(SimpleTestCase):
+    """Pruebas de la traducción de condiciones a criterios de UID SEARCH."""
+
+    def test_condiciones_traducibles(self):
+        self.assertEqual(criterio_condicion('remitente', 'contiene', 'news@'), 'FROM "news@"')
+        self.assertEqual(criterio_condicion('ASUNTO', 'ES_IGUAL', 'Dijo "hola"'), 'SUBJECT "Dijo \\"hola\\""')
+        self.assertEqual(criterio_condicion('fecha_recepcion', 'contiene', '2024-05-06'), 'SENTON 6-May-2024')
+        self.assertEqual(
+            criterio_condicion('fecha_recepcion', 'contiene', '2024-12'),
+            'SENTSINCE 1-Dec-2024 SENTBEFORE 1-Jan-2025'
+        )
+
+    def test_condiciones_no_traducibles(self):
+        self.assertIsNone(criterio_condicion('asunto', 'no_contiene', 'glosa'))
+        self.assertIsNone(criterio_condicion('contenido', 'contiene', 'glosa'))
+        self.assertIsNone(criterio_condicion('asunto', 'contiene', 'boletín'))
+        self.assertIsNone(criterio_condicion('fecha_recepcion', 'es_igual', '2024-05'))
+
+    def test_regla_compuesta(self):
+        regla = ReglaFiltrado(id=1, es_compuesta=True, operador_logico=ReglaFiltrado.TipoOperador.O)
+        condiciones = [
+            SimpleNamespace(campo='remitente', condicion='contiene', valor='a@', orden=0),
+            SimpleNamespace(campo='remitente', condicion='contiene', valor='b@', orden=1),
+            SimpleNamespace(campo='asunto', condicion='contiene', valor='promo', orden=2),
+        ]
+        self.assertEqual(criterio_regla(regla, condiciones), 'OR FROM "a@" OR FROM "b@" SUBJECT "promo"')
+
+        regla.operador_logico = ReglaFiltrado.TipoOperador.Y
+        self.assertEqual(criterio_regla(regla, condiciones), '(FROM "a@" FROM "b@" SUBJECT "promo")')
+
+        condiciones.append(SimpleNamespace(campo='contenido', condicion='contiene', valor='x', orden=3))
+        self.assertIsNone(criterio_regla(regla, condiciones))
+
+
+class PrefiltroImapTests(SimpleTestCase):
+    """Pruebas del prefiltro de reglas IGNORAR en el servidor IMAP."""
+
+    def test_solo_reglas_ignorar_previas_a_otra_accion(self):
+        motor = _motor(
+            _regla(1, 'remitente', 'contiene', 'news@'),
+            _regla(2, 'contenido', 'contiene', 'baja'),
+            _regla(3, 'asunto', 'contiene', 'glosa', accion=TipoAccion.PROCESAR),
+            _regla(4, 'asunto', 'contiene', 'promo'),
+        )
+        prefiltro = PrefiltroImap.desde_motor(motor)
+        self.assertEqual([regla.id for regla in prefiltro.reglas], [1])
+        self.assertEqual(prefiltro.criterio, 'FROM "news@"')
+
+        motor = _motor(_regla(1, 'asunto', 'contiene', 'glosa', accion=TipoAccion.PROCESAR),
+                       _regla(2, 'remitente', 'contiene', 'news@'))
+        self.assertIsNone(PrefiltroImap.desde_motor(motor))
+
+    def test_omite_cuerpos_confirmados(self):
+        """Los candidatos confirmados por sus cabeceras no se descargan; los falsos positivos sí."""
+        mensajes = {uid: generar_mensaje(uid, 50 * 1024) for uid in range(1, 7)}
+        mensajes[2] = generar_mensaje(2, 50 * 1024, asunto='Newsletter')
+        mensajes[4] = generar_mensaje(4, 50 * 1024, asunto='NEWSLETTER')
+        # El servidor busca por subcadena; la regla exige el asunto exacto
+        mensajes[5] = generar_mensaje(5, 50 * 1024, asunto='Newsletter y glosa')
+        servidor = ServidorImapSimulado(mensajes, rtt=0)
+        prefiltro = PrefiltroImap.desde_motor(_motor(_regla(1, 'asunto', 'es_igual', 'newsletter')))
+
+        self.assertEqual(prefiltro.buscar(servidor, list(mensajes)), {2, 4, 5})
+
+        lotes = list(ImapSyncService.fetch_lotes(servidor, list(mensajes), 10, deduplicar=False, prefiltro=prefiltro))
+        _, recibidos = lotes[0]
+        self.assertEqual([uid for uid, _ in recibidos], [1, 3, 5, 6])
+        self.assertEqual([(uid, regla.id) for uid, _, regla in prefiltro.omitidos], [(2, 1), (4, 1)])
+        self.assertEqual(prefiltro.omitidos[0][1]['mensaje_id'], '<bench-2@zentraflow.local>')
+
+    def test_busqueda_rechazada_no_omite_nada(self):
+        class ServidorSinSearch:
+            def uid(self, comando, *args):
+                return 'BAD', [b'Unknown search key']
+
+        prefiltro = PrefiltroImap.desde_motor(_motor(_regla(1, 'remitente', 'contiene', 'news@')))
+        with self.assertLogs('apps.ingesta_correo.services.prefiltro_imap_service', 'WARNING'):
+            self.assertEqual(prefiltro.buscar(ServidorSinSearch(), [1, 2]), set())
@@ -0,0 +1,32 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.services.presupuesto_ingesta_service import PresupuestoIngesta
+
+
+class PresupuestoIngestaTests(SimpleTestCase):
+    """Pruebas del presupuesto de mensajes y tiempo de cada tramo de ingesta."""
+
+    def test_recorta_a_los_mensajes_del_presupuesto(self):
+        presupuesto = PresupuestoIngesta(mensajes=3, segundos=60)
+        self.assertEqual(presupuesto.recortar([1, 2, 3]), [1, 2, 3])
+        self.assertFalse(presupuesto.pendiente)
+
+        self.assertEqual(presupuesto.recortar([1, 2, 3, 4, 5]), [1, 2, 3])
+        self.assertTrue(presupuesto.pendiente)
+        # Los números de mensaje POP3 se recortan como rango
+        self.assertEqual(PresupuestoIngesta(mensajes=2).recortar(range(4, 10)), range(4, 6))
+
+    def test_sin_limite_de_mensajes(self):
+        presupuesto = PresupuestoIngesta(mensajes=0, segundos=60)
+        self.assertEqual(len(presupuesto.recortar(list(range(5000)))), 5000)
+        self.assertFalse(presupuesto.pendiente)
+
+    def test_agotado_al_pasar_el_tiempo(self):
+        with mock.patch('apps.ingesta_correo.services.presupuesto_ingesta_service.time.monotonic', return_value=100):
+            presupuesto = PresupuestoIngesta(mensajes=10, segundos=30)
+        with mock.patch('apps.ingesta_correo.services.presupuesto_ingesta_service.time.monotonic', return_value=129):
+            self.assertFalse(presupuesto.agotado())
+        with mock.patch('apps.ingesta_correo.services.presupuesto_ingesta_service.time.monotonic', return_value=130):
+            self.assertTrue(presupuesto.agotado())
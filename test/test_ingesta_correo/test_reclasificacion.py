@@ -0,0 +1,73 @@
+import random
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services import reclasificacion_service
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.reclasificacion_service import EvaluadorVectorizado
+from apps.ingesta_correo.services.regla_motor_service import MotorReglas, ReglaMotorService
+
+PALABRAS = ['glosa', 'factura', 'urgente', 'eps', 'soporte', 'xlsx', 'pdf']
+CONDICIONES = [
+    ('asunto', 'contiene'), ('asunto', 'no_contiene'), ('remitente', 'termina_con'),
+    ('asunto', 'empieza_con'), ('adjunto_nombre', 'regex'), ('adjunto_tamaño', 'mayor_que'),
+    ('adjunto_tamaño', 'menor_que'), ('tiene_adjuntos', 'es_verdadero'), ('remitente', 'es_igual'),
+]
+
+
+class _Condiciones(list):
+    def all(self):
+        return self
+
+
+def _reglas(aleatorio, cantidad):
+    reglas = []
+    for i in range(cantidad):
+        condiciones = []
+        for orden in range(aleatorio.randint(1, 3)):
+            campo, condicion = aleatorio.choice(CONDICIONES)
+            valor = str(aleatorio.randint(1, 200)) if 'que' in condicion else aleatorio.choice(PALABRAS)
+            condiciones.append(SimpleNamespace(campo=campo, condicion=condicion, valor=valor, orden=orden))
+        regla = ReglaFiltrado(
+            id=i + 1, nombre=f'Regla {i + 1}', prioridad=i, accion=ReglaFiltrado.TipoAccion.PROCESAR,
+            es_compuesta=len(condiciones) > 1, operador_logico=aleatorio.choice(['AND', 'OR']),
+            campo=condiciones[0].campo, condicion=condiciones[0].condicion, valor=condiciones[0].valor,
+        )
+        # Sustituye al prefetch de condiciones
+        regla._prefetched_objects_cache = {'condiciones': _Condiciones(condiciones)}
+        reglas.append(regla)
+    return reglas
+
+
+def _instantaneas(aleatorio, cantidad):
+    return [
+        InstantaneaCorreo.construir(
+            remitente=f"{aleatorio.choice(PALABRAS)}@{aleatorio.choice(PALABRAS)}.com",
+            asunto=' '.join(aleatorio.choice(PALABRAS) for _ in range(4)),
+            adjuntos=[(f"{aleatorio.choice(PALABRAS)}.{aleatorio.choice(PALABRAS)}", '', aleatorio.randint(0, 300000))
+                      for _ in range(aleatorio.randint(0, 2))],
+        )
+        for _ in range(cantidad)
+    ]
+
+
+class EvaluadorVectorizadoTests(SimpleTestCase):
+    """El evaluador por columnas elige la misma regla que el motor compilado."""
+
+    def test_misma_ganadora_que_el_motor(self):
+        aleatorio = random.Random(7)
+        for _ in range(5):
+            reglas = _reglas(aleatorio, 30)
+            instantaneas = _instantaneas(aleatorio, 300)
+            motor = MotorReglas([ReglaMotorService.compilar_regla(regla) for regla in reglas])
+            esperadas = []
+            for instantanea in instantaneas:
+                compilada = motor.primera_coincidencia(instantanea)
+                esperadas.append(compilada.id - 1 if compilada else -1)
+
+            self.assertEqual(EvaluadorVectorizado(reglas).ganadoras(instantaneas), esperadas)
+            with mock.patch.object(reclasificacion_service, 'np', None):
+                self.assertEqual(EvaluadorVectorizado(reglas).ganadoras(instantaneas), esperadas)
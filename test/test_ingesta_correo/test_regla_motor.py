@@ -0,0 +1,178 @@
+import random
+import time
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.aho_corasick import AutomataPython
+from apps.ingesta_correo.services.regla_motor_service import (
+    MotorReglas, PredicadoCompuesto, ReglaMotorService, RegistroPatrones, compilar_condicion
+)
+
+
+def _regla(id, campo=None, condicion=None, valor=None, prioridad=0, **kwargs):
+    return ReglaFiltrado(
+        id=id, nombre=f'Regla {id}', campo=campo, condicion=condicion, valor=valor,
+        prioridad=prioridad, accion=ReglaFiltrado.TipoAccion.PROCESAR, **kwargs
+    )
+
+
+def _condicion(campo, condicion, valor, orden=0):
+    return SimpleNamespace(campo=campo, condicion=condicion, valor=valor, orden=orden)
+
+
+VALORES = {
+    'asunto': 'glosa factura 123',
+    'remitente': 'glosas@eps.example.com',
+    'contenido': 'adjunto relación de glosas',
+    'adjunto_nombre': 'glosa_123.xlsx',
+    'adjunto_tamaño': '250.0',
+    'tiene_adjuntos': 'true',
+}
+
+
+class ReglaMotorServiceTests(SimpleTestCase):
+    """Pruebas del compilador de reglas de filtrado."""
+
+    def test_condiciones_insensibles_a_mayusculas(self):
+        self.assertTrue(compilar_condicion('asunto', 'contiene', 'FACTURA')(VALORES))
+        self.assertTrue(compilar_condicion('REMITENTE', 'TERMINA_CON', '@EPS.example.com')(VALORES))
+        self.assertTrue(compilar_condicion('adjunto', 'COINCIDE_REGEX', r'GLOSA_\d+\.xlsx')(VALORES))
+        self.assertTrue(compilar_condicion('adjunto_tamaño', 'mayor_que', '100')(VALORES))
+        self.assertTrue(compilar_condicion('tiene_adjuntos', 'es_verdadero', '')(VALORES))
+        self.assertFalse(compilar_condicion('asunto', 'regex', '([')(VALORES))
+
+    def test_regla_compuesta(self):
+        regla = _regla(1, es_compuesta=True, operador_logico=ReglaFiltrado.TipoOperador.Y)
+        condiciones = [_condicion('asunto', 'contiene', 'glosa'), _condicion('remitente', 'contiene', 'otra')]
+        self.assertFalse(ReglaMotorService.compilar_regla(regla, condiciones).cumple(VALORES))
+
+        regla.operador_logico = ReglaFiltrado.TipoOperador.O
+        self.assertTrue(ReglaMotorService.compilar_regla(regla, condiciones).cumple(VALORES))
+
+    def test_primera_coincidencia_por_prioridad(self):
+        motor = MotorReglas([
+            ReglaMotorService.compilar_regla(_regla(1, 'asunto', 'contiene', 'otra', prioridad=1)),
+            ReglaMotorService.compilar_regla(_regla(2, 'asunto', 'contiene', 'glosa', prioridad=2)),
+            ReglaMotorService.compilar_regla(_regla(3, 'asunto', 'contiene', 'factura', prioridad=3)),
+        ])
+
+        self.assertEqual(motor.primera_coincidencia(VALORES).id, 2)
+        self.assertEqual([(regla.id, cumple) for regla, cumple in motor.evaluar(VALORES)], [(1, False), (2, True)])
+
+    def test_200_reglas_sin_consultas(self):
+        """La evaluación no consulta la base de datos (SimpleTestCase lo impide) y es rápida."""
+        motor = MotorReglas([
+            ReglaMotorService.compilar_regla(_regla(i, 'contenido', 'contiene', f'patron {i}', prioridad=i))
+            for i in range(200)
+        ])
+
+        inicio = time.perf_counter()
+        for _ in range(100):
+            self.assertIsNone(motor.primera_coincidencia(VALORES))
+        por_correo = (time.perf_counter() - inicio) / 100
+
+        self.assertLess(por_correo, 0.005)
+
+
+class AhoCorasickTests(SimpleTestCase):
+    """Pruebas del autómata de múltiples patrones y su uso en el motor de reglas."""
+
+    def test_automata_python_equivale_a_busqueda_directa(self):
+        aleatorio = random.Random(7)
+        patrones = {''.join(aleatorio.choice('abc') for _ in range(aleatorio.randint(1, 4))) for _ in range(40)}
+        claves = {patron: indice for indice, patron in enumerate(sorted(patrones))}
+        automata = AutomataPython(claves)
+
+        for _ in range(50):
+            texto = ''.join(aleatorio.choice('abcd') for _ in range(aleatorio.randint(0, 30)))
+            esperado = {clave for patron, clave in claves.items() if patron in texto}
+            self.assertEqual(automata.buscar(texto), esperado)
+
+    def test_motor_con_automata_resuelve_igual_prioridad(self):
+        aleatorio = random.Random(11)
+        reglas = []
+        for i in range(60):
+            condicion = aleatorio.choice(['contiene', 'contiene', 'no_contiene', 'empieza_con'])
+            reglas.append(_regla(i, aleatorio.choice(['asunto', 'contenido']), condicion,
+                                 ''.join(aleatorio.choice('abcde') for _ in range(3)), prioridad=aleatorio.randint(0, 5)))
+        reglas.sort(key=lambda regla: (regla.prioridad, regla.id))
+
+        secuencial = MotorReglas([ReglaMotorService.compilar_regla(regla) for regla in reglas])
+        registro = RegistroPatrones()
+        automata = MotorReglas([ReglaMotorService.compilar_regla(regla, registro=registro) for regla in reglas], registro=registro)
+
+        for _ in range(100):
+            valores = {
+                'asunto': ''.join(aleatorio.choice('abcde') for _ in range(20)),
+                'contenido': ''.join(aleatorio.choice('abcde') for _ in range(200)),
+            }
+            esperado = secuencial.primera_coincidencia(valores)
+            obtenido = automata.primera_coincidencia(valores)
+            self.assertEqual(getattr(obtenido, 'id', None), getattr(esperado, 'id', None))
+            self.assertEqual(
+                [(regla.id, cumple) for regla, cumple in automata.evaluar(valores)],
+                [(regla.id, cumple) for regla, cumple in secuencial.evaluar(valores)],
+            )
+
+
+class OrdenCondicionesTests(SimpleTestCase):
+    """Pruebas de la reordenación de condiciones de las reglas compuestas."""
+
+    def test_condiciones_baratas_y_selectivas_primero(self):
+        regla = _regla(1, es_compuesta=True, operador_logico=ReglaFiltrado.TipoOperador.Y)
+        condiciones = [
+            _condicion('contenido', 'regex', r'glosas?$', orden=0),
+            _condicion('asunto', 'contiene', 'glosa', orden=1),
+            _condicion('remitente', 'es_igual', 'otra@eps.example.com', orden=2),
+        ]
+        predicado = ReglaMotorService.compilar_regla(regla, condiciones).predicado
+        self.assertIsInstance(predicado, PredicadoCompuesto)
+        # Antes de medir, por coste estimado: la regex sobre el contenido al final
+        self.assertEqual([c.orden for c in predicado.secuencia], [2, 1, 0])
+
+        for _ in range(200):
+            self.assertFalse(predicado(VALORES))
+        # La igualdad del remitente nunca se cumple y decide la Y
+        self.assertEqual(predicado.secuencia[0].orden, 2)
+        estadisticas = predicado.estadisticas()
+        self.assertEqual(estadisticas[0]['tasa_aciertos'], 0.0)
+        self.assertTrue(all(c['muestras'] > 0 and c['ns_medio'] is not None for c in estadisticas))
+
+    def test_reordenar_no_cambia_la_regla_ganadora(self):
+        aleatorio = random.Random(5)
+        campos = ['asunto', 'remitente', 'contenido']
+        tipos = ['contiene', 'no_contiene', 'empieza_con', 'es_igual', 'regex']
+        reglas = []
+        for i in range(40):
+            regla = _regla(i, es_compuesta=True, prioridad=i, operador_logico=aleatorio.choice(
+                [ReglaFiltrado.TipoOperador.Y, ReglaFiltrado.TipoOperador.O]))
+            condiciones = [
+                _condicion(aleatorio.choice(campos), aleatorio.choice(tipos),
+                           ''.join(aleatorio.choice('abc') for _ in range(2)), orden=j)
+                for j in range(aleatorio.randint(2, 4))
+            ]
+            reglas.append((regla, condiciones))
+
+        def en_orden_guardado(regla, condiciones):
+            predicados = [compilar_condicion(c.campo, c.condicion, c.valor) for c in condiciones]
+            operador = all if regla.operador_logico == ReglaFiltrado.TipoOperador.Y else any
+            compilada = ReglaMotorService.compilar_regla(regla, condiciones)
+            compilada.predicado = lambda v, e=None: operador(p(v, e) for p in predicados)
+            return compilada
+
+        guardado = MotorReglas([en_orden_guardado(regla, condiciones) for regla, condiciones in reglas])
+        registro = RegistroPatrones()
+        reordenado = MotorReglas(
+            [ReglaMotorService.compilar_regla(regla, condiciones, registro) for regla, condiciones in reglas],
+            registro=registro,
+        )
+
+        for _ in range(1500):
+            valores = {campo: ''.join(aleatorio.choice('abc') for _ in range(aleatorio.randint(0, 12))) for campo in campos}
+            self.assertEqual(
+                [regla.id for regla in reordenado.coincidencias(valores)],
+                [regla.id for regla in guardado.coincidencias(valores)],
+            )
+        self.assertEqual(len(reordenado.estadisticas_condiciones()), 40)
@@ -0,0 +1,70 @@
+import random
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from apps.ingesta_correo.models import CorreoIngesta, ReglaFiltrado, RegistroLogRegla
+from apps.ingesta_correo.services.instantanea_correo import InstantaneaCorreo
+from apps.ingesta_correo.services.regla_filtrado_service import ReglaFiltradoService
+from apps.ingesta_correo.services.regla_motor_service import MotorReglas, ReglaMotorService
+from apps.ingesta_correo.services.traza_reglas_service import TrazaReglas
+
+
+VALORES = {'asunto': 'glosa factura 123', 'remitente': 'glosas@eps.example.com'}
+
+
+def _motor():
+    reglas = [
+        ReglaFiltrado(id=i, nombre=f'Regla {i}', campo='asunto', condicion='contiene', valor=valor,
+                      prioridad=i, accion=ReglaFiltrado.TipoAccion.PROCESAR)
+        for i, valor in enumerate(['otra', 'distinta', 'factura'], start=1)
+    ]
+    return MotorReglas([ReglaMotorService.compilar_regla(regla) for regla in reglas])
+
+
+def _correo():
+    return CorreoIngesta(id=10, servicio_id=1, asunto='Glosa factura 123',
+                         remitente='glosas@eps.example.com', fecha_recepcion=timezone.now())
+
+
+@mock.patch.object(InstantaneaCorreo, 'desde_correo', lambda correo: InstantaneaCorreo(VALORES))
+class TrazaReglasTests(SimpleTestCase):
+    """Pruebas de los niveles y el muestreo de la traza de reglas."""
+
+    def _evaluar(self, traza):
+        return ReglaFiltradoService.evaluar_reglas(_correo(), motor=_motor(), traza=traza)
+
+    def test_niveles(self):
+        eventos = {}
+        for nivel in ['off', 'errores', 'coincidencias', 'completo']:
+            traza = TrazaReglas(1, nivel=nivel, persistir=False)
+            self.assertEqual(self._evaluar(traza).id, 3)
+            eventos[nivel] = traza.eventos
+
+        self.assertEqual(eventos['off'], [])
+        self.assertEqual(eventos['errores'], [])
+        self.assertEqual(len(eventos['coincidencias']), 1)
+        # Inicio + dos reglas que no coinciden + la coincidencia
+        self.assertEqual(len(eventos['completo']), 4)
+        self.assertEqual(eventos['completo'][-1].datos_contexto['coincidencia'], True)
+
+    def test_muestreo(self):
+        traza = TrazaReglas(1, nivel='coincidencias', muestreo=0.25, persistir=False,
+                            aleatorio=random.Random(1))
+        for _ in range(400):
+            self._evaluar(traza)
+        self.assertTrue(60 < len(traza.eventos) < 140)
+
+    def test_errores_sin_muestreo(self):
+        traza = TrazaReglas(1, nivel='errores', muestreo=0.0, persistir=False)
+        motor = mock.Mock(__len__=lambda self: 1)
+        motor.primera_coincidencia.side_effect = RuntimeError('fallo')
+        self.assertIsNone(ReglaFiltradoService.evaluar_reglas(_correo(), motor=motor, traza=traza))
+        self.assertEqual([evento.nivel for evento in traza.eventos], [RegistroLogRegla.TipoLog.ERROR])
+
+    def test_flush_sin_persistir_vacia_el_buffer(self):
+        traza = TrazaReglas(1, nivel='completo', persistir=False)
+        self._evaluar(traza)
+        self.assertEqual(traza.flush(), 0)
+        self.assertEqual(traza.eventos, [])
@@ -0,0 +1,42 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from apps.ingesta_correo.models import ReglaFiltrado
+from apps.ingesta_correo.services.uso_reglas_service import ContadorUsosReglas
+
+
+class ContadorUsosReglasTests(SimpleTestCase):
+    """Pruebas del acumulador de usos de reglas."""
+
+    def test_agrupa_los_usos_en_un_update_por_cantidad(self):
+        momento = timezone.now()
+        reglas = [ReglaFiltrado(id=i, conteo_usos=5) for i in (3, 1, 2)]
+        contador = ContadorUsosReglas(momento=momento)
+        for regla in reglas + reglas[:2]:
+            contador.registrar(regla)
+        # Un uso posterior al del lote solo adelanta la última aplicación de la regla 2
+        contador.registrar(reglas[2], momento + timedelta(seconds=5))
+
+        self.assertEqual([r.conteo_usos for r in reglas], [7, 7, 7])
+        self.assertEqual(reglas[2].ultima_aplicacion, momento + timedelta(seconds=5))
+
+        with mock.patch.object(ReglaFiltrado.objects, 'filter') as filtrar:
+            self.assertEqual(contador.flush(), 2)
+
+        ids = [llamada.kwargs['id__in'] for llamada in filtrar.call_args_list]
+        self.assertEqual(ids, [[1, 3], [2]])
+        cantidades = [llamada.kwargs['conteo_usos'].rhs.value for llamada in filtrar.return_value.update.call_args_list]
+        self.assertEqual(cantidades, [2, 2])
+        self.assertEqual(len(contador), 0)
+
+    def test_flush_tras_el_commit_solo_con_usos_pendientes(self):
+        contador = ContadorUsosReglas()
+        with mock.patch('apps.ingesta_correo.services.uso_reglas_service.transaction.on_commit') as on_commit:
+            contador.flush_al_confirmar()
+            on_commit.assert_not_called()
+            contador.registrar(ReglaFiltrado(id=1, conteo_usos=0))
+            contador.flush_al_confirmar()
+        on_commit.assert_called_once_with(contador.flush)
@@ -198,3 +198,21 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+
+# Despacho de ingesta: ejecuciones simultáneas por servidor de correo y por tenant
+INGESTA_MAX_POR_HOST = 4
+INGESTA_MAX_POR_TENANT = 1
+# Cada despacho encola lo que vence antes del siguiente (periodo del beat), con
+# espera hasta su turno más un jitter aleatorio de hasta INGESTA_JITTER_SEGUNDOS
+INGESTA_HORIZONTE_DESPACHO_SEGUNDOS = 60
+INGESTA_JITTER_SEGUNDOS = 15
+
+# Lease de una sola ejecución por servicio: 'db' (fila de ServicioIngesta) o 'cache' (caché compartida)
+INGESTA_LEASE_BACKEND = 'db'
+INGESTA_LEASE_SEGUNDOS = 300
+
+# Presupuesto de cada ejecución de ingesta; lo que no cabe sigue en una continuación
+INGESTA_PRESUPUESTO_MENSAJES = 1000
+INGESTA_PRESUPUESTO_SEGUNDOS = 300
+# Cada cuánto consulta una ejecución si se pidió cancelarla
+INGESTA_CANCELACION_CONSULTA_SEGUNDOS = 2